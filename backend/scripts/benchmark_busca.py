@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Benchmark da busca de produtos - Emily Kids ERP
+Mede a latência da busca por termo (caixa de busca do PDV) sobre um catálogo grande:
+$regex sem âncora (abordagem anterior) contra o índice de busca normalizado.
+
+Uso: python scripts/benchmark_busca.py [--produtos 100000] [--repeticoes 5]
+
+- Semeia um banco temporário <DB_NAME>_benchmark_busca (removido ao final)
+- Cria os mesmos índices do startup do servidor e reconstrói o índice de busca
+- Lê configuração do .env
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+load_dotenv(ROOT_DIR / '.env')
+sys.path.insert(0, str(ROOT_DIR))
+
+import server  # noqa: E402
+
+USUARIO = {"id": "benchmark", "nome": "Benchmark", "papel": "admin"}
+PECAS = ["Body", "Macacão", "Calção", "Camiseta", "Vestido", "Jardineira", "Pijama", "Casaco", "Meia", "Sapatinho"]
+DETALHES = ["Algodão", "Estampado", "Listrado", "Básico", "Plush", "Moletom", "Térmico", "Manga Longa"]
+CORES = ["Azul", "Rosa", "Branco", "Amarelo", "Verde", "Cinza", "Lilás", "Vermelho"]
+TAMANHOS = ["RN", "P", "M", "G", "1", "2", "3", "4"]
+TERMOS = ["calcao", "Calção", "maca", "jardineira rosa", "pijama term", "sku-0004", "7891000012"]
+
+
+def gerar_produtos(quantidade: int):
+    for i in range(quantidade):
+        yield {
+            "id": f"prod-{i}",
+            "nome": f"{random.choice(PECAS)} {random.choice(DETALHES)} {random.choice(CORES)} {random.choice(TAMANHOS)}",
+            "sku": f"SKU-{i:06d}",
+            "codigo_barras": f"789{i:010d}",
+            "ativo": random.random() > 0.05,
+            "estoque_atual": random.randint(0, 50),
+            "created_at": f"2024-01-01T00:00:{i % 60:02d}+00:00"
+        }
+
+
+async def semear(db, quantidade: int):
+    lote = []
+    inseridos = 0
+    for doc in gerar_produtos(quantidade):
+        lote.append(doc)
+        if len(lote) == 10000:
+            await db.produtos.insert_many(lote, ordered=False)
+            inseridos += len(lote)
+            lote = []
+            print(f"\r  {inseridos:,} produtos semeados", end="", flush=True)
+    if lote:
+        await db.produtos.insert_many(lote, ordered=False)
+        inseridos += len(lote)
+    print(f"\r  {inseridos:,} produtos semeados")
+
+
+async def busca_anterior(db, termo: str):
+    """Abordagem anterior: $or de $regex sem âncora, case-insensitive"""
+    filtro = {"ativo": True, "$or": [
+        {"nome": {"$regex": termo, "$options": "i"}},
+        {"sku": {"$regex": termo, "$options": "i"}},
+        {"codigo_barras": {"$regex": termo, "$options": "i"}}
+    ]}
+    produtos = await db.produtos.find(filtro, {"_id": 0}).sort("created_at", -1).limit(20).to_list(20)
+    total = await db.produtos.count_documents(filtro)
+    return total, produtos
+
+
+async def medir(nome: str, funcao, repeticoes: int):
+    tempos = []
+    resultado = None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = await funcao()
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    print(f"  {nome:<44} mediana {statistics.median(tempos):9.1f} ms   min {min(tempos):9.1f} ms")
+    return resultado
+
+
+async def main(produtos: int, repeticoes: int):
+    mongo_url = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[f"{os.environ.get('DB_NAME', 'erp')}_benchmark_busca"]
+    await client.drop_database(db.name)
+    server.db = db
+
+    try:
+        print(f"Semeando {produtos:,} produtos em {db.name}...")
+        await semear(db, produtos)
+        await server.startup_create_indexes()
+        await server.agendador.parar()
+
+        inicio = time.perf_counter()
+        resultado = await server.reconstruir_busca("produtos")
+        print(f"  índice de busca: {resultado['produtos']:,} linhas em {time.perf_counter() - inicio:.1f} s")
+
+        for termo in TERMOS:
+            print(f"\nTermo '{termo}':")
+            total_anterior, _ = await medir(
+                "abordagem anterior ($regex sem âncora)",
+                lambda: busca_anterior(db, termo),
+                repeticoes
+            )
+            listagem = await medir(
+                "GET /produtos?q= (índice de busca)",
+                lambda: server.get_produtos(
+                    incluir_inativos=False, page=1, limit=20, sort="-created_at", q=termo,
+                    categoria_id=None, current_user=USUARIO
+                ),
+                repeticoes
+            )
+            ranqueados = await medir(
+                "GET /busca/produtos (ranqueada)",
+                lambda: server.buscar_ranqueado("produtos", termo, 20),
+                repeticoes
+            )
+            print(f"  resultados: anterior {total_anterior:,} | índice {listagem['meta']['total']:,}"
+                  f" | ranqueada top {len(ranqueados)}")
+    finally:
+        await server.log_writer.parar()
+        await client.drop_database(db.name)
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark da busca de produtos")
+    parser.add_argument("--produtos", type=int, default=100_000)
+    parser.add_argument("--repeticoes", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.produtos, args.repeticoes))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Benchmark de login concorrente - Emily Kids ERP
+Mede a latência p50/p99 de uma requisição não relacionada (ping no MongoDB)
+enquanto N logins simultâneos verificam senha com bcrypt.
+
+Uso: python scripts/benchmark_login.py [--logins 50] [--rodadas 3]
+
+- Semeia um banco temporário <DB_NAME>_benchmark_login (removido ao final)
+- Compara bcrypt síncrono no event loop (comportamento anterior) com o pool de hash
+- Lê configuração do .env (BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS, ...)
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+load_dotenv(ROOT_DIR / '.env')
+sys.path.insert(0, str(ROOT_DIR))
+
+import server  # noqa: E402
+
+SENHA = "Benchmark@123"
+
+
+async def semear(db, quantidade: int):
+    senha_hash = server.hash_password(SENHA)
+    await db.users.insert_many([
+        {
+            "id": f"bench-{i}",
+            "nome": f"Usuário {i}",
+            "email": f"bench{i}@exemplo.com",
+            "senha_hash": senha_hash,
+            "papel": "vendedor",
+            "ativo": True,
+            "senha_historia": [senha_hash],
+            "login_attempts": 0,
+            "require_password_change": False
+        }
+        for i in range(quantidade)
+    ])
+
+
+async def login(i: int):
+    request = SimpleNamespace(client=SimpleNamespace(host=f"10.0.0.{i % 250}"), headers={})
+    dados = server.UserLogin(email=f"bench{i}@exemplo.com", senha=SENHA)
+    await server.login(dados, request)
+
+
+async def sondar(db, parar: asyncio.Event, latencias: list):
+    """Requisição não relacionada ao login, repetida enquanto os logins estão em andamento"""
+    while not parar.is_set():
+        inicio = time.perf_counter()
+        await db.command("ping")
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        await asyncio.sleep(0.005)
+
+
+def percentil(valores: list, p: float) -> float:
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+async def medir(nome: str, db, logins: int, rodadas: int):
+    latencias = []
+    duracoes = []
+    for _ in range(rodadas):
+        server.login_rate_limiter.backend.limpar()
+        parar = asyncio.Event()
+        sonda = asyncio.create_task(sondar(db, parar, latencias))
+        inicio = time.perf_counter()
+        await asyncio.gather(*[login(i) for i in range(logins)])
+        duracoes.append(time.perf_counter() - inicio)
+        parar.set()
+        await sonda
+    print(f"  {nome:<36} p50 {statistics.median(latencias):8.1f} ms   p99 {percentil(latencias, 99):8.1f} ms"
+          f"   máx {max(latencias):8.1f} ms   {logins / statistics.median(duracoes):6.1f} logins/s")
+
+
+async def main(logins: int, rodadas: int):
+    mongo_url = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[f"{os.environ.get('DB_NAME', 'erp')}_benchmark_login"]
+    await client.drop_database(db.name)
+    server.db = db
+
+    try:
+        print(f"Semeando {logins} usuários em {db.name} (bcrypt custo {server.BCRYPT_ROUNDS})...")
+        await semear(db, logins)
+        print(f"\n{logins} logins simultâneos, latência de ping concorrente:")
+
+        # Comportamento anterior: bcrypt chamado diretamente no event loop
+        verificar_no_pool = server.password_hasher.verify
+
+        async def verificar_sincrono(senha, senha_hash):
+            return server.verify_password(senha, senha_hash)
+
+        server.password_hasher.verify = verificar_sincrono
+        try:
+            await medir("bcrypt síncrono no event loop", db, logins, rodadas)
+        finally:
+            server.password_hasher.verify = verificar_no_pool
+
+        await medir(f"pool de hash ({server.password_hasher.workers} threads)", db, logins, rodadas)
+        print(f"\nContadores do pool: {server.password_hasher.stats()}")
+    finally:
+        await server.log_writer.parar()
+        await client.drop_database(db.name)
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de login concorrente")
+    parser.add_argument("--logins", type=int, default=50)
+    parser.add_argument("--rodadas", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.logins, args.rodadas))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Benchmark das estatísticas de logs - Emily Kids ERP
+Mede a latência de /logs/estatisticas, /logs/dashboard e
+/relatorios/operacional/auditoria sobre uma coleção de logs grande.
+
+Uso: python scripts/benchmark_logs.py [--linhas 1000000] [--repeticoes 5]
+
+- Semeia um banco temporário <DB_NAME>_benchmark_logs (removido ao final)
+- Cria os mesmos índices do startup do servidor
+- Compara com a abordagem anterior (find de até 10 000 logs + contagem em Python)
+- Lê configuração do .env
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+load_dotenv(ROOT_DIR / '.env')
+sys.path.insert(0, str(ROOT_DIR))
+
+import server  # noqa: E402
+
+USUARIO = {"id": "benchmark", "nome": "Benchmark", "papel": "admin"}
+TELAS = ["vendas", "orcamentos", "produtos", "clientes", "contas_receber", "contas_pagar", "estoque"]
+ACOES = ["criar", "editar", "deletar", "visualizar", "login", "exportar"]
+SEVERIDADES = ["INFO"] * 90 + ["WARNING"] * 6 + ["ERROR"] * 3 + ["CRITICAL"]
+NAVEGADORES = ["Chrome", "Firefox", "Safari", "Edge", None]
+DISPOSITIVOS = ["Desktop", "Mobile", "Tablet", None]
+
+
+def gerar_logs(quantidade: int, inicio: datetime, dias: int):
+    usuarios = [(f"u{i}", f"Usuário {i}") for i in range(50)]
+    for i in range(quantidade):
+        user_id, user_nome = random.choice(usuarios)
+        yield {
+            "id": f"log-{i}",
+            "timestamp": (inicio + timedelta(seconds=random.randint(0, dias * 86400))).isoformat(),
+            "ip": "127.0.0.1",
+            "user_id": user_id,
+            "user_nome": user_nome,
+            "tela": random.choice(TELAS),
+            "acao": random.choice(ACOES),
+            "severidade": random.choice(SEVERIDADES),
+            "navegador": random.choice(NAVEGADORES),
+            "dispositivo": random.choice(DISPOSITIVOS),
+            "tempo_execucao_ms": random.choice([None, random.uniform(5, 500)]),
+            "arquivado": False
+        }
+
+
+async def semear(db, linhas: int):
+    agora = datetime.now(timezone.utc)
+    lote = []
+    inseridos = 0
+    # Dentro da retenção, para o arquivamento do startup não mover logs durante a medição
+    for doc in gerar_logs(linhas, agora - timedelta(days=89), 89):
+        lote.append(doc)
+        if len(lote) == 10000:
+            await db.logs.insert_many(lote, ordered=False)
+            inseridos += len(lote)
+            lote = []
+            print(f"\r  {inseridos:,} logs semeados", end="", flush=True)
+    if lote:
+        await db.logs.insert_many(lote, ordered=False)
+        inseridos += len(lote)
+    print(f"\r  {inseridos:,} logs semeados")
+
+
+async def estatisticas_anterior(db, data_inicio, data_fim):
+    """Abordagem anterior: carrega até 10 000 logs e conta em Python"""
+    filtro = {"arquivado": False, "timestamp": {"$gte": data_inicio, "$lte": data_fim}}
+    logs = await db.logs.find(filtro, {"_id": 0}).to_list(10000)
+    por_severidade = {}
+    for log in logs:
+        por_severidade[log.get("severidade", "INFO")] = por_severidade.get(log.get("severidade", "INFO"), 0) + 1
+    return len(logs)
+
+
+def indice_usado(plano):
+    """Procura o primeiro indexName no plano retornado pelo explain"""
+    if isinstance(plano, dict):
+        if "indexName" in plano:
+            return plano["indexName"]
+        valores = plano.values()
+    elif isinstance(plano, list):
+        valores = plano
+    else:
+        return None
+    for valor in valores:
+        encontrado = indice_usado(valor)
+        if encontrado:
+            return encontrado
+    return None
+
+
+async def medir(nome: str, funcao, repeticoes: int):
+    tempos = []
+    resultado = None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = await funcao()
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    print(f"  {nome:<48} mediana {statistics.median(tempos):9.1f} ms   min {min(tempos):9.1f} ms")
+    return resultado
+
+
+async def main(linhas: int, repeticoes: int):
+    mongo_url = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[f"{os.environ.get('DB_NAME', 'erp')}_benchmark_logs"]
+    await client.drop_database(db.name)
+    server.db = db
+
+    try:
+        print(f"Semeando {linhas:,} logs em {db.name}...")
+        await semear(db, linhas)
+        await server.startup_create_indexes()
+
+        hoje = datetime.now(timezone.utc)
+        janelas = {
+            "7 dias": (hoje - timedelta(days=7)).isoformat(),
+            "90 dias": (hoje - timedelta(days=91)).isoformat(),
+        }
+
+        for rotulo, data_inicio in janelas.items():
+            data_fim = hoje.isoformat()
+            print(f"\nJanela de {rotulo}:")
+            resultado = await medir(
+                "GET /logs/estatisticas ($facet)",
+                lambda: server.get_estatisticas_logs(data_inicio=data_inicio, data_fim=data_fim, current_user=USUARIO),
+                repeticoes
+            )
+            carregados = await medir(
+                "abordagem anterior (find 10 000 + Python)",
+                lambda: estatisticas_anterior(db, data_inicio, data_fim),
+                repeticoes
+            )
+            print(f"  total exato: {resultado['total_logs']:,} | abordagem anterior contava: {carregados:,}")
+            await medir(
+                "GET /relatorios/operacional/auditoria ($facet)",
+                lambda: server.relatorio_auditoria(
+                    data_inicio=data_inicio[:10], data_fim=data_fim[:10], user_id=None, acao=None,
+                    current_user=USUARIO
+                ),
+                repeticoes
+            )
+
+        print("\nÚltimos 7 dias:")
+        await medir("GET /logs/dashboard ($facet)", lambda: server.get_dashboard_logs(current_user=USUARIO), repeticoes)
+
+        plano = await db.command(
+            "explain",
+            {"aggregate": "logs", "pipeline": [{"$match": {"arquivado": False, "timestamp": {"$gte": janelas["7 dias"]}}}],
+             "cursor": {}},
+            verbosity="queryPlanner"
+        )
+        print(f"\nÍndice usado no $match: {indice_usado(plano) or 'nenhum (COLLSCAN)'}")
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark das estatísticas de logs")
+    parser.add_argument("--linhas", type=int, default=1_000_000)
+    parser.add_argument("--repeticoes", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.linhas, args.repeticoes))
@@ -1,7 +1,7 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Body
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -40,42 +40,155 @@ _JWT_SECRET = _validate_required_env('JWT_SECRET', 'Chave secreta para assinatur
 
 # ==================== ETAPA 11 - HARDENING FINAL ====================
 
-# 6) Rate Limit em memória para login (sem dependências externas)
-from collections import defaultdict
+# 6) Rate Limit para login e endpoints caros
+# Janela deslizante aproximada por dois contadores (janela atual + anterior, ponderada
+# pelo tempo decorrido): memória fixa por chave e verificação O(1). O backend em memória
+# descarta as chaves menos usadas acima de RATE_LIMIT_MAX_CHAVES; com RATE_LIMIT_BACKEND=mongo
+# os contadores ficam na coleção rate_limits (TTL) e valem entre workers e reinícios.
+from collections import defaultdict, OrderedDict
+import math
 import time
 
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memoria').lower()
+RATE_LIMIT_MAX_CHAVES = int(os.environ.get('RATE_LIMIT_MAX_CHAVES', 100000))
+
+class MemoriaRateLimitBackend:
+    """Contadores por chave em um OrderedDict com descarte LRU (local ao processo)."""
+    def __init__(self, max_chaves: int = 100000):
+        self.max_chaves = max_chaves
+        self.contadores = OrderedDict()  # {chave: [indice_janela, atual, anterior]}
+    
+    async def contagens(self, chave: str, janela: int):
+        """Retorna (contagem da janela atual, contagem da janela anterior)."""
+        registro = self.contadores.get(chave)
+        if registro is None:
+            return 0, 0
+        self.contadores.move_to_end(chave)
+        if registro[0] == janela:
+            return registro[1], registro[2]
+        if registro[0] == janela - 1:
+            return 0, registro[1]
+        return 0, 0
+    
+    async def incrementar(self, chave: str, janela: int, window_seconds: int):
+        registro = self.contadores.get(chave)
+        if registro is None:
+            self.contadores[chave] = [janela, 1, 0]
+            if len(self.contadores) > self.max_chaves:
+                self.contadores.popitem(last=False)
+            return
+        self.contadores.move_to_end(chave)
+        if registro[0] != janela:
+            registro[2] = registro[1] if registro[0] == janela - 1 else 0
+            registro[0], registro[1] = janela, 0
+        registro[1] += 1
+    
+    def limpar(self):
+        self.contadores.clear()
+
+class MongoRateLimitBackend:
+    """Um documento por chave e janela em rate_limits; o índice TTL em expira_em remove os antigos."""
+    colecao = "rate_limits"
+    
+    async def contagens(self, chave: str, janela: int):
+        try:
+            docs = await db[self.colecao].find(
+                {"_id": {"$in": [f"{chave}|{janela}", f"{chave}|{janela - 1}"]}}
+            ).to_list(2)
+        except Exception as e:
+            # Sem o banco o limite não deve derrubar o endpoint
+            print(f"Aviso: rate limit indisponível ({e})")
+            return 0, 0
+        por_id = {d["_id"]: d.get("n", 0) for d in docs}
+        return por_id.get(f"{chave}|{janela}", 0), por_id.get(f"{chave}|{janela - 1}", 0)
+    
+    async def incrementar(self, chave: str, janela: int, window_seconds: int):
+        # Mantido por duas janelas: a atual e a seguinte, onde entra como "anterior"
+        expira_em = datetime.fromtimestamp((janela + 2) * window_seconds, tz=timezone.utc)
+        try:
+            await db[self.colecao].update_one(
+                {"_id": f"{chave}|{janela}"},
+                {"$inc": {"n": 1}, "$setOnInsert": {"expira_em": expira_em}},
+                upsert=True
+            )
+        except Exception as e:
+            print(f"Aviso: rate limit indisponível ({e})")
+    
+    def limpar(self):
+        pass
+
+def criar_backend_rate_limit():
+    if RATE_LIMIT_BACKEND == "mongo":
+        return MongoRateLimitBackend()
+    return MemoriaRateLimitBackend(max_chaves=RATE_LIMIT_MAX_CHAVES)
+
 class RateLimiter:
-    """Rate limiter simples em memória para ambiente de teste."""
-    def __init__(self, max_attempts: int = 10, window_seconds: int = 300):
+    """Rate limiter de janela deslizante com backend em memória (LRU) ou MongoDB."""
+    def __init__(self, max_attempts: int = 10, window_seconds: int = 300, nome: str = "login", backend=None):
         self.max_attempts = max_attempts
         self.window_seconds = window_seconds
-        self.attempts = defaultdict(list)  # {key: [timestamps]}
+        self.nome = nome
+        self.backend = backend or criar_backend_rate_limit()
     
-    def _clean_old_attempts(self, key: str):
-        """Remove tentativas antigas fora da janela."""
-        now = time.time()
-        self.attempts[key] = [t for t in self.attempts[key] if now - t < self.window_seconds]
+    def _janela(self):
+        agora = time.time()
+        janela = int(agora // self.window_seconds)
+        return janela, (agora - janela * self.window_seconds) / self.window_seconds
     
-    def is_rate_limited(self, key: str) -> bool:
+    async def _estimativa(self, key: str):
+        janela, fracao = self._janela()
+        atual, anterior = await self.backend.contagens(f"{self.nome}:{key}", janela)
+        return atual, anterior, fracao
+    
+    async def is_rate_limited(self, key: str) -> bool:
         """Verifica se a chave está rate limited."""
-        self._clean_old_attempts(key)
-        return len(self.attempts[key]) >= self.max_attempts
+        atual, anterior, fracao = await self._estimativa(key)
+        return anterior * (1 - fracao) + atual >= self.max_attempts
     
-    def record_attempt(self, key: str):
+    async def record_attempt(self, key: str):
         """Registra uma tentativa."""
-        self._clean_old_attempts(key)
-        self.attempts[key].append(time.time())
+        janela, _ = self._janela()
+        await self.backend.incrementar(f"{self.nome}:{key}", janela, self.window_seconds)
     
-    def get_remaining_time(self, key: str) -> int:
-        """Retorna segundos restantes até reset."""
-        if not self.attempts[key]:
+    async def get_remaining_time(self, key: str) -> int:
+        """Retorna segundos restantes até a estimativa da janela ficar abaixo do limite."""
+        atual, anterior, fracao = await self._estimativa(key)
+        if anterior * (1 - fracao) + atual < self.max_attempts:
             return 0
-        oldest = min(self.attempts[key])
-        remaining = self.window_seconds - (time.time() - oldest)
-        return max(0, int(remaining))
+        if atual < self.max_attempts:
+            # Basta a janela anterior perder peso suficiente
+            restante = (1 - (self.max_attempts - atual) / anterior) - fracao
+        else:
+            # Só depois da virada, quando a janela atual passa a ser a anterior
+            restante = (1 - fracao) + (1 - self.max_attempts / atual)
+        return max(1, math.ceil(restante * self.window_seconds))
+    
+    async def consumir(self, key: str) -> int:
+        """Registra uma requisição; retorna 0 se permitida ou os segundos de espera se bloqueada."""
+        restante = await self.get_remaining_time(key)
+        if restante:
+            return restante
+        await self.record_attempt(key)
+        return 0
 
 # Instância global do rate limiter para login
-login_rate_limiter = RateLimiter(max_attempts=10, window_seconds=300)
+login_rate_limiter = RateLimiter(max_attempts=10, window_seconds=300, nome="login")
+
+# Endpoints caros (IA e relatórios): limite por usuário (ou IP, sem token) e prefixo de rota
+ia_rate_limiter = RateLimiter(
+    max_attempts=int(os.environ.get('RATE_LIMIT_IA_MAX', 20)),
+    window_seconds=int(os.environ.get('RATE_LIMIT_IA_JANELA', 60)),
+    nome="ia"
+)
+relatorios_rate_limiter = RateLimiter(
+    max_attempts=int(os.environ.get('RATE_LIMIT_RELATORIOS_MAX', 60)),
+    window_seconds=int(os.environ.get('RATE_LIMIT_RELATORIOS_JANELA', 60)),
+    nome="relatorios"
+)
+RATE_LIMIT_ROTAS = [
+    ("/api/ia/", ia_rate_limiter),
+    ("/api/relatorios/", relatorios_rate_limiter),
+]
 
 # 8) Request ID para observabilidade
 import contextvars
@@ -85,6 +198,9 @@ def get_request_id() -> str:
     """Retorna o request_id atual do contexto."""
     return request_id_var.get()
 
+# Memo de usuários por requisição ({user_id: user}) - reiniciado pelo RequestIdMiddleware
+request_user_cache_var: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar('request_user_cache', default=None)
+
 # ==================== HELPERS - ETAPA 6 ====================
 
 def iso_utc_now() -> str:
@@ -263,8 +379,6 @@ def validate_parcelas_soma(parcelas: list, valor_total: float, auto_adjust: bool
 
 # ==================== ETAPA 13 - HELPERS DE RESPOSTA PADRONIZADA ====================
 
-import math
-
 def api_ok(data=None, meta: dict = None, message: str = None) -> dict:
     """
     Resposta padronizada de sucesso.
@@ -285,14 +399,18 @@ def api_list(
     *, 
     page: int, 
     limit: int, 
-    total: int, 
+    total: Optional[int], 
     extra_meta: dict = None
 ) -> dict:
     """
     Resposta padronizada para listas paginadas.
     Formato: {"ok": true, "data": [...], "meta": {"page", "limit", "total", "pages"}}
+    Com contagem desligada, total e pages vêm como None.
     """
-    pages = math.ceil(total / limit) if limit > 0 else 0
+    if total is None:
+        pages = None
+    else:
+        pages = math.ceil(total / limit) if limit > 0 else 0
     meta = {
         "page": page,
         "limit": limit,
@@ -329,6 +447,113 @@ def validate_pagination(page: int, limit: int) -> tuple:
     return page, limit, skip
 
 
+# Paginação por cursor (keyset): opcional em todas as listagens com api_list. O token
+# 'after' (opaco, devolvido em meta.next_cursor) guarda o valor do campo de ordenação e o
+# id do último item; a página seguinte filtra a partir dele em vez de usar skip, com
+# custo constante em qualquer profundidade. O total pode ser exato, estimado (metadados
+# da coleção sem filtro ou contagem em cache por CONTAGEM_CACHE_TTL_SECONDS) ou omitido.
+
+import base64
+import json
+
+MODOS_CONTAGEM = ("exato", "estimado", "nenhum")
+CONTAGEM_CACHE_TTL_SECONDS = float(os.environ.get('CONTAGEM_CACHE_TTL_SECONDS', 60))
+CONTAGEM_CACHE_MAX_ENTRIES = 1000
+_contagens_cache = {}  # {(colecao, filtro): (expira_em, total)}
+
+def codificar_cursor(chave: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(chave, default=str).encode("utf-8")).decode("ascii")
+
+def decodificar_cursor(cursor: str, tamanho: int) -> list:
+    try:
+        chave = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except Exception:
+        chave = None
+    if not isinstance(chave, list) or len(chave) != tamanho:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return chave
+
+def filtro_apos_cursor(sort_field: str, sort_dir: int, valor, ultimo_id: str) -> dict:
+    """
+    Itens depois de (valor, ultimo_id) na ordem (sort_field, id) com direção sort_dir.
+    Nulos/ausentes vêm antes de qualquer valor na ordenação do MongoDB.
+    """
+    op = "$gt" if sort_dir == 1 else "$lt"
+    clausulas = [{sort_field: valor, "id": {op: ultimo_id}}]
+    if valor is None:
+        if sort_dir == 1:
+            clausulas.append({sort_field: {"$ne": None}})
+    else:
+        clausulas.append({sort_field: {op: valor}})
+        if sort_dir == -1:
+            clausulas.append({sort_field: None})
+    return {"$or": clausulas}
+
+def combinar_filtros(filtro: dict, extra: dict) -> dict:
+    return {"$and": [filtro, extra]} if filtro else extra
+
+def validar_contagem(contagem: str) -> str:
+    if contagem not in MODOS_CONTAGEM:
+        raise HTTPException(status_code=400, detail=f"contagem deve ser um de: {', '.join(MODOS_CONTAGEM)}")
+    return contagem
+
+async def contar_documentos(colecao, filtro: dict, contagem: str = "exato") -> Optional[int]:
+    """Total da listagem conforme o modo: exato, estimado (barato) ou nenhum (None)"""
+    if contagem == "nenhum":
+        return None
+    if contagem == "exato":
+        return await colecao.count_documents(filtro)
+    if not filtro:
+        return await colecao.estimated_document_count()
+    
+    chave = (colecao.name, json.dumps(filtro, sort_keys=True, default=str))
+    item = _contagens_cache.get(chave)
+    if item and item[0] > time.time():
+        return item[1]
+    total = await colecao.count_documents(filtro)
+    if chave not in _contagens_cache and len(_contagens_cache) >= CONTAGEM_CACHE_MAX_ENTRIES:
+        _contagens_cache.pop(next(iter(_contagens_cache)))
+    _contagens_cache[chave] = (time.time() + CONTAGEM_CACHE_TTL_SECONDS, total)
+    return total
+
+async def paginar_colecao(
+    colecao,
+    filtro: dict,
+    projection: dict,
+    *,
+    sort_field: str,
+    sort_dir: int,
+    skip: int,
+    limit: int,
+    after: str = None,
+    contagem: str = "exato"
+) -> tuple:
+    """
+    Busca uma página ordenada por (sort_field, id). Com 'after' usa o cursor em vez de skip.
+    Retorna (itens, total, meta) com meta = {"next_cursor", "has_more", "contagem"}.
+    """
+    validar_contagem(contagem)
+    filtro_pagina = filtro
+    if after:
+        valor, ultimo_id = decodificar_cursor(after, 2)
+        filtro_pagina = combinar_filtros(filtro, filtro_apos_cursor(sort_field, sort_dir, valor, ultimo_id))
+        skip = 0
+    
+    # O cursor precisa dos campos de ordenação mesmo com projeção enxuta
+    if any(v == 1 for k, v in projection.items() if k != "_id"):
+        projection = {**projection, sort_field: 1, "id": 1}
+    
+    itens = await colecao.find(filtro_pagina, projection).sort(
+        [(sort_field, sort_dir), ("id", sort_dir)]
+    ).skip(skip).limit(limit + 1).to_list(limit + 1)
+    
+    has_more = len(itens) > limit
+    itens = itens[:limit]
+    next_cursor = codificar_cursor([itens[-1].get(sort_field), itens[-1].get("id")]) if has_more else None
+    total = await contar_documentos(colecao, filtro, contagem)
+    return itens, total, {"next_cursor": next_cursor, "has_more": has_more, "contagem": contagem}
+
+
 def normalize_search_query(q: str) -> str:
     """Normaliza query de busca: strip e limita tamanho."""
     if not q:
@@ -352,7 +577,6 @@ import hmac
 import hashlib
 import struct
 import secrets
-import base64
 
 def generate_totp_secret() -> str:
     """Gera secret base32 para TOTP (20 bytes = 32 chars base32)."""
@@ -973,6 +1197,7 @@ class ProdutoVariante(BaseModel):
     tamanho: Optional[str] = None
     cor: Optional[str] = None
     sku_variante: str
+    codigo_barras: Optional[str] = None
     estoque_atual: int = 0
     preco_adicional: float = 0
 
@@ -994,6 +1219,10 @@ class Produto(BaseModel):
     preco_inicial: float  # Informado pelo usuário no cadastro
     preco_medio: float  # Calculado automaticamente (média ponderada das compras)
     preco_ultima_compra: Optional[float] = None  # Preço da última nota fiscal confirmada
+    qtd_comprada_acumulada: float = 0  # Soma das quantidades das notas fiscais confirmadas
+    valor_comprado_acumulado: float = 0  # Soma de quantidade * preço das notas fiscais confirmadas
+    data_ultima_compra: Optional[str] = None
+    ultima_compra_nota_id: Optional[str] = None
     preco_venda: float
     margem_lucro: Optional[float] = None  # Calculado: (preco_venda - preco_medio) / preco_medio * 100
     preco_promocional: Optional[float] = None
@@ -2133,12 +2362,81 @@ class PasswordResetToken(BaseModel):
 
 # ========== AUTH UTILS ==========
 
+# Custo do bcrypt para novos hashes; hashes com outro custo são refeitos no próximo login
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+def password_needs_rehash(hashed_password: str) -> bool:
+    """True se o hash ($2b$<custo>$...) foi gerado com custo diferente de BCRYPT_ROUNDS"""
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+# ==================== POOL DE HASH DE SENHAS ====================
+# bcrypt custa ~250 ms no custo 12 e bloquearia o event loop. hash/verify rodam num
+# ThreadPoolExecutor dedicado (bcrypt libera o GIL) com PASSWORD_HASH_WORKERS threads;
+# acima de PASSWORD_HASH_MAX_PENDING operações na fila, novas chamadas recebem 503
+# em vez de acumular memória e latência.
+
+from concurrent.futures import ThreadPoolExecutor
+
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1)))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 200))
+
+class PasswordHasher:
+    """Executa bcrypt em um pool limitado e mede a profundidade da fila."""
+    def __init__(self, workers: int = 4, max_pending: int = 200):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.pendentes = 0  # enviadas ao pool e ainda não concluídas (em execução + na fila)
+        self.pico_pendentes = 0
+        self.executadas = 0
+        self.rejeitadas = 0
+        self.tempo_total_ms = 0.0
+    
+    async def _executar(self, funcao, *args):
+        if self.pendentes >= self.max_pending:
+            self.rejeitadas += 1
+            raise HTTPException(status_code=503, detail="Servidor ocupado. Tente novamente em instantes.")
+        self.pendentes += 1
+        self.pico_pendentes = max(self.pico_pendentes, self.pendentes)
+        inicio = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, funcao, *args)
+        finally:
+            self.pendentes -= 1
+            self.executadas += 1
+            self.tempo_total_ms += (time.perf_counter() - inicio) * 1000
+    
+    async def hash(self, password: str) -> str:
+        return await self._executar(hash_password, password)
+    
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._executar(verify_password, plain_password, hashed_password)
+    
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "na_fila": max(0, self.pendentes - self.workers),
+            "pendentes": self.pendentes,
+            "pico_pendentes": self.pico_pendentes,
+            "max_pendentes": self.max_pending,
+            "executadas": self.executadas,
+            "rejeitadas": self.rejeitadas,
+            "tempo_medio_ms": round(self.tempo_total_ms / self.executadas, 2) if self.executadas else 0.0,
+            "bcrypt_rounds": BCRYPT_ROUNDS
+        }
+
+# Instância global do pool de hash de senhas
+password_hasher = PasswordHasher(workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING)
+
 def generate_reset_token() -> str:
     """Gera token seguro e aleatório para recuperação de senha"""
     import secrets
@@ -2198,6 +2496,81 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
+# ==================== CACHE DE USUÁRIOS (REQUISIÇÃO + PROCESSO) ====================
+# Uma chamada de API nunca carrega o mesmo usuário duas vezes: o memo por requisição
+# (contextvar) atende get_current_user, check_permission e get_user_permissions.
+# Opcionalmente, um cache de processo com TTL curto evita a leitura entre requisições
+# (USER_CACHE_TTL_SECONDS=0 desativa).
+
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', 5))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 5000))
+
+class UserCache:
+    """Cache em memória de documentos de usuário com TTL curto e tamanho limitado."""
+    def __init__(self, ttl_seconds: float = 5, max_entries: int = 5000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = {}  # {user_id: (expira_em, user)}
+    
+    def get(self, user_id: str) -> Optional[dict]:
+        """Retorna cópia do usuário se ainda válido, senão None."""
+        if self.ttl_seconds <= 0:
+            return None
+        item = self.entries.get(user_id)
+        if item is None:
+            return None
+        expira_em, user = item
+        if expira_em <= time.time():
+            self.entries.pop(user_id, None)
+            return None
+        return dict(user)
+    
+    def set(self, user_id: str, user: dict):
+        """Armazena o usuário; descarta a entrada mais antiga se cheio."""
+        if self.ttl_seconds <= 0:
+            return
+        if user_id not in self.entries and len(self.entries) >= self.max_entries:
+            self.entries.pop(next(iter(self.entries)))
+        self.entries[user_id] = (time.time() + self.ttl_seconds, dict(user))
+    
+    def invalidate(self, user_id: str):
+        self.entries.pop(user_id, None)
+    
+    def clear(self):
+        self.entries.clear()
+
+# Instância global do cache de usuários
+user_cache = UserCache(ttl_seconds=USER_CACHE_TTL_SECONDS, max_entries=USER_CACHE_MAX_ENTRIES)
+
+
+async def carregar_usuario(user_id: str) -> Optional[dict]:
+    """
+    Carrega usuário por id consultando, nesta ordem, o memo da requisição,
+    o cache de processo e o banco.
+    """
+    memo = request_user_cache_var.get()
+    if memo is not None and user_id in memo:
+        return memo[user_id]
+    
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        if user is not None:
+            user_cache.set(user_id, user)
+    
+    if memo is not None and user is not None:
+        memo[user_id] = user
+    return user
+
+
+def invalidar_usuario_cache(user_id: str):
+    """Invalida o usuário nos caches de requisição e de processo."""
+    user_cache.invalidate(user_id)
+    memo = request_user_cache_var.get()
+    if memo is not None:
+        memo.pop(user_id, None)
+
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """
     5) JWT Security: Valida que sub existe e é string.
@@ -2211,7 +2584,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if user_id is None or not isinstance(user_id, str):
             raise HTTPException(status_code=401, detail="Token inválido: sub ausente ou inválido")
         
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        user = await carregar_usuario(user_id)
         if user is None:
             raise HTTPException(status_code=401, detail="Usuário não encontrado")
         return user
@@ -2225,93 +2598,281 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
 
 # ========== RBAC FUNCTIONS ==========
 
-async def get_user_permissions(user_id: str) -> List[dict]:
-    """Retorna todas as permissões do usuário (diretas + por papel + por grupo + temporárias)"""
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if not user:
-        return []
+# ==================== CACHE DE PERMISSÕES COMPILADAS ====================
+# Cada usuário tem suas permissões efetivas (papel + grupos + temporárias + delegadas)
+# compiladas em um conjunto de pares (modulo, acao). Um acerto no cache custa zero
+# queries; a entrada expira pelo TTL ou na próxima mudança de janela de validade
+# de uma permissão temporária/delegação, o que ocorrer primeiro.
+# Obs: o cache é por processo. Com múltiplos workers, a invalidação explícita só
+# vale no worker que recebeu a alteração; os demais convergem pelo TTL.
+
+PERMISSION_CACHE_TTL_SECONDS = int(os.environ.get('PERMISSION_CACHE_TTL_SECONDS', 60))
+
+class PermissionCache:
+    """Cache em memória de permissões compiladas por user_id."""
+    def __init__(self, ttl_seconds: int = 60):
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}  # {user_id: {"is_admin", "pares", "expira_em", "geracao"}}
+        self.user_generations = defaultdict(int)  # {user_id: geracao}
+        self.global_generation = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def snapshot(self, user_id: str) -> tuple:
+        """Captura a geração atual antes de compilar (evita gravar dado obsoleto)."""
+        return (self.global_generation, self.user_generations[user_id])
+    
+    def get(self, user_id: str) -> Optional[dict]:
+        """Retorna a entrada compilada se ainda válida, senão None."""
+        entry = self.entries.get(user_id)
+        if entry is None or entry["geracao"] != self.snapshot(user_id) or entry["expira_em"] <= time.time():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+    
+    def set(self, user_id: str, geracao: tuple, is_admin: bool, pares: frozenset, proxima_transicao: float = None):
+        """Grava entrada compilada, a menos que tenha havido invalidação durante a compilação."""
+        if geracao != self.snapshot(user_id):
+            return
+        expira_em = time.time() + self.ttl_seconds
+        if proxima_transicao is not None:
+            expira_em = min(expira_em, proxima_transicao)
+        self.entries[user_id] = {
+            "is_admin": is_admin,
+            "pares": pares,
+            "expira_em": expira_em,
+            "geracao": geracao
+        }
     
-    all_permissions = []
+    def invalidate_user(self, user_id: str):
+        """Invalida as permissões de um usuário (alteração de usuário/permissão temporária)."""
+        self.user_generations[user_id] += 1
+        self.entries.pop(user_id, None)
     
-    # 1. Permissões por papel
-    if user.get("role_id"):
-        role = await db.roles.find_one({"id": user["role_id"]}, {"_id": 0})
-        if role:
-            for perm_id in role.get("permissoes", []):
-                perm = await db.permissions.find_one({"id": perm_id}, {"_id": 0})
-                if perm:
-                    all_permissions.append(perm)
-    
-    # 2. Permissões por grupos
-    for grupo_id in user.get("grupos", []):
-        grupo = await db.user_groups.find_one({"id": grupo_id}, {"_id": 0})
-        if grupo:
-            for role_id in grupo.get("role_ids", []):
-                role = await db.roles.find_one({"id": role_id}, {"_id": 0})
-                if role:
-                    for perm_id in role.get("permissoes", []):
-                        perm = await db.permissions.find_one({"id": perm_id}, {"_id": 0})
-                        if perm:
-                            all_permissions.append(perm)
+    def invalidate_all(self):
+        """Invalida todo o cache (alteração de papel/grupo/permissões)."""
+        self.global_generation += 1
+        self.entries.clear()
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entradas": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "ttl_seconds": self.ttl_seconds
+        }
+
+# Instância global do cache de permissões
+permission_cache = PermissionCache(ttl_seconds=PERMISSION_CACHE_TTL_SECONDS)
+
+
+def _iso_to_epoch(iso_str: str) -> Optional[float]:
+    """Converte string ISO para epoch (segundos). Retorna None se inválida."""
+    dt = parse_date_input(iso_str) if iso_str else None
+    return dt.timestamp() if dt else None
+
+
+def _proxima_transicao_janelas(janelas: List[dict], now_iso: str) -> Optional[float]:
+    """
+    Menor instante futuro em que alguma permissão temporária/delegação
+    começa (valid_from) ou termina (valid_until) de valer.
+    """
+    candidatos = []
+    for janela in janelas:
+        for campo in ("valid_from", "valid_until"):
+            valor = janela.get(campo)
+            if valor and valor > now_iso:
+                epoch = _iso_to_epoch(valor)
+                if epoch is not None:
+                    candidatos.append(epoch)
+    return min(candidatos) if candidatos else None
+
+
+async def _carregar_permissoes_usuarios(users: List[dict]) -> dict:
+    """
+    Resolve as permissões efetivas de vários usuários já carregados com um número
+    constante de queries ($in em grupos, papéis, temporárias, delegações e permissões),
+    independente da quantidade de usuários, papéis ou grupos.
+    Retorna {user_id: (lista_de_permissoes, proxima_transicao_epoch)}.
+    """
+    if not users:
+        return {}
     
-    # 3. Permissões temporárias ativas
+    user_ids = [u["id"] for u in users]
     now = datetime.now(timezone.utc).isoformat()
+    
+    # 1. Grupos de todos os usuários
+    grupo_ids = {g for u in users for g in (u.get("grupos") or [])}
+    grupos_por_id = {}
+    if grupo_ids:
+        grupos = await db.user_groups.find(
+            {"id": {"$in": list(grupo_ids)}},
+            {"_id": 0, "id": 1, "role_ids": 1}
+        ).to_list(None)
+        grupos_por_id = {g["id"]: g for g in grupos}
+    
+    # 2. Papéis diretos + papéis dos grupos
+    role_ids = {u["role_id"] for u in users if u.get("role_id")}
+    for grupo in grupos_por_id.values():
+        role_ids.update(grupo.get("role_ids") or [])
+    roles_por_id = {}
+    if role_ids:
+        roles = await db.roles.find(
+            {"id": {"$in": list(role_ids)}},
+            {"_id": 0, "id": 1, "permissoes": 1}
+        ).to_list(None)
+        roles_por_id = {r["id"]: r for r in roles}
+    
+    # 3/4. Permissões temporárias e delegadas ainda não expiradas
+    # (as futuras são lidas apenas para calcular quando o cache deve expirar)
     temp_perms = await db.temporary_permissions.find({
-        "user_id": user_id,
+        "user_id": {"$in": user_ids},
         "ativo": True,
-        "valid_from": {"$lte": now},
         "valid_until": {"$gte": now}
-    }, {"_id": 0}).to_list(100)
+    }, {"_id": 0}).to_list(None)
     
-    for temp in temp_perms:
-        for perm_id in temp.get("permission_ids", []):
-            perm = await db.permissions.find_one({"id": perm_id}, {"_id": 0})
-            if perm:
-                all_permissions.append(perm)
-    
-    # 4. Permissões delegadas ativas
     delegations = await db.permission_delegations.find({
-        "to_user_id": user_id,
+        "to_user_id": {"$in": user_ids},
         "ativo": True,
-        "valid_from": {"$lte": now},
         "valid_until": {"$gte": now}
-    }, {"_id": 0}).to_list(100)
+    }, {"_id": 0}).to_list(None)
     
+    janelas_por_usuario = defaultdict(list)
+    for temp in temp_perms:
+        janelas_por_usuario[temp["user_id"]].append(temp)
     for deleg in delegations:
-        for perm_id in deleg.get("permission_ids", []):
-            perm = await db.permissions.find_one({"id": perm_id}, {"_id": 0})
-            if perm:
-                all_permissions.append(perm)
+        janelas_por_usuario[deleg["to_user_id"]].append(deleg)
+    
+    # Ids de permissão por usuário, na ordem papel -> grupos -> temporárias/delegadas
+    perm_ids_por_usuario = {}
+    for user in users:
+        perm_ids = []
+        role = roles_por_id.get(user.get("role_id")) if user.get("role_id") else None
+        if role:
+            perm_ids.extend(role.get("permissoes") or [])
+        for grupo_id in user.get("grupos") or []:
+            grupo = grupos_por_id.get(grupo_id)
+            if not grupo:
+                continue
+            for role_id in grupo.get("role_ids") or []:
+                role = roles_por_id.get(role_id)
+                if role:
+                    perm_ids.extend(role.get("permissoes") or [])
+        for janela in janelas_por_usuario[user["id"]]:
+            if janela.get("valid_from", "") > now:
+                continue
+            perm_ids.extend(janela.get("permission_ids") or [])
+        perm_ids_por_usuario[user["id"]] = perm_ids
+    
+    # 5. Documentos de permissão (uma única query para todos)
+    todos_perm_ids = {pid for ids in perm_ids_por_usuario.values() for pid in ids}
+    perms_por_id = {}
+    if todos_perm_ids:
+        perms = await db.permissions.find(
+            {"id": {"$in": list(todos_perm_ids)}},
+            {"_id": 0}
+        ).to_list(None)
+        perms_por_id = {p["id"]: p for p in perms}
+    
+    resultado = {}
+    for user in users:
+        # Remover duplicatas preservando a ordem
+        unique_perms = []
+        seen_ids = set()
+        for perm_id in perm_ids_por_usuario[user["id"]]:
+            perm = perms_por_id.get(perm_id)
+            if perm and perm_id not in seen_ids:
+                unique_perms.append(perm)
+                seen_ids.add(perm_id)
+        resultado[user["id"]] = (
+            unique_perms,
+            _proxima_transicao_janelas(janelas_por_usuario[user["id"]], now)
+        )
+    
+    return resultado
+
+
+async def _carregar_permissoes_usuario(user: dict) -> tuple:
+    """
+    Resolve as permissões efetivas de um usuário já carregado.
+    Retorna (lista_de_permissoes, proxima_transicao_epoch).
+    """
+    resultado = await _carregar_permissoes_usuarios([user])
+    return resultado[user["id"]]
+
+
+async def get_user_permissions(user_id: str) -> List[dict]:
+    """Retorna todas as permissões do usuário (diretas + por papel + por grupo + temporárias)"""
+    user = await carregar_usuario(user_id)
+    if not user:
+        return []
+    
+    permissions, _ = await _carregar_permissoes_usuario(user)
+    return permissions
+
+
+async def get_users_permissions_bulk(user_ids: List[str]) -> dict:
+    """
+    Variante em lote de get_user_permissions: {user_id: [permissoes]}.
+    Custo constante em queries, independente do número de usuários.
+    """
+    if not user_ids:
+        return {}
+    users = await db.users.find(
+        {"id": {"$in": list(set(user_ids))}},
+        {"_id": 0, "id": 1, "role_id": 1, "grupos": 1}
+    ).to_list(None)
+    resultado = await _carregar_permissoes_usuarios(users)
+    return {
+        user_id: resultado[user_id][0] if user_id in resultado else []
+        for user_id in user_ids
+    }
+
+
+async def get_compiled_permissions(user_id: str) -> dict:
+    """
+    Retorna as permissões compiladas do usuário: {"is_admin": bool, "pares": frozenset}.
+    Usa o cache em processo; no miss compila a partir do banco e grava no cache.
+    """
+    entry = permission_cache.get(user_id)
+    if entry is not None:
+        return entry
     
-    # Remover duplicatas
-    unique_perms = []
-    seen_ids = set()
-    for perm in all_permissions:
-        if perm["id"] not in seen_ids:
-            unique_perms.append(perm)
-            seen_ids.add(perm["id"])
+    geracao = permission_cache.snapshot(user_id)
+    user = await carregar_usuario(user_id)
+    if not user:
+        return {"is_admin": False, "pares": frozenset()}
     
-    return unique_perms
+    permissions, proxima_transicao = await _carregar_permissoes_usuario(user)
+    pares = frozenset(
+        (p["modulo"], p["acao"]) for p in permissions if "modulo" in p and "acao" in p
+    )
+    is_admin = user.get("papel") == "admin"
+    permission_cache.set(user_id, geracao, is_admin, pares, proxima_transicao)
+    return {"is_admin": is_admin, "pares": pares}
+
+
+def permissao_concedida(pares: frozenset, modulo: str, acao: str) -> bool:
+    """Verifica (modulo, acao) no conjunto compilado, incluindo wildcards (*)."""
+    return (
+        (modulo, acao) in pares
+        or (modulo, "*") in pares
+        or ("*", acao) in pares
+    )
+
 
 async def check_permission(user_id: str, modulo: str, acao: str) -> bool:
     """Verifica se usuário tem permissão específica"""
+    compiled = await get_compiled_permissions(user_id)
+    
     # Admin sempre tem tudo
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if user and user.get("papel") == "admin":
+    if compiled["is_admin"]:
         return True
     
-    permissions = await get_user_permissions(user_id)
-    
-    for perm in permissions:
-        if perm["modulo"] == modulo and perm["acao"] == acao:
-            return True
-        # Permissão wildcard (*)
-        if perm["modulo"] == modulo and perm["acao"] == "*":
-            return True
-        if perm["modulo"] == "*" and perm["acao"] == acao:
-            return True
-    
-    return False
+    return permissao_concedida(compiled["pares"], modulo, acao)
 
 def require_permission(modulo: str, acao: str):
     """Dependency para verificar permissão"""
@@ -2335,22 +2896,14 @@ async def get_my_permissions(current_user: dict = Depends(get_current_user)):
     """
     user_id = current_user["id"]
     
-    # Buscar role do usuário
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if not user:
-        raise HTTPException(status_code=404, detail="Usuário não encontrado")
+    # Usuário já carregado por get_current_user
+    user = current_user
     
     role_id = user.get("role_id")
-    role = await db.roles.find_one({"id": role_id}, {"_id": 0}) if role_id else None
+    role = await db.roles.find_one({"id": role_id}, {"_id": 0, "nome": 1}) if role_id else None
     
-    # Buscar permissões da role
-    permissions = []
-    if role and role.get("permissoes"):
-        perm_cursor = db.permissions.find(
-            {"id": {"$in": role["permissoes"]}},
-            {"_id": 0}
-        )
-        permissions = await perm_cursor.to_list(None)
+    # Permissões efetivas (papel + grupos + temporárias + delegadas)
+    permissions, _ = await _carregar_permissoes_usuario(user)
     
     # Agrupar por módulo
     por_modulo = {}
@@ -2379,7 +2932,7 @@ async def arquivar_logs_antigos(
 ):
     """
     Correção 10: Arquiva logs mais antigos que X dias.
-    Não deleta, apenas marca como arquivado.
+    Não deleta: move para o arquivo (logs_arquivo), ainda consultável por /logs.
     """
     if dias < 30:
         raise HTTPException(
@@ -2387,26 +2940,11 @@ async def arquivar_logs_antigos(
             detail="Período mínimo para arquivar é 30 dias"
         )
     
-    data_corte = (datetime.now(timezone.utc) - timedelta(days=dias)).isoformat()
-    
-    result = await db.logs.update_many(
-        {
-            "timestamp": {"$lt": data_corte},
-            "arquivado": {"$ne": True}
-        },
-        {
-            "$set": {
-                "arquivado": True,
-                "data_arquivamento": iso_utc_now()
-            }
-        }
-    )
+    resultado = await arquivar_logs(dias)
     
     return {
         "success": True,
-        "logs_arquivados": result.modified_count,
-        "data_corte": data_corte,
-        "dias": dias
+        **resultado
     }
 
 
@@ -2609,6 +3147,142 @@ async def initialize_default_roles_and_permissions():
     await db.roles.insert_one(visualizador_role.model_dump())
 
 
+# ==================== GRAVAÇÃO ASSÍNCRONA DE LOGS ====================
+# log_action e log_seguranca não gravam mais na requisição: os documentos entram
+# numa fila em memória (limitada) e uma task de fundo grava em lotes com insert_many
+# a cada LOG_FLUSH_INTERVAL_MS ou LOG_BATCH_SIZE registros, o que vier primeiro.
+# Fila cheia: a requisição espera até LOG_QUEUE_PUT_TIMEOUT_MS por espaço; se não
+# houver, o registro é descartado e contado. Sem a task ativa (fora do startup ou
+# LOG_ASYNC_ENABLED=0), a gravação continua direta, como antes.
+
+import asyncio
+
+LOG_ASYNC_ENABLED = os.environ.get('LOG_ASYNC_ENABLED', '1') != '0'
+LOG_QUEUE_MAX_SIZE = int(os.environ.get('LOG_QUEUE_MAX_SIZE', 10000))
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 500))
+LOG_FLUSH_INTERVAL_MS = int(os.environ.get('LOG_FLUSH_INTERVAL_MS', 200))
+LOG_QUEUE_PUT_TIMEOUT_MS = int(os.environ.get('LOG_QUEUE_PUT_TIMEOUT_MS', 50))
+
+class LogWriter:
+    """Fila limitada de documentos de log gravados em lote por uma task de fundo."""
+    def __init__(self, max_size: int = 10000, batch_size: int = 500,
+                 flush_interval_ms: int = 200, put_timeout_ms: int = 50):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.put_timeout = put_timeout_ms / 1000
+        self.queue = None
+        self.task = None
+        self.enfileirados = 0
+        self.gravados = 0
+        self.lotes = 0
+        self.esperas = 0  # requisições que aguardaram espaço na fila
+        self.descartados = 0  # fila cheia além do timeout
+        self.falhas = 0  # registros perdidos em erro de gravação
+    
+    @property
+    def ativo(self) -> bool:
+        return self.task is not None and not self.task.done()
+    
+    def iniciar(self):
+        """Cria a fila e a task de gravação (chamado no startup, dentro do event loop)."""
+        if self.ativo:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self.task = asyncio.create_task(self._executar())
+    
+    async def gravar(self, colecao: str, doc: dict):
+        """Enfileira o documento; grava direto se a task não estiver ativa."""
+        if not self.ativo:
+            await db[colecao].insert_one(doc)
+            return
+        try:
+            self.queue.put_nowait((colecao, doc))
+        except asyncio.QueueFull:
+            self.esperas += 1
+            try:
+                await asyncio.wait_for(self.queue.put((colecao, doc)), timeout=self.put_timeout)
+            except asyncio.TimeoutError:
+                self.descartados += 1
+                if self.descartados == 1 or self.descartados % 1000 == 0:
+                    print(f"Aviso: Fila de logs cheia - {self.descartados} registros descartados")
+                return
+        self.enfileirados += 1
+    
+    async def _executar(self):
+        encerrar = False
+        while not encerrar:
+            item = await self.queue.get()
+            if item is None:
+                break
+            lote = [item]
+            limite = asyncio.get_running_loop().time() + self.flush_interval
+            while len(lote) < self.batch_size:
+                restante = limite - asyncio.get_running_loop().time()
+                if restante <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout=restante)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    encerrar = True
+                    break
+                lote.append(item)
+            await self._gravar_lote(lote)
+        
+        # Drenar o que restou na fila após o sinal de parada
+        restantes = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                restantes.append(item)
+        for inicio in range(0, len(restantes), self.batch_size):
+            await self._gravar_lote(restantes[inicio:inicio + self.batch_size])
+    
+    async def _gravar_lote(self, lote: list):
+        por_colecao = defaultdict(list)
+        for colecao, doc in lote:
+            por_colecao[colecao].append(doc)
+        for colecao, docs in por_colecao.items():
+            try:
+                await db[colecao].insert_many(docs, ordered=False)
+                self.gravados += len(docs)
+            except Exception as e:
+                self.falhas += len(docs)
+                print(f"Aviso: Erro ao gravar lote de {len(docs)} logs em {colecao}: {str(e)}")
+            self.lotes += 1
+    
+    async def parar(self):
+        """Sinaliza a task e aguarda a gravação de tudo que já foi enfileirado."""
+        if not self.ativo:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+    
+    def stats(self) -> dict:
+        return {
+            "ativo": self.ativo,
+            "na_fila": self.queue.qsize() if self.queue else 0,
+            "capacidade": self.max_size,
+            "enfileirados": self.enfileirados,
+            "gravados": self.gravados,
+            "lotes": self.lotes,
+            "esperas": self.esperas,
+            "descartados": self.descartados,
+            "falhas": self.falhas
+        }
+
+# Instância global do gravador de logs
+log_writer = LogWriter(
+    max_size=LOG_QUEUE_MAX_SIZE,
+    batch_size=LOG_BATCH_SIZE,
+    flush_interval_ms=LOG_FLUSH_INTERVAL_MS,
+    put_timeout_ms=LOG_QUEUE_PUT_TIMEOUT_MS
+)
+
+
 async def log_action(
     ip: str, 
     user_id: str, 
@@ -2689,7 +3363,7 @@ async def log_action(
         stack_trace=stack_trace
     )
     
-    await db.logs.insert_one(log.model_dump())
+    await log_writer.gravar("logs", log.model_dump())
     
     # Alertas automáticos para eventos críticos
     if severidade in ["CRITICAL", "SECURITY"]:
@@ -3040,99 +3714,7 @@ async def verificar_e_atualizar_parcelas_vencidas():
     """
     Job automático para marcar parcelas vencidas e atualizar status
     """
-    hoje = datetime.now(timezone.utc).date()
-    
-    # Verificar Contas a Receber
-    contas_receber = await db.contas_receber.find({
-        "status": {"$in": ["pendente", "recebido_parcial"]},
-        "cancelada": False
-    }).to_list(10000)
-    
-    for conta in contas_receber:
-        parcelas_alteradas = False
-        for i, parcela in enumerate(conta["parcelas"]):
-            if parcela["status"] == "pendente":
-                vencimento = datetime.fromisoformat(parcela["data_vencimento"]).date()
-                if vencimento < hoje:
-                    dias_atraso = (hoje - vencimento).days
-                    
-                    # Atualizar parcela
-                    await db.contas_receber.update_one(
-                        {"id": conta["id"]},
-                        {
-                            "$set": {
-                                f"parcelas.{i}.status": "vencido",
-                                f"parcelas.{i}.dias_atraso": dias_atraso,
-                                "status": "vencido",
-                                "dias_atraso": dias_atraso
-                            }
-                        }
-                    )
-                    parcelas_alteradas = True
-                    
-                    # Log automático
-                    await registrar_log_financeiro(
-                        usuario_id="sistema",
-                        usuario_nome="Sistema Automático",
-                        acao="parcela_vencida_automatica",
-                        modulo="contas_receber",
-                        registro_id=conta["id"],
-                        registro_numero=conta["numero"],
-                        detalhes={
-                            "numero_parcela": parcela["numero_parcela"],
-                            "dias_atraso": dias_atraso,
-                            "valor_pendente": parcela["valor"]
-                        },
-                        severidade="WARNING"
-                    )
-        
-        if parcelas_alteradas:
-            # Atualizar cliente como inadimplente
-            await db.clientes.update_one(
-                {"id": conta["cliente_id"]},
-                {"$set": {"inadimplente": True}}
-            )
-    
-    # Verificar Contas a Pagar (similar)
-    contas_pagar = await db.contas_pagar.find({
-        "status": {"$in": ["pendente", "pago_parcial"]},
-        "cancelada": False
-    }).to_list(10000)
-    
-    for conta in contas_pagar:
-        for i, parcela in enumerate(conta["parcelas"]):
-            if parcela["status"] == "pendente":
-                vencimento = datetime.fromisoformat(parcela["data_vencimento"]).date()
-                if vencimento < hoje:
-                    dias_atraso = (hoje - vencimento).days
-                    
-                    await db.contas_pagar.update_one(
-                        {"id": conta["id"]},
-                        {
-                            "$set": {
-                                f"parcelas.{i}.status": "vencido",
-                                f"parcelas.{i}.dias_atraso": dias_atraso,
-                                "status": "vencido",
-                                "dias_atraso": dias_atraso
-                            }
-                        }
-                    )
-                    
-                    # Log automático
-                    await registrar_log_financeiro(
-                        usuario_id="sistema",
-                        usuario_nome="Sistema Automático",
-                        acao="parcela_vencida_automatica",
-                        modulo="contas_pagar",
-                        registro_id=conta["id"],
-                        registro_numero=conta["numero"],
-                        detalhes={
-                            "numero_parcela": parcela["numero_parcela"],
-                            "dias_atraso": dias_atraso,
-                            "valor_pendente": parcela["valor"]
-                        },
-                        severidade="WARNING"
-                    )
+    return {tipo: await marcar_parcelas_vencidas(tipo) for tipo in ("receber", "pagar")}
 
 # ==================== FIM FUNÇÕES DE LOG FINANCEIRO ====================
 
@@ -3149,7 +3731,7 @@ async def log_seguranca(tipo: str, ip: str, detalhes: dict, user_id: str = None,
         detalhes=detalhes
     )
     
-    await db.logs_seguranca.insert_one(log_seg.model_dump())
+    await log_writer.gravar("logs_seguranca", log_seg.model_dump())
     
     # Alerta imediato
     await enviar_alerta_seguranca(log_seg)
@@ -3217,8 +3799,8 @@ async def login(login_data: UserLogin, request: Request):
     client_ip = request.client.host if request.client else "0.0.0.0"
     rate_limit_key = f"{client_ip}:{login_data.email}"
     
-    if login_rate_limiter.is_rate_limited(rate_limit_key):
-        remaining = login_rate_limiter.get_remaining_time(rate_limit_key)
+    if await login_rate_limiter.is_rate_limited(rate_limit_key):
+        remaining = await login_rate_limiter.get_remaining_time(rate_limit_key)
         await log_action(
             ip=client_ip,
             user_id="",
@@ -3239,7 +3821,7 @@ async def login(login_data: UserLogin, request: Request):
     # Se usuário não existe, retornar erro genérico (não revelar se email existe)
     if not user:
         # 6) Registrar tentativa no rate limiter
-        login_rate_limiter.record_attempt(rate_limit_key)
+        await login_rate_limiter.record_attempt(rate_limit_key)
         
         # Log tentativa de login com email inexistente
         await log_action(
@@ -3284,9 +3866,9 @@ async def login(login_data: UserLogin, request: Request):
             user["login_attempts"] = 0
     
     # Verificar senha
-    if not verify_password(login_data.senha, user["senha_hash"]):
+    if not await password_hasher.verify(login_data.senha, user["senha_hash"]):
         # 6) Registrar tentativa no rate limiter
-        login_rate_limiter.record_attempt(rate_limit_key)
+        await login_rate_limiter.record_attempt(rate_limit_key)
         
         # Incrementar tentativas falhadas
         login_attempts = user.get("login_attempts", 0) + 1
@@ -3330,6 +3912,15 @@ async def login(login_data: UserLogin, request: Request):
         
         raise HTTPException(status_code=401, detail="Credenciais inválidas")
     
+    # Senha correta com hash de custo diferente do configurado: refazer o hash
+    if password_needs_rehash(user["senha_hash"]):
+        novo_hash = await password_hasher.hash(login_data.senha)
+        await db.users.update_one(
+            {"id": user["id"], "senha_hash": user["senha_hash"]},
+            {"$set": {"senha_hash": novo_hash}}
+        )
+        invalidar_usuario_cache(user["id"])
+    
     # Verificar se usuário está ativo
     if not user.get("ativo", True):
         await log_action(
@@ -3403,7 +3994,7 @@ async def login(login_data: UserLogin, request: Request):
             backup_valid = backup_idx >= 0
         
         if not totp_valid and not backup_valid:
-            login_rate_limiter.record_attempt(rate_limit_key)
+            await login_rate_limiter.record_attempt(rate_limit_key)
             await log_action(
                 ip=client_ip,
                 user_id=user["id"],
@@ -3479,8 +4070,8 @@ async def login(login_data: UserLogin, request: Request):
     # Remover dados sensíveis e adicionar permissões legíveis
     user_data = {k: v for k, v in user.items() if k not in ["senha_hash", "senha_historia", "locked_until"]}
     
-    # Obter permissões legíveis (módulo:ação)
-    permissions = await get_user_permissions(user["id"])
+    # Obter permissões legíveis (módulo:ação) - usuário já carregado, sem nova leitura
+    permissions, _ = await _carregar_permissoes_usuario(user)
     user_data["permissoes"] = [f"{p['modulo']}:{p['acao']}" for p in permissions if 'modulo' in p and 'acao' in p]
     
     return Token(access_token=access_token, token_type="bearer", user=user_data)
@@ -3499,6 +4090,7 @@ async def logout(request: Request, current_user: dict = Depends(get_current_user
             {"user_id": current_user["id"], "token": token},
             {"$set": {"ativo": False}}
         )
+        invalidar_usuario_cache(current_user["id"])
     
     # Log
     await log_action(
@@ -3643,15 +4235,18 @@ async def reset_password(token: str, new_password: str, request: Request):
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
     
     # Verificar se nova senha é diferente das últimas (se histórico existir)
-    senha_hash_nova = hash_password(new_password)
+    senha_hash_nova = await password_hasher.hash(new_password)
     senha_historia = user.get("senha_historia", [])
     
-    for old_hash in senha_historia[-5:]:  # Últimas 5 senhas
-        if verify_password(new_password, old_hash):
-            raise HTTPException(
-                status_code=400,
-                detail="Não use uma das suas últimas 5 senhas. Escolha uma senha diferente."
-            )
+    # Últimas 5 senhas, verificadas em paralelo no pool
+    repetidas = await asyncio.gather(*[
+        password_hasher.verify(new_password, old_hash) for old_hash in senha_historia[-5:]
+    ])
+    if any(repetidas):
+        raise HTTPException(
+            status_code=400,
+            detail="Não use uma das suas últimas 5 senhas. Escolha uma senha diferente."
+        )
     
     # Atualizar senha
     senha_historia.append(user["senha_hash"])
@@ -3670,6 +4265,7 @@ async def reset_password(token: str, new_password: str, request: Request):
             }
         }
     )
+    invalidar_usuario_cache(user["id"])
     
     # Marcar token como usado
     await db.password_reset_tokens.update_one(
@@ -3742,6 +4338,11 @@ async def get_me(current_user: dict = Depends(get_current_user)):
     
     return user_data
 
+@api_router.get("/auth/hash-senhas")
+async def get_hash_senhas_stats(current_user: dict = Depends(require_permission("admin", "ler"))):
+    """Profundidade da fila e contadores do pool de hash de senhas (bcrypt)"""
+    return password_hasher.stats()
+
 @api_router.get("/auth/sessions")
 async def get_my_sessions(current_user: dict = Depends(get_current_user)):
     """Lista sessões ativas do usuário"""
@@ -3766,6 +4367,7 @@ async def revoke_session(session_id: str, current_user: dict = Depends(get_curre
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Sessão não encontrada")
+    invalidar_usuario_cache(current_user["id"])
     
     await log_action(
         ip="0.0.0.0",
@@ -3844,7 +4446,7 @@ async def create_usuario(user_data: dict, current_user: dict = Depends(require_p
     user = User(
         email=user_data["email"],
         nome=user_data["nome"],
-        senha_hash=hash_password(user_data["senha"]),
+        senha_hash=await password_hasher.hash(user_data["senha"]),
         papel=user_data.get("papel", papel_default),  # Sincroniza com role ou usa valor fornecido
         ativo=user_data.get("ativo", True)
     )
@@ -3930,12 +4532,14 @@ async def update_usuario(user_id: str, user_data: dict, current_user: dict = Dep
     if user_data.get("senha"):
         if len(user_data["senha"]) < 6:
             raise HTTPException(status_code=400, detail="Senha deve ter pelo menos 6 caracteres")
-        update_fields["senha_hash"] = hash_password(user_data["senha"])
+        update_fields["senha_hash"] = await password_hasher.hash(user_data["senha"])
         update_fields["senha_ultimo_change"] = datetime.now(timezone.utc).isoformat()
     
     update_fields["updated_at"] = datetime.now(timezone.utc).isoformat()
     
     await db.users.update_one({"id": user_id}, {"$set": update_fields})
+    invalidar_usuario_cache(user_id)
+    permission_cache.invalidate_user(user_id)
     
     await log_action(
         ip="0.0.0.0",
@@ -3958,6 +4562,8 @@ async def delete_usuario(user_id: str, current_user: dict = Depends(require_perm
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
+    invalidar_usuario_cache(user_id)
+    permission_cache.invalidate_user(user_id)
     
     await log_action(
         ip="0.0.0.0",
@@ -3988,6 +4594,8 @@ async def toggle_usuario_status(user_id: str, current_user: dict = Depends(get_c
         {"id": user_id},
         {"$set": {"ativo": novo_status}}
     )
+    invalidar_usuario_cache(user_id)
+    permission_cache.invalidate_user(user_id)
     
     await log_action(
         ip="0.0.0.0",
@@ -4108,6 +4716,7 @@ async def update_role(role_id: str, role_data: RoleUpdate, current_user: dict =
     update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
     
     await db.roles.update_one({"id": role_id}, {"$set": update_data})
+    permission_cache.invalidate_all()
     
     # Log de auditoria
     await log_permission_change(
@@ -4152,6 +4761,7 @@ async def delete_role(role_id: str, current_user: dict = Depends(get_current_use
         )
     
     await db.roles.delete_one({"id": role_id})
+    permission_cache.invalidate_all()
     
     # Log de auditoria
     await log_permission_change(
@@ -4274,6 +4884,28 @@ async def get_user_all_permissions(user_id: str, current_user: dict = Depends(re
         "by_module": by_module
     }
 
+@api_router.post("/users/permissions/bulk")
+async def get_users_all_permissions_bulk(
+    user_ids: List[str] = Body(..., embed=True),
+    current_user: dict = Depends(require_permission("usuarios", "ler"))
+):
+    """Retorna as permissões efetivas (modulo:acao) de vários usuários em uma chamada"""
+    if current_user.get("papel") != "admin":
+        raise HTTPException(status_code=403, detail="Apenas administradores")
+    
+    if len(user_ids) > MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_LIMIT} usuários por chamada")
+    
+    permissoes_por_usuario = await get_users_permissions_bulk(user_ids)
+    
+    return {
+        user_id: {
+            "total_permissions": len(permissions),
+            "permissoes": [f"{p['modulo']}:{p['acao']}" for p in permissions if 'modulo' in p and 'acao' in p]
+        }
+        for user_id, permissions in permissoes_por_usuario.items()
+    }
+
 # --- USER GROUPS (Grupos) ---
 
 @api_router.get("/user-groups", response_model=List[UserGroup])
@@ -4330,6 +4962,7 @@ async def update_user_group(group_id: str, group_data: UserGroupCreate, current_
         {"id": group_id},
         {"$set": group_data.model_dump()}
     )
+    permission_cache.invalidate_all()
     
     await log_action(
         ip="0.0.0.0",
@@ -4357,6 +4990,8 @@ async def delete_user_group(group_id: str, current_user: dict = Depends(get_curr
         {"grupos": group_id},
         {"$pull": {"grupos": group_id}}
     )
+    user_cache.clear()
+    permission_cache.invalidate_all()
     
     await log_action(
         ip="0.0.0.0",
@@ -4418,6 +5053,7 @@ async def grant_temporary_permission(
     )
     
     await db.temporary_permissions.insert_one(temp_perm.model_dump())
+    permission_cache.invalidate_user(user_id)
     
     await log_permission_change(
         user_id=current_user["id"],
@@ -4452,6 +5088,7 @@ async def initialize_rbac(current_user: dict = Depends(require_permission("usuar
         raise HTTPException(status_code=403, detail="Apenas administradores")
     
     await initialize_default_roles_and_permissions()
+    permission_cache.invalidate_all()
     
     return {"message": "Sistema RBAC inicializado com sucesso"}
 
@@ -4475,7 +5112,7 @@ async def validar_autorizacao(auth_data: AutorizacaoRequest, current_user: dict
         raise HTTPException(status_code=403, detail="Usuário não autorizado. Apenas supervisores ou administradores.")
     
     # Verificar senha
-    if not verify_password(auth_data.senha, usuario["senha_hash"]):
+    if not await password_hasher.verify(auth_data.senha, usuario["senha_hash"]):
         raise HTTPException(status_code=401, detail="Senha incorreta")
     
     # Verificar se está ativo
@@ -4524,12 +5161,7 @@ async def get_clientes(
     if q:
         q_norm = normalize_search_query(q)
         if q_norm:
-            filtro["$or"] = [
-                {"nome": {"$regex": q_norm, "$options": "i"}},
-                {"email": {"$regex": q_norm, "$options": "i"}},
-                {"telefone": {"$regex": q_norm, "$options": "i"}},
-                {"cpf_cnpj": {"$regex": q_norm, "$options": "i"}}
-            ]
+            filtro.update(await filtro_busca("clientes", q_norm))
     
     # Ordenação
     sort_field = sort.lstrip("-")
@@ -4548,6 +5180,7 @@ async def get_clientes(
 async def create_cliente(cliente_data: ClienteCreate, current_user: dict = Depends(require_permission("clientes", "criar"))):
     cliente = Cliente(**cliente_data.model_dump())
     await db.clientes.insert_one(cliente.model_dump())
+    await sincronizar_busca("clientes", [cliente.id])
     
     await log_action(
         ip="0.0.0.0",
@@ -4572,6 +5205,7 @@ async def update_cliente(cliente_id: str, cliente_data: ClienteCreate, current_u
     updated_data["ativo"] = existing.get("ativo", True)  # Preservar status ativo
     
     await db.clientes.replace_one({"id": cliente_id}, updated_data)
+    await sincronizar_busca("clientes", [cliente_id])
     
     await log_action(
         ip="0.0.0.0",
@@ -4609,6 +5243,7 @@ async def delete_cliente(cliente_id: str, current_user: dict = Depends(require_p
     
     # Excluir cliente
     await db.clientes.delete_one({"id": cliente_id})
+    await sincronizar_busca("clientes", [cliente_id])
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -4690,12 +5325,7 @@ async def get_fornecedores(
     if q:
         q_norm = normalize_search_query(q)
         if q_norm:
-            filtro["$or"] = [
-                {"razao_social": {"$regex": q_norm, "$options": "i"}},
-                {"nome_fantasia": {"$regex": q_norm, "$options": "i"}},
-                {"cnpj": {"$regex": q_norm, "$options": "i"}},
-                {"email": {"$regex": q_norm, "$options": "i"}}
-            ]
+            filtro.update(await filtro_busca("fornecedores", q_norm))
     
     # Ordenação
     sort_field = sort.lstrip("-")
@@ -4714,6 +5344,7 @@ async def get_fornecedores(
 async def create_fornecedor(fornecedor_data: FornecedorCreate, current_user: dict = Depends(require_permission("fornecedores", "criar"))):
     fornecedor = Fornecedor(**fornecedor_data.model_dump())
     await db.fornecedores.insert_one(fornecedor.model_dump())
+    await sincronizar_busca("fornecedores", [fornecedor.id])
     return fornecedor
 
 @api_router.put("/fornecedores/{fornecedor_id}", response_model=Fornecedor)
@@ -4730,6 +5361,7 @@ async def update_fornecedor(fornecedor_id: str, fornecedor_data: FornecedorCreat
     updated_data["ativo"] = existing.get("ativo", True)  # Preservar status ativo
     
     await db.fornecedores.replace_one({"id": fornecedor_id}, updated_data)
+    await sincronizar_busca("fornecedores", [fornecedor_id])
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -4765,6 +5397,7 @@ async def delete_fornecedor(fornecedor_id: str, current_user: dict = Depends(req
     
     # Excluir fornecedor
     await db.fornecedores.delete_one({"id": fornecedor_id})
+    await sincronizar_busca("fornecedores", [fornecedor_id])
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -4824,6 +5457,83 @@ async def toggle_fornecedor_status(fornecedor_id: str, current_user: dict = Depe
     return {"message": f"Fornecedor {'ativado' if novo_status else 'inativado'} com sucesso", "ativo": novo_status}
 
 
+# ========== CACHE DE DIMENSÕES DO CATÁLOGO ==========
+# marcas, categorias e subcategorias são tabelas pequenas e quase estáticas: ficam inteiras
+# em memória, carregadas no startup e invalidadas pelos endpoints que as alteram. O TTL
+# cobre alterações feitas por outros workers.
+
+DIMENSOES_CACHE_TTL_SECONDS = float(os.environ.get('DIMENSOES_CACHE_TTL_SECONDS', '300'))
+DIMENSOES_CATALOGO = ("marcas", "categorias", "subcategorias")
+
+class CatalogoDimensoesCache:
+    """Tabelas de dimensão do catálogo em memória: {tabela: {id: documento}}."""
+    def __init__(self, ttl_seconds: float = 300):
+        self.ttl_seconds = ttl_seconds
+        self.tabelas = {}  # {tabela: (expira_em, {id: doc})}
+        self.cargas = 0
+    
+    async def obter(self, tabela: str) -> dict:
+        item = self.tabelas.get(tabela)
+        if item is not None and item[0] > time.time():
+            return item[1]
+        docs = await db[tabela].find({}, {"_id": 0}).to_list(None)
+        por_id = {doc["id"]: doc for doc in docs if "id" in doc}
+        if self.ttl_seconds > 0:
+            self.tabelas[tabela] = (time.time() + self.ttl_seconds, por_id)
+        self.cargas += 1
+        return por_id
+    
+    async def carregar(self):
+        """Carrega todas as tabelas (startup)."""
+        for tabela in DIMENSOES_CATALOGO:
+            self.invalidar(tabela)
+            await self.obter(tabela)
+    
+    def invalidar(self, tabela: str = None):
+        if tabela is None:
+            self.tabelas.clear()
+        else:
+            self.tabelas.pop(tabela, None)
+    
+    def stats(self) -> dict:
+        return {
+            "tabelas": {tabela: len(item[1]) for tabela, item in self.tabelas.items()},
+            "ttl_segundos": self.ttl_seconds,
+            "cargas": self.cargas
+        }
+
+dimensoes_cache = CatalogoDimensoesCache(ttl_seconds=DIMENSOES_CACHE_TTL_SECONDS)
+
+async def descricoes_completas(produto_ids: List[str], produtos_por_id: dict = None) -> dict:
+    """
+    "Marca | Categoria | Subcategoria | Nome" de vários produtos: uma consulta $in para os
+    produtos (nenhuma se já vierem em produtos_por_id) e as dimensões do cache.
+    Retorna {produto_id: descricao}.
+    """
+    ids = list(dict.fromkeys(produto_ids))
+    if produtos_por_id is None:
+        produtos_por_id = await carregar_produtos_por_id(ids)
+    marcas = await dimensoes_cache.obter("marcas")
+    categorias = await dimensoes_cache.obter("categorias")
+    subcategorias = await dimensoes_cache.obter("subcategorias")
+    
+    def nome(tabela: dict, dimensao_id) -> str:
+        doc = tabela.get(dimensao_id)
+        return doc.get("nome") if doc else "N/A"
+    
+    descricoes = {}
+    for produto_id in ids:
+        produto = produtos_por_id.get(produto_id)
+        if not produto:
+            descricoes[produto_id] = "Produto não encontrado"
+            continue
+        descricoes[produto_id] = (
+            f"{nome(marcas, produto.get('marca_id'))} | {nome(categorias, produto.get('categoria_id'))} | "
+            f"{nome(subcategorias, produto.get('subcategoria_id'))} | {produto['nome']}"
+        )
+    return descricoes
+
+
 # ========== MARCAS ==========
 
 @api_router.get("/marcas", response_model=List[Marca])
@@ -4849,6 +5559,7 @@ async def get_marcas(
 async def create_marca(marca_data: MarcaCreate, current_user: dict = Depends(require_permission("marcas", "criar"))):
     marca = Marca(**marca_data.model_dump())
     await db.marcas.insert_one(marca.model_dump())
+    dimensoes_cache.invalidar("marcas")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -4872,6 +5583,7 @@ async def update_marca(marca_id: str, marca_data: MarcaCreate, current_user: dic
     updated_data["created_at"] = existing["created_at"]
     
     await db.marcas.replace_one({"id": marca_id}, updated_data)
+    dimensoes_cache.invalidar("marcas")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -4907,6 +5619,7 @@ async def delete_marca(marca_id: str, current_user: dict = Depends(require_permi
     
     # Excluir marca
     await db.marcas.delete_one({"id": marca_id})
+    dimensoes_cache.invalidar("marcas")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -4955,6 +5668,7 @@ async def toggle_marca_status(marca_id: str, current_user: dict = Depends(requir
         {"id": marca_id},
         {"$set": {"ativo": novo_status}}
     )
+    dimensoes_cache.invalidar("marcas")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5005,6 +5719,7 @@ async def create_categoria(categoria_data: CategoriaCreate, current_user: dict =
     
     categoria = Categoria(**categoria_data.model_dump())
     await db.categorias.insert_one(categoria.model_dump())
+    dimensoes_cache.invalidar("categorias")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5041,6 +5756,7 @@ async def update_categoria(categoria_id: str, categoria_data: CategoriaCreate, c
     updated_data["created_at"] = existing["created_at"]
     
     await db.categorias.replace_one({"id": categoria_id}, updated_data)
+    dimensoes_cache.invalidar("categorias")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5076,6 +5792,7 @@ async def delete_categoria(categoria_id: str, current_user: dict = Depends(requi
     
     # Excluir categoria
     await db.categorias.delete_one({"id": categoria_id})
+    dimensoes_cache.invalidar("categorias")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5122,6 +5839,7 @@ async def toggle_categoria_status(categoria_id: str, current_user: dict = Depend
         {"id": categoria_id},
         {"$set": {"ativo": novo_status}}
     )
+    dimensoes_cache.invalidar("categorias")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5172,6 +5890,7 @@ async def create_subcategoria(subcategoria_data: SubcategoriaCreate, current_use
     
     subcategoria = Subcategoria(**subcategoria_data.model_dump())
     await db.subcategorias.insert_one(subcategoria.model_dump())
+    dimensoes_cache.invalidar("subcategorias")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5208,6 +5927,7 @@ async def update_subcategoria(subcategoria_id: str, subcategoria_data: Subcatego
     updated_data["created_at"] = existing["created_at"]
     
     await db.subcategorias.replace_one({"id": subcategoria_id}, updated_data)
+    dimensoes_cache.invalidar("subcategorias")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5235,6 +5955,7 @@ async def delete_subcategoria(subcategoria_id: str, current_user: dict = Depends
     
     # Excluir subcategoria
     await db.subcategorias.delete_one({"id": subcategoria_id})
+    dimensoes_cache.invalidar("subcategorias")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5271,6 +5992,7 @@ async def toggle_subcategoria_status(subcategoria_id: str, current_user: dict =
         {"id": subcategoria_id},
         {"$set": {"ativo": novo_status}}
     )
+    dimensoes_cache.invalidar("subcategorias")
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5284,78 +6006,350 @@ async def toggle_subcategoria_status(subcategoria_id: str, current_user: dict =
 
 # ========== PRODUTOS ==========
 
-async def recalcular_precos_produto(produto_id: str):
+# Custo de compra: produtos guardam os acumulados das notas fiscais confirmadas
+# (qtd_comprada_acumulada, valor_comprado_acumulado) e a última compra. Confirmar ou cancelar
+# uma nota aplica só a diferença, numa escrita atômica por produto; preco_medio é derivado
+# dos acumulados na mesma escrita. reconstruir_custos_compra refaz tudo a partir das notas.
+
+FILTRO_NOTAS_CONFIRMADAS = {"confirmado": True, "cancelada": False, "status": {"$ne": "cancelada"}}
+
+# preco_medio = valor/quantidade acumulados (preco_inicial enquanto não houver compra)
+_PRECO_MEDIO_ACUMULADO = {"$cond": [
+    {"$gt": ["$qtd_comprada_acumulada", 0]},
+    {"$round": [{"$divide": ["$valor_comprado_acumulado", "$qtd_comprada_acumulada"]}, 2]},
+    {"$ifNull": ["$preco_inicial", 0]}
+]}
+
+def compras_por_produto(nota: dict) -> dict:
+    """{produto_id: {"quantidade", "valor", "preco"}} dos itens da nota (preço do primeiro item do produto)"""
+    compras = {}
+    for item in nota.get("itens", []):
+        produto_id = item.get("produto_id")
+        if not produto_id:
+            continue
+        quantidade = item.get("quantidade", 0)
+        preco_unitario = item.get("preco_unitario", 0)
+        compra = compras.setdefault(produto_id, {"quantidade": 0, "valor": 0, "preco": preco_unitario})
+        compra["quantidade"] += quantidade
+        compra["valor"] += quantidade * preco_unitario
+    return compras
+
+async def aplicar_custos_compra(nota: dict, produto_ids: List[str] = None, sinal: int = 1):
+    """
+    Soma (sinal=1, confirmação) ou subtrai (sinal=-1, cancelamento) os itens da nota nos
+    acumulados de custo dos produtos, em um bulk_write. Na confirmação a nota vira a última
+    compra do produto se for a mais recente por data_emissao.
+    """
+    compras = compras_por_produto(nota)
+    if produto_ids is not None:
+        compras = {pid: compra for pid, compra in compras.items() if pid in set(produto_ids)}
+    if not compras:
+        return
+    
+    data = nota.get("data_emissao") or ""
+    mais_recente = {"$gte": [{"$literal": data}, {"$ifNull": ["$data_ultima_compra", ""]}]}
+    operacoes = []
+    for produto_id, compra in compras.items():
+        acumulados = {
+            "qtd_comprada_acumulada": {"$add": [{"$ifNull": ["$qtd_comprada_acumulada", 0]}, sinal * compra["quantidade"]]},
+            "valor_comprado_acumulado": {"$add": [{"$ifNull": ["$valor_comprado_acumulado", 0]}, sinal * compra["valor"]]}
+        }
+        if sinal > 0:
+            acumulados.update({
+                "preco_ultima_compra": {"$cond": [mais_recente, round(compra["preco"], 2), "$preco_ultima_compra"]},
+                "data_ultima_compra": {"$cond": [mais_recente, {"$literal": data}, "$data_ultima_compra"]},
+                "ultima_compra_nota_id": {"$cond": [mais_recente, {"$literal": nota["id"]}, "$ultima_compra_nota_id"]}
+            })
+        operacoes.append(UpdateOne(
+            {"id": produto_id},
+            [{"$set": acumulados}, {"$set": {"preco_medio": _PRECO_MEDIO_ACUMULADO}}]
+        ))
+    await db.produtos.bulk_write(operacoes, ordered=False)
+
+async def estornar_custos_compra(nota: dict):
     """
-    Recalcula preço_medio e preco_ultima_compra de um produto com base nas notas fiscais confirmadas
-    - Preço Médio: média ponderada de todas as compras (soma(preco*qtd) / soma(qtd))
-    - Preço Última Compra: preço da nota fiscal mais recente
+    Retira dos acumulados uma nota já marcada como cancelada. Produtos cuja última compra
+    era esta nota têm a última compra refeita a partir das notas que restaram.
     """
-    # Buscar o produto
-    produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0})
-    if not produto:
+    produto_ids = list(compras_por_produto(nota))
+    if not produto_ids:
         return
+    await aplicar_custos_compra(nota, sinal=-1)
+    afetados = await db.produtos.find(
+        {"id": {"$in": produto_ids}, "ultima_compra_nota_id": nota["id"]},
+        {"_id": 0, "id": 1}
+    ).to_list(None)
+    if afetados:
+        await reconstruir_custos_compra([p["id"] for p in afetados])
+
+async def reconstruir_custos_compra(produto_ids: List[str] = None) -> dict:
+    """
+    Recalcula acumulados, preco_medio e última compra a partir das notas confirmadas com uma
+    agregação ($unwind/$group). Sem produto_ids, refaz todos os produtos (reparo e migração).
+    """
+    filtro_itens = {"itens.produto_id": {"$in": produto_ids}} if produto_ids is not None else {}
+    pipeline = [
+        {"$match": {**FILTRO_NOTAS_CONFIRMADAS, **filtro_itens}},
+        {"$unwind": {"path": "$itens", "includeArrayIndex": "posicao_item"}},
+    ]
+    if produto_ids is not None:
+        pipeline.append({"$match": filtro_itens})
+    pipeline += [
+        {"$sort": {"data_emissao": -1, "posicao_item": 1}},
+        {"$group": {
+            "_id": "$itens.produto_id",
+            "quantidade": {"$sum": {"$ifNull": ["$itens.quantidade", 0]}},
+            "valor": {"$sum": {"$multiply": [
+                {"$ifNull": ["$itens.quantidade", 0]}, {"$ifNull": ["$itens.preco_unitario", 0]}
+            ]}},
+            "preco_ultima_compra": {"$first": {"$ifNull": ["$itens.preco_unitario", 0]}},
+            "data_ultima_compra": {"$first": "$data_emissao"},
+            "ultima_compra_nota_id": {"$first": "$id"}
+        }}
+    ]
+    compras = await db.notas_fiscais.aggregate(pipeline, allowDiskUse=True).to_list(None)
     
-    # Buscar todas as notas fiscais confirmadas que contêm este produto
-    notas = await db.notas_fiscais.find(
-        {
-            "confirmado": True,
-            "cancelada": False,
-            "status": {"$ne": "cancelada"},
-            "itens.produto_id": produto_id
-        },
-        {"_id": 0}
-    ).sort("data_emissao", -1).to_list(10000)
-    
-    if not notas:
-        # Se não há notas fiscais, preco_medio = preco_inicial e preco_ultima_compra = None
-        await db.produtos.update_one(
-            {"id": produto_id},
+    operacoes = [
+        UpdateOne({"id": compra["_id"]}, [
             {"$set": {
-                "preco_medio": produto.get("preco_inicial", 0),
-                "preco_ultima_compra": None
-            }}
-        )
-        return
+                "qtd_comprada_acumulada": compra["quantidade"],
+                "valor_comprado_acumulado": compra["valor"],
+                "preco_ultima_compra": round(compra["preco_ultima_compra"], 2),
+                "data_ultima_compra": {"$literal": compra["data_ultima_compra"]},
+                "ultima_compra_nota_id": {"$literal": compra["ultima_compra_nota_id"]}
+            }},
+            {"$set": {"preco_medio": _PRECO_MEDIO_ACUMULADO}}
+        ])
+        for compra in compras if compra["_id"]
+    ]
+    for inicio in range(0, len(operacoes), 1000):
+        await db.produtos.bulk_write(operacoes[inicio:inicio + 1000], ordered=False)
+    
+    # Produtos sem compra confirmada voltam ao preço inicial
+    com_compra = [compra["_id"] for compra in compras if compra["_id"]]
+    filtro_sem_compra = {"id": {"$nin": com_compra}}
+    if produto_ids is not None:
+        filtro_sem_compra = {"id": {"$in": [pid for pid in produto_ids if pid not in set(com_compra)]}}
+    sem_compra = await db.produtos.update_many(filtro_sem_compra, [{"$set": {
+        "qtd_comprada_acumulada": 0,
+        "valor_comprado_acumulado": 0,
+        "preco_medio": {"$ifNull": ["$preco_inicial", 0]},
+        "preco_ultima_compra": None,
+        "data_ultima_compra": None,
+        "ultima_compra_nota_id": None
+    }}])
+    
+    return {"produtos_com_compra": len(operacoes), "produtos_sem_compra": sem_compra.modified_count}
+
+@api_router.post("/produtos/recalcular-custos")
+async def recalcular_custos_produtos(current_user: dict = Depends(require_permission("produtos", "editar"))):
+    """Refaz preço médio e última compra de todos os produtos a partir das notas fiscais confirmadas"""
+    resultado = await reconstruir_custos_compra()
     
-    # Calcular preço médio ponderado e preço da última compra
-    soma_valores = 0
-    soma_quantidades = 0
-    preco_ultima_compra = None
+    await log_action(
+        ip="0.0.0.0",
+        user_id=current_user["id"],
+        user_nome=current_user["nome"],
+        tela="produtos",
+        acao="recalcular_custos",
+        detalhes=resultado
+    )
     
-    for nota in notas:
-        for item in nota.get("itens", []):
-            if item.get("produto_id") == produto_id:
-                quantidade = item.get("quantidade", 0)
-                preco_unitario = item.get("preco_unitario", 0)
-                
-                soma_valores += quantidade * preco_unitario
-                soma_quantidades += quantidade
-                
-                # Primeira iteração (nota mais recente)
-                if preco_ultima_compra is None:
-                    preco_ultima_compra = preco_unitario
-    
-    # Calcular preço médio
-    preco_medio = soma_valores / soma_quantidades if soma_quantidades > 0 else produto.get("preco_inicial", 0)
-    
-    # Se não há última compra, usar preço inicial
-    if preco_ultima_compra is None:
-        preco_ultima_compra = produto.get("preco_inicial", 0)
-    
-    # Atualizar produto
-    await db.produtos.update_one(
-        {"id": produto_id},
-        {"$set": {
-            "preco_medio": round(preco_medio, 2),
-            "preco_ultima_compra": round(preco_ultima_compra, 2)
-        }}
-    )
+    return {"message": "Custos de compra recalculados", **resultado}
+
+
+# ==================== LEITURA DE CÓDIGOS (PDV) ====================
+# O leitor do caixa envia código de barras ou SKU, que é busca exata: vai pelos índices
+# únicos de codigo_barras/sku (inclusive das variações) em vez da busca textual. Os produtos
+# lidos ficam num LRU em processo com o resumo que o caixa precisa (preço, estoque, reserva),
+# invalidado nas escritas do produto e de estoque; o TTL limita a defasagem entre workers.
+# A venda continua validando o estoque na própria escrita (aplicar_movimentacoes_estoque).
+
+PRODUTO_CODIGO_CACHE_TTL_SECONDS = float(os.environ.get('PRODUTO_CODIGO_CACHE_TTL_SECONDS', '10'))
+PRODUTO_CODIGO_CACHE_MAX = int(os.environ.get('PRODUTO_CODIGO_CACHE_MAX', '5000'))
+MAX_CODIGOS_POR_LEITURA = 100
+
+CAMPOS_RESUMO_PDV = {
+    "_id": 0, "id": 1, "nome": 1, "sku": 1, "codigo_barras": 1, "unidade": 1, "ativo": 1,
+    "preco_venda": 1, "preco_promocional": 1, "data_inicio_promo": 1, "data_fim_promo": 1,
+    "estoque_atual": 1, "estoque_reservado": 1, "tem_variacoes": 1, "variacoes": 1, "eh_kit": 1
+}
+
+class ProdutoCodigoCache:
+    """LRU de resumos de produto por código lido, com TTL e invalidação por produto_id."""
+    def __init__(self, ttl_seconds: float = 10, max_entries: int = 5000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {codigo: (expira_em, produto_id, resumo)}
+        self.codigos_por_produto = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, codigo: str) -> Optional[dict]:
+        item = self.entries.get(codigo)
+        if item is None or item[0] <= time.time():
+            if item is not None:
+                self._remover(codigo)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(codigo)
+        self.hits += 1
+        return dict(item[2])
+    
+    def set(self, codigo: str, produto_id: str, resumo: dict):
+        if self.ttl_seconds <= 0:
+            return
+        self._remover(codigo)
+        self.entries[codigo] = (time.time() + self.ttl_seconds, produto_id, dict(resumo))
+        self.codigos_por_produto[produto_id].add(codigo)
+        while len(self.entries) > self.max_entries:
+            self._remover(next(iter(self.entries)))
+    
+    def _remover(self, codigo: str):
+        item = self.entries.pop(codigo, None)
+        if item is not None:
+            codigos = self.codigos_por_produto.get(item[1])
+            if codigos is not None:
+                codigos.discard(codigo)
+                if not codigos:
+                    del self.codigos_por_produto[item[1]]
+    
+    def invalidar(self, produto_ids):
+        """Remove todos os códigos já lidos dos produtos informados."""
+        for produto_id in produto_ids:
+            for codigo in list(self.codigos_por_produto.get(produto_id, ())):
+                self._remover(codigo)
+    
+    def clear(self):
+        self.entries.clear()
+        self.codigos_por_produto.clear()
+    
+    def stats(self) -> dict:
+        return {
+            "entradas": len(self.entries),
+            "capacidade": self.max_entries,
+            "ttl_segundos": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+produto_codigo_cache = ProdutoCodigoCache(
+    ttl_seconds=PRODUTO_CODIGO_CACHE_TTL_SECONDS, max_entries=PRODUTO_CODIGO_CACHE_MAX
+)
+
+def promocao_vigente(produto: dict, hoje: str = None) -> bool:
+    """Preço promocional definido e hoje (YYYY-MM-DD) dentro do período, quando informado"""
+    if not produto.get("preco_promocional"):
+        return False
+    hoje = hoje or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    inicio = parse_date_only(produto.get("data_inicio_promo"))
+    fim = parse_date_only(produto.get("data_fim_promo"))
+    return (not inicio or inicio <= hoje) and (not fim or hoje <= fim)
+
+def resumo_produto_pdv(produto: dict, variacao: dict = None) -> dict:
+    """Resumo do produto para o caixa; com variação, estoque e preço são os da variação"""
+    preco = produto["preco_promocional"] if promocao_vigente(produto) else produto.get("preco_venda", 0)
+    resumo = {
+        "id": produto["id"],
+        "nome": produto.get("nome"),
+        "sku": produto.get("sku"),
+        "codigo_barras": produto.get("codigo_barras"),
+        "unidade": produto.get("unidade", "UN"),
+        "ativo": produto.get("ativo", True),
+        "eh_kit": produto.get("eh_kit", False),
+        "preco_venda": produto.get("preco_venda", 0),
+        "preco_unitario": preco,
+        "promocao": promocao_vigente(produto),
+        "estoque_atual": produto.get("estoque_atual", 0),
+        "estoque_reservado": produto.get("estoque_reservado", 0),
+        "estoque_disponivel": calcular_estoque_disponivel(produto),
+        "variacao": None
+    }
+    if variacao:
+        resumo["variacao"] = {
+            "id": variacao.get("id"),
+            "sku_variante": variacao.get("sku_variante"),
+            "codigo_barras": variacao.get("codigo_barras"),
+            "tamanho": variacao.get("tamanho"),
+            "cor": variacao.get("cor"),
+            "estoque_atual": variacao.get("estoque_atual", 0),
+            "preco_adicional": variacao.get("preco_adicional", 0)
+        }
+        resumo["preco_unitario"] = preco + (variacao.get("preco_adicional") or 0)
+    return resumo
+
+async def resolver_codigos_produto(codigos: List[str]) -> dict:
+    """
+    Resolve códigos de barras/SKUs (do produto ou das variações) em resumos de produto.
+    Códigos já em cache não vão ao banco; os demais saem numa única consulta.
+    Retorna {codigo: resumo ou None}.
+    """
+    codigos = [c.strip() for c in codigos if c and c.strip()]
+    resultado = {}
+    faltantes = []
+    for codigo in dict.fromkeys(codigos):
+        resumo = produto_codigo_cache.get(codigo)
+        if resumo is not None:
+            resultado[codigo] = resumo
+        else:
+            faltantes.append(codigo)
+    
+    if faltantes:
+        produtos = await db.produtos.find(
+            {"$or": [
+                {"codigo_barras": {"$in": faltantes}},
+                {"sku": {"$in": faltantes}},
+                {"variacoes.codigo_barras": {"$in": faltantes}},
+                {"variacoes.sku_variante": {"$in": faltantes}}
+            ]},
+            CAMPOS_RESUMO_PDV
+        ).to_list(None)
+        
+        pendentes = set(faltantes)
+        for produto in produtos:
+            for campo in ("codigo_barras", "sku"):
+                if produto.get(campo) in pendentes:
+                    resultado[produto[campo]] = resumo_produto_pdv(produto)
+            for variacao in produto.get("variacoes") or []:
+                for campo in ("codigo_barras", "sku_variante"):
+                    if variacao.get(campo) in pendentes:
+                        resultado[variacao[campo]] = resumo_produto_pdv(produto, variacao)
+        for codigo in faltantes:
+            if codigo in resultado:
+                produto_codigo_cache.set(codigo, resultado[codigo]["id"], resultado[codigo])
+            else:
+                resultado[codigo] = None
     
+    return {codigo: resultado[codigo] for codigo in dict.fromkeys(codigos)}
+
+class LeituraCodigosRequest(BaseModel):
+    codigos: List[str]
+
+@api_router.get("/produtos/codigo/{codigo}", tags=["Produtos"], summary="Produto por código de barras ou SKU")
+async def get_produto_por_codigo(codigo: str, current_user: dict = Depends(require_permission("produtos", "ler"))):
+    """Leitura do PDV: busca exata por código de barras ou SKU (produto ou variação)"""
+    resumo = (await resolver_codigos_produto([codigo])).get(codigo.strip())
+    if resumo is None:
+        raise HTTPException(status_code=404, detail="Produto não encontrado para o código informado")
+    return resumo
+
+@api_router.post("/produtos/codigos", tags=["Produtos"], summary="Produtos por vários códigos")
+async def get_produtos_por_codigos(
+    request: LeituraCodigosRequest,
+    current_user: dict = Depends(require_permission("produtos", "ler"))
+):
+    """Leitura em lote do PDV: resolve até MAX_CODIGOS_POR_LEITURA códigos em uma consulta"""
+    if len(request.codigos) > MAX_CODIGOS_POR_LEITURA:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_CODIGOS_POR_LEITURA} códigos por chamada")
+    resultado = await resolver_codigos_produto(request.codigos)
     return {
-        "preco_medio": round(preco_medio, 2),
-        "preco_ultima_compra": round(preco_ultima_compra, 2)
+        "produtos": {codigo: resumo for codigo, resumo in resultado.items() if resumo is not None},
+        "nao_encontrados": [codigo for codigo, resumo in resultado.items() if resumo is None]
     }
 
+@api_router.get("/produtos/codigos/cache", tags=["Produtos"], summary="Contadores do cache de leitura")
+async def get_cache_codigos(current_user: dict = Depends(require_permission("admin", "ler"))):
+    return produto_codigo_cache.stats()
 
 
 @api_router.get("/produtos", tags=["Produtos"], summary="Lista produtos")
@@ -5366,11 +6360,14 @@ async def get_produtos(
     sort: str = "-created_at",
     q: str = None,
     categoria_id: str = None,
+    after: str = None,
+    contagem: str = "exato",
     current_user: dict = Depends(require_permission("produtos", "ler"))
 ):
     """
     Lista produtos com paginação e busca.
     ETAPA 13: Resposta padronizada com api_list.
+    Paginação por cursor com 'after' (meta.next_cursor); contagem: exato, estimado ou nenhum.
     """
     # Validar paginação
     page, limit, skip = validate_pagination(page, limit)
@@ -5381,11 +6378,7 @@ async def get_produtos(
     if q:
         q_norm = normalize_search_query(q)
         if q_norm:
-            filtro["$or"] = [
-                {"nome": {"$regex": q_norm, "$options": "i"}},
-                {"sku": {"$regex": q_norm, "$options": "i"}},
-                {"codigo_barras": {"$regex": q_norm, "$options": "i"}}
-            ]
+            filtro.update(await filtro_busca("produtos", q_norm))
     
     if categoria_id:
         filtro["categoria_id"] = categoria_id
@@ -5395,13 +6388,43 @@ async def get_produtos(
     sort_dir = -1 if sort.startswith("-") else 1
     
     # Buscar dados
-    cursor = db.produtos.find(filtro, {"_id": 0})
-    cursor = cursor.sort(sort_field, sort_dir).skip(skip).limit(limit)
-    produtos = await cursor.to_list(limit)
+    produtos, total, meta = await paginar_colecao(
+        db.produtos, filtro, {"_id": 0}, sort_field=sort_field, sort_dir=sort_dir,
+        skip=skip, limit=limit, after=after, contagem=contagem
+    )
     
-    total = await db.produtos.count_documents(filtro)
+    return api_list(produtos, page=page, limit=limit, total=total, extra_meta=meta)
+
+async def validar_codigos_variacoes(variacoes: Optional[List[dict]], produto_id: str):
+    """
+    Unicidade de codigo_barras e sku_variante das variações (vazios e nulos ficam de fora):
+    dentro do próprio produto e contra os demais, em uma única consulta com $in.
+    """
+    barras = [v.get("codigo_barras") for v in variacoes or [] if v.get("codigo_barras")]
+    skus = [v.get("sku_variante") for v in variacoes or [] if v.get("sku_variante")]
+    for rotulo, codigos in (("Código de barras", barras), ("SKU", skus)):
+        repetidos = sorted({c for c in codigos if codigos.count(c) > 1})
+        if repetidos:
+            raise HTTPException(status_code=400, detail=f"{rotulo} repetido nas variações: {', '.join(repetidos)}")
+    if not barras and not skus:
+        return
     
-    return api_list(produtos, page=page, limit=limit, total=total)
+    outro = await db.produtos.find_one(
+        {
+            "id": {"$ne": produto_id},
+            "$or": [{"variacoes.codigo_barras": {"$in": barras}}, {"variacoes.sku_variante": {"$in": skus}}]
+        },
+        {"_id": 0, "nome": 1, "variacoes.codigo_barras": 1, "variacoes.sku_variante": 1}
+    )
+    if outro:
+        em_uso = sorted(
+            {v.get("codigo_barras") for v in outro.get("variacoes") or []} & set(barras)
+            | {v.get("sku_variante") for v in outro.get("variacoes") or []} & set(skus)
+        )
+        raise HTTPException(
+            status_code=400,
+            detail=f"Código {', '.join(em_uso)} já usado em variação do produto '{outro.get('nome')}'"
+        )
 
 @api_router.post("/produtos", response_model=Produto)
 async def create_produto(produto_data: ProdutoCreate, current_user: dict = Depends(require_permission("produtos", "criar"))):
@@ -5415,7 +6438,10 @@ async def create_produto(produto_data: ProdutoCreate, current_user: dict = Depen
         produto_dict["margem_lucro"] = ((produto_dict["preco_venda"] - produto_dict["preco_medio"]) / produto_dict["preco_medio"]) * 100
     
     produto = Produto(**produto_dict)
+    await validar_codigos_variacoes(produto_dict.get("variacoes"), produto.id)
+    produto.fotos = await normalizar_fotos_produto(produto.id, produto.fotos)
     await db.produtos.insert_one(produto.model_dump())
+    await sincronizar_busca("produtos", [produto.id])
     
     # Registrar histórico de preço inicial
     historico = HistoricoPreco(
@@ -5449,6 +6475,7 @@ async def update_produto(produto_id: str, produto_data: ProdutoCreate, current_u
         raise HTTPException(status_code=404, detail="Produto não encontrado")
     
     updated_data = produto_data.model_dump()
+    await validar_codigos_variacoes(updated_data.get("variacoes"), produto_id)
     updated_data["id"] = produto_id
     updated_data["estoque_atual"] = existing.get("estoque_atual", 0)
     updated_data["created_at"] = existing["created_at"]
@@ -5456,6 +6483,9 @@ async def update_produto(produto_id: str, produto_data: ProdutoCreate, current_u
     # Preservar campos calculados automaticamente (não devem ser editados pelo usuário)
     updated_data["preco_medio"] = existing.get("preco_medio", existing.get("preco_inicial", 0))
     updated_data["preco_ultima_compra"] = existing.get("preco_ultima_compra")
+    for campo in ("qtd_comprada_acumulada", "valor_comprado_acumulado", "data_ultima_compra", "ultima_compra_nota_id"):
+        if campo in existing:
+            updated_data[campo] = existing[campo]
     
     # Calcular margem usando preco_medio
     if updated_data.get("margem_lucro") is None and updated_data["preco_medio"] > 0:
@@ -5484,7 +6514,14 @@ async def update_produto(produto_id: str, produto_data: ProdutoCreate, current_u
         )
         await db.historico_precos.insert_one(historico.model_dump())
     
+    # Fotos novas chegam em base64; as que saíram da lista são removidas do bucket
+    updated_data["fotos"] = await normalizar_fotos_produto(produto_id, updated_data.get("fotos"))
+    removidas = set(existing.get("fotos") or []) - set(updated_data["fotos"] or [])
+    
     await db.produtos.replace_one({"id": produto_id}, updated_data)
+    await sincronizar_busca("produtos", [produto_id])
+    produto_codigo_cache.invalidar([produto_id])
+    await remover_imagens([f for f in removidas if foto_e_imagem_id(f)])
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5521,6 +6558,9 @@ async def migrar_precos_produtos(current_user: dict = Depends(get_current_user))
 async def deletar_todos_produtos(current_user: dict = Depends(get_current_user)):
     """ENDPOINT TEMPORÁRIO: Deleta todos os produtos"""
     result = await db.produtos.delete_many({})
+    await bucket_imagens().drop()
+    await db.busca_index.delete_many({"colecao": "produtos"})
+    produto_codigo_cache.clear()
     return {"message": f"Deletados {result.deleted_count} produtos"}
 
 
@@ -5557,6 +6597,9 @@ async def delete_produto(produto_id: str, current_user: dict = Depends(require_p
     
     # Excluir produto
     await db.produtos.delete_one({"id": produto_id})
+    await sincronizar_busca("produtos", [produto_id])
+    produto_codigo_cache.invalidar([produto_id])
+    await remover_imagens([f for f in produto.get("fotos") or [] if foto_e_imagem_id(f)])
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5567,15 +6610,231 @@ async def delete_produto(produto_id: str, current_user: dict = Depends(require_p
     )
     return {"message": "Produto excluído com sucesso"}
 
+# ==================== IMAGENS DE PRODUTOS (GRIDFS) ====================
+# As fotos ficam no bucket GridFS 'imagens'; produtos.fotos guarda apenas os ids.
+# Cada imagem tem dois arquivos: '<id>/original' e '<id>/miniatura' (WEBP gerado no
+# upload). Conteúdo de um id nunca muda, então o ETag é o sha256 e o cache é imutável.
+# A leitura (GET /imagens/...) é pública para poder ser usada direto em <img src>.
+
+import io
+from PIL import Image, ImageOps
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+
+IMAGEM_MAX_BYTES = int(os.environ.get('IMAGEM_MAX_BYTES', 10 * 1024 * 1024))
+MINIATURA_TAMANHO = int(os.environ.get('MINIATURA_TAMANHO', 320))
+IMAGEM_CHUNK_BYTES = 255 * 1024
+VARIANTES_IMAGEM = ("original", "miniatura")
+
+def bucket_imagens() -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db, bucket_name="imagens")
+
+def foto_e_imagem_id(foto: str) -> bool:
+    """Id de imagem do bucket (uuid); qualquer outro valor não é removido do GridFS"""
+    try:
+        uuid.UUID(foto)
+    except (ValueError, TypeError, AttributeError):
+        return False
+    return True
+
+# Data URL ou base64 começando pelo cabeçalho de JPEG, PNG, GIF ou WEBP (RIFF). O mesmo
+# critério em Python e no filtro do MongoDB (migração e verificação no startup)
+PREFIXOS_FOTO_BASE64 = ("data:", "/9j/", "iVBORw0KGgo", "R0lGOD", "UklGR")
+FILTRO_FOTOS_BASE64 = {"fotos": {"$regex": "^(" + "|".join(PREFIXOS_FOTO_BASE64) + ")"}}
+
+def foto_em_base64(foto: str) -> bool:
+    """Fotos legadas (data URL ou imagem em base64) a gravar no bucket; ids, URLs e outros textos ficam como estão"""
+    return not foto_e_imagem_id(foto) and foto.startswith(PREFIXOS_FOTO_BASE64)
+
+def processar_imagem(dados: bytes) -> tuple:
+    """Valida a imagem e gera a miniatura. Retorna (content_type, miniatura). Bloqueante: rodar em executor."""
+    try:
+        with Image.open(io.BytesIO(dados)) as img:
+            content_type = Image.MIME.get(img.format, "application/octet-stream")
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((MINIATURA_TAMANHO, MINIATURA_TAMANHO))
+            img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")
+            saida = io.BytesIO()
+            img.save(saida, format="WEBP", quality=80)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Arquivo de imagem inválido")
+    return content_type, saida.getvalue()
+
+async def salvar_imagem(conteudo_base64: str, produto_id: str = None) -> str:
+    """Decodifica a imagem (data URL ou base64), grava original + miniatura e retorna o id"""
+    if conteudo_base64.startswith("data:"):
+        conteudo_base64 = conteudo_base64.split(",", 1)[-1]
+    try:
+        dados = base64.b64decode(conteudo_base64, validate=True)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Imagem deve estar em base64")
+    if len(dados) > IMAGEM_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Imagem excede o limite de {IMAGEM_MAX_BYTES // (1024 * 1024)} MB")
+    
+    content_type, miniatura = await asyncio.get_running_loop().run_in_executor(None, processar_imagem, dados)
+    
+    imagem_id = str(uuid.uuid4())
+    bucket = bucket_imagens()
+    for variante, conteudo, tipo in (("original", dados, content_type), ("miniatura", miniatura, "image/webp")):
+        await bucket.upload_from_stream_with_id(
+            f"{imagem_id}/{variante}",
+            f"{imagem_id}/{variante}",
+            conteudo,
+            metadata={
+                "imagem_id": imagem_id,
+                "variante": variante,
+                "produto_id": produto_id,
+                "content_type": tipo,
+                "sha256": hashlib.sha256(conteudo).hexdigest()
+            }
+        )
+    return imagem_id
+
+async def remover_imagens(imagem_ids: List[str]):
+    """Remove original e miniatura das imagens (ids inexistentes são ignorados)"""
+    bucket = bucket_imagens()
+    for imagem_id in imagem_ids:
+        for variante in VARIANTES_IMAGEM:
+            try:
+                await bucket.delete(f"{imagem_id}/{variante}")
+            except NoFile:
+                pass
+
+async def remover_imagens_orfas() -> int:
+    """Remove do bucket as imagens que nenhum produto referencia mais"""
+    referenciadas = set(await db.produtos.distinct("fotos"))
+    existentes = set(await db["imagens.files"].distinct("metadata.imagem_id"))
+    orfas = list(existentes - referenciadas)
+    await remover_imagens(orfas)
+    return len(orfas)
+
+async def normalizar_fotos_produto(produto_id: str, fotos: Optional[List[str]]) -> Optional[List[str]]:
+    """Grava no bucket as fotos enviadas em base64 e devolve a lista só com ids"""
+    if not fotos:
+        return fotos
+    return [
+        await salvar_imagem(foto, produto_id) if foto_em_base64(foto) else foto
+        for foto in fotos
+    ]
+
+async def migrar_fotos_produtos() -> dict:
+    """Move para o bucket as fotos base64 ainda gravadas nos documentos de produto"""
+    filtro = FILTRO_FOTOS_BASE64
+    migrados = 0
+    imagens = 0
+    erros = []
+    async for produto in db.produtos.find(filtro, {"_id": 0, "id": 1, "fotos": 1}):
+        novas = []
+        try:
+            for foto in produto["fotos"]:
+                if foto_em_base64(foto):
+                    novas.append(await salvar_imagem(foto, produto["id"]))
+                    imagens += 1
+                else:
+                    novas.append(foto)
+        except HTTPException as e:
+            await remover_imagens([f for f in novas if f not in produto["fotos"]])
+            erros.append({"produto_id": produto["id"], "erro": e.detail})
+            continue
+        await db.produtos.update_one({"id": produto["id"]}, {"$set": {"fotos": novas}})
+        migrados += 1
+    return {"produtos_migrados": migrados, "imagens_migradas": imagens, "erros": erros[:20]}
+
+def _intervalo_range(range_header: Optional[str], tamanho: int) -> Optional[tuple]:
+    """Interpreta 'Range: bytes=ini-fim' (intervalo único). None = arquivo inteiro."""
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    inicio_txt, _, fim_txt = range_header[6:].strip().partition("-")
+    try:
+        if inicio_txt == "":
+            # Sufixo: últimos N bytes
+            inicio = max(0, tamanho - int(fim_txt))
+            fim = tamanho - 1
+        else:
+            inicio = int(inicio_txt)
+            fim = min(int(fim_txt), tamanho - 1) if fim_txt else tamanho - 1
+    except ValueError:
+        return None
+    if inicio >= tamanho or inicio > fim:
+        raise HTTPException(status_code=416, detail="Intervalo não satisfatório",
+                            headers={"Content-Range": f"bytes */{tamanho}"})
+    return inicio, fim
+
+async def responder_imagem(request: Request, imagem_id: str, variante: str):
+    try:
+        arquivo = await bucket_imagens().open_download_stream(f"{imagem_id}/{variante}")
+    except NoFile:
+        raise HTTPException(status_code=404, detail="Imagem não encontrada")
+    
+    metadata = arquivo.metadata or {}
+    etag = f'"{metadata.get("sha256", imagem_id)}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes"
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    tamanho = arquivo.length
+    intervalo = _intervalo_range(request.headers.get("range"), tamanho)
+    inicio, fim = intervalo if intervalo else (0, tamanho - 1)
+    headers["Content-Length"] = str(fim - inicio + 1)
+    if intervalo:
+        headers["Content-Range"] = f"bytes {inicio}-{fim}/{tamanho}"
+    
+    async def conteudo():
+        arquivo.seek(inicio)
+        restante = fim - inicio + 1
+        while restante > 0:
+            bloco = await arquivo.read(min(IMAGEM_CHUNK_BYTES, restante))
+            if not bloco:
+                break
+            restante -= len(bloco)
+            yield bloco
+    
+    return StreamingResponse(
+        conteudo(),
+        status_code=206 if intervalo else 200,
+        media_type=metadata.get("content_type", "application/octet-stream"),
+        headers=headers
+    )
+
+@api_router.get("/imagens/{imagem_id}")
+async def get_imagem(imagem_id: str, request: Request):
+    """Imagem original (suporta ETag/If-None-Match e Range)"""
+    return await responder_imagem(request, imagem_id, "original")
+
+@api_router.get("/imagens/{imagem_id}/miniatura")
+async def get_imagem_miniatura(imagem_id: str, request: Request):
+    """Miniatura WEBP da imagem (suporta ETag/If-None-Match e Range)"""
+    return await responder_imagem(request, imagem_id, "miniatura")
+
+@api_router.post("/produtos/migrar-imagens")
+async def migrar_imagens_produtos_endpoint(current_user: dict = Depends(require_permission("admin", "editar"))):
+    """Move fotos base64 legadas dos produtos para o bucket de imagens"""
+    resultado = await migrar_fotos_produtos()
+    
+    await log_action(
+        ip="0.0.0.0",
+        user_id=current_user["id"],
+        user_nome=current_user["nome"],
+        tela="produtos",
+        acao="migrar_imagens",
+        detalhes=resultado
+    )
+    
+    return resultado
+
 @api_router.post("/produtos/{produto_id}/upload-imagem")
 async def upload_imagem_produto(
     produto_id: str,
     imagem: dict,
     current_user: dict = Depends(require_permission("produtos", "editar"))
 ):
-    """Upload de imagem para produto (base64)"""
+    """Upload de imagem para produto (base64); o produto guarda apenas o id da imagem"""
     # Verificar se o produto existe
-    produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0})
+    produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0, "fotos": 1})
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
     
@@ -5584,13 +6843,15 @@ async def upload_imagem_produto(
     if not imagem_base64:
         raise HTTPException(status_code=400, detail="Imagem não fornecida")
     
+    imagem_id = await salvar_imagem(imagem_base64, produto_id)
+    
     # Verificar se já tem fotos, se não, criar lista
     fotos_atuais = produto.get("fotos", [])
     if fotos_atuais is None:
         fotos_atuais = []
     
     # Adicionar nova foto
-    fotos_atuais.append(imagem_base64)
+    fotos_atuais.append(imagem_id)
     
     # Atualizar produto
     await db.produtos.update_one(
@@ -5604,10 +6865,10 @@ async def upload_imagem_produto(
         user_nome=current_user["nome"],
         tela="produtos",
         acao="upload_imagem",
-        detalhes={"produto_id": produto_id, "total_fotos": len(fotos_atuais)}
+        detalhes={"produto_id": produto_id, "imagem_id": imagem_id, "total_fotos": len(fotos_atuais)}
     )
     
-    return {"message": "Imagem enviada com sucesso", "total_fotos": len(fotos_atuais)}
+    return {"message": "Imagem enviada com sucesso", "imagem_id": imagem_id, "total_fotos": len(fotos_atuais)}
 
 @api_router.delete("/produtos/{produto_id}/imagem/{indice}")
 async def deletar_imagem_produto(
@@ -5616,7 +6877,7 @@ async def deletar_imagem_produto(
     current_user: dict = Depends(require_permission("produtos", "editar"))
 ):
     """Remove uma imagem específica do produto"""
-    produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0})
+    produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0, "fotos": 1})
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
     
@@ -5625,12 +6886,14 @@ async def deletar_imagem_produto(
         raise HTTPException(status_code=404, detail="Imagem não encontrada")
     
     # Remover imagem
-    fotos.pop(indice)
+    imagem_id = fotos.pop(indice)
     
     await db.produtos.update_one(
         {"id": produto_id},
         {"$set": {"fotos": fotos}}
     )
+    if foto_e_imagem_id(imagem_id):
+        await remover_imagens([imagem_id])
     
     await log_action(
         ip="0.0.0.0",
@@ -5650,7 +6913,7 @@ async def reordenar_imagens_produto(
     current_user: dict = Depends(require_permission("produtos", "editar"))
 ):
     """Reordena as imagens do produto"""
-    produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0})
+    produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0, "fotos": 1})
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
     
@@ -5687,7 +6950,7 @@ async def definir_imagem_principal(
     current_user: dict = Depends(require_permission("produtos", "editar"))
 ):
     """Define qual imagem é a principal do produto"""
-    produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0})
+    produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0, "fotos": 1})
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
     
@@ -5738,6 +7001,7 @@ async def toggle_produto_status(produto_id: str, current_user: dict = Depends(re
         {"id": produto_id},
         {"$set": {"ativo": novo_status}}
     )
+    produto_codigo_cache.invalidar([produto_id])
     await log_action(
         ip="0.0.0.0",
         user_id=current_user["id"],
@@ -5946,12 +7210,8 @@ async def busca_avancada_produtos(
     """Busca avançada de produtos com múltiplos filtros"""
     filtros = {}
     
-    if termo:
-        filtros["$or"] = [
-            {"nome": {"$regex": termo, "$options": "i"}},
-            {"sku": {"$regex": termo, "$options": "i"}},
-            {"codigo_barras": {"$regex": termo, "$options": "i"}}
-        ]
+    if termo and normalize_search_query(termo):
+        filtros.update(await filtro_busca("produtos", normalize_search_query(termo)))
     
     if marca_id:
         filtros["marca_id"] = marca_id
@@ -5982,6 +7242,180 @@ async def busca_avancada_produtos(
     
     return produtos
 
+# ==================== MOTOR DE MOVIMENTAÇÃO DE ESTOQUE ====================
+# Entradas/saídas aplicadas com $inc atômico e filtro de guarda, em um único
+# bulk_write por operação (em vez de find_one -> calcular -> $set por item).
+# A guarda é avaliada pelo MongoDB no momento da escrita, então vendas
+# concorrentes do mesmo produto nunca perdem atualização nem passam do disponível.
+
+from pymongo import UpdateOne
+
+
+class EstoqueInsuficienteError(Exception):
+    """Guarda de estoque falhou para um ou mais produtos."""
+    def __init__(self, falhas: List[dict]):
+        self.falhas = falhas
+        descricao = ", ".join(f"'{f['nome']}' (disponível: {f['disponivel']})" for f in falhas)
+        super().__init__(f"Estoque insuficiente para {descricao}")
+
+
+def _guarda_estoque(validar: Optional[str], delta_atual: int, delta_reservado: int) -> dict:
+    """
+    Filtro de guarda para um $inc de estoque.
+    - "disponivel": estoque_atual - estoque_reservado >= 0 após a escrita
+    - "atual": estoque_atual >= 0 após a escrita
+    Só é aplicado quando a escrita reduz o estoque.
+    """
+    if validar == "disponivel" and delta_atual - delta_reservado < 0:
+        return {"$expr": {"$gte": [
+            {"$subtract": [
+                {"$add": [{"$ifNull": ["$estoque_atual", 0]}, delta_atual]},
+                {"$add": [{"$ifNull": ["$estoque_reservado", 0]}, delta_reservado]}
+            ]},
+            0
+        ]}}
+    if validar == "atual" and delta_atual < 0:
+        return {"estoque_atual": {"$gte": -delta_atual}}
+    return {}
+
+
+async def aplicar_movimentacoes_estoque(
+    itens: List[dict],
+    tipo: str,
+    referencia_tipo: str,
+    referencia_id: str,
+    user_id: str,
+    validar: Optional[str] = "disponivel",
+    reservas_liberadas: List[dict] = None,
+    tudo_ou_nada: bool = True,
+    registrar_movimentacao: bool = True,
+    motivo: str = None
+) -> dict:
+    """
+    Aplica movimentações de estoque com custo constante em round-trips.
+    
+    itens: [{"produto_id", "quantidade", "tipo"?}] - "tipo" no item sobrepõe o parâmetro
+    reservas_liberadas: itens cuja reserva (estoque_reservado) é liberada na mesma escrita
+    validar: "disponivel", "atual" ou None (sem guarda)
+    tudo_ou_nada: se alguma guarda falhar, desfaz os produtos já alterados e
+                  levanta EstoqueInsuficienteError
+    
+    Retorna {"aplicados": [produto_id], "falhas": [...], "movimentacoes": int}.
+    """
+    delta_atual = defaultdict(int)
+    delta_reservado = defaultdict(int)
+    for item in itens:
+        sinal = 1 if item.get("tipo", tipo) == "entrada" else -1
+        delta_atual[item["produto_id"]] += sinal * item["quantidade"]
+    for item in reservas_liberadas or []:
+        delta_reservado[item["produto_id"]] -= item["quantidade"]
+    
+    produto_ids = list(dict.fromkeys(list(delta_atual) + list(delta_reservado)))
+    if not produto_ids:
+        return {"aplicados": [], "falhas": [], "movimentacoes": 0}
+    
+    # Com mais de um produto, cada escrita marca o lote para sabermos quais
+    # foram aplicadas caso alguma guarda falhe
+    lote_id = uuid.uuid4().hex
+    marcador = f"lotes_estoque.{lote_id}"
+    usar_marcador = len(produto_ids) > 1
+    
+    operacoes = []
+    for produto_id in produto_ids:
+        filtro = {"id": produto_id, **_guarda_estoque(validar, delta_atual[produto_id], delta_reservado[produto_id])}
+        incrementos = {}
+        if delta_atual[produto_id]:
+            incrementos["estoque_atual"] = delta_atual[produto_id]
+        if delta_reservado[produto_id]:
+            incrementos["estoque_reservado"] = delta_reservado[produto_id]
+        update = {"$inc": incrementos} if incrementos else {}
+        if usar_marcador:
+            update["$set"] = {marcador: True}
+        if update:
+            operacoes.append(UpdateOne(filtro, update))
+    
+    if not operacoes:
+        return {"aplicados": produto_ids, "falhas": [], "movimentacoes": 0}
+    
+    resultado = await db.produtos.bulk_write(operacoes, ordered=False)
+    produto_codigo_cache.invalidar(produto_ids)
+    
+    if resultado.matched_count == len(operacoes):
+        aplicados = produto_ids
+    elif usar_marcador:
+        marcados = await db.produtos.find(
+            {"id": {"$in": produto_ids}, marcador: True},
+            {"_id": 0, "id": 1}
+        ).to_list(None)
+        aplicados_set = {p["id"] for p in marcados}
+        aplicados = [pid for pid in produto_ids if pid in aplicados_set]
+    else:
+        aplicados = []
+    
+    falhas = []
+    falhas_ids = [pid for pid in produto_ids if pid not in set(aplicados)]
+    if falhas_ids:
+        estado = await db.produtos.find(
+            {"id": {"$in": falhas_ids}},
+            {"_id": 0, "id": 1, "nome": 1, "estoque_atual": 1, "estoque_reservado": 1}
+        ).to_list(None)
+        estado_por_id = {p["id"]: p for p in estado}
+        for produto_id in falhas_ids:
+            produto = estado_por_id.get(produto_id)
+            falhas.append({
+                "produto_id": produto_id,
+                "nome": produto.get("nome", produto_id) if produto else produto_id,
+                "encontrado": produto is not None,
+                "disponivel": calcular_estoque_disponivel(produto) if produto else 0,
+                "solicitado": -delta_atual[produto_id]
+            })
+    
+    if falhas and tudo_ou_nada:
+        # Desfazer o que já foi aplicado (mesmos deltas com sinal invertido)
+        if aplicados:
+            reversoes = []
+            for produto_id in aplicados:
+                incrementos = {}
+                if delta_atual[produto_id]:
+                    incrementos["estoque_atual"] = -delta_atual[produto_id]
+                if delta_reservado[produto_id]:
+                    incrementos["estoque_reservado"] = -delta_reservado[produto_id]
+                update = {"$unset": {marcador: ""}}
+                if incrementos:
+                    update["$inc"] = incrementos
+                reversoes.append(UpdateOne({"id": produto_id}, update))
+            await db.produtos.bulk_write(reversoes, ordered=False)
+            produto_codigo_cache.invalidar(aplicados)
+        raise EstoqueInsuficienteError([f for f in falhas if f["encontrado"]] or falhas)
+    
+    if usar_marcador and aplicados:
+        await db.produtos.update_many(
+            {"id": {"$in": aplicados}},
+            {"$unset": {marcador: ""}}
+        )
+    
+    # Movimentações dos produtos efetivamente alterados, em um único insert_many
+    movimentacoes = []
+    if registrar_movimentacao:
+        aplicados_set = set(aplicados)
+        for item in itens:
+            if item["produto_id"] not in aplicados_set:
+                continue
+            movimentacoes.append(MovimentacaoEstoque(
+                produto_id=item["produto_id"],
+                tipo=item.get("tipo", tipo),
+                quantidade=item["quantidade"],
+                referencia_tipo=referencia_tipo,
+                referencia_id=referencia_id,
+                user_id=user_id,
+                motivo=motivo
+            ).model_dump())
+        if movimentacoes:
+            await db.movimentacoes_estoque.insert_many(movimentacoes, ordered=False)
+    
+    return {"aplicados": aplicados, "falhas": falhas, "movimentacoes": len(movimentacoes)}
+
+
 # ========== ESTOQUE ==========
 
 @api_router.get("/estoque/alertas")
@@ -6005,29 +7439,52 @@ async def get_alertas_estoque(
 
 @api_router.get("/estoque/movimentacoes")
 async def get_movimentacoes(
+    response: Response,
     page: int = 1,
     limit: int = 0,
+    after: str = None,
     current_user: dict = Depends(get_current_user)
 ):
-    """Lista movimentações de estoque com paginação opcional"""
+    """
+    Lista movimentações de estoque com paginação opcional.
+    Com limit > 0, o cursor da próxima página vem no header X-Next-Cursor (usar em 'after').
+    """
+    pipeline = []
+    if after:
+        valor, ultimo_id = decodificar_cursor(after, 2)
+        pipeline.append({"$match": filtro_apos_cursor("timestamp", -1, valor, ultimo_id)})
+    pipeline.append({"$sort": {"timestamp": -1, "id": -1}})
     # Se limit=0, retorna todos (mantém compatibilidade)
     if limit == 0:
-        movimentacoes = await db.movimentacoes_estoque.find({}, {"_id": 0}).sort("timestamp", -1).to_list(10000)
+        pipeline.append({"$limit": 10000})
     else:
-        skip = (page - 1) * limit
-        movimentacoes = await db.movimentacoes_estoque.find({}, {"_id": 0}).sort("timestamp", -1).skip(skip).limit(limit).to_list(limit)
-    
-    # Enriquecer movimentações com nome do usuário
-    for mov in movimentacoes:
-        if mov.get("user_id"):
-            usuario = await db.users.find_one({"id": mov["user_id"]}, {"_id": 0, "nome": 1})
-            if usuario:
-                mov["user_nome"] = usuario.get("nome", "Usuário não encontrado")
-            else:
-                mov["user_nome"] = "Usuário não encontrado"
-        else:
-            mov["user_nome"] = "Sistema"
+        if not after:
+            pipeline.append({"$skip": (page - 1) * limit})
+        pipeline.append({"$limit": limit + 1})
+    
+    # Nome do usuário no mesmo pipeline (em vez de um find_one por movimentação)
+    pipeline += [
+        {"$lookup": {
+            "from": "users",
+            "localField": "user_id",
+            "foreignField": "id",
+            "pipeline": [{"$project": {"_id": 0, "nome": 1}}],
+            "as": "_usuario"
+        }},
+        {"$set": {"user_nome": {"$cond": [
+            {"$ifNull": ["$user_id", False]},
+            {"$ifNull": [{"$first": "$_usuario.nome"}, "Usuário não encontrado"]},
+            "Sistema"
+        ]}}},
+        {"$project": {"_id": 0, "_usuario": 0}}
+    ]
     
+    movimentacoes = await db.movimentacoes_estoque.aggregate(pipeline).to_list(None)
+    if limit and len(movimentacoes) > limit:
+        movimentacoes = movimentacoes[:limit]
+        if response is not None:
+            ultima = movimentacoes[-1]
+            response.headers["X-Next-Cursor"] = codificar_cursor([ultima.get("timestamp"), ultima.get("id")])
     return movimentacoes
 
 @api_router.post("/estoque/check-disponibilidade", response_model=CheckEstoqueResponse)
@@ -6098,6 +7555,7 @@ async def ajuste_manual_estoque(request: AjusteEstoqueRequest, current_user: dic
         {"id": request.produto_id},
         {"$set": {"estoque_atual": novo_estoque}}
     )
+    produto_codigo_cache.invalidar([request.produto_id])
     
     # Registrar movimentação
     movimentacao_dict = {
@@ -6331,35 +7789,33 @@ async def finalizar_inventario(
     ajustes_aplicados = []
     
     if aplicar_ajustes:
-        # Aplicar ajustes de estoque
-        for item in inventario["itens"]:
-            if item.get("diferenca", 0) != 0:
-                # Atualizar estoque do produto
-                await db.produtos.update_one(
-                    {"id": item["produto_id"]},
-                    {"$set": {"estoque_atual": item["estoque_contado"]}}
-                )
-                
-                # Registrar movimentação
-                tipo_mov = "entrada" if item["diferenca"] > 0 else "saida"
-                movimentacao = {
-                    "id": str(uuid.uuid4()),
+        # Aplicar ajustes de estoque: $inc pela diferença contada, preservando
+        # movimentações ocorridas durante a contagem (mesmo delta registrado no livro)
+        itens_divergentes = [item for item in inventario["itens"] if item.get("diferenca", 0) != 0]
+        await aplicar_movimentacoes_estoque(
+            [
+                {
                     "produto_id": item["produto_id"],
-                    "tipo": tipo_mov,
                     "quantidade": abs(item["diferenca"]),
-                    "referencia_tipo": "inventario",
-                    "referencia_id": inventario_id,
-                    "user_id": current_user["id"],
-                    "motivo": f"Ajuste de inventário {inventario['numero']}",
-                    "timestamp": datetime.now(timezone.utc).isoformat()
+                    "tipo": "entrada" if item["diferenca"] > 0 else "saida"
                 }
-                await db.movimentacoes_estoque.insert_one(movimentacao)
-                
-                ajustes_aplicados.append({
-                    "produto": item["produto_nome"],
-                    "sku": item["produto_sku"],
-                    "diferenca": item["diferenca"]
-                })
+                for item in itens_divergentes
+            ],
+            tipo="entrada",
+            referencia_tipo="inventario",
+            referencia_id=inventario_id,
+            user_id=current_user["id"],
+            validar=None,
+            tudo_ou_nada=False,
+            motivo=f"Ajuste de inventário {inventario['numero']}"
+        )
+        
+        for item in itens_divergentes:
+            ajustes_aplicados.append({
+                "produto": item["produto_nome"],
+                "sku": item["produto_sku"],
+                "diferenca": item["diferenca"]
+            })
     
     # Atualizar status do inventário
     await db.inventarios.update_one(
@@ -6736,29 +8192,19 @@ async def confirmar_nota_fiscal(nota_id: str, current_user: dict = Depends(get_c
     if nota.get("confirmado", False) or nota["status"] == "confirmada":
         raise HTTPException(status_code=400, detail="Nota fiscal já confirmada")
     
-    # Atualizar estoque e recalcular preços
-    for item in nota["itens"]:
-        produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
-        if produto:
-            novo_estoque = produto["estoque_atual"] + item["quantidade"]
-            await db.produtos.update_one(
-                {"id": item["produto_id"]},
-                {"$set": {"estoque_atual": novo_estoque}}
-            )
-            
-            # Registrar movimentação
-            movimentacao = MovimentacaoEstoque(
-                produto_id=item["produto_id"],
-                tipo="entrada",
-                quantidade=item["quantidade"],
-                referencia_tipo="nota_fiscal",
-                referencia_id=nota_id,
-                user_id=current_user["id"]
-            )
-            await db.movimentacoes_estoque.insert_one(movimentacao.model_dump())
-            
-            # Recalcular preço médio e preço última compra
-            await recalcular_precos_produto(item["produto_id"])
+    # Atualizar estoque (entrada atômica em lote) e recalcular preços
+    resultado_estoque = await aplicar_movimentacoes_estoque(
+        nota["itens"],
+        tipo="entrada",
+        referencia_tipo="nota_fiscal",
+        referencia_id=nota_id,
+        user_id=current_user["id"],
+        validar=None,
+        tudo_ou_nada=False
+    )
+    
+    # Preço médio e última compra: acumulados incrementados em um bulk_write
+    await aplicar_custos_compra(nota, resultado_estoque["aplicados"])
     
     # Adicionar ao histórico
     historico_entry = {
@@ -6871,6 +8317,8 @@ async def confirmar_nota_fiscal(nota_id: str, current_user: dict = Depends(get_c
         }
         
         await db.contas_pagar.insert_one(conta_pagar)
+        await sincronizar_parcelas_index("pagar", [conta_pagar["id"]])
+        await sincronizar_busca("contas_pagar", [conta_pagar["id"]])
         
         # Atualizar nota fiscal com ID da conta a pagar
         await db.notas_fiscais.update_one(
@@ -6933,6 +8381,7 @@ async def cancelar_nota_fiscal(
                     {"id": item["produto_id"]},
                     {"$set": {"estoque_atual": novo_estoque}}
                 )
+                produto_codigo_cache.invalidar([item["produto_id"]])
                 
                 # Registrar movimentação de cancelamento
                 movimentacao = MovimentacaoEstoque(
@@ -6944,9 +8393,6 @@ async def cancelar_nota_fiscal(
                     user_id=current_user["id"]
                 )
                 await db.movimentacoes_estoque.insert_one(movimentacao.model_dump())
-                
-                # Recalcular preço médio e preço última compra (exclui a nota cancelada)
-                await recalcular_precos_produto(item["produto_id"])
     
     # Adicionar ao histórico
     historico_entry = {
@@ -6973,6 +8419,10 @@ async def cancelar_nota_fiscal(
         }}
     )
     
+    # Retirar a nota dos acumulados de custo (a última compra é refeita sem ela)
+    if nota.get("confirmado", False) or nota["status"] == "confirmada":
+        await estornar_custos_compra(nota)
+    
     # FASE 12: Cancelar contas a pagar vinculadas à nota fiscal
     contas_vinculadas = await db.contas_pagar.find({
         "origem": "nota_fiscal",
@@ -6999,6 +8449,7 @@ async def cancelar_nota_fiscal(
                     "updated_at": datetime.now(timezone.utc).isoformat()
                 }}
             )
+        await sincronizar_parcelas_index("pagar", [conta["id"] for conta in contas_vinculadas])
     
     # Log
     await log_action(
@@ -7081,6 +8532,7 @@ async def delete_nota_fiscal(nota_id: str, current_user: dict = Depends(get_curr
                     {"id": item["produto_id"]},
                     {"$set": {"estoque_atual": novo_estoque}}
                 )
+                produto_codigo_cache.invalidar([item["produto_id"]])
                 
                 # Registrar movimentação de estorno
                 movimentacao = MovimentacaoEstoque(
@@ -7234,11 +8686,11 @@ async def create_orcamento(orcamento_data: OrcamentoCreate, current_user: dict =
         raise HTTPException(status_code=404, detail="Cliente não encontrado")
     
     # Validar estoque antes de criar o orçamento
-    orcamentos_abertos = await db.orcamentos.find({"status": {"$in": ["aberto", "aprovado"]}}, {"_id": 0}).to_list(1000)
+    produtos_por_id = await carregar_produtos_por_id([item["produto_id"] for item in orcamento_data.itens])
     
     produtos_db = []
     for item in orcamento_data.itens:
-        produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
+        produto = produtos_por_id.get(item["produto_id"])
         if not produto:
             raise HTTPException(status_code=404, detail=f"Produto {item['produto_id']} não encontrado")
         
@@ -7247,16 +8699,8 @@ async def create_orcamento(orcamento_data: OrcamentoCreate, current_user: dict =
         
         produtos_db.append(produto)
         
-        estoque_atual = produto.get("estoque_atual", 0)
-        
-        # Calcular estoque reservado
-        estoque_reservado = 0
-        for orc in orcamentos_abertos:
-            for orc_item in orc.get("itens", []):
-                if orc_item.get("produto_id") == item["produto_id"]:
-                    estoque_reservado += orc_item.get("quantidade", 0)
-        
-        estoque_disponivel = estoque_atual - estoque_reservado
+        # MELHORIA 1: reservas de orçamentos abertos já mantidas em estoque_reservado
+        estoque_disponivel = calcular_estoque_disponivel(produto)
         
         if item["quantidade"] > estoque_disponivel:
             raise HTTPException(
@@ -7353,12 +8797,21 @@ async def update_orcamento(
         raise HTTPException(status_code=400, detail="Nenhum campo para atualizar")
     
     # Se alterou itens, recalcular tudo
+    delta_reserva = {}
     if "itens" in update_data:
-        produtos_db = []
-        for item in update_data["itens"]:
-            produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
-            if produto:
-                produtos_db.append(produto)
+        produtos_por_id = await carregar_produtos_por_id([item["produto_id"] for item in update_data["itens"]])
+        produtos_db = [produtos_por_id[item["produto_id"]] for item in update_data["itens"] if item["produto_id"] in produtos_por_id]
+        
+        # MELHORIA 1: orçamento aberto já reserva seus itens; só a diferença entra/sai da reserva
+        if orcamento["status"] == "aberto":
+            delta_reserva = diferenca_reserva(orcamento.get("itens", []), update_data["itens"])
+            for produto_id, quantidade in delta_reserva.items():
+                produto = produtos_por_id.get(produto_id)
+                if quantidade > 0 and produto and quantidade > calcular_estoque_disponivel(produto):
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Estoque insuficiente para '{produto['nome']}'. Disponível: {calcular_estoque_disponivel(produto)}"
+                    )
         
         subtotal = sum(item["quantidade"] * item["preco_unitario"] for item in update_data["itens"])
         desconto = update_data.get("desconto", orcamento.get("desconto", 0))
@@ -7401,6 +8854,7 @@ async def update_orcamento(
         {"id": orcamento_id},
         {"$set": update_data}
     )
+    await ajustar_reserva_orcamento(orcamento_id, delta_reserva)
     
     return {"message": "Orçamento atualizado com sucesso", "alteracoes": alteracoes}
 
@@ -7460,18 +8914,8 @@ async def aprovar_orcamento(orcamento_id: str, current_user: dict = Depends(get_
         orcamento["historico_alteracoes"] = []
     orcamento["historico_alteracoes"].append(historico_entry)
     
-    # Reservar estoque ao aprovar
-    for item in orcamento["itens"]:
-        produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
-        if produto:
-            novo_estoque = produto["estoque_atual"] - item["quantidade"]
-            await db.produtos.update_one(
-                {"id": item["produto_id"]},
-                {"$set": {"estoque_atual": novo_estoque}}
-            )
-    
-    await db.orcamentos.update_one(
-        {"id": orcamento_id},
+    resultado = await db.orcamentos.update_one(
+        {"id": orcamento_id, "status": "em_analise"},
         {"$set": {
             "status": "aberto",
             "aprovado": True,
@@ -7482,6 +8926,10 @@ async def aprovar_orcamento(orcamento_id: str, current_user: dict = Depends(get_
         }}
     )
     
+    # MELHORIA 1: ao passar para "aberto" o orçamento reserva seus itens (estoque_atual só baixa na venda)
+    if resultado.modified_count:
+        await reservar_estoque_orcamento(orcamento_id, orcamento["itens"])
+    
     return {"message": "Orçamento aprovado com sucesso"}
 
 @api_router.post("/orcamentos/{orcamento_id}/converter-venda")
@@ -7514,30 +8962,24 @@ async def converter_orcamento_venda(
         raise HTTPException(status_code=400, detail="Orçamento expirado. Não pode ser convertido.")
     
     # REVALIDAR ESTOQUE (pode ter vendido para outro)
-    orcamentos_abertos = await db.orcamentos.find(
-        {"status": {"$in": ["aberto", "aprovado"]}, "id": {"$ne": orcamento_id}},
-        {"_id": 0}
-    ).to_list(1000)
+    produtos_por_id = await carregar_produtos_por_id([item["produto_id"] for item in orcamento["itens"]])
+    
+    # Reserva deste próprio orçamento (MELHORIA 1: só aberto/aprovado reservam)
+    reserva_propria = defaultdict(int)
+    if orcamento["status"] in ["aberto", "aprovado"]:
+        for item in orcamento["itens"]:
+            reserva_propria[item["produto_id"]] += item["quantidade"]
     
     for item in orcamento["itens"]:
-        produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
+        produto = produtos_por_id.get(item["produto_id"])
         if not produto:
             raise HTTPException(status_code=404, detail=f"Produto {item['produto_id']} não encontrado")
         
-        estoque_atual = produto.get("estoque_atual", 0)
-        
-        # Calcular estoque reservado (SEM contar este orçamento)
-        estoque_reservado = 0
-        for orc in orcamentos_abertos:
-            for orc_item in orc.get("itens", []):
-                if orc_item.get("produto_id") == item["produto_id"]:
-                    estoque_reservado += orc_item.get("quantidade", 0)
-        
-        # Este orçamento já tem estoque reservado, então precisa ter pelo menos a quantidade dele
+        # Disponível para este orçamento = atual - reservas dos OUTROS orçamentos
         estoque_necessario = item["quantidade"]
-        estoque_disponivel_total = estoque_atual + estoque_necessario  # Somar o que já está reservado por este
+        estoque_disponivel_total = calcular_estoque_disponivel(produto) + reserva_propria[item["produto_id"]]
         
-        if estoque_disponivel_total - estoque_reservado < estoque_necessario:
+        if estoque_disponivel_total < estoque_necessario:
             raise HTTPException(
                 status_code=400,
                 detail=f"Estoque insuficiente para '{produto['nome']}'. Estoque foi vendido para outro cliente."
@@ -7546,36 +8988,18 @@ async def converter_orcamento_venda(
     # Usar novos itens se fornecidos, senão usar do orçamento
     itens_final = conversao.itens if conversao.itens is not None else orcamento["itens"]
     
-    # Se itens foram editados, reverter estoque dos itens originais e validar novos
+    # Se itens foram editados, validar que os novos produtos existem
+    # (a disponibilidade é garantida pela guarda atômica na baixa abaixo)
     if conversao.itens is not None:
-        # Reverter estoque dos itens originais do orçamento
-        for item in orcamento["itens"]:
-            produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
-            if produto:
-                novo_estoque = produto["estoque_atual"] + item["quantidade"]
-                await db.produtos.update_one(
-                    {"id": item["produto_id"]},
-                    {"$set": {"estoque_atual": novo_estoque}}
-                )
-        
-        # Validar e reservar estoque dos novos itens
-        for item in itens_final:
-            produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
-            if not produto:
-                raise HTTPException(status_code=404, detail=f"Produto {item['produto_id']} não encontrado")
-            
-            if produto["estoque_atual"] < item["quantidade"]:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Estoque insuficiente para '{produto['nome']}'. Disponível: {produto['estoque_atual']}"
-                )
-            
-            # Reservar estoque
-            novo_estoque = produto["estoque_atual"] - item["quantidade"]
-            await db.produtos.update_one(
-                {"id": item["produto_id"]},
-                {"$set": {"estoque_atual": novo_estoque}}
-            )
+        novos_ids = list({item["produto_id"] for item in itens_final})
+        existentes = await db.produtos.find(
+            {"id": {"$in": novos_ids}},
+            {"_id": 0, "id": 1}
+        ).to_list(None)
+        existentes_ids = {p["id"] for p in existentes}
+        for produto_id in novos_ids:
+            if produto_id not in existentes_ids:
+                raise HTTPException(status_code=404, detail=f"Produto {produto_id} não encontrado")
     
     # Usar novo desconto/frete se fornecido, senão usar do orçamento
     desconto_final = conversao.desconto if conversao.desconto is not None else orcamento["desconto"]
@@ -7626,7 +9050,27 @@ async def converter_orcamento_venda(
         }]
     )
     
+    # MELHORIA 1: Liberar reserva e baixar estoque real ao converter
+    # Em uma única escrita atômica por produto: libera a reserva dos itens originais
+    # (só aberto/aprovado reservam; em_analise não) e baixa os itens finais,
+    # exigindo que o disponível não fique negativo
+    try:
+        await aplicar_movimentacoes_estoque(
+            venda.itens,
+            tipo="saida",
+            referencia_tipo="venda",
+            referencia_id=venda.id,
+            user_id=current_user["id"],
+            validar="disponivel",
+            reservas_liberadas=orcamento["itens"] if orcamento["status"] in ["aberto", "aprovado"] else None,
+            tudo_ou_nada=True
+        )
+    except EstoqueInsuficienteError as e:
+        raise HTTPException(status_code=400, detail=f"{e}. Estoque foi vendido para outro cliente.")
+    
     await db.vendas.insert_one(venda.model_dump())
+    await atualizar_rollup_vendas(None, venda.model_dump())
+    await sincronizar_busca("vendas", [venda.id])
     
     # CRIAR CONTAS A RECEBER (igual à criação de venda normal)
     if numero_parcelas > 1:
@@ -7674,33 +9118,13 @@ async def converter_orcamento_venda(
                 )
                 
                 await db.contas_receber.insert_one(conta_receber.model_dump())
+                await sincronizar_parcelas_index("receber", [conta_receber.id])
+                await sincronizar_busca("contas_receber", [conta_receber.id])
                 
         except Exception as e:
             # Não falhar a venda se houver erro ao criar conta a receber
             print(f"Aviso: Erro ao criar conta a receber para venda {venda.id}: {str(e)}")
     
-    # MELHORIA 1: Liberar reserva e baixar estoque real ao converter
-    # O estoque estava reservado, agora baixamos do estoque_atual e liberamos a reserva
-    await liberar_estoque_orcamento(orcamento_id, orcamento["itens"])
-    
-    # Registrar movimentações e baixar estoque real
-    for item in venda.itens:
-        # Baixar estoque real
-        await db.produtos.update_one(
-            {"id": item["produto_id"]},
-            {"$inc": {"estoque_atual": -item["quantidade"]}}
-        )
-        
-        movimentacao = MovimentacaoEstoque(
-            produto_id=item["produto_id"],
-            tipo="saida",
-            quantidade=item["quantidade"],
-            referencia_tipo="venda",
-            referencia_id=venda.id,
-            user_id=current_user["id"]
-        )
-        await db.movimentacoes_estoque.insert_one(movimentacao.model_dump())
-    
     # Adicionar ao histórico do orçamento
     historico_entry = {
         "data": datetime.now(timezone.utc).isoformat(),
@@ -7832,16 +9256,9 @@ async def marcar_orcamento_perdido(
             detail=f"Não é possível marcar como perdido orçamento com status '{orcamento['status']}'"
         )
     
-    # Devolver estoque se estava reservado
+    # MELHORIA 1: Liberar reserva de estoque se estava reservado (estoque real não foi baixado)
     if orcamento["status"] in ["aberto", "aprovado"]:
-        for item in orcamento["itens"]:
-            produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
-            if produto:
-                novo_estoque = produto["estoque_atual"] + item["quantidade"]
-                await db.produtos.update_one(
-                    {"id": item["produto_id"]},
-                    {"$set": {"estoque_atual": novo_estoque}}
-                )
+        await liberar_estoque_orcamento(orcamento_id, orcamento["itens"])
     
     # Adicionar ao histórico
     historico_entry = {
@@ -7879,28 +9296,29 @@ async def verificar_orcamentos_expirados(current_user: dict = Depends(get_curren
     #     if current_user["papel"] != "admin":
     #         raise HTTPException(status_code=403, detail="Apenas administradores podem executar esta ação")
     
+    return await expirar_orcamentos(current_user["id"])
+
+async def expirar_orcamentos(user_id: str) -> dict:
+    """Marca como expirados os orçamentos vencidos e libera o estoque reservado"""
     # Buscar orçamentos abertos ou aprovados
     orcamentos = await db.orcamentos.find(
         {"status": {"$in": ["aberto", "aprovado", "em_analise"]}},
         {"_id": 0}
     ).to_list(5000)
     
-    expirados = 0
     agora = datetime.now(timezone.utc)
     
+    itens_por_orcamento = {}
+    operacoes_orcamentos = []
+    
     for orcamento in orcamentos:
         data_validade = datetime.fromisoformat(orcamento["data_validade"])
         
         if data_validade < agora:
-            # Devolver estoque
-            for item in orcamento["itens"]:
-                produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
-                if produto:
-                    novo_estoque = produto["estoque_atual"] + item["quantidade"]
-                    await db.produtos.update_one(
-                        {"id": item["produto_id"]},
-                        {"$set": {"estoque_atual": novo_estoque}}
-                    )
+            # Liberar reserva (aplicado em lote abaixo); em_analise não reservou
+            itens_por_orcamento[orcamento["id"]] = (
+                orcamento["itens"] if orcamento["status"] in ["aberto", "aprovado"] else []
+            )
             
             # Marcar como expirado
             historico_entry = {
@@ -7910,24 +9328,46 @@ async def verificar_orcamentos_expirados(current_user: dict = Depends(get_curren
                 "detalhes": "Orçamento expirado automaticamente"
             }
             
-            if "historico_alteracoes" not in orcamento:
-                orcamento["historico_alteracoes"] = []
-            orcamento["historico_alteracoes"].append(historico_entry)
-            
-            await db.orcamentos.update_one(
-                {"id": orcamento["id"]},
-                {"$set": {
-                    "status": "expirado",
-                    "historico_alteracoes": orcamento["historico_alteracoes"],
-                    "updated_at": agora.isoformat()
-                }}
-            )
-            
-            expirados += 1
+            operacoes_orcamentos.append(UpdateOne(
+                {"id": orcamento["id"], "status": orcamento["status"]},
+                {
+                    "$set": {"status": "expirado", "updated_at": agora.isoformat()},
+                    "$push": {"historico_alteracoes": historico_entry}
+                }
+            ))
     
-    return {
-        "message": f"Verificação concluída. {expirados} orçamentos expirados.",
-        "expirados": expirados,
+    expirados = 0
+    if operacoes_orcamentos:
+        resultado = await db.orcamentos.bulk_write(operacoes_orcamentos, ordered=False)
+        expirados = resultado.modified_count
+        
+        # A guarda de status evita liberar a reserva de orçamento convertido/alterado
+        # durante a varredura: só libera o que foi de fato expirado aqui
+        expirados_ids = list(itens_por_orcamento)
+        if expirados < len(operacoes_orcamentos):
+            marcados = await db.orcamentos.find(
+                {"id": {"$in": expirados_ids}, "status": "expirado", "updated_at": agora.isoformat()},
+                {"_id": 0, "id": 1}
+            ).to_list(None)
+            expirados_ids = [o["id"] for o in marcados]
+        
+        itens_liberados = [item for orcamento_id in expirados_ids for item in itens_por_orcamento[orcamento_id]]
+        if itens_liberados:
+            await aplicar_movimentacoes_estoque(
+                [],
+                tipo="entrada",
+                referencia_tipo="orcamento_expirado",
+                referencia_id="verificar-expirados",
+                user_id=user_id,
+                validar=None,
+                reservas_liberadas=itens_liberados,
+                tudo_ou_nada=False,
+                registrar_movimentacao=False
+            )
+    
+    return {
+        "message": f"Verificação concluída. {expirados} orçamentos expirados.",
+        "expirados": expirados,
         "total_verificados": len(orcamentos)
     }
 
@@ -8060,11 +9500,14 @@ async def get_vendas(
     q: str = None,
     data_inicio: str = None,
     data_fim: str = None,
+    after: str = None,
+    contagem: str = "exato",
     current_user: dict = Depends(require_permission("vendas", "ler"))
 ):
     """
     Lista vendas com filtros e paginação.
     ETAPA 13: Resposta padronizada com api_list, projeção enxuta (sem itens completos).
+    Paginação por cursor com 'after' (meta.next_cursor); contagem: exato, estimado ou nenhum.
     """
     # Validar paginação
     page, limit, skip = validate_pagination(page, limit)
@@ -8082,10 +9525,7 @@ async def get_vendas(
     if q:
         q_norm = normalize_search_query(q)
         if q_norm:
-            filtro["$or"] = [
-                {"numero_venda": {"$regex": q_norm, "$options": "i"}},
-                {"cliente_nome": {"$regex": q_norm, "$options": "i"}}
-            ]
+            filtro.update(await filtro_busca("vendas", q_norm))
     
     # Filtro por período
     if data_inicio and data_fim:
@@ -8099,7 +9539,9 @@ async def get_vendas(
         "cliente_id": 1, "cliente_nome": 1,
         "total": 1, "desconto": 1, "valor_final": 1,
         "forma_pagamento": 1, "status_financeiro": 1,
-        "created_at": 1, "updated_at": 1
+        "created_at": 1, "updated_at": 1,
+        # Contagem de itens calculada no servidor
+        "itens_count": {"$size": {"$ifNull": ["$itens", []]}}
     }
     
     # Ordenação
@@ -8107,18 +9549,12 @@ async def get_vendas(
     sort_dir = -1 if sort.startswith("-") else 1
     
     # Buscar dados
-    cursor = db.vendas.find(filtro, projection)
-    cursor = cursor.sort(sort_field, sort_dir).skip(skip).limit(limit)
-    vendas = await cursor.to_list(limit)
-    
-    # Adicionar contagem de itens
-    for venda in vendas:
-        venda_full = await db.vendas.find_one({"id": venda["id"]}, {"itens": 1})
-        venda["itens_count"] = len(venda_full.get("itens", [])) if venda_full else 0
-    
-    total = await db.vendas.count_documents(filtro)
+    vendas, total, meta = await paginar_colecao(
+        db.vendas, filtro, projection, sort_field=sort_field, sort_dir=sort_dir,
+        skip=skip, limit=limit, after=after, contagem=contagem
+    )
     
-    return api_list(vendas, page=page, limit=limit, total=total)
+    return api_list(vendas, page=page, limit=limit, total=total, extra_meta=meta)
 
 @api_router.post("/vendas", response_model=Venda)
 async def create_venda(venda_data: VendaCreate, current_user: dict = Depends(require_permission("vendas", "criar"))):
@@ -8131,14 +9567,11 @@ async def create_venda(venda_data: VendaCreate, current_user: dict = Depends(req
         raise HTTPException(status_code=404, detail="Cliente não encontrado")
     
     # Validar estoque antes de criar a venda
-    orcamentos_abertos = await db.orcamentos.find(
-        {"status": {"$in": ["aberto", "aprovado"]}}, 
-        {"_id": 0}
-    ).to_list(1000)
+    produtos_por_id = await carregar_produtos_por_id([item["produto_id"] for item in venda_data.itens])
     
     produtos_db = []
     for item in venda_data.itens:
-        produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
+        produto = produtos_por_id.get(item["produto_id"])
         if not produto:
             raise HTTPException(status_code=404, detail=f"Produto {item['produto_id']} não encontrado")
         
@@ -8147,16 +9580,8 @@ async def create_venda(venda_data: VendaCreate, current_user: dict = Depends(req
         
         produtos_db.append(produto)
         
-        estoque_atual = produto.get("estoque_atual", 0)
-        
-        # Calcular estoque reservado
-        estoque_reservado = 0
-        for orc in orcamentos_abertos:
-            for orc_item in orc.get("itens", []):
-                if orc_item.get("produto_id") == item["produto_id"]:
-                    estoque_reservado += orc_item.get("quantidade", 0)
-        
-        estoque_disponivel = estoque_atual - estoque_reservado
+        # MELHORIA 1: reservas de orçamentos abertos já mantidas em estoque_reservado
+        estoque_disponivel = calcular_estoque_disponivel(produto)
         
         if item["quantidade"] > estoque_disponivel:
             raise HTTPException(
@@ -8249,28 +9674,26 @@ async def create_venda(venda_data: VendaCreate, current_user: dict = Depends(req
         }]
     )
     
-    await db.vendas.insert_one(venda.model_dump())
-    
     # Baixar estoque e registrar movimentações (apenas se não precisa autorização)
+    # Guarda atômica: se outro vendedor levou o estoque entre a validação e a baixa,
+    # nenhum item é baixado e a venda não é gravada
     if not requer_autorizacao:
-        for item in venda.itens:
-            produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
-            if produto:
-                novo_estoque = produto["estoque_atual"] - item["quantidade"]
-                await db.produtos.update_one(
-                    {"id": item["produto_id"]},
-                    {"$set": {"estoque_atual": novo_estoque}}
-                )
-                
-                movimentacao = MovimentacaoEstoque(
-                    produto_id=item["produto_id"],
-                    tipo="saida",
-                    quantidade=item["quantidade"],
-                    referencia_tipo="venda",
-                    referencia_id=venda.id,
-                    user_id=current_user["id"]
-                )
-                await db.movimentacoes_estoque.insert_one(movimentacao.model_dump())
+        try:
+            await aplicar_movimentacoes_estoque(
+                venda.itens,
+                tipo="saida",
+                referencia_tipo="venda",
+                referencia_id=venda.id,
+                user_id=current_user["id"],
+                validar="disponivel",
+                tudo_ou_nada=True
+            )
+        except EstoqueInsuficienteError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    await db.vendas.insert_one(venda.model_dump())
+    await atualizar_rollup_vendas(None, venda.model_dump())
+    await sincronizar_busca("vendas", [venda.id])
     
     # FASE 10: Gerar Conta a Receber automaticamente
     # Somente se não precisa autorização (venda confirmada) e não for pagamento à vista
@@ -8319,6 +9742,8 @@ async def create_venda(venda_data: VendaCreate, current_user: dict = Depends(req
                 )
                 
                 await db.contas_receber.insert_one(conta_receber.model_dump())
+                await sincronizar_parcelas_index("receber", [conta_receber.id])
+                await sincronizar_busca("contas_receber", [conta_receber.id])
                 
         except Exception as e:
             # Não falhar a venda se houver erro ao criar conta a receber
@@ -8423,6 +9848,7 @@ async def update_venda(
         {"id": venda_id},
         {"$set": update_data}
     )
+    await atualizar_rollup_vendas(venda, {**venda, **update_data})
     
     return {"message": "Venda atualizada com sucesso", "alteracoes": alteracoes}
 
@@ -8482,18 +9908,21 @@ async def registrar_pagamento(
         venda["historico_alteracoes"] = []
     venda["historico_alteracoes"].append(historico_entry)
     
+    update_data = {
+        "valor_pago": novo_valor_pago,
+        "saldo_pendente": novo_saldo,
+        "status_venda": novo_status,
+        "data_pagamento": pagamento.data_pagamento or datetime.now(timezone.utc).isoformat(),
+        "parcelas": parcelas,
+        "historico_alteracoes": venda["historico_alteracoes"],
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
     await db.vendas.update_one(
         {"id": venda_id},
-        {"$set": {
-            "valor_pago": novo_valor_pago,
-            "saldo_pendente": novo_saldo,
-            "status_venda": novo_status,
-            "data_pagamento": pagamento.data_pagamento or datetime.now(timezone.utc).isoformat(),
-            "parcelas": parcelas,
-            "historico_alteracoes": venda["historico_alteracoes"],
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
+        {"$set": update_data}
     )
+    # Rascunho paga passa a contar como efetivada no rollup
+    await atualizar_rollup_vendas(venda, {**venda, **update_data})
     
     return {
         "message": "Pagamento registrado com sucesso",
@@ -8527,6 +9956,7 @@ async def cancelar_venda(
                 {"id": item["produto_id"]},
                 {"$set": {"estoque_atual": novo_estoque}}
             )
+            produto_codigo_cache.invalidar([item["produto_id"]])
             
             movimentacao = MovimentacaoEstoque(
                 produto_id=item["produto_id"],
@@ -8562,6 +9992,7 @@ async def cancelar_venda(
             "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
+    await atualizar_rollup_vendas(venda, None)
     
     # Se a venda foi originada de um orçamento, atualizar o orçamento
     if venda.get("orcamento_id"):
@@ -8618,6 +10049,7 @@ async def cancelar_venda(
                     "updated_at": datetime.now(timezone.utc).isoformat()
                 }}
             )
+        await sincronizar_parcelas_index("receber", [conta["id"] for conta in contas_vinculadas])
     
     # Log
     await log_action(
@@ -8685,6 +10117,7 @@ async def devolucao_parcial(
                 {"id": item_dev["produto_id"]},
                 {"$set": {"estoque_atual": novo_estoque}}
             )
+            produto_codigo_cache.invalidar([item_dev["produto_id"]])
             
             movimentacao = MovimentacaoEstoque(
                 produto_id=item_dev["produto_id"],
@@ -8733,6 +10166,11 @@ async def devolucao_parcial(
             "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
+    await atualizar_rollup_vendas(venda, {
+        **venda,
+        "itens_devolvidos": itens_devolvidos_total,
+        "valor_devolvido": valor_devolvido_total
+    })
     
     # MELHORIA 9: Gerar crédito automático para o cliente
     credito_gerado = None
@@ -8788,6 +10226,7 @@ async def trocar_produto(
         {"id": troca.produto_saida_id},
         {"$inc": {"estoque_atual": troca.quantidade_saida}}
     )
+    produto_codigo_cache.invalidar([troca.produto_saida_id])
     
     # Retirar novo produto do estoque
     if produto_entrada["estoque_atual"] < troca.quantidade_entrada:
@@ -8797,6 +10236,7 @@ async def trocar_produto(
         {"id": troca.produto_entrada_id},
         {"$inc": {"estoque_atual": -troca.quantidade_entrada}}
     )
+    produto_codigo_cache.invalidar([troca.produto_entrada_id])
     
     # Registrar movimentações
     mov_saida = MovimentacaoEstoque(
@@ -8831,13 +10271,24 @@ async def trocar_produto(
         venda["historico_alteracoes"] = []
     venda["historico_alteracoes"].append(historico_entry)
     
+    # Trocas ficam registradas na venda para o rollup diário por produto
+    trocas = venda.get("trocas", []) + [{
+        "produto_saida_id": troca.produto_saida_id,
+        "quantidade_saida": troca.quantidade_saida,
+        "produto_entrada_id": troca.produto_entrada_id,
+        "quantidade_entrada": troca.quantidade_entrada,
+        "data": datetime.now(timezone.utc).isoformat()
+    }]
+    
     await db.vendas.update_one(
         {"id": venda_id},
         {"$set": {
+            "trocas": trocas,
             "historico_alteracoes": venda["historico_alteracoes"],
             "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
+    await atualizar_rollup_vendas(venda, {**venda, "trocas": trocas})
     
     return {"message": "Troca de produto registrada com sucesso"}
 
@@ -8945,6 +10396,7 @@ async def delete_venda(venda_id: str, current_user: dict = Depends(get_current_u
                 {"id": item["produto_id"]},
                 {"$set": {"estoque_atual": novo_estoque}}
             )
+            produto_codigo_cache.invalidar([item["produto_id"]])
             
             # Registrar movimentação de devolução
             movimentacao = MovimentacaoEstoque(
@@ -8959,6 +10411,8 @@ async def delete_venda(venda_id: str, current_user: dict = Depends(get_current_u
     
     # Deletar venda
     await db.vendas.delete_one({"id": venda_id})
+    await sincronizar_busca("vendas", [venda_id])
+    await atualizar_rollup_vendas(venda, None)
     
     await log_action(
         ip="0.0.0.0",
@@ -9085,16 +10539,20 @@ async def recomendacoes_cliente(request: RecomendacoesClienteRequest, current_us
         marcas_compradas = set()
         total_gasto = 0
         
+        # Produtos comprados e suas descrições completas em uma consulta
+        produtos_por_id = await carregar_produtos_por_id(
+            [item["produto_id"] for venda in vendas for item in venda.get("itens", [])]
+        )
+        descricoes = await descricoes_completas(list(produtos_por_id), produtos_por_id)
+        
         for venda in vendas:
             total_gasto += venda.get("total", 0)
             for item in venda.get("itens", []):
-                produto = await db.produtos.find_one({"id": item["produto_id"]}, {"_id": 0})
+                produto = produtos_por_id.get(item["produto_id"])
                 if produto:
-                    # Obter descrição completa do produto
-                    descricao_completa = await get_produto_descricao_completa(item["produto_id"])
                     produtos_comprados.append({
                         "nome": produto["nome"],
-                        "descricao_completa": descricao_completa,
+                        "descricao_completa": descricoes[produto["id"]],
                         "quantidade": item["quantidade"],
                         "valor": item["preco_unitario"]
                     })
@@ -9115,10 +10573,9 @@ async def recomendacoes_cliente(request: RecomendacoesClienteRequest, current_us
         ).with_model("openai", "gpt-4")
         
         # Montar catálogo com descrição completa
-        produtos_catalogo = []
-        for p in produtos_disponiveis[:30]:
-            descricao = await get_produto_descricao_completa(p['id'])
-            produtos_catalogo.append(f"{descricao} (R$ {p['preco_venda']:.2f})")
+        catalogo = produtos_disponiveis[:30]
+        descricoes_catalogo = await descricoes_completas([p["id"] for p in catalogo], {p["id"]: p for p in catalogo})
+        produtos_catalogo = [f"{descricoes_catalogo[p['id']]} (R$ {p['preco_venda']:.2f})" for p in catalogo]
         
         prompt = f"""Analise o perfil de compras do cliente "{cliente['nome']}" e forneça recomendações personalizadas:
 
@@ -9170,20 +10627,9 @@ Formate sua resposta de forma estruturada e persuasiva."""
 
 # Função helper para obter descrição completa do produto
 async def get_produto_descricao_completa(produto_id: str) -> str:
+    """Descrição de um único produto; em loops use descricoes_completas com a lista de ids"""
     try:
-        produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0})
-        if not produto:
-            return "Produto não encontrado"
-        
-        marca = await db.marcas.find_one({"id": produto.get("marca_id")}, {"_id": 0})
-        categoria = await db.categorias.find_one({"id": produto.get("categoria_id")}, {"_id": 0})
-        subcategoria = await db.subcategorias.find_one({"id": produto.get("subcategoria_id")}, {"_id": 0})
-        
-        marca_nome = marca.get("nome") if marca else "N/A"
-        categoria_nome = categoria.get("nome") if categoria else "N/A"
-        subcategoria_nome = subcategoria.get("nome") if subcategoria else "N/A"
-        
-        return f"{marca_nome} | {categoria_nome} | {subcategoria_nome} | {produto['nome']}"
+        return (await descricoes_completas([produto_id]))[produto_id]
     except Exception as e:
         return f"Erro ao obter descrição: {str(e)}"
 
@@ -9212,10 +10658,8 @@ async def analise_preditiva(current_user: dict = Depends(get_current_user)):
                 vendas_por_produto[pid] += item["quantidade"]
         
         top_produtos = sorted(vendas_por_produto.items(), key=lambda x: x[1], reverse=True)[:10]
-        top_produtos_info = []
-        for pid, qtd in top_produtos:
-            descricao = await get_produto_descricao_completa(pid)
-            top_produtos_info.append(f"{descricao} ({qtd} unidades)")
+        descricoes = await descricoes_completas([pid for pid, _ in top_produtos])
+        top_produtos_info = [f"{descricoes[pid]} ({qtd} unidades)" for pid, qtd in top_produtos]
         
         # Produtos com estoque baixo
         produtos_estoque_baixo = [p for p in produtos if p["estoque_atual"] <= p["estoque_minimo"]]
@@ -9437,6 +10881,256 @@ Seja específico nos valores sugeridos e forneça justificativas claras para cad
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro na análise de precificação: {str(e)}")
 
+# ==================== ROLLUP DIÁRIO DE VENDAS ====================
+# vendas_diarias: uma linha por (data, vendedor_id, cliente_id, efetivada)
+# vendas_item_diario: uma linha por (data, vendedor_id, cliente_id, produto_id), só vendas efetivadas
+# As linhas são mantidas por delta (contribuição depois - contribuição antes) nos mesmos
+# caminhos que criam, editam, cancelam, devolvem, trocam ou excluem vendas. Os relatórios
+# leem apenas as linhas do período pedido, sem depender do tamanho do histórico.
+
+from pymongo.errors import BulkWriteError
+
+CAMPOS_ROLLUP_DIARIO = ("quantidade_vendas", "faturamento", "descontos", "frete", "valor_devolvido")
+CAMPOS_ROLLUP_ITEM = (
+    "quantidade", "faturamento", "quantidade_devolvida", "valor_devolvido",
+    "quantidade_troca_saida", "quantidade_troca_entrada"
+)
+
+def venda_efetivada(venda: dict) -> bool:
+    """Critério dos relatórios avançados: exclui rascunhos e canceladas"""
+    return venda.get("status_venda") not in ("rascunho", "cancelada")
+
+def venda_conta_no_dashboard(venda: dict) -> bool:
+    """Critério do dashboard: qualquer venda não cancelada (inclui rascunhos)"""
+    return not venda.get("cancelada", False) and venda.get("status") != "cancelada"
+
+def _acumular_rollup(linhas: dict, chave: tuple, valores: dict):
+    linha = linhas.setdefault(chave, {})
+    for campo, valor in valores.items():
+        if campo == "ultima_compra":
+            if valor and (not linha.get(campo) or valor > linha[campo]):
+                linha[campo] = valor
+        elif valor:
+            linha[campo] = linha.get(campo, 0) + valor
+
+def contribuicao_venda_rollup(venda: Optional[dict]):
+    """
+    Retorna (linhas_diarias, linhas_item) com a contribuição da venda no estado informado.
+    Venda ausente ou cancelada não contribui.
+    """
+    diarias = {}
+    itens = {}
+    if not venda or not venda_conta_no_dashboard(venda):
+        return diarias, itens
+    
+    data = venda["created_at"][:10]
+    vendedor_id = venda.get("user_id")
+    cliente_id = venda.get("cliente_id")
+    efetivada = venda_efetivada(venda)
+    
+    _acumular_rollup(diarias, (data, vendedor_id, cliente_id, efetivada), {
+        "quantidade_vendas": 1,
+        "faturamento": venda.get("total", 0),
+        "descontos": venda.get("desconto", 0),
+        "frete": venda.get("frete", 0),
+        "valor_devolvido": venda.get("valor_devolvido", 0),
+        "ultima_compra": venda["created_at"]
+    })
+    
+    if not efetivada:
+        return diarias, itens
+    
+    for item in venda.get("itens", []):
+        _acumular_rollup(itens, (data, vendedor_id, cliente_id, item["produto_id"]), {
+            "quantidade": item["quantidade"],
+            "faturamento": item["quantidade"] * item["preco_unitario"]
+        })
+    for devolvido in venda.get("itens_devolvidos", []):
+        _acumular_rollup(itens, (data, vendedor_id, cliente_id, devolvido["produto_id"]), {
+            "quantidade_devolvida": devolvido["quantidade"],
+            "valor_devolvido": devolvido.get("valor", 0)
+        })
+    for troca in venda.get("trocas", []):
+        _acumular_rollup(itens, (data, vendedor_id, cliente_id, troca["produto_saida_id"]), {
+            "quantidade_troca_saida": troca["quantidade_saida"]
+        })
+        _acumular_rollup(itens, (data, vendedor_id, cliente_id, troca["produto_entrada_id"]), {
+            "quantidade_troca_entrada": troca["quantidade_entrada"]
+        })
+    
+    return diarias, itens
+
+def _filtro_chave_diaria(chave: tuple) -> dict:
+    data, vendedor_id, cliente_id, efetivada = chave
+    return {"data": data, "vendedor_id": vendedor_id, "cliente_id": cliente_id, "efetivada": efetivada}
+
+def _filtro_chave_item(chave: tuple) -> dict:
+    data, vendedor_id, cliente_id, produto_id = chave
+    return {"data": data, "vendedor_id": vendedor_id, "cliente_id": cliente_id, "produto_id": produto_id}
+
+def _operacoes_delta_rollup(antes: dict, depois: dict, campos: tuple, filtro_chave) -> List[UpdateOne]:
+    operacoes = []
+    agora = iso_utc_now()
+    for chave in set(antes) | set(depois):
+        linha_antes = antes.get(chave, {})
+        linha_depois = depois.get(chave, {})
+        delta = {}
+        for campo in campos:
+            diferenca = linha_depois.get(campo, 0) - linha_antes.get(campo, 0)
+            if diferenca:
+                delta[campo] = diferenca
+        if not delta:
+            continue
+        update = {"$inc": delta, "$set": {"updated_at": agora}}
+        if linha_depois.get("ultima_compra"):
+            update["$max"] = {"ultima_compra": linha_depois["ultima_compra"]}
+        operacoes.append(UpdateOne(filtro_chave(chave), update, upsert=True))
+    return operacoes
+
+async def _bulk_upsert_sem_ordem(colecao, operacoes: list):
+    """
+    Aplica upserts sem ordem. Dois upserts simultâneos da mesma chave nova fazem um deles
+    falhar no índice único; apenas essas operações são repetidas (já encontram a linha criada).
+    """
+    if not operacoes:
+        return
+    try:
+        await colecao.bulk_write(operacoes, ordered=False)
+    except BulkWriteError as e:
+        erros = e.details.get("writeErrors", [])
+        if any(erro.get("code") != 11000 for erro in erros):
+            raise
+        await colecao.bulk_write([operacoes[erro["index"]] for erro in erros], ordered=False)
+
+async def _recalcular_ultima_compra(chaves: List[tuple]):
+    """Após remover vendas de uma linha diária, recalcula ultima_compra com as vendas restantes"""
+    for data, vendedor_id, cliente_id, efetivada in chaves:
+        candidatas = await db.vendas.find(
+            {"cliente_id": cliente_id, "user_id": vendedor_id, "created_at": {"$regex": f"^{data}"}},
+            {"_id": 0, "created_at": 1, "status_venda": 1, "cancelada": 1, "status": 1}
+        ).sort("created_at", -1).to_list(None)
+        ultima = next(
+            (v["created_at"] for v in candidatas
+             if venda_conta_no_dashboard(v) and venda_efetivada(v) == efetivada),
+            None
+        )
+        if ultima:
+            await db.vendas_diarias.update_one(
+                _filtro_chave_diaria((data, vendedor_id, cliente_id, efetivada)),
+                {"$set": {"ultima_compra": ultima}}
+            )
+
+async def atualizar_rollup_vendas(venda_antes: Optional[dict], venda_depois: Optional[dict]):
+    """
+    Aplica no rollup a diferença entre dois estados da mesma venda.
+    venda_antes=None para venda nova; venda_depois=None para venda cancelada ou excluída.
+    Falhas não desfazem a operação de venda: ficam no log e são corrigidas por
+    POST /relatorios/rollup/reconstruir.
+    """
+    try:
+        diarias_antes, itens_antes = contribuicao_venda_rollup(venda_antes)
+        diarias_depois, itens_depois = contribuicao_venda_rollup(venda_depois)
+        
+        await _bulk_upsert_sem_ordem(
+            db.vendas_diarias,
+            _operacoes_delta_rollup(diarias_antes, diarias_depois, CAMPOS_ROLLUP_DIARIO, _filtro_chave_diaria)
+        )
+        await _bulk_upsert_sem_ordem(
+            db.vendas_item_diario,
+            _operacoes_delta_rollup(itens_antes, itens_depois, CAMPOS_ROLLUP_ITEM, _filtro_chave_item)
+        )
+        
+        # Linhas que perderam vendas: remover as zeradas e corrigir ultima_compra das restantes
+        diarias_reduzidas = [
+            chave for chave, linha in diarias_antes.items()
+            if diarias_depois.get(chave, {}).get("quantidade_vendas", 0) < linha.get("quantidade_vendas", 0)
+        ]
+        if diarias_reduzidas:
+            await db.vendas_diarias.delete_many({
+                "$or": [_filtro_chave_diaria(chave) for chave in diarias_reduzidas],
+                "quantidade_vendas": {"$lte": 0}
+            })
+            await _recalcular_ultima_compra(diarias_reduzidas)
+        
+        itens_reduzidos = [chave for chave in itens_antes if chave not in itens_depois]
+        if itens_reduzidos:
+            await db.vendas_item_diario.delete_many({
+                "$or": [_filtro_chave_item(chave) for chave in itens_reduzidos],
+                "quantidade": {"$not": {"$gt": 0}},
+                "quantidade_troca_entrada": {"$not": {"$gt": 0}}
+            })
+    except Exception as e:
+        venda_ref = (venda_depois or venda_antes or {}).get("id")
+        print(f"Aviso: Erro ao atualizar rollup de vendas (venda {venda_ref}): {str(e)}")
+
+async def reconstruir_rollup_vendas() -> dict:
+    """
+    Recalcula vendas_diarias e vendas_item_diario a partir de todas as vendas.
+    Usado no backfill inicial e para corrigir divergências; percorre o histórico uma vez.
+    """
+    diarias = {}
+    itens = {}
+    projecao = {
+        "_id": 0, "id": 1, "created_at": 1, "user_id": 1, "cliente_id": 1,
+        "status_venda": 1, "cancelada": 1, "status": 1, "total": 1, "desconto": 1,
+        "frete": 1, "valor_devolvido": 1, "itens": 1, "itens_devolvidos": 1, "trocas": 1
+    }
+    vendas_processadas = 0
+    async for venda in db.vendas.find({}, projecao):
+        diarias_venda, itens_venda = contribuicao_venda_rollup(venda)
+        for chave, valores in diarias_venda.items():
+            _acumular_rollup(diarias, chave, valores)
+        for chave, valores in itens_venda.items():
+            _acumular_rollup(itens, chave, valores)
+        vendas_processadas += 1
+    
+    agora = iso_utc_now()
+    docs_diarios = [
+        {**_filtro_chave_diaria(chave), **{campo: linha.get(campo, 0) for campo in CAMPOS_ROLLUP_DIARIO},
+         "ultima_compra": linha.get("ultima_compra"), "updated_at": agora}
+        for chave, linha in diarias.items()
+    ]
+    docs_itens = [
+        {**_filtro_chave_item(chave), **{campo: linha.get(campo, 0) for campo in CAMPOS_ROLLUP_ITEM},
+         "updated_at": agora}
+        for chave, linha in itens.items()
+    ]
+    
+    await db.vendas_diarias.delete_many({})
+    await db.vendas_item_diario.delete_many({})
+    for inicio in range(0, len(docs_diarios), 1000):
+        await db.vendas_diarias.insert_many(docs_diarios[inicio:inicio + 1000])
+    for inicio in range(0, len(docs_itens), 1000):
+        await db.vendas_item_diario.insert_many(docs_itens[inicio:inicio + 1000])
+    
+    return {
+        "vendas_processadas": vendas_processadas,
+        "linhas_diarias": len(docs_diarios),
+        "linhas_item": len(docs_itens)
+    }
+
+def filtro_periodo_rollup(data_inicio: Optional[str], data_fim: Optional[str]) -> dict:
+    """Mesmo recorte de antes (data_inicio <= created_at[:10] <= data_fim), aplicado à chave 'data'"""
+    if data_inicio and data_fim:
+        return {"data": {"$gte": data_inicio, "$lte": data_fim}}
+    return {}
+
+@api_router.post("/relatorios/rollup/reconstruir")
+async def reconstruir_rollup_vendas_endpoint(current_user: dict = Depends(require_permission("admin", "editar"))):
+    """Reconstrói o rollup diário de vendas a partir do histórico completo"""
+    resultado = await reconstruir_rollup_vendas()
+    
+    await log_action(
+        ip="0.0.0.0",
+        user_id=current_user["id"],
+        user_nome=current_user["nome"],
+        tela="relatorios",
+        acao="reconstruir_rollup_vendas",
+        detalhes=resultado
+    )
+    
+    return {"message": "Rollup de vendas reconstruído", **resultado}
+
 # ========== RELATÓRIOS ==========
 
 @api_router.get("/relatorios/dashboard")
@@ -9451,16 +11145,18 @@ async def get_dashboard(current_user: dict = Depends(require_permission("relator
     total_produtos_inativos = await db.produtos.count_documents({"ativo": False})
     total_produtos = total_produtos_ativos + total_produtos_inativos
     
-    # Vendas - apenas efetivadas (não canceladas)
-    vendas_efetivadas = await db.vendas.find({
-        "$and": [
-            {"$or": [{"cancelada": {"$exists": False}}, {"cancelada": False}]},
-            {"$or": [{"status": {"$exists": False}}, {"status": {"$ne": "cancelada"}}]}
-        ]
-    }, {"_id": 0}).to_list(10000)
+    # Vendas - apenas efetivadas (não canceladas), somadas no rollup diário
+    totais_vendas = await db.vendas_diarias.aggregate([
+        {"$group": {
+            "_id": None,
+            "total_vendas": {"$sum": "$quantidade_vendas"},
+            "total_faturamento": {"$sum": "$faturamento"}
+        }}
+    ]).to_list(1)
+    totais_vendas = totais_vendas[0] if totais_vendas else {}
     
-    total_vendas = len(vendas_efetivadas)
-    total_faturamento = sum(v["total"] for v in vendas_efetivadas)
+    total_vendas = totais_vendas.get("total_vendas", 0)
+    total_faturamento = totais_vendas.get("total_faturamento", 0)
     
     produtos = await db.produtos.find({}, {"_id": 0}).to_list(1000)
     produtos_estoque_baixo = len([p for p in produtos if p["estoque_atual"] <= p["estoque_minimo"]])
@@ -9479,21 +11175,18 @@ async def get_dashboard(current_user: dict = Depends(require_permission("relator
 
 @api_router.get("/relatorios/vendas-por-periodo")
 async def vendas_por_periodo(current_user: dict = Depends(require_permission("relatorios", "ler"))):
-    # Apenas vendas efetivadas (excluir rascunhos e canceladas)
-    vendas = await db.vendas.find({
-        "status_venda": {"$nin": ["rascunho", "cancelada"]}
-    }, {"_id": 0}).to_list(10000)
-    
-    # Agrupar por data
-    vendas_por_dia = {}
-    for venda in vendas:
-        data = venda["created_at"][:10]
-        if data not in vendas_por_dia:
-            vendas_por_dia[data] = {"quantidade": 0, "total": 0}
-        vendas_por_dia[data]["quantidade"] += 1
-        vendas_por_dia[data]["total"] += venda["total"]
+    # Apenas vendas efetivadas (excluir rascunhos e canceladas), agrupadas por data no rollup
+    linhas = await db.vendas_diarias.aggregate([
+        {"$match": {"efetivada": True}},
+        {"$group": {
+            "_id": "$data",
+            "quantidade": {"$sum": "$quantidade_vendas"},
+            "total": {"$sum": "$faturamento"}
+        }},
+        {"$sort": {"_id": 1}}
+    ]).to_list(None)
     
-    return vendas_por_dia
+    return {linha["_id"]: {"quantidade": linha["quantidade"], "total": linha["total"]} for linha in linhas}
 
 # ========== LOGS ==========
 
@@ -9502,6 +11195,137 @@ async def vendas_por_periodo(current_user: dict = Depends(require_permission("re
 # Configuração de retenção
 DIAS_RETENCAO_LOGS = 90
 
+# ==================== ARQUIVO DE LOGS (CAMADA FRIA) ====================
+# 'logs' guarda só os últimos DIAS_RETENCAO_LOGS dias. O arquivamento move os mais
+# antigos para 'logs_arquivo', uma coleção time-series (MongoDB 5.0+, armazenamento
+# em buckets comprimidos por período) com o timestamp original preservado e 'ts'
+# (Date) como campo de tempo. /logs e /logs/exportar consultam o arquivo com
+# $unionWith apenas quando o intervalo pedido alcança logs arquivados.
+
+LOGS_ARQUIVO_LOTE = 5000
+
+async def garantir_colecao_arquivo_logs():
+    """Cria logs_arquivo como time-series; sem suporte, cai para coleção comum indexada por ts."""
+    if "logs_arquivo" in await db.list_collection_names(filter={"name": "logs_arquivo"}):
+        return
+    try:
+        await db.create_collection(
+            "logs_arquivo",
+            timeseries={"timeField": "ts", "granularity": "hours"}
+        )
+    except Exception as e:
+        if "already exists" in str(e).lower():
+            return
+        print(f"Aviso: Coleção time-series indisponível para o arquivo de logs: {str(e)}")
+        await db.logs_arquivo.create_index([("ts", -1)], name="logs_arquivo_ts_idx")
+
+async def arquivar_logs(dias: int, max_lotes: int = None) -> dict:
+    """
+    Move para logs_arquivo os logs com mais de 'dias' dias (e os já marcados como
+    arquivados pela rotina anterior), em lotes de insert_many + delete_many.
+    Com max_lotes, para após esse número de lotes (o agendador chama de novo até zerar).
+    """
+    data_corte = (datetime.now(timezone.utc) - timedelta(days=dias)).isoformat()
+    filtro = {"$or": [{"timestamp": {"$lt": data_corte}}, {"arquivado": True}]}
+    
+    await garantir_colecao_arquivo_logs()
+    
+    movidos = 0
+    lotes = 0
+    ultimo_timestamp = None
+    while max_lotes is None or lotes < max_lotes:
+        lote = await db.logs.find(filtro).limit(LOGS_ARQUIVO_LOTE).to_list(LOGS_ARQUIVO_LOTE)
+        if not lote:
+            break
+        docs = []
+        for log in lote:
+            doc = {k: v for k, v in log.items() if k != "_id"}
+            doc["ts"] = parse_date_input(doc.get("timestamp")) or datetime.now(timezone.utc)
+            doc["arquivado"] = True
+            doc.setdefault("data_arquivamento", iso_utc_now())
+            docs.append(doc)
+            if doc.get("timestamp") and (ultimo_timestamp is None or doc["timestamp"] > ultimo_timestamp):
+                ultimo_timestamp = doc["timestamp"]
+        await db.logs_arquivo.insert_many(docs, ordered=False)
+        await db.logs.delete_many({"_id": {"$in": [log["_id"] for log in lote]}})
+        movidos += len(lote)
+        lotes += 1
+    
+    if ultimo_timestamp:
+        await db.logs_arquivo_controle.update_one(
+            {"id": "corte"},
+            {"$max": {"ultimo_timestamp": ultimo_timestamp}, "$set": {"atualizado_em": iso_utc_now()}},
+            upsert=True
+        )
+    
+    return {"logs_arquivados": movidos, "data_corte": data_corte, "dias": dias}
+
+async def intervalo_alcanca_arquivo(data_inicio: Optional[str]) -> bool:
+    """True se a consulta pode incluir logs arquivados (sem início ou início até o último arquivado)"""
+    controle = await db.logs_arquivo_controle.find_one({"id": "corte"}, {"_id": 0})
+    if not controle or not controle.get("ultimo_timestamp"):
+        return False
+    return not data_inicio or data_inicio <= controle["ultimo_timestamp"]
+
+def filtro_arquivo_logs(filtro: dict) -> dict:
+    """
+    Filtro equivalente para logs_arquivo: mesmas condições sobre o timestamp original
+    mais uma faixa folgada em 'ts' para o MongoDB descartar buckets fora do período.
+    """
+    filtro_arquivo = {k: v for k, v in filtro.items() if k != "arquivado"}
+    faixa = filtro.get("timestamp") or {}
+    faixa_ts = {}
+    inicio = parse_date_input(faixa.get("$gte")) if isinstance(faixa, dict) else None
+    fim = parse_date_input(faixa.get("$lte")) if isinstance(faixa, dict) else None
+    if inicio:
+        faixa_ts["$gte"] = inicio - timedelta(days=1)
+    if fim:
+        faixa_ts["$lte"] = fim + timedelta(days=1)
+    if faixa_ts:
+        filtro_arquivo["ts"] = faixa_ts
+    return filtro_arquivo
+
+async def buscar_logs_com_arquivo(filtro: dict, data_inicio: Optional[str], skip: int = 0,
+                                  limit: int = None, after: str = None, contagem: str = "exato") -> tuple:
+    """
+    Busca logs ordenados por (timestamp, id) desc na coleção quente e, se o intervalo
+    alcançar o arquivo, também em logs_arquivo. Com 'after' continua a partir do cursor
+    em vez de usar skip. Retorna (logs, total); total é None com contagem="nenhum".
+    """
+    apos_cursor = None
+    if after:
+        valor, ultimo_id = decodificar_cursor(after, 2)
+        apos_cursor = filtro_apos_cursor("timestamp", -1, valor, ultimo_id)
+        skip = 0
+    
+    if not await intervalo_alcanca_arquivo(data_inicio):
+        total = await contar_documentos(db.logs, filtro, contagem)
+        filtro_pagina = combinar_filtros(filtro, apos_cursor) if apos_cursor else filtro
+        cursor = db.logs.find(filtro_pagina, {"_id": 0}).sort([("timestamp", -1), ("id", -1)]).skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(limit), total
+    
+    filtro_arquivo = filtro_arquivo_logs(filtro)
+    total = await contar_documentos(db.logs, filtro, contagem)
+    if total is not None:
+        total += await contar_documentos(db.logs_arquivo, filtro_arquivo, contagem)
+    pipeline = [
+        {"$match": filtro},
+        {"$unionWith": {"coll": "logs_arquivo", "pipeline": [{"$match": filtro_arquivo}]}},
+    ]
+    if apos_cursor:
+        pipeline.append({"$match": apos_cursor})
+    pipeline += [
+        {"$sort": {"timestamp": -1, "id": -1}},
+        {"$skip": skip}
+    ]
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$project": {"_id": 0, "ts": 0}})
+    logs = await db.logs.aggregate(pipeline, allowDiskUse=True).to_list(limit)
+    return logs, total
+
 @api_router.get("/logs")
 async def get_logs(
     data_inicio: str = None,
@@ -9513,10 +11337,13 @@ async def get_logs(
     metodo_http: str = None,
     limit: int = 20,
     offset: int = 0,
+    after: str = None,
+    contagem: str = "exato",
     current_user: dict = Depends(require_permission("logs", "ler"))
 ):
     """
-    Lista logs com filtros avançados e paginação
+    Lista logs com filtros avançados e paginação.
+    Paginação por cursor com 'after' (next_cursor da resposta); contagem: exato, estimado ou nenhum.
     """
     # Apenas admin pode ver todos os logs
     # RBAC: Verificação manual removida - agora usa Depends(require_permission)
@@ -9544,20 +11371,38 @@ async def get_logs(
     if metodo_http:
         filtro["metodo_http"] = metodo_http
     
-    # Contar total
-    total = await db.logs.count_documents(filtro)
-    
-    # Buscar logs com paginação
-    logs = await db.logs.find(filtro, {"_id": 0}).sort("timestamp", -1).skip(offset).limit(limit).to_list(limit)
+    # Contar e buscar com paginação (inclui o arquivo se o período alcançá-lo)
+    validar_contagem(contagem)
+    logs, total = await buscar_logs_com_arquivo(
+        filtro, data_inicio, skip=offset, limit=limit + 1, after=after, contagem=contagem
+    )
+    has_more = len(logs) > limit
+    logs = logs[:limit]
     
     return {
         "logs": logs,
         "total": total,
         "limit": limit,
         "offset": offset,
-        "has_more": (offset + limit) < total
+        "has_more": has_more,
+        "next_cursor": codificar_cursor([logs[-1].get("timestamp"), logs[-1].get("id")]) if has_more else None
     }
 
+# Estatísticas de logs: um único $match (índice arquivado + timestamp) seguido de
+# $facet com todas as contagens, exatas para qualquer tamanho de janela.
+
+def _facet_contagem(campo: str, padrao: str = None, ignorar: list = None) -> list:
+    """Sub-pipeline de $facet que conta documentos por valor do campo"""
+    etapas = []
+    if ignorar:
+        etapas.append({"$match": {campo: {"$nin": ignorar}}})
+    chave = {"$ifNull": [f"${campo}", padrao]} if padrao is not None else f"${campo}"
+    etapas.append({"$group": {"_id": chave, "quantidade": {"$sum": 1}}})
+    return etapas
+
+def _mapa_contagem(linhas: list) -> dict:
+    return {linha["_id"]: linha["quantidade"] for linha in linhas}
+
 @api_router.get("/logs/estatisticas")
 async def get_estatisticas_logs(
     data_inicio: str = None,
@@ -9575,81 +11420,49 @@ async def get_estatisticas_logs(
     if data_inicio and data_fim:
         filtro["timestamp"] = {"$gte": data_inicio, "$lte": data_fim}
     
-    logs = await db.logs.find(filtro, {"_id": 0}).to_list(10000)
-    
-    # Estatísticas por severidade
-    por_severidade = {}
-    for log in logs:
-        sev = log.get("severidade", "INFO")
-        if sev not in por_severidade:
-            por_severidade[sev] = 0
-        por_severidade[sev] += 1
-    
-    # Estatísticas por usuário
-    por_usuario = {}
-    for log in logs:
-        user = log.get("user_nome", "Desconhecido")
-        if user not in por_usuario:
-            por_usuario[user] = 0
-        por_usuario[user] += 1
-    
-    # Top 10 usuários mais ativos
-    top_usuarios = sorted(por_usuario.items(), key=lambda x: x[1], reverse=True)[:10]
-    
-    # Estatísticas por ação
-    por_acao = {}
-    for log in logs:
-        acao = log.get("acao", "desconhecido")
-        if acao not in por_acao:
-            por_acao[acao] = 0
-        por_acao[acao] += 1
-    
-    # Estatísticas por tela
-    por_tela = {}
-    for log in logs:
-        tela = log.get("tela", "desconhecido")
-        if tela not in por_tela:
-            por_tela[tela] = 0
-        por_tela[tela] += 1
-    
-    # Estatísticas por dispositivo
-    por_dispositivo = {}
-    for log in logs:
-        disp = log.get("dispositivo", "Desconhecido")
-        if disp and disp != "Desconhecido":
-            if disp not in por_dispositivo:
-                por_dispositivo[disp] = 0
-            por_dispositivo[disp] += 1
-    
-    # Estatísticas por navegador
-    por_navegador = {}
-    for log in logs:
-        nav = log.get("navegador", "Desconhecido")
-        if nav and nav != "Desconhecido":
-            if nav not in por_navegador:
-                por_navegador[nav] = 0
-            por_navegador[nav] += 1
+    tem_tempo = {"$ne": [{"$ifNull": ["$tempo_execucao_ms", 0]}, 0]}
+    resultado = await db.logs.aggregate([
+        {"$match": filtro},
+        {"$facet": {
+            "totais": [{"$group": {
+                "_id": None,
+                "total": {"$sum": 1},
+                "erros": {"$sum": {"$cond": [{"$in": ["$severidade", ["ERROR", "CRITICAL"]]}, 1, 0]}},
+                "soma_tempo": {"$sum": {"$cond": [tem_tempo, "$tempo_execucao_ms", 0]}},
+                "medidas": {"$sum": {"$cond": [tem_tempo, 1, 0]}}
+            }}],
+            "por_severidade": _facet_contagem("severidade", "INFO"),
+            "por_acao": _facet_contagem("acao", "desconhecido"),
+            "por_tela": _facet_contagem("tela", "desconhecido"),
+            "por_dispositivo": _facet_contagem("dispositivo", ignorar=[None, "", "Desconhecido"]),
+            "por_navegador": _facet_contagem("navegador", ignorar=[None, "", "Desconhecido"]),
+            # Top 10 usuários mais ativos
+            "top_usuarios": _facet_contagem("user_nome", "Desconhecido") + [
+                {"$sort": {"quantidade": -1, "_id": 1}},
+                {"$limit": 10}
+            ]
+        }}
+    ], allowDiskUse=True).to_list(1)
+    resultado = resultado[0]
+    totais = resultado["totais"][0] if resultado["totais"] else {}
     
     # Performance médio
-    tempos_execucao = [log.get("tempo_execucao_ms", 0) for log in logs if log.get("tempo_execucao_ms")]
-    tempo_medio = sum(tempos_execucao) / len(tempos_execucao) if tempos_execucao else 0
-    
-    # Erros
-    total_erros = len([log_entry for log_entry in logs if log_entry.get("severidade") in ["ERROR", "CRITICAL"]])
+    medidas = totais.get("medidas", 0)
+    tempo_medio = totais.get("soma_tempo", 0) / medidas if medidas else 0
     
     return {
         "periodo": {"data_inicio": data_inicio, "data_fim": data_fim},
-        "total_logs": len(logs),
-        "total_erros": total_erros,
-        "por_severidade": por_severidade,
-        "por_acao": por_acao,
-        "por_tela": por_tela,
-        "por_dispositivo": por_dispositivo,
-        "por_navegador": por_navegador,
-        "top_usuarios": [{"usuario": u, "quantidade": q} for u, q in top_usuarios],
+        "total_logs": totais.get("total", 0),
+        "total_erros": totais.get("erros", 0),
+        "por_severidade": _mapa_contagem(resultado["por_severidade"]),
+        "por_acao": _mapa_contagem(resultado["por_acao"]),
+        "por_tela": _mapa_contagem(resultado["por_tela"]),
+        "por_dispositivo": _mapa_contagem(resultado["por_dispositivo"]),
+        "por_navegador": _mapa_contagem(resultado["por_navegador"]),
+        "top_usuarios": [{"usuario": linha["_id"], "quantidade": linha["quantidade"]} for linha in resultado["top_usuarios"]],
         "performance": {
             "tempo_medio_ms": tempo_medio,
-            "total_medidas": len(tempos_execucao)
+            "total_medidas": medidas
         }
     }
 
@@ -9665,26 +11478,27 @@ async def get_dashboard_logs(current_user: dict = Depends(require_permission("lo
     # Últimos 7 dias
     data_inicio = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
     
-    logs = await db.logs.find(
-        {"timestamp": {"$gte": data_inicio}, "arquivado": False},
-        {"_id": 0}
-    ).to_list(10000)
-    
-    # KPIs
-    total_logs = len(logs)
-    total_erros = len([log_entry for log_entry in logs if log_entry.get("severidade") in ["ERROR", "CRITICAL"]])
+    # KPIs e atividade por dia em uma única agregação
+    resultado = await db.logs.aggregate([
+        {"$match": {"arquivado": False, "timestamp": {"$gte": data_inicio}}},
+        {"$facet": {
+            "totais": [{"$group": {
+                "_id": None,
+                "total": {"$sum": 1},
+                "erros": {"$sum": {"$cond": [{"$in": ["$severidade", ["ERROR", "CRITICAL"]]}, 1, 0]}}
+            }}],
+            "por_dia": [
+                {"$group": {"_id": {"$substrCP": ["$timestamp", 0, 10]}, "quantidade": {"$sum": 1}}},
+                {"$sort": {"_id": 1}}
+            ]
+        }}
+    ], allowDiskUse=True).to_list(1)
+    resultado = resultado[0]
+    totais = resultado["totais"][0] if resultado["totais"] else {}
     
     # Contar usuários REALMENTE ativos no sistema (não apenas nos logs)
     usuarios_ativos_count = await db.users.count_documents({"ativo": True})
     
-    # Atividade por dia
-    atividade_por_dia = {}
-    for log in logs:
-        dia = log["timestamp"][:10]
-        if dia not in atividade_por_dia:
-            atividade_por_dia[dia] = 0
-        atividade_por_dia[dia] += 1
-    
     # Logs de segurança recentes (últimos 7 dias)
     logs_seguranca = await db.logs_seguranca.find(
         {"timestamp": {"$gte": data_inicio}},
@@ -9697,15 +11511,20 @@ async def get_dashboard_logs(current_user: dict = Depends(require_permission("lo
     return {
         "periodo": "Últimos 7 dias",
         "kpis": {
-            "total_logs": total_logs,
-            "total_erros": total_erros,
+            "total_logs": totais.get("total", 0),
+            "total_erros": totais.get("erros", 0),
             "total_security": total_security,
             "usuarios_ativos": usuarios_ativos_count
         },
-        "atividade_por_dia": atividade_por_dia,
+        "atividade_por_dia": _mapa_contagem(resultado["por_dia"]),
         "logs_seguranca_recentes": logs_seguranca
     }
 
+@api_router.get("/logs/gravacao")
+async def get_logs_gravacao(current_user: dict = Depends(require_permission("logs", "ler"))):
+    """Contadores do gravador assíncrono de logs (fila, lotes, esperas e descartes)"""
+    return log_writer.stats()
+
 @api_router.get("/logs/seguranca")
 async def get_logs_seguranca(
     limit: int = 20,
@@ -9748,7 +11567,7 @@ async def exportar_logs(
     if data_inicio and data_fim:
         filtro["timestamp"] = {"$gte": data_inicio, "$lte": data_fim}
     
-    logs = await db.logs.find(filtro, {"_id": 0}).sort("timestamp", -1).to_list(5000)
+    logs, _ = await buscar_logs_com_arquivo(filtro, data_inicio if data_inicio and data_fim else None, limit=5000)
     
     if formato == "json":
         return {
@@ -9780,30 +11599,12 @@ async def arquivar_logs_antigos(current_user: dict = Depends(require_permission(
     #     if current_user["papel"] != "admin":
     #         raise HTTPException(status_code=403, detail="Apenas administradores podem arquivar logs")
     
-    # Data limite
-    data_limite = (datetime.now(timezone.utc) - timedelta(days=DIAS_RETENCAO_LOGS)).isoformat()
-    
-    # Contar logs a arquivar
-    filtro = {
-        "timestamp": {"$lt": data_limite},
-        "arquivado": False
-    }
-    
-    total_arquivar = await db.logs.count_documents(filtro)
-    
-    # Arquivar
-    resultado = await db.logs.update_many(
-        filtro,
-        {"$set": {
-            "arquivado": True,
-            "data_arquivamento": datetime.now(timezone.utc).isoformat()
-        }}
-    )
+    resultado = await arquivar_logs(DIAS_RETENCAO_LOGS)
     
     return {
-        "message": f"{total_arquivar} logs arquivados com sucesso",
-        "total_arquivados": resultado.modified_count,
-        "data_limite": data_limite,
+        "message": f"{resultado['logs_arquivados']} logs arquivados com sucesso",
+        "total_arquivados": resultado["logs_arquivados"],
+        "data_limite": resultado["data_corte"],
         "dias_retencao": DIAS_RETENCAO_LOGS
     }
 
@@ -9876,8 +11677,12 @@ async def criar_indices_logs(current_user: dict = Depends(require_permission("lo
         await db.logs.create_index([("acao", 1)])
         await db.logs.create_index([("arquivado", 1)])
         await db.logs.create_index([("request_id", 1)])
+        await db.logs.create_index([("arquivado", 1), ("timestamp", -1)])
+        await db.logs.create_index([("user_id", 1), ("timestamp", -1)])
+        await db.logs.create_index([("acao", 1), ("timestamp", -1)])
         
         await db.logs_seguranca.create_index([("timestamp", -1)])
+        await db.logs_seguranca.create_index([("tipo", 1), ("timestamp", -1)])
         await db.logs_seguranca.create_index([("tipo", 1)])
         await db.logs_seguranca.create_index([("ip", 1)])
         
@@ -9887,65 +11692,119 @@ async def criar_indices_logs(current_user: dict = Depends(require_permission("lo
 
 # ========== RELATÓRIOS AVANÇADOS ==========
 
+def filtro_periodo_iso(campo: str, data_inicio: Optional[str], data_fim: Optional[str]) -> dict:
+    """
+    Filtro indexável equivalente a data_inicio <= doc[campo][:10] <= data_fim para datas ISO
+    gravadas como string. O caractere U+FFFF é maior que qualquer caractere de um timestamp
+    ISO, então todo o dia data_fim fica abaixo do limite superior.
+    """
+    if data_inicio and data_fim:
+        return {campo: {"$gte": data_inicio, "$lt": data_fim + "\uffff"}}
+    return {}
+
+def contar_se_igual(campo: str, valor, soma=1) -> dict:
+    """Acumulador $sum que conta (ou soma 'soma') apenas quando campo == valor"""
+    return {"$sum": {"$cond": [{"$eq": [f"${campo}", valor]}, soma, 0]}}
+
+# Chave de agrupamento por período sobre o campo 'dia' (data do rollup convertida em Date).
+# Semana mantém o formato existente: ano civil + semana ISO (ex.: 2025-W03)
+CHAVES_AGRUPAMENTO_PERIODO = {
+    "dia": "$data",
+    "mes": {"$dateToString": {"format": "%Y-%m", "date": {"$dateTrunc": {"date": "$dia", "unit": "month"}}}},
+    "semana": {"$concat": [
+        {"$toString": {"$year": "$dia"}},
+        "-W",
+        {"$cond": [{"$lt": [{"$isoWeek": "$dia"}, 10]}, "0", ""]},
+        {"$toString": {"$isoWeek": "$dia"}}
+    ]}
+}
+
 @api_router.get("/relatorios/dashboard/kpis")
 async def get_kpis_dashboard(data_inicio: str = None, data_fim: str = None, current_user: dict = Depends(require_permission("relatorios", "ler"))):
     """
     Retorna KPIs principais do dashboard executivo
     """
-    # Buscar todos os dados necessários - apenas vendas efetivadas (excluir rascunhos e canceladas)
-    vendas = await db.vendas.find({
-        "status_venda": {"$nin": ["rascunho", "cancelada"]}
-    }, {"_id": 0}).to_list(10000)
-    produtos = await db.produtos.find({}, {"_id": 0}).to_list(10000)
-    clientes = await db.clientes.find({}, {"_id": 0}).to_list(10000)
-    orcamentos = await db.orcamentos.find({}, {"_id": 0}).to_list(10000)
+    # Vendas efetivadas (excluir rascunhos e canceladas) vêm do rollup diário do período
+    filtro_periodo = filtro_periodo_rollup(data_inicio, data_fim)
+    resumo_vendas = await db.vendas_diarias.aggregate([
+        {"$match": {"efetivada": True, **filtro_periodo}},
+        {"$group": {
+            "_id": None,
+            "total_vendas": {"$sum": "$quantidade_vendas"},
+            "faturamento": {"$sum": "$faturamento"},
+            "descontos": {"$sum": "$descontos"},
+            "frete": {"$sum": "$frete"},
+            "clientes": {"$addToSet": "$cliente_id"}
+        }}
+    ]).to_list(1)
+    resumo_vendas = resumo_vendas[0] if resumo_vendas else {}
     
-    # Filtrar por data se fornecido
-    if data_inicio and data_fim:
-        vendas = [v for v in vendas if data_inicio <= v["created_at"][:10] <= data_fim]
-        orcamentos = [o for o in orcamentos if data_inicio <= o["created_at"][:10] <= data_fim]
+    resumo_estoque = await db.produtos.aggregate([
+        {"$group": {
+            "_id": None,
+            "produtos_total": {"$sum": 1},
+            "valor_total": {"$sum": {"$multiply": ["$estoque_atual", {"$ifNull": ["$preco_medio", 0]}]}},
+            "alertas_minimo": {"$sum": {"$cond": [{"$lte": ["$estoque_atual", "$estoque_minimo"]}, 1, 0]}}
+        }}
+    ]).to_list(1)
+    resumo_estoque = resumo_estoque[0] if resumo_estoque else {}
+    
+    resumo_orcamentos = await db.orcamentos.aggregate([
+        {"$match": filtro_periodo_iso("created_at", data_inicio, data_fim)},
+        {"$group": {
+            "_id": None,
+            "total": {"$sum": 1},
+            "abertos": contar_se_igual("status", "aberto"),
+            "convertidos": contar_se_igual("status", "vendido")
+        }}
+    ]).to_list(1)
+    resumo_orcamentos = resumo_orcamentos[0] if resumo_orcamentos else {}
+    
+    total_clientes = await db.clientes.count_documents({})
     
     # Cálculos de KPIs
-    total_vendas = len(vendas)
-    faturamento_total = sum(v["total"] for v in vendas)
+    total_vendas = resumo_vendas.get("total_vendas", 0)
+    faturamento_total = resumo_vendas.get("faturamento", 0)
     ticket_medio = faturamento_total / total_vendas if total_vendas > 0 else 0
     
-    total_descontos = sum(v.get("desconto", 0) for v in vendas)
-    total_frete = sum(v.get("frete", 0) for v in vendas)
+    total_descontos = resumo_vendas.get("descontos", 0)
+    total_frete = resumo_vendas.get("frete", 0)
     
     # Estoque
-    valor_estoque = sum(p["estoque_atual"] * p.get("preco_medio", 0) for p in produtos)
-    produtos_alerta_minimo = len([p for p in produtos if p["estoque_atual"] <= p["estoque_minimo"]])
+    valor_estoque = resumo_estoque.get("valor_total", 0)
+    produtos_alerta_minimo = resumo_estoque.get("alertas_minimo", 0)
     
     # Orçamentos
-    orcamentos_abertos = len([o for o in orcamentos if o["status"] == "aberto"])
-    orcamentos_convertidos = len([o for o in orcamentos if o["status"] == "vendido"])
-    taxa_conversao = (orcamentos_convertidos / len(orcamentos) * 100) if len(orcamentos) > 0 else 0
+    total_orcamentos = resumo_orcamentos.get("total", 0)
+    orcamentos_abertos = resumo_orcamentos.get("abertos", 0)
+    orcamentos_convertidos = resumo_orcamentos.get("convertidos", 0)
+    taxa_conversao = (orcamentos_convertidos / total_orcamentos * 100) if total_orcamentos > 0 else 0
     
     # Clientes ativos (compraram no período)
-    clientes_ativos = len(set(v["cliente_id"] for v in vendas))
+    clientes_ativos = len(resumo_vendas.get("clientes", []))
     
     # Top produtos
-    produtos_vendidos = {}
-    for venda in vendas:
-        for item in venda.get("itens", []):
-            pid = item["produto_id"]
-            if pid not in produtos_vendidos:
-                produtos_vendidos[pid] = {"quantidade": 0, "faturamento": 0}
-            produtos_vendidos[pid]["quantidade"] += item["quantidade"]
-            produtos_vendidos[pid]["faturamento"] += item["quantidade"] * item["preco_unitario"]
-    
-    top_produtos = sorted(produtos_vendidos.items(), key=lambda x: x[1]["faturamento"], reverse=True)[:5]
+    top_produtos = await db.vendas_item_diario.aggregate([
+        {"$match": filtro_periodo},
+        {"$group": {
+            "_id": "$produto_id",
+            "quantidade": {"$sum": "$quantidade"},
+            "faturamento": {"$sum": "$faturamento"}
+        }},
+        {"$match": {"quantidade": {"$gt": 0}}},
+        {"$sort": {"faturamento": -1, "_id": 1}},
+        {"$limit": 5}
+    ]).to_list(5)
     
     # Adicionar descrição completa dos produtos
+    descricoes = await descricoes_completas([linha["_id"] for linha in top_produtos])
     top_produtos_completo = []
-    for pid, data in top_produtos:
-        descricao = await get_produto_descricao_completa(pid)
+    for linha in top_produtos:
         top_produtos_completo.append({
-            "produto_id": pid,
-            "produto_descricao": descricao,
-            "quantidade": data["quantidade"],
-            "faturamento": data["faturamento"]
+            "produto_id": linha["_id"],
+            "produto_descricao": descricoes[linha["_id"]],
+            "quantidade": linha["quantidade"],
+            "faturamento": linha["faturamento"]
         })
     
     return {
@@ -9963,17 +11822,17 @@ async def get_kpis_dashboard(data_inicio: str = None, data_fim: str = None, curr
         },
         "estoque": {
             "valor_total": valor_estoque,
-            "produtos_total": len(produtos),
+            "produtos_total": resumo_estoque.get("produtos_total", 0),
             "alertas_minimo": produtos_alerta_minimo
         },
         "orcamentos": {
-            "total": len(orcamentos),
+            "total": total_orcamentos,
             "abertos": orcamentos_abertos,
             "convertidos": orcamentos_convertidos,
             "taxa_conversao": taxa_conversao
         },
         "clientes": {
-            "total": len(clientes),
+            "total": total_clientes,
             "ativos": clientes_ativos
         },
         "top_produtos": top_produtos_completo
@@ -9989,44 +11848,40 @@ async def relatorio_vendas_periodo(
     """
     Relatório de vendas agrupadas por período com comparação
     """
-    vendas = await db.vendas.find({
-        "status_venda": {"$nin": ["rascunho", "cancelada"]}
-    }, {"_id": 0}).to_list(10000)
-    
-    # Filtrar por período
-    vendas_periodo = [v for v in vendas if data_inicio <= v["created_at"][:10] <= data_fim]
-    
-    # Agrupar vendas
-    vendas_agrupadas = {}
-    for venda in vendas_periodo:
-        if agrupamento == "dia":
-            chave = venda["created_at"][:10]
-        elif agrupamento == "mes":
-            chave = venda["created_at"][:7]
-        else:  # semana
-            data = datetime.fromisoformat(venda["created_at"])
-            chave = f"{data.year}-W{data.isocalendar()[1]:02d}"
-        
-        if chave not in vendas_agrupadas:
-            vendas_agrupadas[chave] = {
-                "quantidade": 0,
-                "faturamento": 0,
-                "ticket_medio": 0
-            }
-        
-        vendas_agrupadas[chave]["quantidade"] += 1
-        vendas_agrupadas[chave]["faturamento"] += venda["total"]
+    # Agrupar vendas no banco: uma linha por dia, semana ou mês do período
+    chave = CHAVES_AGRUPAMENTO_PERIODO.get(agrupamento, CHAVES_AGRUPAMENTO_PERIODO["semana"])
+    periodos = await db.vendas_diarias.aggregate([
+        {"$match": {"efetivada": True, **filtro_periodo_rollup(data_inicio, data_fim)}},
+        {"$addFields": {"dia": {"$dateFromString": {"dateString": "$data", "format": "%Y-%m-%d"}}}},
+        {"$group": {
+            "_id": chave,
+            "quantidade": {"$sum": "$quantidade_vendas"},
+            "faturamento": {"$sum": "$faturamento"}
+        }},
+        {"$addFields": {
+            "ticket_medio": {"$cond": [
+                {"$gt": ["$quantidade", 0]},
+                {"$divide": ["$faturamento", "$quantidade"]},
+                0
+            ]}
+        }},
+        {"$sort": {"_id": 1}}
+    ]).to_list(None)
     
-    # Calcular ticket médio
-    for chave in vendas_agrupadas:
-        if vendas_agrupadas[chave]["quantidade"] > 0:
-            vendas_agrupadas[chave]["ticket_medio"] = vendas_agrupadas[chave]["faturamento"] / vendas_agrupadas[chave]["quantidade"]
+    vendas_agrupadas = {
+        linha["_id"]: {
+            "quantidade": linha["quantidade"],
+            "faturamento": linha["faturamento"],
+            "ticket_medio": linha["ticket_medio"]
+        }
+        for linha in periodos
+    }
     
     return {
         "periodo": {"data_inicio": data_inicio, "data_fim": data_fim},
         "agrupamento": agrupamento,
-        "total_vendas": len(vendas_periodo),
-        "faturamento_total": sum(v["total"] for v in vendas_periodo),
+        "total_vendas": sum(linha["quantidade"] for linha in periodos),
+        "faturamento_total": sum(linha["faturamento"] for linha in periodos),
         "dados": vendas_agrupadas
     }
 
@@ -10039,37 +11894,33 @@ async def relatorio_vendas_vendedor(
     """
     Relatório de vendas por vendedor/usuário
     """
-    vendas = await db.vendas.find({
-        "status_venda": {"$nin": ["rascunho", "cancelada"]}
-    }, {"_id": 0}).to_list(10000)
-    usuarios = await db.users.find({}, {"_id": 0}).to_list(1000)
+    # Agrupar por vendedor no rollup diário do período
+    vendas_por_vendedor = await db.vendas_diarias.aggregate([
+        {"$match": {"efetivada": True, **filtro_periodo_rollup(data_inicio, data_fim)}},
+        {"$group": {
+            "_id": "$vendedor_id",
+            "quantidade": {"$sum": "$quantidade_vendas"},
+            "faturamento": {"$sum": "$faturamento"}
+        }},
+        {"$sort": {"faturamento": -1, "_id": 1}}
+    ]).to_list(None)
     
-    if data_inicio and data_fim:
-        vendas = [v for v in vendas if data_inicio <= v["created_at"][:10] <= data_fim]
-    
-    # Agrupar por vendedor
-    vendas_por_vendedor = {}
-    for venda in vendas:
-        user_id = venda.get("user_id")
-        if user_id not in vendas_por_vendedor:
-            vendas_por_vendedor[user_id] = {
-                "quantidade": 0,
-                "faturamento": 0,
-                "ticket_medio": 0
-            }
-        vendas_por_vendedor[user_id]["quantidade"] += 1
-        vendas_por_vendedor[user_id]["faturamento"] += venda["total"]
+    usuarios = await db.users.find(
+        {"id": {"$in": [linha["_id"] for linha in vendas_por_vendedor]}},
+        {"_id": 0, "id": 1, "nome": 1}
+    ).to_list(None)
+    nomes_usuarios = {u["id"]: u["nome"] for u in usuarios}
     
     # Calcular ticket médio e adicionar nome do usuário
     resultado = []
-    for user_id, data in vendas_por_vendedor.items():
-        usuario = next((u for u in usuarios if u["id"] == user_id), None)
-        data["ticket_medio"] = data["faturamento"] / data["quantidade"]
-        data["user_id"] = user_id
-        data["user_nome"] = usuario["nome"] if usuario else "Usuário Desconhecido"
-        resultado.append(data)
-    
-    resultado.sort(key=lambda x: x["faturamento"], reverse=True)
+    for linha in vendas_por_vendedor:
+        resultado.append({
+            "quantidade": linha["quantidade"],
+            "faturamento": linha["faturamento"],
+            "ticket_medio": linha["faturamento"] / linha["quantidade"],
+            "user_id": linha["_id"],
+            "user_nome": nomes_usuarios.get(linha["_id"], "Usuário Desconhecido")
+        })
     
     return {
         "periodo": {"data_inicio": data_inicio, "data_fim": data_fim},
@@ -10085,29 +11936,38 @@ async def relatorio_dre(
     """
     DRE Simplificado - Demonstrativo de Resultado
     """
-    vendas = await db.vendas.find({
-        "status_venda": {"$nin": ["rascunho", "cancelada"]}
-    }, {"_id": 0}).to_list(10000)
-    produtos = await db.produtos.find({}, {"_id": 0}).to_list(10000)
-    
-    vendas_periodo = [v for v in vendas if data_inicio <= v["created_at"][:10] <= data_fim]
+    filtro_periodo = filtro_periodo_rollup(data_inicio, data_fim)
+    resumo = await db.vendas_diarias.aggregate([
+        {"$match": {"efetivada": True, **filtro_periodo}},
+        {"$group": {
+            "_id": None,
+            "faturamento": {"$sum": "$faturamento"},
+            "descontos": {"$sum": "$descontos"}
+        }}
+    ]).to_list(1)
+    resumo = resumo[0] if resumo else {}
     
     # Receita Bruta
-    receita_bruta = sum(v["total"] for v in vendas_periodo)
+    receita_bruta = resumo.get("faturamento", 0)
     
     # Descontos
-    total_descontos = sum(v.get("desconto", 0) for v in vendas_periodo)
+    total_descontos = resumo.get("descontos", 0)
     
     # Receita Líquida
     receita_liquida = receita_bruta - total_descontos
     
-    # Custo dos Produtos Vendidos (CMV)
+    # Custo dos Produtos Vendidos (CMV): quantidades do período x preço médio atual
+    quantidades = await db.vendas_item_diario.aggregate([
+        {"$match": filtro_periodo},
+        {"$group": {"_id": "$produto_id", "quantidade": {"$sum": "$quantidade"}}}
+    ]).to_list(None)
+    produtos_por_id = await carregar_produtos_por_id([linha["_id"] for linha in quantidades])
+    
     cmv = 0
-    for venda in vendas_periodo:
-        for item in venda.get("itens", []):
-            produto = next((p for p in produtos if p["id"] == item["produto_id"]), None)
-            if produto:
-                cmv += item["quantidade"] * produto.get("preco_medio", 0)
+    for linha in quantidades:
+        produto = produtos_por_id.get(linha["_id"])
+        if produto:
+            cmv += linha["quantidade"] * produto.get("preco_medio", 0)
     
     # Lucro Bruto
     lucro_bruto = receita_liquida - cmv
@@ -10134,30 +11994,27 @@ async def relatorio_curva_abc(current_user: dict = Depends(require_permission("r
     """
     Curva ABC de produtos baseada em faturamento
     """
-    vendas = await db.vendas.find({
-        "status_venda": {"$nin": ["rascunho", "cancelada"]}
-    }, {"_id": 0}).to_list(10000)
-    produtos = await db.produtos.find({}, {"_id": 0}).to_list(10000)
-    
-    # Calcular faturamento por produto
-    faturamento_por_produto = {}
-    for venda in vendas:
-        for item in venda.get("itens", []):
-            pid = item["produto_id"]
-            if pid not in faturamento_por_produto:
-                faturamento_por_produto[pid] = 0
-            faturamento_por_produto[pid] += item["quantidade"] * item["preco_unitario"]
-    
-    # Ordenar por faturamento
-    produtos_ordenados = sorted(faturamento_por_produto.items(), key=lambda x: x[1], reverse=True)
+    # Calcular faturamento por produto, já ordenado, a partir do rollup por item
+    faturamento_por_produto = await db.vendas_item_diario.aggregate([
+        {"$group": {
+            "_id": "$produto_id",
+            "quantidade": {"$sum": "$quantidade"},
+            "faturamento": {"$sum": "$faturamento"}
+        }},
+        {"$match": {"quantidade": {"$gt": 0}}},
+        {"$sort": {"faturamento": -1, "_id": 1}}
+    ]).to_list(None)
+    produtos_ordenados = [(linha["_id"], linha["faturamento"]) for linha in faturamento_por_produto]
+    produtos_por_id = await carregar_produtos_por_id([pid for pid, _ in produtos_ordenados])
+    descricoes = await descricoes_completas([pid for pid, _ in produtos_ordenados], produtos_por_id)
     
     # Calcular percentuais acumulados
-    faturamento_total = sum(faturamento_por_produto.values())
+    faturamento_total = sum(faturamento for _, faturamento in produtos_ordenados)
     percentual_acumulado = 0
     curva_abc = []
     
     for pid, faturamento in produtos_ordenados:
-        produto = next((p for p in produtos if p["id"] == pid), None)
+        produto = produtos_por_id.get(pid)
         percentual = (faturamento / faturamento_total * 100) if faturamento_total > 0 else 0
         percentual_acumulado += percentual
         
@@ -10169,13 +12026,10 @@ async def relatorio_curva_abc(current_user: dict = Depends(require_permission("r
         else:
             classe = "C"
         
-        # Obter descrição completa do produto
-        descricao = await get_produto_descricao_completa(pid)
-        
         curva_abc.append({
             "produto_id": pid,
             "produto_nome": produto["nome"] if produto else "Desconhecido",
-            "produto_descricao": descricao,
+            "produto_descricao": descricoes[pid],
             "faturamento": faturamento,
             "percentual": percentual,
             "percentual_acumulado": percentual_acumulado,
@@ -10203,43 +12057,39 @@ async def relatorio_rfm(current_user: dict = Depends(require_permission("relator
     """
     Análise RFM (Recência, Frequência, Valor Monetário) dos clientes
     """
-    vendas = await db.vendas.find({
-        "status_venda": {"$nin": ["rascunho", "cancelada"]}
-    }, {"_id": 0}).to_list(10000)
-    clientes = await db.clientes.find({}, {"_id": 0}).to_list(10000)
-    
     data_referencia = datetime.now(timezone.utc)
     
-    # Calcular RFM por cliente
+    # Calcular RFM por cliente a partir do rollup diário
+    linhas_rfm = await db.vendas_diarias.aggregate([
+        {"$match": {"efetivada": True}},
+        {"$group": {
+            "_id": "$cliente_id",
+            "frequencia": {"$sum": "$quantidade_vendas"},
+            "valor_monetario": {"$sum": "$faturamento"},
+            "ultima_compra": {"$max": "$ultima_compra"}
+        }}
+    ]).to_list(None)
+    
     rfm_por_cliente = {}
-    for venda in vendas:
-        cliente_id = venda["cliente_id"]
-        if cliente_id not in rfm_por_cliente:
-            rfm_por_cliente[cliente_id] = {
-                "recencia": 9999,  # dias desde última compra
-                "frequencia": 0,
-                "valor_monetario": 0,
-                "ultima_compra": None
-            }
-        
-        data_venda = datetime.fromisoformat(venda["created_at"])
-        dias_desde_compra = (data_referencia - data_venda).days
-        
-        # Recência (menor é melhor)
-        if dias_desde_compra < rfm_por_cliente[cliente_id]["recencia"]:
-            rfm_por_cliente[cliente_id]["recencia"] = dias_desde_compra
-            rfm_por_cliente[cliente_id]["ultima_compra"] = venda["created_at"]
-        
-        # Frequência
-        rfm_por_cliente[cliente_id]["frequencia"] += 1
-        
-        # Valor Monetário
-        rfm_por_cliente[cliente_id]["valor_monetario"] += venda["total"]
+    for linha in linhas_rfm:
+        rfm_por_cliente[linha["_id"]] = {
+            # Recência: dias desde a última compra (menor é melhor)
+            "recencia": (data_referencia - datetime.fromisoformat(linha["ultima_compra"])).days,
+            "frequencia": linha["frequencia"],
+            "valor_monetario": linha["valor_monetario"],
+            "ultima_compra": linha["ultima_compra"]
+        }
+    
+    clientes = await db.clientes.find(
+        {"id": {"$in": list(rfm_por_cliente.keys())}},
+        {"_id": 0, "id": 1, "nome": 1}
+    ).to_list(None)
+    clientes_por_id = {c["id"]: c for c in clientes}
     
     # Calcular scores RFM (1-5)
     resultado = []
     for cliente_id, rfm in rfm_por_cliente.items():
-        cliente = next((c for c in clientes if c["id"] == cliente_id), None)
+        cliente = clientes_por_id.get(cliente_id)
         
         # Score de Recência (inverso - quanto menor, melhor)
         if rfm["recencia"] <= 30:
@@ -10322,24 +12172,34 @@ async def relatorio_conversao_orcamentos(
     """
     Análise de conversão de orçamentos em vendas
     """
-    orcamentos = await db.orcamentos.find({}, {"_id": 0}).to_list(10000)
-    
-    if data_inicio and data_fim:
-        orcamentos = [o for o in orcamentos if data_inicio <= o["created_at"][:10] <= data_fim]
+    resumo = await db.orcamentos.aggregate([
+        {"$match": filtro_periodo_iso("created_at", data_inicio, data_fim)},
+        {"$group": {
+            "_id": None,
+            "total": {"$sum": 1},
+            "abertos": contar_se_igual("status", "aberto"),
+            "vendidos": contar_se_igual("status", "vendido"),
+            "devolvidos": contar_se_igual("status", "devolvido"),
+            "cancelados": contar_se_igual("status", "cancelado"),
+            "valor_total": {"$sum": "$total"},
+            "valor_vendido": contar_se_igual("status", "vendido", soma="$total")
+        }}
+    ]).to_list(1)
+    resumo = resumo[0] if resumo else {}
     
     # Estatísticas por status
-    total = len(orcamentos)
-    abertos = len([o for o in orcamentos if o["status"] == "aberto"])
-    vendidos = len([o for o in orcamentos if o["status"] == "vendido"])
-    devolvidos = len([o for o in orcamentos if o["status"] == "devolvido"])
-    cancelados = len([o for o in orcamentos if o.get("status") == "cancelado"])
+    total = resumo.get("total", 0)
+    abertos = resumo.get("abertos", 0)
+    vendidos = resumo.get("vendidos", 0)
+    devolvidos = resumo.get("devolvidos", 0)
+    cancelados = resumo.get("cancelados", 0)
     
     # Taxa de conversão
     taxa_conversao = (vendidos / total * 100) if total > 0 else 0
     
     # Valor médio
-    valor_medio_orcamento = sum(o["total"] for o in orcamentos) / total if total > 0 else 0
-    valor_medio_vendido = sum(o["total"] for o in orcamentos if o["status"] == "vendido") / vendidos if vendidos > 0 else 0
+    valor_medio_orcamento = resumo.get("valor_total", 0) / total if total > 0 else 0
+    valor_medio_vendido = resumo.get("valor_vendido", 0) / vendidos if vendidos > 0 else 0
     
     return {
         "periodo": {"data_inicio": data_inicio, "data_fim": data_fim},
@@ -10368,49 +12228,33 @@ async def relatorio_auditoria(
     """
     Relatório de auditoria - logs de ações do sistema
     """
-    logs = await db.logs.find({}, {"_id": 0}).sort("timestamp", -1).to_list(5000)
-    
     # Filtros
-    if data_inicio and data_fim:
-        logs = [log for log in logs if data_inicio <= log["timestamp"][:10] <= data_fim]
-    
+    filtro = filtro_periodo_iso("timestamp", data_inicio, data_fim)
     if user_id:
-        logs = [log for log in logs if log["user_id"] == user_id]
-    
+        filtro["user_id"] = user_id
     if acao:
-        logs = [log for log in logs if log["acao"] == acao]
+        filtro["acao"] = acao
     
-    # Estatísticas
-    acoes_por_tipo = {}
-    acoes_por_usuario = {}
-    acoes_por_tela = {}
-    
-    for log_item in logs:
-        # Por tipo de ação
-        acao_tipo = log_item["acao"]
-        if acao_tipo not in acoes_por_tipo:
-            acoes_por_tipo[acao_tipo] = 0
-        acoes_por_tipo[acao_tipo] += 1
-        
-        # Por usuário
-        usuario = log_item["user_nome"]
-        if usuario not in acoes_por_usuario:
-            acoes_por_usuario[usuario] = 0
-        acoes_por_usuario[usuario] += 1
-        
-        # Por tela
-        tela = log_item["tela"]
-        if tela not in acoes_por_tela:
-            acoes_por_tela[tela] = 0
-        acoes_por_tela[tela] += 1
+    # Estatísticas e últimos 50 logs em uma única passada
+    resultado = await db.logs.aggregate([
+        {"$match": filtro},
+        {"$facet": {
+            "total": [{"$count": "quantidade"}],
+            "por_tipo": [{"$group": {"_id": "$acao", "quantidade": {"$sum": 1}}}],
+            "por_usuario": [{"$group": {"_id": "$user_nome", "quantidade": {"$sum": 1}}}],
+            "por_tela": [{"$group": {"_id": "$tela", "quantidade": {"$sum": 1}}}],
+            "recentes": [{"$sort": {"timestamp": -1}}, {"$limit": 50}, {"$project": {"_id": 0}}]
+        }}
+    ]).to_list(1)
+    resultado = resultado[0]
     
     return {
         "periodo": {"data_inicio": data_inicio, "data_fim": data_fim},
-        "total_acoes": len(logs),
-        "acoes_por_tipo": acoes_por_tipo,
-        "acoes_por_usuario": acoes_por_usuario,
-        "acoes_por_tela": acoes_por_tela,
-        "logs_recentes": logs[:50]  # Últimos 50 logs
+        "total_acoes": resultado["total"][0]["quantidade"] if resultado["total"] else 0,
+        "acoes_por_tipo": {linha["_id"]: linha["quantidade"] for linha in resultado["por_tipo"]},
+        "acoes_por_usuario": {linha["_id"]: linha["quantidade"] for linha in resultado["por_usuario"]},
+        "acoes_por_tela": {linha["_id"]: linha["quantidade"] for linha in resultado["por_tela"]},
+        "logs_recentes": resultado["recentes"]  # Últimos 50 logs
     }
 
 
@@ -10425,6 +12269,7 @@ async def reservar_estoque_orcamento(orcamento_id: str, itens: List[dict]):
             {"id": item["produto_id"]},
             {"$inc": {"estoque_reservado": item["quantidade"]}}
         )
+        produto_codigo_cache.invalidar([item["produto_id"]])
 
 async def liberar_estoque_orcamento(orcamento_id: str, itens: List[dict]):
     """Libera estoque reservado ao converter/cancelar/expirar orçamento"""
@@ -10433,19 +12278,98 @@ async def liberar_estoque_orcamento(orcamento_id: str, itens: List[dict]):
             {"id": item["produto_id"]},
             {"$inc": {"estoque_reservado": -item["quantidade"]}}
         )
+        produto_codigo_cache.invalidar([item["produto_id"]])
+
+def diferenca_reserva(itens_anteriores: List[dict], itens_novos: List[dict]) -> dict:
+    """{produto_id: novo - anterior} das quantidades reservadas, só para os produtos que mudaram"""
+    delta = defaultdict(int)
+    for item in itens_novos:
+        delta[item["produto_id"]] += item["quantidade"]
+    for item in itens_anteriores:
+        delta[item["produto_id"]] -= item["quantidade"]
+    return {produto_id: quantidade for produto_id, quantidade in delta.items() if quantidade}
+
+async def ajustar_reserva_orcamento(orcamento_id: str, delta: dict):
+    """Aplica em estoque_reservado a diferença calculada por diferenca_reserva ao editar um orçamento aberto"""
+    if not delta:
+        return
+    await db.produtos.bulk_write([
+        UpdateOne({"id": produto_id}, {"$inc": {"estoque_reservado": quantidade}})
+        for produto_id, quantidade in delta.items()
+    ], ordered=False)
+    produto_codigo_cache.invalidar(list(delta))
 
 def calcular_estoque_disponivel(produto: dict) -> int:
     """Calcula estoque disponível = atual - reservado"""
     return produto.get("estoque_atual", 0) - produto.get("estoque_reservado", 0)
 
-# ==================== MELHORIA 2: VALIDAÇÃO DE LIMITE DE CRÉDITO ====================
+async def carregar_produtos_por_id(produto_ids: List[str]) -> dict:
+    """Busca vários produtos em uma única query ($in). Retorna {produto_id: produto}."""
+    ids = list(dict.fromkeys(produto_ids))
+    if not ids:
+        return {}
+    produtos = await db.produtos.find({"id": {"$in": ids}}, {"_id": 0}).to_list(None)
+    return {p["id"]: p for p in produtos}
 
-async def validar_limite_credito(cliente_id: str, valor_venda: float, forma_pagamento: str) -> dict:
+async def reconciliar_estoque_reservado() -> dict:
     """
-    Valida se cliente pode realizar venda a prazo baseado no limite de crédito.
-    Retorna: {"permitido": bool, "mensagem": str, "credito_disponivel": float}
+    Reconstrói estoque_reservado de todos os produtos a partir dos orçamentos
+    abertos/aprovados com uma única agregação, corrigindo desvios do contador.
     """
-    # Vendas à vista não precisam validar crédito
+    reservas = await db.orcamentos.aggregate([
+        {"$match": {"status": {"$in": ["aberto", "aprovado"]}}},
+        {"$unwind": "$itens"},
+        {"$group": {"_id": "$itens.produto_id", "reservado": {"$sum": "$itens.quantidade"}}}
+    ]).to_list(None)
+    reservas_por_produto = {r["_id"]: r["reservado"] for r in reservas if r["_id"]}
+    
+    # Produtos com reserva registrada mas sem orçamento aberto
+    zerados = await db.produtos.update_many(
+        {"id": {"$nin": list(reservas_por_produto)}, "estoque_reservado": {"$nin": [0, None]}},
+        {"$set": {"estoque_reservado": 0}}
+    )
+    
+    corrigidos = 0
+    if reservas_por_produto:
+        resultado = await db.produtos.bulk_write([
+            UpdateOne(
+                {"id": produto_id, "estoque_reservado": {"$ne": reservado}},
+                {"$set": {"estoque_reservado": reservado}}
+            )
+            for produto_id, reservado in reservas_por_produto.items()
+        ], ordered=False)
+        corrigidos = resultado.modified_count
+    produto_codigo_cache.clear()
+    
+    return {
+        "produtos_com_reserva": len(reservas_por_produto),
+        "produtos_corrigidos": corrigidos + zerados.modified_count
+    }
+
+@api_router.post("/estoque/reconciliar-reservas")
+async def reconciliar_reservas_estoque(current_user: dict = Depends(require_permission("estoque", "editar"))):
+    """Recalcula estoque_reservado de todos os produtos a partir dos orçamentos abertos"""
+    resultado = await reconciliar_estoque_reservado()
+    
+    await log_action(
+        ip="0.0.0.0",
+        user_id=current_user["id"],
+        user_nome=current_user["nome"],
+        tela="estoque",
+        acao="reconciliar_reservas",
+        detalhes=resultado
+    )
+    
+    return {"success": True, **resultado}
+
+# ==================== MELHORIA 2: VALIDAÇÃO DE LIMITE DE CRÉDITO ====================
+
+async def validar_limite_credito(cliente_id: str, valor_venda: float, forma_pagamento: str) -> dict:
+    """
+    Valida se cliente pode realizar venda a prazo baseado no limite de crédito.
+    Retorna: {"permitido": bool, "mensagem": str, "credito_disponivel": float}
+    """
+    # Vendas à vista não precisam validar crédito
     if forma_pagamento in ["pix", "dinheiro", "cartao_debito"]:
         return {"permitido": True, "mensagem": "Pagamento à vista", "credito_disponivel": None}
     
@@ -10593,9 +12517,11 @@ async def listar_comissoes(
     data_fim: Optional[str] = None,
     page: int = 1,
     limit: int = 20,
+    after: str = None,
+    contagem: str = "exato",
     current_user: dict = Depends(get_current_user)
 ):
-    """Lista comissões de vendedores"""
+    """Lista comissões de vendedores (paginação por cursor opcional com 'after')"""
     filtro = {}
     
     # Vendedor só vê suas próprias comissões
@@ -10612,15 +12538,18 @@ async def listar_comissoes(
     if data_fim:
         filtro.setdefault("data_venda", {})["$lte"] = data_fim
     
-    skip = (page - 1) * limit
-    total = await db.comissoes_vendedores.count_documents(filtro)
-    comissoes = await db.comissoes_vendedores.find(filtro, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    page, limit, skip = validate_pagination(page, limit)
+    comissoes, total, meta = await paginar_colecao(
+        db.comissoes_vendedores, filtro, {"_id": 0}, sort_field="created_at", sort_dir=-1,
+        skip=skip, limit=limit, after=after, contagem=contagem
+    )
     
     # Calcular totais
     total_pendente = sum(c["valor_comissao"] for c in comissoes if c["status"] == "pendente")
     total_pago = sum(c["valor_comissao"] for c in comissoes if c["status"] == "pago")
     
     return api_list(comissoes, page=page, limit=limit, total=total, extra_meta={
+        **meta,
         "total_pendente": total_pendente,
         "total_pago": total_pago
     })
@@ -10712,6 +12641,10 @@ async def calcular_curva_abc(
     B = 15% do faturamento (próximos ~30%)
     C = 5% do faturamento (restante ~50%)
     """
+    return await recalcular_curva_abc(periodo_meses)
+
+async def recalcular_curva_abc(periodo_meses: int = 12) -> dict:
+    """Classifica os produtos na Curva ABC pelo faturamento dos últimos periodo_meses"""
     data_limite = (datetime.now(timezone.utc) - timedelta(days=periodo_meses * 30)).isoformat()
     
     # Buscar vendas do período
@@ -10735,9 +12668,16 @@ async def calcular_curva_abc(
     # Calcular totais
     faturamento_total = sum(r["faturamento"] for r in resultados)
     
-    # Classificar produtos
+    # Estoque dos produtos vendidos em uma consulta; classificação e distribuição no mesmo laço
+    estoques = {
+        p["id"]: p.get("estoque_atual", 1)
+        async for p in db.produtos.find(
+            {"id": {"$in": [r["_id"] for r in resultados]}}, {"_id": 0, "id": 1, "estoque_atual": 1}
+        )
+    }
     faturamento_acumulado = 0
-    produtos_atualizados = 0
+    distribuicao = {"A": 0, "B": 0, "C": 0}
+    operacoes = []
     
     for r in resultados:
         faturamento_acumulado += r["faturamento"]
@@ -10750,22 +12690,23 @@ async def calcular_curva_abc(
             curva = "B"
         else:
             curva = "C"
+        distribuicao[curva] += 1
         
         # Calcular giro de estoque
-        produto = await db.produtos.find_one({"id": r["_id"]}, {"_id": 0})
-        if produto:
-            estoque_medio = produto.get("estoque_atual", 1) or 1
+        if r["_id"] in estoques:
+            estoque_medio = estoques[r["_id"]] or 1
             giro = (r["quantidade_vendida"] / estoque_medio) / periodo_meses if estoque_medio > 0 else 0
-            
-            await db.produtos.update_one(
+            operacoes.append(UpdateOne(
                 {"id": r["_id"]},
                 {"$set": {
                     "curva_abc": curva,
                     "giro_estoque": round(giro, 2),
                     "faturamento_acumulado": r["faturamento"]
                 }}
-            )
-            produtos_atualizados += 1
+            ))
+    
+    for inicio in range(0, len(operacoes), 1000):
+        await db.produtos.bulk_write(operacoes[inicio:inicio + 1000], ordered=False)
     
     # Produtos sem vendas são classificados como C
     produtos_sem_venda = await db.produtos.update_many(
@@ -10777,13 +12718,9 @@ async def calcular_curva_abc(
         "message": "Curva ABC calculada com sucesso",
         "periodo_meses": periodo_meses,
         "faturamento_total": faturamento_total,
-        "produtos_atualizados": produtos_atualizados,
+        "produtos_atualizados": len(operacoes),
         "produtos_sem_venda": produtos_sem_venda.modified_count,
-        "distribuicao": {
-            "A": len([r for r in resultados if (sum(x["faturamento"] for x in resultados[:resultados.index(r)+1]) / faturamento_total * 100) <= 80]),
-            "B": len([r for r in resultados if 80 < (sum(x["faturamento"] for x in resultados[:resultados.index(r)+1]) / faturamento_total * 100) <= 95]),
-            "C": len([r for r in resultados if (sum(x["faturamento"] for x in resultados[:resultados.index(r)+1]) / faturamento_total * 100) > 95])
-        }
+        "distribuicao": distribuicao
     }
 
 @api_router.get("/produtos/curva-abc")
@@ -11379,25 +13316,20 @@ async def auditoria_estoque(
     """
     Gera relatório de auditoria comparando estoque do sistema com movimentações.
     Identifica divergências.
+    O estoque calculado parte do último checkpoint do razão e soma, em um único $group,
+    só as movimentações posteriores a ele.
     """
-    produtos = await db.produtos.find({"ativo": True}, {"_id": 0}).to_list(10000)
+    produtos = await db.produtos.find(
+        {"ativo": True},
+        {"_id": 0, "id": 1, "nome": 1, "sku": 1, "estoque_atual": 1}
+    ).to_list(None)
+    saldos, corte = await saldos_ledger()
     
     divergencias = []
     
     for produto in produtos:
-        # Calcular estoque teórico baseado em movimentações
-        movimentacoes = await db.movimentacoes_estoque.find(
-            {"produto_id": produto["id"]},
-            {"_id": 0}
-        ).to_list(10000)
-        
-        estoque_calculado = 0
-        for mov in movimentacoes:
-            if mov.get("tipo") == "entrada":
-                estoque_calculado += mov.get("quantidade", 0)
-            else:
-                estoque_calculado -= mov.get("quantidade", 0)
-        
+        saldo = saldos.get(produto["id"], {"saldo": 0, "movimentacoes": 0})
+        estoque_calculado = saldo["saldo"]
         estoque_sistema = produto.get("estoque_atual", 0)
         
         if estoque_calculado != estoque_sistema:
@@ -11408,11 +13340,12 @@ async def auditoria_estoque(
                 "estoque_sistema": estoque_sistema,
                 "estoque_calculado": estoque_calculado,
                 "diferenca": estoque_sistema - estoque_calculado,
-                "total_movimentacoes": len(movimentacoes)
+                "total_movimentacoes": saldo["movimentacoes"]
             })
     
     return {
         "data_auditoria": datetime.now(timezone.utc).isoformat(),
+        "checkpoint": corte,
         "total_produtos": len(produtos),
         "produtos_com_divergencia": len(divergencias),
         "divergencias": sorted(divergencias, key=lambda x: abs(x["diferenca"]), reverse=True)
@@ -11425,7 +13358,11 @@ async def reconciliar_estoque(
     motivo: str = Body(...),
     current_user: dict = Depends(require_permission("estoque", "editar"))
 ):
-    """Reconcilia estoque do sistema com contagem física"""
+    """
+    Reconcilia estoque do sistema com contagem física.
+    A movimentação de ajuste leva o razão (último checkpoint + movimentações desde ele)
+    à contagem física, de modo que a auditoria deixa de apontar divergência no produto.
+    """
     produto = await db.produtos.find_one({"id": produto_id}, {"_id": 0})
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
@@ -11433,39 +13370,328 @@ async def reconciliar_estoque(
     estoque_sistema = produto.get("estoque_atual", 0)
     diferenca = estoque_fisico - estoque_sistema
     
-    if diferenca == 0:
+    saldos, _ = await saldos_ledger(produto_ids=[produto_id])
+    estoque_calculado = saldos.get(produto_id, {"saldo": 0})["saldo"]
+    ajuste_movimentacao = estoque_fisico - estoque_calculado
+    
+    if diferenca == 0 and ajuste_movimentacao == 0:
         return {"message": "Estoque já está correto, nenhum ajuste necessário"}
     
     # Criar movimentação de ajuste
-    tipo = "entrada" if diferenca > 0 else "saida"
-    
-    movimentacao = MovimentacaoEstoque(
-        produto_id=produto_id,
-        tipo=tipo,
-        quantidade=abs(diferenca),
-        referencia_tipo="reconciliacao_auditoria",
-        referencia_id=f"AUDIT-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}",
-        user_id=current_user["id"],
-        observacao=f"Reconciliação de auditoria: {motivo}"
-    )
+    tipo = "entrada" if (ajuste_movimentacao or diferenca) > 0 else "saida"
     
-    await db.movimentacoes_estoque.insert_one(movimentacao.model_dump())
+    if ajuste_movimentacao != 0:
+        movimentacao = MovimentacaoEstoque(
+            produto_id=produto_id,
+            tipo=tipo,
+            quantidade=abs(ajuste_movimentacao),
+            referencia_tipo="reconciliacao_auditoria",
+            referencia_id=f"AUDIT-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}",
+            user_id=current_user["id"],
+            observacao=f"Reconciliação de auditoria: {motivo}"
+        )
+        
+        await db.movimentacoes_estoque.insert_one(movimentacao.model_dump())
     
     # Atualizar estoque
-    await db.produtos.update_one(
-        {"id": produto_id},
-        {"$set": {"estoque_atual": estoque_fisico}}
-    )
+    if diferenca != 0:
+        await db.produtos.update_one(
+            {"id": produto_id},
+            {"$set": {"estoque_atual": estoque_fisico}}
+        )
+        produto_codigo_cache.invalidar([produto_id])
     
     return {
         "message": "Estoque reconciliado",
         "estoque_anterior": estoque_sistema,
+        "estoque_calculado": estoque_calculado,
         "estoque_novo": estoque_fisico,
         "ajuste": diferenca,
+        "ajuste_movimentacao": ajuste_movimentacao,
         "tipo_ajuste": tipo
     }
 
 
+# ==================== CHECKPOINTS DO RAZÃO DE ESTOQUE ====================
+# estoque_checkpoints: saldo de cada produto pelas movimentações com timestamp anterior ao
+# corte (uma linha por produto e corte); estoque_checkpoints_controle marca os cortes
+# completos. Auditoria e reconciliação partem do último corte completo e somam só as
+# movimentações a partir dele. Os cortes são mensais (início do mês em UTC) e criados pelo
+# agendador; como as movimentações são gravadas com o horário atual, um corte passado não
+# recebe movimentações novas.
+
+SALDO_MOVIMENTACAO_EXPR = {"$cond": [
+    {"$eq": ["$tipo", "entrada"]},
+    {"$ifNull": ["$quantidade", 0]},
+    {"$multiply": [-1, {"$ifNull": ["$quantidade", 0]}]}
+]}
+
+def inicio_mes_utc(data: datetime = None) -> str:
+    data = (data or datetime.now(timezone.utc)).astimezone(timezone.utc)
+    return data.replace(day=1, hour=0, minute=0, second=0, microsecond=0).isoformat()
+
+def proximo_mes_utc(corte: str) -> str:
+    data = datetime.fromisoformat(corte)
+    if data.month == 12:
+        return data.replace(year=data.year + 1, month=1).isoformat()
+    return data.replace(month=data.month + 1).isoformat()
+
+async def ultimo_checkpoint_estoque(ate: str = None) -> Optional[dict]:
+    """Último corte completo (com corte <= ate, se informado)"""
+    filtro = {"status": "completo"}
+    if ate:
+        filtro["corte"] = {"$lte": ate}
+    return await db.estoque_checkpoints_controle.find_one(filtro, {"_id": 0}, sort=[("corte", -1)])
+
+async def saldos_movimentacoes(inicio: str = None, fim: str = None, produto_ids: List[str] = None) -> dict:
+    """{produto_id: {"saldo", "movimentacoes"}} das movimentações com inicio <= timestamp < fim"""
+    filtro = {}
+    faixa = {}
+    if inicio:
+        faixa["$gte"] = inicio
+    if fim:
+        faixa["$lt"] = fim
+    if faixa:
+        filtro["timestamp"] = faixa
+    if produto_ids is not None:
+        filtro["produto_id"] = {"$in": produto_ids}
+    linhas = await db.movimentacoes_estoque.aggregate([
+        {"$match": filtro},
+        {"$group": {"_id": "$produto_id", "saldo": {"$sum": SALDO_MOVIMENTACAO_EXPR}, "movimentacoes": {"$sum": 1}}}
+    ], allowDiskUse=True).to_list(None)
+    return {linha["_id"]: {"saldo": linha["saldo"], "movimentacoes": linha["movimentacoes"]} for linha in linhas}
+
+async def saldos_ledger(ate: str = None, produto_ids: List[str] = None) -> tuple:
+    """
+    Saldo pelas movimentações com timestamp < ate (todas, sem ate): linhas do último corte
+    completo mais as movimentações desde ele. Retorna ({produto_id: {"saldo", "movimentacoes"}}, corte).
+    """
+    checkpoint = await ultimo_checkpoint_estoque(ate)
+    corte = checkpoint["corte"] if checkpoint else None
+    saldos = {}
+    if corte:
+        filtro = {"corte": corte}
+        if produto_ids is not None:
+            filtro["produto_id"] = {"$in": produto_ids}
+        async for linha in db.estoque_checkpoints.find(filtro, {"_id": 0, "produto_id": 1, "saldo": 1, "movimentacoes": 1}):
+            saldos[linha["produto_id"]] = {"saldo": linha["saldo"], "movimentacoes": linha["movimentacoes"]}
+    
+    for produto_id, delta in (await saldos_movimentacoes(corte, ate, produto_ids)).items():
+        saldo = saldos.setdefault(produto_id, {"saldo": 0, "movimentacoes": 0})
+        saldo["saldo"] += delta["saldo"]
+        saldo["movimentacoes"] += delta["movimentacoes"]
+    return saldos, corte
+
+async def custos_checkpoint(corte: Optional[str], produto_ids: List[str] = None) -> dict:
+    """{produto_id: preco_medio} gravado nas linhas do corte (cortes antigos, sem o campo, ficam de fora)"""
+    if not corte:
+        return {}
+    filtro = {"corte": corte, "preco_medio": {"$ne": None}}
+    if produto_ids is not None:
+        filtro["produto_id"] = {"$in": produto_ids}
+    return {
+        linha["produto_id"]: linha["preco_medio"]
+        async for linha in db.estoque_checkpoints.find(filtro, {"_id": 0, "produto_id": 1, "preco_medio": 1})
+    }
+
+async def criar_checkpoint_estoque(corte: str = None) -> dict:
+    """
+    Grava o saldo e o preço médio de todos os produtos no corte (padrão: início do mês atual),
+    a partir do corte anterior. O preço médio é o do momento da gravação: na rotina mensal
+    (logo após a virada) é o do corte; cortes antigos refeitos depois recebem o preço de agora.
+    """
+    corte = corte or inicio_mes_utc()
+    # Fora de "completo" enquanto é regravado: o cálculo abaixo parte do corte anterior
+    await db.estoque_checkpoints_controle.update_one(
+        {"corte": corte},
+        {"$set": {"corte": corte, "status": "em_andamento", "iniciado_em": iso_utc_now()}},
+        upsert=True
+    )
+    saldos, corte_base = await saldos_ledger(corte)
+    # Custo médio de cada produto no momento do corte, para valorizar posições passadas
+    precos = {
+        p["id"]: p.get("preco_medio") or 0
+        async for p in db.produtos.find({}, {"_id": 0, "id": 1, "preco_medio": 1})
+    }
+    
+    await db.estoque_checkpoints.delete_many({"corte": corte})
+    agora = iso_utc_now()
+    linhas = [
+        {"corte": corte, "produto_id": produto_id, "saldo": saldo["saldo"],
+         "movimentacoes": saldo["movimentacoes"], "preco_medio": precos.get(produto_id), "criado_em": agora}
+        for produto_id, saldo in saldos.items() if produto_id
+    ]
+    for inicio in range(0, len(linhas), 1000):
+        await db.estoque_checkpoints.insert_many(linhas[inicio:inicio + 1000], ordered=False)
+    
+    resultado = {"corte": corte, "corte_base": corte_base, "produtos": len(linhas)}
+    await db.estoque_checkpoints_controle.update_one(
+        {"corte": corte},
+        {"$set": {"status": "completo", "produtos": len(linhas), "corte_base": corte_base, "criado_em": agora}}
+    )
+    return resultado
+
+async def cortes_mensais_pendentes() -> List[str]:
+    """Inícios de mês, do mês seguinte à primeira movimentação até o atual, ainda sem corte completo"""
+    primeira = await db.movimentacoes_estoque.find_one(
+        {"timestamp": {"$type": "string"}}, {"_id": 0, "timestamp": 1}, sort=[("timestamp", 1)]
+    )
+    if not primeira:
+        return []
+    data_primeira = parse_date_input(primeira["timestamp"])
+    if not data_primeira:
+        return []
+    completos = set(await db.estoque_checkpoints_controle.distinct("corte", {"status": "completo"}))
+    atual = inicio_mes_utc()
+    cortes = []
+    corte = proximo_mes_utc(inicio_mes_utc(data_primeira))
+    while corte <= atual:
+        if corte not in completos:
+            cortes.append(corte)
+        corte = proximo_mes_utc(corte)
+    return cortes
+
+@api_router.get("/estoque/checkpoints")
+async def listar_checkpoints_estoque(current_user: dict = Depends(require_permission("estoque", "ler"))):
+    """Cortes do razão de estoque (mais recentes primeiro)"""
+    checkpoints = await db.estoque_checkpoints_controle.find({}, {"_id": 0}).sort("corte", -1).to_list(240)
+    return {"checkpoints": checkpoints}
+
+@api_router.post("/estoque/checkpoints")
+async def criar_checkpoint_estoque_endpoint(
+    corte: Optional[str] = Body(None, embed=True),
+    current_user: dict = Depends(require_permission("estoque", "editar"))
+):
+    """Cria (ou refaz) o corte informado; sem corte, o do início do mês atual"""
+    if corte:
+        data = parse_date_input(corte)
+        if not data:
+            raise HTTPException(status_code=400, detail="Corte inválido. Use YYYY-MM-DD ou ISO 8601")
+        corte = data.astimezone(timezone.utc).isoformat()
+    resultado = await criar_checkpoint_estoque(corte)
+    
+    await log_action(
+        ip="0.0.0.0",
+        user_id=current_user["id"],
+        user_nome=current_user["nome"],
+        tela="estoque",
+        acao="criar_checkpoint",
+        detalhes=resultado
+    )
+    
+    return resultado
+
+
+# ==================== POSIÇÃO DE ESTOQUE EM DATA ====================
+# Quantidade e valor de cada produto numa data passada: saldo do último checkpoint do razão
+# anterior à data mais o $group das movimentações entre o corte e a data (no máximo um mês
+# quando o agendador está em dia). Valorização pelo preço médio gravado no checkpoint; as
+# compras entre o corte e a data não entram no custo (aproximação de até um mês), e produtos
+# sem linha no corte (ou posições anteriores ao primeiro corte) usam o preço médio atual.
+
+import csv
+
+POSICAO_CAMPOS_CSV = ["produto_id", "sku", "nome", "categoria_id", "marca_id", "quantidade", "custo_unitario", "valor"]
+
+def limite_posicao(data: str) -> str:
+    """Limite exclusivo da posição: fim do dia para YYYY-MM-DD, senão o próprio instante (UTC)"""
+    data_dt = parse_date_input(data)
+    if not data_dt:
+        raise HTTPException(status_code=400, detail="Data inválida. Use YYYY-MM-DD ou ISO 8601")
+    if len(data.strip()) == 10:
+        data_dt = data_dt.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    return data_dt.astimezone(timezone.utc).isoformat()
+
+async def posicao_estoque(
+    ate: str,
+    categoria_id: Optional[str] = None,
+    marca_id: Optional[str] = None,
+    incluir_zerados: bool = False
+) -> tuple:
+    """
+    Retorna (corte, linhas): corte usado do razão e gerador assíncrono de
+    {produto_id, sku, nome, categoria_id, marca_id, quantidade, custo_unitario, valor}.
+    """
+    filtro = {}
+    if categoria_id:
+        filtro["categoria_id"] = categoria_id
+    if marca_id:
+        filtro["marca_id"] = marca_id
+    produto_ids = await db.produtos.distinct("id", filtro) if filtro else None
+    saldos, corte = await saldos_ledger(ate, produto_ids)
+    custos = await custos_checkpoint(corte, produto_ids)
+    
+    async def linhas():
+        projecao = {"_id": 0, "id": 1, "sku": 1, "nome": 1, "categoria_id": 1, "marca_id": 1, "preco_medio": 1}
+        async for produto in db.produtos.find(filtro, projecao).sort("nome", 1):
+            quantidade = saldos.get(produto["id"], {"saldo": 0})["saldo"]
+            if not quantidade and not incluir_zerados:
+                continue
+            custo = custos.get(produto["id"], produto.get("preco_medio")) or 0
+            yield {
+                "produto_id": produto["id"],
+                "sku": produto.get("sku"),
+                "nome": produto.get("nome"),
+                "categoria_id": produto.get("categoria_id"),
+                "marca_id": produto.get("marca_id"),
+                "quantidade": quantidade,
+                "custo_unitario": round(custo, 2),
+                "valor": round(quantidade * custo, 2)
+            }
+    
+    return corte, linhas()
+
+@api_router.get("/estoque/posicao")
+async def get_posicao_estoque(
+    data: str,
+    categoria_id: Optional[str] = None,
+    marca_id: Optional[str] = None,
+    incluir_zerados: bool = False,
+    formato: str = "ndjson",
+    current_user: dict = Depends(require_permission("estoque", "ler"))
+):
+    """
+    Posição (quantidade e valor) de todos os produtos em `data`, em streaming.
+    formato=ndjson: uma linha JSON por produto e uma linha final {"resumo": {...}};
+    formato=csv: cabeçalho e uma linha por produto.
+    """
+    if formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Formato inválido. Use ndjson ou csv")
+    ate = limite_posicao(data)
+    corte, linhas = await posicao_estoque(ate, categoria_id, marca_id, incluir_zerados)
+    
+    async def ndjson():
+        produtos = 0
+        quantidade = 0
+        valor = 0.0
+        async for linha in linhas:
+            produtos += 1
+            quantidade += linha["quantidade"]
+            valor += linha["valor"]
+            yield json.dumps(linha, ensure_ascii=False) + "\n"
+        yield json.dumps({"resumo": {
+            "data": data, "ate": ate, "checkpoint": corte, "produtos": produtos,
+            "quantidade_total": quantidade, "valor_total": round(valor, 2)
+        }}, ensure_ascii=False) + "\n"
+    
+    async def csv_linhas():
+        buffer = io.StringIO()
+        escritor = csv.DictWriter(buffer, fieldnames=POSICAO_CAMPOS_CSV)
+        escritor.writeheader()
+        async for linha in linhas:
+            escritor.writerow(linha)
+            if buffer.tell() >= 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    headers = {"X-Posicao-Ate": ate, "X-Posicao-Checkpoint": corte or ""}
+    if formato == "csv":
+        headers["Content-Disposition"] = f'attachment; filename="posicao_estoque_{data[:10]}.csv"'
+        return StreamingResponse(csv_linhas(), media_type="text/csv; charset=utf-8", headers=headers)
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson", headers=headers)
+
 # ========== CONTAS A RECEBER ==========
 
 # Função helper para gerar número de conta a receber
@@ -11526,6 +13752,42 @@ async def atualizar_status_conta_receber(conta_id: str):
             "updated_at": iso_utc_now()
         }}
     )
+    
+    # Chamado após toda baixa, estorno ou vencimento de parcela
+    await sincronizar_parcelas_index("receber", [conta_id])
+
+def projecao_contagem_parcelas(campo_liquidadas: str, status_liquidada: str) -> dict:
+    """Campos de projeção que contam as parcelas (total e liquidadas) no próprio servidor"""
+    parcelas = {"$ifNull": ["$parcelas", []]}
+    return {
+        "parcelas_count": {"$size": parcelas},
+        campo_liquidadas: {"$size": {"$filter": {
+            "input": parcelas, "as": "p", "cond": {"$eq": ["$$p.status", status_liquidada]}
+        }}}
+    }
+
+# Projeções enxutas das listas de contas (sem parcelas completas, só as contagens)
+PROJECAO_LISTA_CONTAS_RECEBER = {
+    "_id": 0,
+    "id": 1, "numero": 1, "descricao": 1, "status": 1,
+    "valor_total": 1, "valor_recebido": 1, "valor_pendente": 1,
+    "cliente_id": 1, "cliente_nome": 1,
+    "forma_pagamento": 1, "categoria": 1,
+    "origem": 1, "origem_numero": 1,
+    "created_at": 1, "updated_at": 1, "cancelada": 1,
+    **projecao_contagem_parcelas("parcelas_recebidas_count", "recebido")
+}
+
+PROJECAO_LISTA_CONTAS_PAGAR = {
+    "_id": 0,
+    "id": 1, "numero": 1, "descricao": 1, "status": 1,
+    "valor_total": 1, "valor_pago": 1, "valor_pendente": 1,
+    "fornecedor_id": 1, "fornecedor_nome": 1,
+    "forma_pagamento": 1, "categoria": 1, "prioridade": 1,
+    "origem": 1, "origem_numero": 1,
+    "created_at": 1, "updated_at": 1, "cancelada": 1,
+    **projecao_contagem_parcelas("parcelas_pagas_count", "pago")
+}
 
 # Listar contas a receber
 @api_router.get("/contas-receber", tags=["Financeiro"], summary="Lista contas a receber")
@@ -11541,11 +13803,14 @@ async def listar_contas_receber(
     origem: str = None,
     vencidas: bool = None,
     forma_pagamento: str = None,
+    after: str = None,
+    contagem: str = "exato",
     current_user: dict = Depends(require_permission("contas_receber", "ler"))
 ):
     """
     Lista contas a receber com filtros avançados e paginação.
     ETAPA 13: Resposta padronizada com api_list, projeção enxuta (sem parcelas).
+    Paginação por cursor com 'after' (meta.next_cursor); contagem: exato, estimado ou nenhum.
     """
     # Validar paginação
     page, limit, skip = validate_pagination(page, limit)
@@ -11556,11 +13821,7 @@ async def listar_contas_receber(
     if q:
         q_norm = normalize_search_query(q)
         if q_norm:
-            query["$or"] = [
-                {"numero": {"$regex": q_norm, "$options": "i"}},
-                {"descricao": {"$regex": q_norm, "$options": "i"}},
-                {"cliente_nome": {"$regex": q_norm, "$options": "i"}}
-            ]
+            query.update(await filtro_busca("contas_receber", q_norm))
     
     if cliente_id:
         query["cliente_id"] = cliente_id
@@ -11581,39 +13842,19 @@ async def listar_contas_receber(
         inicio_iso, fim_iso = range_to_utc_iso(data_inicio, data_fim)
         query["created_at"] = {"$gte": inicio_iso, "$lte": fim_iso}
     
-    # Projeção enxuta (sem parcelas completas na listagem)
-    projection = {
-        "_id": 0,
-        "id": 1, "numero": 1, "descricao": 1, "status": 1,
-        "valor_total": 1, "valor_recebido": 1, "valor_pendente": 1,
-        "cliente_id": 1, "cliente_nome": 1,
-        "forma_pagamento": 1, "categoria": 1,
-        "origem": 1, "origem_numero": 1,
-        "created_at": 1, "updated_at": 1, "cancelada": 1
-    }
+    projection = PROJECAO_LISTA_CONTAS_RECEBER
     
     # Ordenação
     sort_field = sort.lstrip("-")
     sort_dir = -1 if sort.startswith("-") else 1
     
     # Buscar dados
-    cursor = db.contas_receber.find(query, projection)
-    cursor = cursor.sort(sort_field, sort_dir).skip(skip).limit(limit)
-    contas = await cursor.to_list(limit)
-    
-    # Adicionar contagem de parcelas (resumo)
-    for conta in contas:
-        conta_full = await db.contas_receber.find_one(
-            {"id": conta["id"]}, 
-            {"parcelas": 1}
-        )
-        parcelas = conta_full.get("parcelas", []) if conta_full else []
-        conta["parcelas_count"] = len(parcelas)
-        conta["parcelas_recebidas_count"] = len([p for p in parcelas if p.get("status") == "recebido"])
-    
-    total = await db.contas_receber.count_documents(query)
+    contas, total, meta = await paginar_colecao(
+        db.contas_receber, query, projection, sort_field=sort_field, sort_dir=sort_dir,
+        skip=skip, limit=limit, after=after, contagem=contagem
+    )
     
-    return api_list(contas, page=page, limit=limit, total=total)
+    return api_list(contas, page=page, limit=limit, total=total, extra_meta=meta)
 
 # Criar conta a receber manual
 @api_router.post("/contas-receber")
@@ -11677,6 +13918,8 @@ async def criar_conta_receber(
     )
     
     await db.contas_receber.insert_one(nova_conta.dict())
+    await sincronizar_parcelas_index("receber", [nova_conta.id])
+    await sincronizar_busca("contas_receber", [nova_conta.id])
     
     # Registrar log
     await registrar_criacao_conta_receber(
@@ -11749,6 +13992,8 @@ async def editar_conta_receber(
         {"id": id},
         {"$set": update_data}
     )
+    if "descricao" in update_data:
+        await sincronizar_busca("contas_receber", [id])
     
     # Adicionar ao histórico
     await adicionar_historico_conta(
@@ -11907,6 +14152,7 @@ async def cancelar_conta_receber(
             "status": "cancelado"
         }}
     )
+    await sincronizar_parcelas_index("receber", [id])
     
     # Registrar log
     await registrar_cancelamento_conta_receber(
@@ -12207,6 +14453,7 @@ async def admin_delete_vendas_antigas(
         
         # Deletar vendas antigas
         result = await db.vendas.delete_many({"created_at": {"$lt": data_limite}})
+        await reconstruir_rollup_vendas()
         
         # Log de auditoria
         await log_action(
@@ -12327,6 +14574,23 @@ async def admin_resetar_modulo(
         
         # Deletar tudo
         result = await db[collection_name].delete_many({})
+        if collection_name == "vendas":
+            await reconstruir_rollup_vendas()
+        elif collection_name in ("contas_receber", "contas_pagar"):
+            await reconstruir_parcelas_index()
+        elif collection_name == "produtos":
+            await bucket_imagens().drop()
+            produto_codigo_cache.clear()
+        elif collection_name == "orcamentos":
+            await reconciliar_estoque_reservado()
+        if collection_name in BUSCA_CAMPOS:
+            await db.busca_index.delete_many({"colecao": collection_name})
+        elif collection_name == "movimentacoes_estoque":
+            await db.estoque_checkpoints.delete_many({})
+            await db.estoque_checkpoints_controle.delete_many({})
+        elif collection_name == "logs":
+            await db.logs_arquivo.drop()
+            await db.logs_arquivo_controle.delete_many({})
         
         # Log de auditoria
         await log_action(
@@ -12386,6 +14650,7 @@ async def admin_remover_dados_teste(
             ]
         })
         deletados["produtos"] = result_produtos.deleted_count
+        await remover_imagens_orfas()
         
         # Usuários de teste (exceto admin principal)
         result_usuarios = await db.users.delete_many({
@@ -12397,6 +14662,8 @@ async def admin_remover_dados_teste(
                 {"papel": {"$ne": "admin"}}  # Não deletar admin
             ]
         })
+        user_cache.clear()
+        permission_cache.invalidate_all()
         deletados["usuarios"] = result_usuarios.deleted_count
         
         total = sum(deletados.values())
@@ -12437,27 +14704,38 @@ async def admin_limpar_tudo(
         
         # Deletar vendas e orçamentos
         deletados["vendas"] = (await db.vendas.delete_many({})).deleted_count
+        await db.vendas_diarias.delete_many({})
+        await db.vendas_item_diario.delete_many({})
         deletados["orcamentos"] = (await db.orcamentos.delete_many({})).deleted_count
         deletados["notas_fiscais"] = (await db.notas_fiscais.delete_many({})).deleted_count
         
         # Deletar módulos financeiros
         deletados["contas_receber"] = (await db.contas_receber.delete_many({})).deleted_count
         deletados["contas_pagar"] = (await db.contas_pagar.delete_many({})).deleted_count
+        await db.parcelas_index.delete_many({})
         
         # Deletar estoque
         deletados["movimentacoes_estoque"] = (await db.movimentacoes_estoque.delete_many({})).deleted_count
+        await db.estoque_checkpoints.delete_many({})
+        await db.estoque_checkpoints_controle.delete_many({})
         deletados["inventarios"] = (await db.inventarios.delete_many({})).deleted_count
         
         # Deletar produtos e cadastros
         deletados["produtos"] = (await db.produtos.delete_many({})).deleted_count
+        await bucket_imagens().drop()
+        produto_codigo_cache.clear()
         deletados["clientes"] = (await db.clientes.delete_many({})).deleted_count
         deletados["fornecedores"] = (await db.fornecedores.delete_many({})).deleted_count
+        await db.busca_index.delete_many({})
         deletados["marcas"] = (await db.marcas.delete_many({})).deleted_count
         deletados["categorias"] = (await db.categorias.delete_many({})).deleted_count
         deletados["subcategorias"] = (await db.subcategorias.delete_many({})).deleted_count
+        dimensoes_cache.invalidar()
         
         # Deletar TODOS os logs (incluindo este comando será o último log antes da limpeza)
         deletados["logs"] = (await db.logs.delete_many({})).deleted_count
+        await db.logs_arquivo.drop()
+        await db.logs_arquivo_controle.delete_many({})
         deletados["logs_seguranca"] = (await db.logs_seguranca.delete_many({})).deleted_count
         
         # PRESERVAR: Usuários, Roles (Papéis) e Permissões
@@ -12543,6 +14821,7 @@ async def admin_atualizar_permissoes_financeiras(
                 {"id": admin_role["id"]},
                 {"$set": {"permissoes": all_perm_ids}}
             )
+        permission_cache.invalidate_all()
         
         return {
             "success": True,
@@ -12805,7 +15084,6 @@ async def admin_export_collection(
     docs = await db[collection].find({}, {"_id": 0}).limit(limit).to_list(limit)
     
     if format == "jsonl":
-        import json
         lines = [json.dumps(doc, default=str) for doc in docs]
         return {"format": "jsonl", "count": len(docs), "data": "\n".join(lines)}
     
@@ -12852,6 +15130,9 @@ async def admin_import_collection(
     for doc in docs:
         try:
             if mode == "upsert_by_id" and "id" in doc:
+                anterior = None
+                if collection == "vendas":
+                    anterior = await db.vendas.find_one({"id": doc["id"]}, {"_id": 0})
                 result = await db[collection].update_one(
                     {"id": doc["id"]},
                     {"$set": doc},
@@ -12861,12 +15142,32 @@ async def admin_import_collection(
                     inserted += 1
                 else:
                     updated += 1
+                if collection == "vendas":
+                    await atualizar_rollup_vendas(anterior, {**(anterior or {}), **doc})
             else:
                 await db[collection].insert_one(doc)
                 inserted += 1
+                if collection == "vendas":
+                    await atualizar_rollup_vendas(None, doc)
         except Exception as e:
             errors.append({"doc_id": doc.get("id", "?"), "error": str(e)[:100]})
     
+    if collection in ("contas_receber", "contas_pagar"):
+        await sincronizar_parcelas_index(
+            "receber" if collection == "contas_receber" else "pagar",
+            [doc["id"] for doc in docs if "id" in doc]
+        )
+    if collection in BUSCA_CAMPOS:
+        await sincronizar_busca(collection, [doc["id"] for doc in docs if "id" in doc])
+    if collection == "produtos":
+        produto_codigo_cache.clear()
+    if collection in DIMENSOES_CATALOGO:
+        dimensoes_cache.invalidar(collection)
+    if collection == "users":
+        user_cache.clear()
+    if collection in ("users", "roles", "permissions", "user_groups", "temporary_permissions", "permission_delegations"):
+        permission_cache.invalidate_all()
+    
     return {
         "success": len(errors) == 0,
         "inserted": inserted,
@@ -13217,6 +15518,7 @@ async def setup_2fa(
             }
         }}
     )
+    invalidar_usuario_cache(current_user["id"])
     
     # Gerar URI para QR code
     otpauth_uri = generate_otpauth_uri(secret, user.get("email", "user"), "ERP")
@@ -13266,6 +15568,7 @@ async def enable_2fa(
             "two_factor.enabled_at": utc_now_iso()
         }}
     )
+    invalidar_usuario_cache(current_user["id"])
     
     return {"success": True, "message": "2FA habilitado com sucesso"}
 
@@ -13314,6 +15617,7 @@ async def disable_2fa(
             }
         }}
     )
+    invalidar_usuario_cache(current_user["id"])
     
     return {"success": True, "message": "2FA desabilitado"}
 
@@ -13904,6 +16208,36 @@ async def obter_dados_financeiros_cliente(
         "historico": historico
     }
 
+async def listar_contas_com_resumo(colecao, query: dict, campo_liquidado: str, chave_liquidado: str,
+                                   projecao: dict, max_contas: int = 1000) -> tuple:
+    """
+    Contas (mais recentes primeiro, até max_contas) e totais de todas as que atendem ao filtro.
+    Os totais vêm de um $group; as linhas, do cursor com a projeção enxuta (nada de juntar
+    até max_contas contas em um único documento, limitado a 16 MB). Retorna (contas, resumo).
+    """
+    resultado = await colecao.aggregate([
+        {"$match": query},
+        {"$group": {
+            "_id": None,
+            "quantidade": {"$sum": 1},
+            "total_valor": {"$sum": "$valor_total"},
+            chave_liquidado: {"$sum": f"${campo_liquidado}"},
+            "total_pendente": {"$sum": "$valor_pendente"}
+        }}
+    ]).to_list(1)
+    resumo = resultado[0] if resultado else {}
+    
+    contas = []
+    if resumo.get("quantidade"):
+        contas = await colecao.find(query, projecao).sort("created_at", -1).limit(max_contas).to_list(max_contas)
+    
+    return contas, {
+        "quantidade": resumo.get("quantidade", 0),
+        "total_valor": resumo.get("total_valor", 0),
+        chave_liquidado: resumo.get(chave_liquidado, 0),
+        "total_pendente": resumo.get("total_pendente", 0)
+    }
+
 @api_router.get("/clientes/{cliente_id}/contas-receber")
 async def listar_contas_receber_cliente(
     cliente_id: str,
@@ -13917,23 +16251,11 @@ async def listar_contas_receber_cliente(
     if not incluir_canceladas:
         query["cancelada"] = False
     
-    contas = await db.contas_receber.find(query, {"_id": 0})\
-        .sort("created_at", -1)\
-        .to_list(1000)
-    
-    total_valor = sum(c["valor_total"] for c in contas)
-    total_recebido = sum(c["valor_recebido"] for c in contas)
-    total_pendente = sum(c["valor_pendente"] for c in contas)
+    contas, resumo = await listar_contas_com_resumo(
+        db.contas_receber, query, "valor_recebido", "total_recebido", PROJECAO_LISTA_CONTAS_RECEBER
+    )
     
-    return {
-        "contas": contas,
-        "resumo": {
-            "quantidade": len(contas),
-            "total_valor": total_valor,
-            "total_recebido": total_recebido,
-            "total_pendente": total_pendente
-        }
-    }
+    return {"contas": contas, "resumo": resumo}
 
 # ===== DADOS FINANCEIROS DE FORNECEDORES =====
 
@@ -14048,23 +16370,11 @@ async def listar_contas_pagar_fornecedor(
     if not incluir_canceladas:
         query["cancelada"] = False
     
-    contas = await db.contas_pagar.find(query, {"_id": 0})\
-        .sort("created_at", -1)\
-        .to_list(1000)
-    
-    total_valor = sum(c["valor_total"] for c in contas)
-    total_pago = sum(c["valor_pago"] for c in contas)
-    total_pendente = sum(c["valor_pendente"] for c in contas)
+    contas, resumo = await listar_contas_com_resumo(
+        db.contas_pagar, query, "valor_pago", "total_pago", PROJECAO_LISTA_CONTAS_PAGAR
+    )
     
-    return {
-        "contas": contas,
-        "resumo": {
-            "quantidade": len(contas),
-            "total_valor": total_valor,
-            "total_pago": total_pago,
-            "total_pendente": total_pendente
-        }
-    }
+    return {"contas": contas, "resumo": resumo}
 
 # ===== FUNÇÕES AUXILIARES DE SCORE =====
 
@@ -14214,6 +16524,9 @@ async def atualizar_status_conta_pagar(conta_id: str):
             "updated_at": iso_utc_now()
         }}
     )
+    
+    # Chamado após toda baixa, estorno ou vencimento de parcela
+    await sincronizar_parcelas_index("pagar", [conta_id])
 
 # Funções de logging para Contas a Pagar
 async def registrar_criacao_conta_pagar(
@@ -14340,11 +16653,14 @@ async def listar_contas_pagar(
     forma_pagamento: str = None,
     categoria: str = None,
     prioridade: str = None,
+    after: str = None,
+    contagem: str = "exato",
     current_user: dict = Depends(require_permission("contas_pagar", "ler"))
 ):
     """
     Lista contas a pagar com filtros avançados e paginação.
     ETAPA 13: Resposta padronizada com api_list, projeção enxuta (sem parcelas).
+    Paginação por cursor com 'after' (meta.next_cursor); contagem: exato, estimado ou nenhum.
     """
     # Validar paginação
     page, limit, skip = validate_pagination(page, limit)
@@ -14355,11 +16671,7 @@ async def listar_contas_pagar(
     if q:
         q_norm = normalize_search_query(q)
         if q_norm:
-            query["$or"] = [
-                {"numero": {"$regex": q_norm, "$options": "i"}},
-                {"descricao": {"$regex": q_norm, "$options": "i"}},
-                {"fornecedor_nome": {"$regex": q_norm, "$options": "i"}}
-            ]
+            query.update(await filtro_busca("contas_pagar", q_norm))
     
     if fornecedor_id:
         query["fornecedor_id"] = fornecedor_id
@@ -14386,40 +16698,19 @@ async def listar_contas_pagar(
         inicio_iso, fim_iso = range_to_utc_iso(data_inicio, data_fim)
         query["created_at"] = {"$gte": inicio_iso, "$lte": fim_iso}
     
-    # Projeção enxuta (sem parcelas completas na listagem)
-    projection = {
-        "_id": 0,
-        "id": 1, "numero": 1, "descricao": 1, "status": 1,
-        "valor_total": 1, "valor_pago": 1, "valor_pendente": 1,
-        "fornecedor_id": 1, "fornecedor_nome": 1,
-        "forma_pagamento": 1, "categoria": 1, "prioridade": 1,
-        "origem": 1, "origem_numero": 1,
-        "created_at": 1, "updated_at": 1, "cancelada": 1
-    }
+    projection = PROJECAO_LISTA_CONTAS_PAGAR
     
     # Ordenação
     sort_field = sort.lstrip("-")
     sort_dir = -1 if sort.startswith("-") else 1
     
     # Buscar dados
-    cursor = db.contas_pagar.find(query, projection)
-    cursor = cursor.sort(sort_field, sort_dir).skip(skip).limit(limit)
-    contas = await cursor.to_list(limit)
-    
-    # Adicionar contagem de parcelas (resumo)
-    for conta in contas:
-        # Buscar apenas contagem de parcelas
-        conta_full = await db.contas_pagar.find_one(
-            {"id": conta["id"]}, 
-            {"parcelas": 1}
-        )
-        parcelas = conta_full.get("parcelas", []) if conta_full else []
-        conta["parcelas_count"] = len(parcelas)
-        conta["parcelas_pagas_count"] = len([p for p in parcelas if p.get("status") == "pago"])
-    
-    total = await db.contas_pagar.count_documents(query)
+    contas, total, meta = await paginar_colecao(
+        db.contas_pagar, query, projection, sort_field=sort_field, sort_dir=sort_dir,
+        skip=skip, limit=limit, after=after, contagem=contagem
+    )
     
-    return api_list(contas, page=page, limit=limit, total=total)
+    return api_list(contas, page=page, limit=limit, total=total, extra_meta=meta)
 
 # Criar conta a pagar manual
 @api_router.post("/contas-pagar")
@@ -14490,6 +16781,8 @@ async def criar_conta_pagar(
     )
     
     await db.contas_pagar.insert_one(nova_conta.dict())
+    await sincronizar_parcelas_index("pagar", [nova_conta.id])
+    await sincronizar_busca("contas_pagar", [nova_conta.id])
     
     # Registrar log
     await registrar_criacao_conta_pagar(
@@ -14565,6 +16858,8 @@ async def editar_conta_pagar(
         {"id": id},
         {"$set": update_data}
     )
+    if "descricao" in update_data:
+        await sincronizar_busca("contas_pagar", [id])
     
     # Adicionar ao histórico
     await adicionar_historico_conta(
@@ -14726,6 +17021,7 @@ async def cancelar_conta_pagar(
             "status": "cancelado"
         }}
     )
+    await sincronizar_parcelas_index("pagar", [id])
     
     # Registrar log
     await registrar_cancelamento_conta_pagar(
@@ -14916,35 +17212,556 @@ async def contas_por_fornecedor(
     if not incluir_canceladas:
         query["cancelada"] = False
     
-    contas = await db.contas_pagar.find(query, {"_id": 0})\
-        .sort("created_at", -1)\
-        .to_list(1000)
+    contas, resumo = await listar_contas_com_resumo(
+        db.contas_pagar, query, "valor_pago", "total_pago", PROJECAO_LISTA_CONTAS_PAGAR
+    )
     
-    total_valor = sum(c["valor_total"] for c in contas)
-    total_pago = sum(c["valor_pago"] for c in contas)
-    total_pendente = sum(c["valor_pendente"] for c in contas)
+    return {"contas": contas, "resumo": resumo}
+
+
+# ========================================
+# ÍNDICE DE PARCELAS (FLUXO DE CAIXA)
+# ========================================
+# parcelas_index: uma linha por parcela de conta a receber/pagar não cancelada, com as
+# datas já normalizadas (YYYY-MM-DD). Mantida por sincronizar_parcelas_index em todo
+# caminho que grava parcelas; o fluxo de caixa lê apenas o intervalo de datas pedido.
+
+from pymongo import ReplaceOne
+
+PARCELAS_INDEX_TIPOS = {
+    "receber": {
+        "colecao": "contas_receber",
+        "status_liquidada": "recebido",
+        "campo_data_liquidacao": "data_recebimento",
+        "campo_valor_liquidado": "valor_recebido"
+    },
+    "pagar": {
+        "colecao": "contas_pagar",
+        "status_liquidada": "pago",
+        "campo_data_liquidacao": "data_pagamento",
+        "campo_valor_liquidado": "valor_pago"
+    }
+}
+
+def linhas_parcelas_index(tipo: str, conta: dict) -> List[dict]:
+    """Achata as parcelas de uma conta em linhas do índice (conta cancelada não gera linhas)"""
+    if conta.get("cancelada") is True:
+        return []
+    
+    config = PARCELAS_INDEX_TIPOS[tipo]
+    agora = iso_utc_now()
+    linhas = []
+    for posicao, parcela in enumerate(conta.get("parcelas", [])):
+        linhas.append({
+            "tipo": tipo,
+            "conta_id": conta["id"],
+            "conta_numero": conta.get("numero"),
+            "posicao": posicao,
+            "numero_parcela": parcela.get("numero_parcela", parcela.get("numero")),
+            "status": parcela.get("status"),
+            "liquidada": parcela.get("status") == config["status_liquidada"],
+            "data_vencimento": parse_date_only(parcela.get("data_vencimento")),
+            "data_liquidacao": parse_date_only(parcela.get(config["campo_data_liquidacao"])),
+            "valor": parcela.get("valor", 0),
+            "valor_liquidado": parcela.get(config["campo_valor_liquidado"], 0),
+            "updated_at": agora
+        })
+    return linhas
+
+async def sincronizar_parcelas_index(tipo: str, conta_ids: List[str]):
+    """
+    Regrava no índice as parcelas das contas informadas a partir do estado atual no banco.
+    Idempotente: upsert por (tipo, conta_id, posicao) e remoção das posições que sobraram.
+    """
+    conta_ids = [conta_id for conta_id in dict.fromkeys(conta_ids) if conta_id]
+    if not conta_ids:
+        return
     
+    try:
+        colecao = db[PARCELAS_INDEX_TIPOS[tipo]["colecao"]]
+        contas = await colecao.find(
+            {"id": {"$in": conta_ids}},
+            {"_id": 0, "id": 1, "numero": 1, "cancelada": 1, "parcelas": 1}
+        ).to_list(None)
+        
+        operacoes = []
+        posicoes_por_conta = {conta_id: 0 for conta_id in conta_ids}
+        for conta in contas:
+            linhas = linhas_parcelas_index(tipo, conta)
+            posicoes_por_conta[conta["id"]] = len(linhas)
+            for linha in linhas:
+                operacoes.append(ReplaceOne(
+                    {"tipo": tipo, "conta_id": linha["conta_id"], "posicao": linha["posicao"]},
+                    linha,
+                    upsert=True
+                ))
+        
+        await _bulk_upsert_sem_ordem(db.parcelas_index, operacoes)
+        await db.parcelas_index.delete_many({
+            "tipo": tipo,
+            "$or": [
+                {"conta_id": conta_id, "posicao": {"$gte": quantidade}}
+                for conta_id, quantidade in posicoes_por_conta.items()
+            ]
+        })
+    except Exception as e:
+        print(f"Aviso: Erro ao sincronizar índice de parcelas ({tipo}, {conta_ids[:5]}): {str(e)}")
+
+async def reconstruir_parcelas_index() -> dict:
+    """Recria o índice de parcelas a partir de todas as contas (backfill e correção de divergências)"""
+    resultado = {}
+    await db.parcelas_index.delete_many({})
+    for tipo, config in PARCELAS_INDEX_TIPOS.items():
+        lote = []
+        total = 0
+        async for conta in db[config["colecao"]].find(
+            {"cancelada": {"$ne": True}},
+            {"_id": 0, "id": 1, "numero": 1, "cancelada": 1, "parcelas": 1}
+        ):
+            lote.extend(linhas_parcelas_index(tipo, conta))
+            if len(lote) >= 1000:
+                await db.parcelas_index.insert_many(lote)
+                total += len(lote)
+                lote = []
+        if lote:
+            await db.parcelas_index.insert_many(lote)
+            total += len(lote)
+        resultado[tipo] = total
+    return resultado
+
+@api_router.post("/fluxo-caixa/reconstruir-indice")
+async def reconstruir_parcelas_index_endpoint(current_user: dict = Depends(require_permission("admin", "editar"))):
+    """Reconstrói o índice de parcelas usado pelo fluxo de caixa"""
+    resultado = await reconstruir_parcelas_index()
+    
+    await log_action(
+        ip="0.0.0.0",
+        user_id=current_user["id"],
+        user_nome=current_user["nome"],
+        tela="fluxo_caixa",
+        acao="reconstruir_indice_parcelas",
+        detalhes=resultado
+    )
+    
+    return {"message": "Índice de parcelas reconstruído", "parcelas": resultado}
+
+# ========================================
+# ÍNDICE DE BUSCA (PRODUTOS, CADASTROS, VENDAS, CONTAS)
+# ========================================
+# busca_index: uma linha por documento pesquisável, com o texto normalizado (sem acento,
+# minúsculo), os prefixos de cada palavra e os trigramas. As buscas por 'q'/'termo' viram
+# uma consulta de igualdade no índice multikey em vez de $regex sem âncora em cada campo.
+# Mantida por sincronizar_busca nos caminhos que gravam os campos pesquisáveis.
+
+import re
+import unicodedata
+
+BUSCA_PREFIXO_MAX = int(os.environ.get('BUSCA_PREFIXO_MAX', '15'))
+BUSCA_MAX_IDS = int(os.environ.get('BUSCA_MAX_IDS', '5000'))
+BUSCA_SIMILARIDADE_MIN = float(os.environ.get('BUSCA_SIMILARIDADE_MIN', '0.5'))
+
+BUSCA_CAMPOS = {
+    "produtos": {"campos": ["nome", "sku", "codigo_barras"], "modulo": "produtos",
+                 "filtro_ativos": {"ativo": {"$ne": False}}, "projecao": {"_id": 0}},
+    "clientes": {"campos": ["nome", "email", "telefone", "cpf_cnpj"], "modulo": "clientes",
+                 "filtro_ativos": {"ativo": {"$ne": False}}, "projecao": {"_id": 0}},
+    "fornecedores": {"campos": ["razao_social", "nome_fantasia", "cnpj", "email"], "modulo": "fornecedores",
+                     "filtro_ativos": {"ativo": {"$ne": False}}, "projecao": {"_id": 0}},
+    "vendas": {"campos": ["numero_venda", "cliente_nome"], "modulo": "vendas",
+               "filtro_ativos": {}, "projecao": {"_id": 0, "itens": 0, "historico_alteracoes": 0}},
+    "contas_receber": {"campos": ["numero", "descricao", "cliente_nome"], "modulo": "contas_receber",
+                       "filtro_ativos": {"cancelada": {"$ne": True}}, "projecao": {"_id": 0, "parcelas": 0, "historico_alteracoes": 0}},
+    "contas_pagar": {"campos": ["numero", "descricao", "fornecedor_nome"], "modulo": "contas_pagar",
+                     "filtro_ativos": {"cancelada": {"$ne": True}}, "projecao": {"_id": 0, "parcelas": 0, "historico_alteracoes": 0}},
+}
+
+def normalizar_busca(texto) -> str:
+    """Remove acentos, passa para minúsculo e troca pontuação por espaço ('Calção-P' -> 'calcao p')"""
+    if texto is None:
+        return ""
+    decomposto = unicodedata.normalize("NFKD", str(texto))
+    sem_acento = "".join(c for c in decomposto if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", sem_acento.lower()).split())
+
+def palavras_busca(texto) -> List[str]:
+    return list(dict.fromkeys(normalizar_busca(texto).split()))
+
+def trigramas_busca(palavras: List[str]) -> List[str]:
+    """Trigramas de cada palavra; palavras com menos de 3 letras entram inteiras"""
+    trigramas = []
+    for palavra in palavras:
+        if len(palavra) < 3:
+            trigramas.append(palavra)
+        else:
+            trigramas.extend(palavra[i:i + 3] for i in range(len(palavra) - 2))
+    return list(dict.fromkeys(trigramas))
+
+def linha_busca(colecao: str, doc: dict) -> dict:
+    """
+    Linha do índice para um documento. Além das palavras, cada valor entra também com os
+    caracteres juntos ('123.456.789-00' -> '12345678900'), para CPF/CNPJ/telefone/SKU
+    serem achados com ou sem pontuação.
+    """
+    palavras = []
+    tokens = set()
+    textos = []
+    for campo in BUSCA_CAMPOS[colecao]["campos"]:
+        normalizado = normalizar_busca(doc.get(campo))
+        if not normalizado:
+            continue
+        textos.append(normalizado)
+        termos = normalizado.split()
+        palavras.extend(termos)
+        if len(termos) > 1:
+            termos = termos + ["".join(termos)]
+        for termo in termos:
+            tokens.update(termo[:n] for n in range(1, min(len(termo), BUSCA_PREFIXO_MAX) + 1))
+    palavras = list(dict.fromkeys(palavras))
     return {
-        "contas": contas,
-        "resumo": {
-            "quantidade": len(contas),
-            "total_valor": total_valor,
-            "total_pago": total_pago,
-            "total_pendente": total_pendente
-        }
+        "colecao": colecao,
+        "doc_id": doc["id"],
+        "texto": " ".join(textos),
+        "palavras": palavras,
+        "tokens": sorted(tokens),
+        "trigramas": trigramas_busca(palavras),
+        "atualizado_em": iso_utc_now()
     }
 
+async def sincronizar_busca(colecao: str, ids: List[str]):
+    """
+    Regrava no índice de busca os documentos informados a partir do estado atual no banco.
+    Idempotente: upsert por (colecao, doc_id); ids que não existem mais saem do índice.
+    """
+    ids = [doc_id for doc_id in dict.fromkeys(ids) if doc_id]
+    if not ids or colecao not in BUSCA_CAMPOS:
+        return
+    
+    try:
+        projecao = {"_id": 0, "id": 1, **{campo: 1 for campo in BUSCA_CAMPOS[colecao]["campos"]}}
+        docs = await db[colecao].find({"id": {"$in": ids}}, projecao).to_list(None)
+        operacoes = [
+            ReplaceOne({"colecao": colecao, "doc_id": doc["id"]}, linha_busca(colecao, doc), upsert=True)
+            for doc in docs
+        ]
+        await _bulk_upsert_sem_ordem(db.busca_index, operacoes)
+        
+        removidos = set(ids) - {doc["id"] for doc in docs}
+        if removidos:
+            await db.busca_index.delete_many({"colecao": colecao, "doc_id": {"$in": list(removidos)}})
+    except Exception as e:
+        print(f"Aviso: Erro ao sincronizar índice de busca ({colecao}, {ids[:5]}): {str(e)}")
+
+async def reconstruir_busca(colecao: str = None) -> dict:
+    """Recria o índice de busca de uma coleção (ou de todas) a partir dos documentos (backfill)"""
+    resultado = {}
+    for nome in ([colecao] if colecao else list(BUSCA_CAMPOS)):
+        await db.busca_index.delete_many({"colecao": nome})
+        projecao = {"_id": 0, "id": 1, **{campo: 1 for campo in BUSCA_CAMPOS[nome]["campos"]}}
+        lote = []
+        total = 0
+        async for doc in db[nome].find({"id": {"$exists": True}}, projecao):
+            lote.append(linha_busca(nome, doc))
+            if len(lote) >= 1000:
+                await db.busca_index.insert_many(lote, ordered=False)
+                total += len(lote)
+                lote = []
+        if lote:
+            await db.busca_index.insert_many(lote, ordered=False)
+            total += len(lote)
+        resultado[nome] = total
+    return resultado
+
+def _tokens_consulta(palavras: List[str]) -> List[str]:
+    # Palavras maiores que o prefixo indexado são truncadas (o prefixo continua exigido)
+    return list(dict.fromkeys(palavra[:BUSCA_PREFIXO_MAX] for palavra in palavras))
+
+async def ids_busca(colecao: str, q: str) -> Optional[List[str]]:
+    """
+    Ids dos documentos em que todas as palavras de 'q' são prefixo de alguma palavra indexada.
+    Retorna None quando 'q' não tem nada pesquisável ou quando o termo é amplo demais
+    (mais de BUSCA_MAX_IDS resultados) - nesses casos quem chama usa o filtro por $regex.
+    """
+    palavras = palavras_busca(q)
+    if not palavras:
+        return None
+    linhas = await db.busca_index.find(
+        {"colecao": colecao, "tokens": {"$all": _tokens_consulta(palavras)}},
+        {"_id": 0, "doc_id": 1}
+    ).limit(BUSCA_MAX_IDS + 1).to_list(BUSCA_MAX_IDS + 1)
+    if len(linhas) > BUSCA_MAX_IDS:
+        return None
+    return [linha["doc_id"] for linha in linhas]
+
+# Letras sem acento -> classe com as variantes acentuadas, para o $regex do termo amplo
+# casar como o índice ('calcao' acha 'Calção')
+VARIANTES_ACENTO = {"a": "aáàâãä", "e": "eéèêë", "i": "iíìîï", "o": "oóòôõö", "u": "uúùûü", "c": "cç", "n": "nñ"}
+
+def regex_sem_acento(palavra: str) -> str:
+    return "".join(f"[{VARIANTES_ACENTO[c]}]" if c in VARIANTES_ACENTO else re.escape(c) for c in palavra)
+
+async def filtro_busca(colecao: str, q: str) -> dict:
+    """
+    Filtro da busca textual das listagens: ids do índice, ou - termo amplo demais (primeira
+    tecla no PDV) - $regex nos campos, com cada palavra presente em algum deles. O resultado
+    continua completo e na ordenação pedida pela listagem. Termo sem letras nem dígitos não filtra.
+    """
+    palavras = palavras_busca(q)
+    if not palavras:
+        return {}
+    ids = await ids_busca(colecao, q)
+    if ids is not None:
+        return {"id": {"$in": ids}}
+    campos = BUSCA_CAMPOS[colecao]["campos"]
+    return {"$and": [
+        {"$or": [{campo: {"$regex": regex_sem_acento(palavra), "$options": "i"}} for campo in campos]}
+        for palavra in palavras
+    ]}
+
+async def buscar_ranqueado(colecao: str, q: str, limit: int = 20, incluir_inativos: bool = False) -> List[dict]:
+    """
+    Busca ranqueada: primeiro os documentos em que todas as palavras são prefixo (pontuação >= 1,
+    maior quando as palavras batem inteiras e quando o texto começa pela busca); se faltar
+    resultado, completa com correspondência aproximada por trigramas (pontuação < 1).
+    """
+    palavras = palavras_busca(q)
+    if not palavras:
+        return []
+    q_norm = " ".join(palavras)
+    candidatos = limit * 4
+    
+    ranking = await db.busca_index.aggregate([
+        {"$match": {"colecao": colecao, "tokens": {"$all": _tokens_consulta(palavras)}}},
+        {"$project": {
+            "_id": 0, "doc_id": 1, "texto": 1,
+            "score": {"$add": [
+                1,
+                {"$divide": [{"$size": {"$setIntersection": ["$palavras", palavras]}}, len(palavras)]},
+                {"$cond": [{"$eq": [{"$indexOfCP": ["$texto", q_norm]}, 0]}, 1, 0]}
+            ]}
+        }},
+        {"$sort": {"score": -1, "texto": 1}},
+        {"$limit": candidatos}
+    ]).to_list(candidatos)
+    for item in ranking:
+        item["tipo"] = "prefixo"
+    
+    if len(ranking) < candidatos:
+        trigramas = trigramas_busca(palavras)
+        encontrados = [item["doc_id"] for item in ranking]
+        restante = candidatos - len(ranking)
+        aproximados = await db.busca_index.aggregate([
+            {"$match": {"colecao": colecao, "trigramas": {"$in": trigramas}, "doc_id": {"$nin": encontrados}}},
+            {"$project": {
+                "_id": 0, "doc_id": 1, "texto": 1,
+                "score": {"$multiply": [
+                    0.99,
+                    {"$divide": [{"$size": {"$setIntersection": ["$trigramas", trigramas]}}, len(trigramas)]}
+                ]}
+            }},
+            {"$match": {"score": {"$gte": 0.99 * BUSCA_SIMILARIDADE_MIN}}},
+            {"$sort": {"score": -1, "texto": 1}},
+            {"$limit": restante}
+        ]).to_list(restante)
+        for item in aproximados:
+            item["tipo"] = "aproximada"
+        ranking.extend(aproximados)
+    
+    if not ranking:
+        return []
+    
+    config = BUSCA_CAMPOS[colecao]
+    filtro = {"id": {"$in": [item["doc_id"] for item in ranking]}}
+    if not incluir_inativos:
+        filtro.update(config["filtro_ativos"])
+    docs = {doc["id"]: doc for doc in await db[colecao].find(filtro, config["projecao"]).to_list(None)}
+    
+    resultados = []
+    for item in ranking:
+        doc = docs.get(item["doc_id"])
+        if doc is None:
+            continue
+        resultados.append({**doc, "busca_score": round(item["score"], 4), "busca_tipo": item["tipo"]})
+        if len(resultados) >= limit:
+            break
+    return resultados
+
+@api_router.get("/busca/{colecao}")
+async def buscar(
+    colecao: str,
+    q: str,
+    limit: int = 20,
+    incluir_inativos: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Busca ranqueada sem acento (prefixo + aproximada) em produtos, clientes, fornecedores,
+    vendas, contas_receber ou contas_pagar. Exige permissão de leitura no módulo.
+    """
+    if colecao not in BUSCA_CAMPOS:
+        raise HTTPException(status_code=400, detail=f"Coleção inválida. Use: {', '.join(BUSCA_CAMPOS)}")
+    modulo = BUSCA_CAMPOS[colecao]["modulo"]
+    if not await check_permission(current_user["id"], modulo, "ler"):
+        raise HTTPException(status_code=403, detail=f"Você não tem permissão para 'ler' em '{modulo}'")
+    
+    _, limit, _ = validate_pagination(1, limit)
+    resultados = await buscar_ranqueado(colecao, normalize_search_query(q), limit, incluir_inativos)
+    return api_list(resultados, page=1, limit=limit, total=len(resultados))
+
+@api_router.post("/busca/reconstruir")
+async def reconstruir_busca_endpoint(
+    colecao: Optional[str] = None,
+    current_user: dict = Depends(require_permission("admin", "editar"))
+):
+    """Reconstrói o índice de busca (todas as coleções ou apenas a informada)"""
+    if colecao and colecao not in BUSCA_CAMPOS:
+        raise HTTPException(status_code=400, detail=f"Coleção inválida. Use: {', '.join(BUSCA_CAMPOS)}")
+    resultado = await reconstruir_busca(colecao)
+    
+    await log_action(
+        ip="0.0.0.0",
+        user_id=current_user["id"],
+        user_nome=current_user["nome"],
+        tela="administracao",
+        acao="reconstruir_indice_busca",
+        detalhes=resultado
+    )
+    
+    return {"message": "Índice de busca reconstruído", "documentos": resultado}
 
 # ========================================
 # FLUXO DE CAIXA
 # ========================================
 
+TIPOS_VISAO_FLUXO = ("diario", "semanal", "mensal")
+LIMITE_DETALHES_FLUXO = 100
+
+def _validar_parametros_fluxo(regime: str, tipo_visao: str):
+    if regime not in ("caixa", "competencia"):
+        raise HTTPException(status_code=400, detail="Regime deve ser 'caixa' ou 'competencia'")
+    if tipo_visao not in TIPOS_VISAO_FLUXO:
+        raise HTTPException(status_code=400, detail="tipo_visao deve ser 'diario', 'semanal' ou 'mensal'")
+
+def _data_fluxo(valor: str, erro: str) -> str:
+    """YYYY-MM-DD de uma data do fluxo (ISO aceita); inválida -> 400 com 'erro'"""
+    data = parse_date_only(valor)
+    try:
+        datetime.strptime(data or "", "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{erro} (use YYYY-MM-DD)")
+    return data
+
+def campos_regime_fluxo(regime: str) -> tuple:
+    """
+    (campo_data, campo_valor, filtro_extra) do parcelas_index para o regime.
+    
+    Regime CAIXA: só parcelas liquidadas, pela data de recebimento/pagamento.
+    Regime COMPETÊNCIA: todas as parcelas, pela data de vencimento.
+    """
+    if regime == "caixa":
+        return "data_liquidacao", "valor_liquidado", {"liquidada": True}
+    return "data_vencimento", "valor", {}
+
+def inicio_periodo_fluxo(data: str, tipo_visao: str) -> str:
+    """Data (YYYY-MM-DD) que identifica o período: o próprio dia, a segunda-feira da semana ou o dia 1 do mês"""
+    if tipo_visao == "semanal":
+        dia = datetime.strptime(data, "%Y-%m-%d")
+        return (dia - timedelta(days=dia.weekday())).strftime("%Y-%m-%d")
+    if tipo_visao == "mensal":
+        return data[:7] + "-01"
+    return data
+
+def fim_periodo_fluxo(periodo: str, tipo_visao: str) -> str:
+    """Último dia (YYYY-MM-DD) do período iniciado em 'periodo'"""
+    if tipo_visao == "semanal":
+        return (datetime.strptime(periodo, "%Y-%m-%d") + timedelta(days=6)).strftime("%Y-%m-%d")
+    if tipo_visao == "mensal":
+        dia = datetime.strptime(periodo[:7] + "-01", "%Y-%m-%d")
+        proximo_mes = (dia + timedelta(days=32)).replace(day=1)
+        return (proximo_mes - timedelta(days=1)).strftime("%Y-%m-%d")
+    return periodo
+
+def chave_periodo_fluxo(campo_data: str, tipo_visao: str):
+    """Expressão de agregação equivalente a inicio_periodo_fluxo sobre o campo de data"""
+    if tipo_visao == "semanal":
+        return {"$dateToString": {"format": "%Y-%m-%d", "date": {"$dateTrunc": {
+            "date": {"$dateFromString": {"dateString": f"${campo_data}", "format": "%Y-%m-%d"}},
+            "unit": "week",
+            "startOfWeek": "monday"
+        }}}}
+    if tipo_visao == "mensal":
+        return {"$concat": [{"$substrCP": [f"${campo_data}", 0, 7]}, "-01"]}
+    return f"${campo_data}"
+
+def pipeline_resumo_fluxo(filtro: dict, campo_data: str, campo_valor: str, tipo_visao: str) -> list:
+    """
+    Totais por período e saldo acumulado calculados no banco.
+    
+    O saldo acumulado é uma soma em janela (do primeiro período até o atual)
+    sobre o saldo de cada período, ordenada pela data do período.
+    """
+    valor = {"$ifNull": [f"${campo_valor}", 0]}
+    return [
+        {"$match": filtro},
+        {"$group": {
+            "_id": chave_periodo_fluxo(campo_data, tipo_visao),
+            "entradas": contar_se_igual("tipo", "receber", valor),
+            "saidas": contar_se_igual("tipo", "pagar", valor),
+            "qtd_entradas": contar_se_igual("tipo", "receber"),
+            "qtd_saidas": contar_se_igual("tipo", "pagar")
+        }},
+        {"$set": {"saldo_periodo": {"$subtract": ["$entradas", "$saidas"]}}},
+        {"$setWindowFields": {
+            "sortBy": {"_id": 1},
+            "output": {"saldo_acumulado": {
+                "$sum": "$saldo_periodo",
+                "window": {"documents": ["unbounded", "current"]}
+            }}
+        }},
+        {"$project": {
+            "_id": 0,
+            "periodo": "$_id",
+            "entradas": 1,
+            "saidas": 1,
+            "saldo_periodo": 1,
+            "saldo_acumulado": 1,
+            "qtd_entradas": 1,
+            "qtd_saidas": 1
+        }}
+    ]
+
+def detalhe_parcela_fluxo(parcela: dict, campo_data: str, campo_valor: str) -> dict:
+    """Linha de detalhe do fluxo de caixa para uma parcela do índice"""
+    if parcela["tipo"] == "receber":
+        tipo_detalhe, numero_padrao = "CR Parcela", "CR-XXX"
+    else:
+        tipo_detalhe, numero_padrao = "CP Parcela", "CP-XXX"
+    
+    numero_parcela = parcela.get("numero_parcela")
+    return {
+        "tipo": tipo_detalhe,
+        "descricao": f"{parcela.get('conta_numero') or numero_padrao} - Parcela {numero_parcela if numero_parcela is not None else '?'}",
+        "valor": parcela.get(campo_valor, 0),
+        "data": parcela[campo_data],
+        "referencia": {
+            "conta_id": parcela["conta_id"],
+            "numero": parcela.get("conta_numero"),
+            "parcela": numero_parcela
+        }
+    }
+
+def codificar_cursor_fluxo(chave: list) -> str:
+    return codificar_cursor(chave)
+
+def decodificar_cursor_fluxo(cursor: str) -> list:
+    return decodificar_cursor(cursor, 4)
+
 @api_router.get("/fluxo-caixa")
 async def get_fluxo_caixa(
     data_inicio: str,
     data_fim: str,
     regime: str = "caixa",  # caixa (realizado) ou competencia (previsto)
     tipo_visao: str = "diario",  # diario, semanal, mensal
+    apenas_resumo: bool = False,
     current_user: dict = Depends(require_permission("contas_receber", "ler"))
 ):
     """
@@ -14953,161 +17770,78 @@ async def get_fluxo_caixa(
     Regime caixa: considera apenas valores efetivamente recebidos/pagos.
     Regime competência: considera valores por data de vencimento.
     
+    Os períodos seguem tipo_visao: dia, semana (iniciando na segunda-feira)
+    ou mês, identificados pela data do primeiro dia.
+    
+    Com apenas_resumo=true, retorna só os totais e saldos por período (com as
+    quantidades de movimentações); os detalhes de cada período ficam em
+    GET /fluxo-caixa/detalhes.
+    
     IMPORTANTE: Vendas NÃO são contabilizadas para evitar duplicidade,
     pois cada venda já gera contas a receber automaticamente.
     """
+    _validar_parametros_fluxo(regime, tipo_visao)
+    
     try:
-        from datetime import datetime
+        campo_data, campo_valor, filtro_regime = campos_regime_fluxo(regime)
         
-        # Buscar todas as contas a receber (não filtrar no nível raiz)
-        contas_receber = await db.contas_receber.find({
-            "cancelada": {"$ne": True}
-        }, {"_id": 0}).to_list(None)
-        
-        # Buscar todas as contas a pagar
-        contas_pagar = await db.contas_pagar.find({
-            "cancelada": {"$ne": True}
-        }, {"_id": 0}).to_list(None)
-        
-        # Organizar por período
-        fluxo_por_periodo = {}
+        filtro = {
+            "tipo": {"$in": ["receber", "pagar"]},
+            campo_data: {"$gte": data_inicio, "$lte": data_fim},
+            **filtro_regime
+        }
         
-        # Processar CONTAS A RECEBER por parcelas
-        for conta in contas_receber:
-            parcelas = conta.get("parcelas", [])
+        if apenas_resumo:
+            fluxo_final = await db.parcelas_index.aggregate(
+                pipeline_resumo_fluxo(filtro, campo_data, campo_valor, tipo_visao)
+            ).to_list(None)
+            saldo_acumulado = fluxo_final[-1]["saldo_acumulado"] if fluxo_final else 0
+        else:
+            # Varredura apenas do intervalo pedido no índice de parcelas
+            parcelas = await db.parcelas_index.find(filtro, {"_id": 0}).sort(
+                [(campo_data, 1), ("conta_numero", 1), ("posicao", 1)]
+            ).to_list(None)
+            
+            # Organizar por período
+            fluxo_por_periodo = {}
             
             for parcela in parcelas:
-                if regime == "caixa":
-                    # Regime CAIXA: só parcelas efetivamente recebidas (status padronizado)
-                    if parcela.get("status") != "recebido":
-                        continue
-                    
-                    data_ref_str = parcela.get("data_recebimento", "")
-                    if not data_ref_str:
-                        continue
-                    
-                    # Usar helper parse_date_only para extração consistente
-                    data_ref = parse_date_only(data_ref_str)
-                    if not data_ref or not (data_inicio <= data_ref <= data_fim):
-                        continue
-                    
-                    valor = parcela.get("valor_recebido", 0)
-                    
-                else:  # competencia
-                    # Regime COMPETÊNCIA: todas as parcelas por vencimento
-                    data_ref_str = parcela.get("data_vencimento", "")
-                    if not data_ref_str:
-                        continue
-                    
-                    # Usar helper parse_date_only para extração consistente
-                    data_ref = parse_date_only(data_ref_str)
-                    if not data_ref or not (data_inicio <= data_ref <= data_fim):
-                        continue
-                    
-                    valor = parcela.get("valor", 0)
+                periodo = inicio_periodo_fluxo(parcela[campo_data], tipo_visao)
                 
                 # Inicializar período se não existir
-                if data_ref not in fluxo_por_periodo:
-                    fluxo_por_periodo[data_ref] = {
+                if periodo not in fluxo_por_periodo:
+                    fluxo_por_periodo[periodo] = {
                         "entradas": 0,
                         "saidas": 0,
                         "detalhes_entradas": [],
                         "detalhes_saidas": []
                     }
                 
-                # Adicionar entrada
-                fluxo_por_periodo[data_ref]["entradas"] += valor
-                fluxo_por_periodo[data_ref]["detalhes_entradas"].append({
-                    "tipo": "CR Parcela",
-                    "descricao": f"{conta.get('numero', 'CR-XXX')} - Parcela {parcela.get('numero', '?')}",
-                    "valor": valor,
-                    "data": data_ref,
-                    "referencia": {
-                        "conta_id": conta.get("id"),
-                        "numero": conta.get("numero"),
-                        "parcela": parcela.get("numero")
-                    }
-                })
-        
-        # Processar CONTAS A PAGAR por parcelas
-        for conta in contas_pagar:
-            parcelas = conta.get("parcelas", [])
+                sentido = "entradas" if parcela["tipo"] == "receber" else "saidas"
+                fluxo_por_periodo[periodo][sentido] += parcela.get(campo_valor, 0)
+                fluxo_por_periodo[periodo][f"detalhes_{sentido}"].append(
+                    detalhe_parcela_fluxo(parcela, campo_data, campo_valor)
+                )
             
-            for parcela in parcelas:
-                if regime == "caixa":
-                    # Regime CAIXA: só parcelas efetivamente pagas (status padronizado)
-                    if parcela.get("status") != "pago":
-                        continue
-                    
-                    data_ref_str = parcela.get("data_pagamento", "")
-                    if not data_ref_str:
-                        continue
-                    
-                    # Usar helper parse_date_only para extração consistente
-                    data_ref = parse_date_only(data_ref_str)
-                    if not data_ref or not (data_inicio <= data_ref <= data_fim):
-                        continue
-                    
-                    valor = parcela.get("valor_pago", 0)
-                    
-                else:  # competencia
-                    # Regime COMPETÊNCIA: todas as parcelas por vencimento
-                    data_ref_str = parcela.get("data_vencimento", "")
-                    if not data_ref_str:
-                        continue
-                    
-                    # Usar helper parse_date_only para extração consistente
-                    data_ref = parse_date_only(data_ref_str)
-                    if not data_ref or not (data_inicio <= data_ref <= data_fim):
-                        continue
-                    
-                    valor = parcela.get("valor", 0)
-                
-                # Inicializar período se não existir
-                if data_ref not in fluxo_por_periodo:
-                    fluxo_por_periodo[data_ref] = {
-                        "entradas": 0,
-                        "saidas": 0,
-                        "detalhes_entradas": [],
-                        "detalhes_saidas": []
-                    }
+            # Calcular saldos acumulados em ordem de data
+            saldo_acumulado = 0
+            fluxo_final = []
+            
+            for periodo in sorted(fluxo_por_periodo.keys()):
+                dados = fluxo_por_periodo[periodo]
+                saldo_periodo = dados["entradas"] - dados["saidas"]
+                saldo_acumulado += saldo_periodo
                 
-                # Adicionar saída
-                fluxo_por_periodo[data_ref]["saidas"] += valor
-                fluxo_por_periodo[data_ref]["detalhes_saidas"].append({
-                    "tipo": "CP Parcela",
-                    "descricao": f"{conta.get('numero', 'CP-XXX')} - Parcela {parcela.get('numero', '?')}",
-                    "valor": valor,
-                    "data": data_ref,
-                    "referencia": {
-                        "conta_id": conta.get("id"),
-                        "numero": conta.get("numero"),
-                        "parcela": parcela.get("numero")
-                    }
+                fluxo_final.append({
+                    "periodo": periodo,
+                    "entradas": dados["entradas"],
+                    "saidas": dados["saidas"],
+                    "saldo_periodo": saldo_periodo,
+                    "saldo_acumulado": saldo_acumulado,
+                    "detalhes_entradas": dados["detalhes_entradas"],
+                    "detalhes_saidas": dados["detalhes_saidas"]
                 })
         
-        # Ordenar por data
-        periodos_ordenados = sorted(fluxo_por_periodo.keys())
-        
-        # Calcular saldos acumulados
-        saldo_acumulado = 0
-        fluxo_final = []
-        
-        for periodo in periodos_ordenados:
-            dados = fluxo_por_periodo[periodo]
-            saldo_periodo = dados["entradas"] - dados["saidas"]
-            saldo_acumulado += saldo_periodo
-            
-            fluxo_final.append({
-                "periodo": periodo,
-                "entradas": dados["entradas"],
-                "saidas": dados["saidas"],
-                "saldo_periodo": saldo_periodo,
-                "saldo_acumulado": saldo_acumulado,
-                "detalhes_entradas": dados["detalhes_entradas"],
-                "detalhes_saidas": dados["detalhes_saidas"]
-            })
-        
         # Calcular totais
         total_entradas = sum(item["entradas"] for item in fluxo_final)
         total_saidas = sum(item["saidas"] for item in fluxo_final)
@@ -15119,6 +17853,7 @@ async def get_fluxo_caixa(
                 "fim": data_fim
             },
             "regime": regime,
+            "tipo_visao": tipo_visao,
             "resumo": {
                 "total_entradas": total_entradas,
                 "total_saidas": total_saidas,
@@ -15131,12 +17866,225 @@ async def get_fluxo_caixa(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao buscar fluxo de caixa: {str(e)}")
 
+@api_router.get("/fluxo-caixa/detalhes")
+async def get_fluxo_caixa_detalhes(
+    periodo: str,
+    regime: str = "caixa",
+    tipo_visao: str = "diario",
+    tipo: Optional[str] = None,  # receber (entradas), pagar (saídas) ou ambos
+    data_inicio: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    current_user: dict = Depends(require_permission("contas_receber", "ler"))
+):
+    """
+    Movimentações de um período do fluxo de caixa, paginadas por cursor.
+    
+    'periodo' é a chave retornada em GET /fluxo-caixa para o mesmo tipo_visao;
+    data_inicio/data_fim recortam o período nas bordas do intervalo consultado.
+    Para a próxima página, repassar 'proximo_cursor' (nulo na última).
+    """
+    _validar_parametros_fluxo(regime, tipo_visao)
+    if tipo is not None and tipo not in PARCELAS_INDEX_TIPOS:
+        raise HTTPException(status_code=400, detail="Tipo deve ser 'receber' ou 'pagar'")
+    
+    inicio = _data_fluxo(periodo, "Período inválido")
+    if inicio_periodo_fluxo(inicio, tipo_visao) != inicio:
+        raise HTTPException(status_code=400, detail="Período não corresponde ao início de um período do tipo_visao")
+    
+    fim = fim_periodo_fluxo(inicio, tipo_visao)
+    if data_inicio:
+        inicio = max(inicio, _data_fluxo(data_inicio, "data_inicio inválida"))
+    if data_fim:
+        fim = min(fim, _data_fluxo(data_fim, "data_fim inválida"))
+    limit = max(1, min(limit, LIMITE_DETALHES_FLUXO))
+    
+    campo_data, campo_valor, filtro_regime = campos_regime_fluxo(regime)
+    filtro = {
+        "tipo": tipo if tipo else {"$in": ["receber", "pagar"]},
+        campo_data: {"$gte": inicio, "$lte": fim},
+        **filtro_regime
+    }
+    
+    # Paginação por chave: (data, tipo, conta_id, posicao) é única no índice
+    if cursor:
+        data_c, tipo_c, conta_c, posicao_c = decodificar_cursor_fluxo(cursor)
+        filtro["$or"] = [
+            {campo_data: {"$gt": data_c}},
+            {campo_data: data_c, "tipo": {"$gt": tipo_c}},
+            {campo_data: data_c, "tipo": tipo_c, "conta_id": {"$gt": conta_c}},
+            {campo_data: data_c, "tipo": tipo_c, "conta_id": conta_c, "posicao": {"$gt": posicao_c}}
+        ]
+    
+    parcelas = await db.parcelas_index.find(filtro, {"_id": 0}).sort(
+        [(campo_data, 1), ("tipo", 1), ("conta_id", 1), ("posicao", 1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    proximo_cursor = None
+    if len(parcelas) > limit:
+        parcelas = parcelas[:limit]
+        ultima = parcelas[-1]
+        proximo_cursor = codificar_cursor_fluxo(
+            [ultima[campo_data], ultima["tipo"], ultima["conta_id"], ultima["posicao"]]
+        )
+    
+    return {
+        "periodo": {"inicio": inicio, "fim": fim},
+        "regime": regime,
+        "tipo_visao": tipo_visao,
+        "detalhes": [
+            {"sentido": "entrada" if p["tipo"] == "receber" else "saida", **detalhe_parcela_fluxo(p, campo_data, campo_valor)}
+            for p in parcelas
+        ],
+        "proximo_cursor": proximo_cursor
+    }
+
 # ==================== ETAPA 11 - ROTINA DE VENCIMENTOS ====================
 
+LOTE_LOGS_VENCIMENTO = 1000
+
+def _pipeline_status_vencimento(config: dict, hoje_dt: datetime, agora: str) -> list:
+    """
+    Pipeline de update que recalcula no servidor os dias de atraso das parcelas vencidas
+    e o status da conta, com a mesma regra de atualizar_status_conta_receber/pagar.
+    """
+    liquidada = config["status_liquidada"]
+    
+    def quantidade(status):
+        return {"$size": {"$filter": {"input": "$parcelas", "as": "p", "cond": {"$eq": ["$$p.status", status]}}}}
+    
+    dias_atraso = {"$dateDiff": {
+        "startDate": {"$dateFromString": {
+            "dateString": {"$substrCP": [{"$ifNull": ["$$p.data_vencimento", ""]}, 0, 10]},
+            "format": "%Y-%m-%d", "onError": None, "onNull": None
+        }},
+        "endDate": hoje_dt,
+        "unit": "day"
+    }}
+    
+    return [
+        {"$set": {"parcelas": {"$map": {
+            "input": "$parcelas",
+            "as": "p",
+            "in": {"$cond": [
+                {"$eq": ["$$p.status", "vencido"]},
+                {"$mergeObjects": ["$$p", {"dias_atraso": {"$ifNull": [dias_atraso, 0]}}]},
+                "$$p"
+            ]}
+        }}}},
+        {"$set": {
+            "status": {"$switch": {
+                "branches": [
+                    {"case": {"$eq": [quantidade(liquidada), {"$size": "$parcelas"}]}, "then": f"{liquidada}_total"},
+                    {"case": {"$gt": [quantidade(liquidada), 0]}, "then": f"{liquidada}_parcial"},
+                    {"case": {"$gt": [quantidade("vencido"), 0]}, "then": "vencido"}
+                ],
+                "default": "pendente"
+            }},
+            "dias_atraso": {"$max": {"$map": {
+                "input": {"$filter": {"input": "$parcelas", "as": "p", "cond": {"$eq": ["$$p.status", "vencido"]}}},
+                "as": "p",
+                "in": "$$p.dias_atraso"
+            }}},
+            "updated_at": agora
+        }}
+    ]
+
+async def marcar_parcelas_vencidas(tipo: str) -> dict:
+    """
+    Marca como 'vencido' as parcelas pendentes com data_vencimento < hoje, em operações
+    sobre conjuntos (sem um update por parcela):
+    1. aggregate das parcelas que vão vencer, para os logs e a lista de clientes
+    2. update_many com arrayFilters mudando o status dessas parcelas
+    3. update_many com pipeline recalculando dias_atraso e status das contas com parcela vencida
+    4. logs em insert_many, clientes inadimplentes em um update_many com $in
+       e o índice de parcelas atualizado com um update_many
+    """
+    config = PARCELAS_INDEX_TIPOS[tipo]
+    colecao = db[config["colecao"]]
+    hoje = parse_date_only(iso_utc_now())
+    hoje_dt = datetime.strptime(hoje, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    agora = iso_utc_now()
+    
+    # Strings ISO comparam pela data: "2024-05-31T..." < "2024-06-01"
+    filtro_parcela = {"status": "pendente", "data_vencimento": {"$lt": hoje}}
+    filtro_contas = {"cancelada": {"$ne": True}, "parcelas": {"$elemMatch": filtro_parcela}}
+    
+    conta_ids = set()
+    cliente_ids = set()
+    parcelas_vencidas = 0
+    logs = []
+    
+    async def gravar_logs():
+        if logs:
+            await db.logs.insert_many(logs, ordered=False)
+            logs.clear()
+    
+    async for conta in colecao.aggregate([
+        {"$match": filtro_contas},
+        {"$project": {
+            "_id": 0, "id": 1, "numero": 1, "cliente_id": 1,
+            "parcelas": {"$filter": {
+                "input": "$parcelas",
+                "as": "p",
+                "cond": {"$and": [
+                    {"$eq": ["$$p.status", "pendente"]},
+                    {"$lt": ["$$p.data_vencimento", hoje]}
+                ]}
+            }}
+        }}
+    ]):
+        conta_ids.add(conta["id"])
+        if conta.get("cliente_id"):
+            cliente_ids.add(conta["cliente_id"])
+        for parcela in conta["parcelas"]:
+            parcelas_vencidas += 1
+            vencimento = parse_date_only(parcela.get("data_vencimento"))
+            logs.append(Log(
+                ip="sistema",
+                user_id="sistema",
+                user_nome="Sistema Automático",
+                tela=config["colecao"],
+                acao="parcela_vencida_automatica",
+                severidade="WARNING",
+                detalhes={
+                    "registro_id": conta["id"],
+                    "registro_numero": conta.get("numero"),
+                    "numero_parcela": parcela.get("numero_parcela"),
+                    "dias_atraso": (hoje_dt - datetime.strptime(vencimento, "%Y-%m-%d").replace(tzinfo=timezone.utc)).days if vencimento else 0,
+                    "valor_pendente": parcela.get("valor")
+                }
+            ).model_dump())
+            if len(logs) >= LOTE_LOGS_VENCIMENTO:
+                await gravar_logs()
+    await gravar_logs()
+    
+    if conta_ids:
+        await colecao.update_many(
+            filtro_contas,
+            {"$set": {"parcelas.$[p].status": "vencido"}},
+            array_filters=[{"p.status": "pendente", "p.data_vencimento": {"$lt": hoje}}]
+        )
+        await db.parcelas_index.update_many(
+            {"tipo": tipo, "status": "pendente", "data_vencimento": {"$lt": hoje}},
+            {"$set": {"status": "vencido", "updated_at": agora}}
+        )
+    
+    # Também atualiza o atraso das contas que já estavam vencidas
+    await colecao.update_many(
+        {"cancelada": {"$ne": True}, "parcelas.status": "vencido"},
+        _pipeline_status_vencimento(config, hoje_dt, agora)
+    )
+    
+    if tipo == "receber" and cliente_ids:
+        await db.clientes.update_many({"id": {"$in": list(cliente_ids)}}, {"$set": {"inadimplente": True}})
+    
+    return {"contas_processadas": len(conta_ids), "parcelas_vencidas": parcelas_vencidas}
+
 @api_router.post("/rotinas/atualizar-vencimentos")
 async def rotina_atualizar_vencimentos(
     tipo: str = "ambos",
-    limit: int = 1000,
     current_user: dict = Depends(require_permission("configuracoes", "editar"))
 ):
     """
@@ -15146,63 +18094,20 @@ async def rotina_atualizar_vencimentos(
     if tipo not in ["receber", "pagar", "ambos"]:
         raise HTTPException(status_code=400, detail="Tipo deve ser 'receber', 'pagar' ou 'ambos'")
     
-    hoje = parse_date_only(iso_utc_now())
     resultados = {"receber": {"contas_processadas": 0, "parcelas_vencidas": 0}, 
                   "pagar": {"contas_processadas": 0, "parcelas_vencidas": 0}}
     
-    async def processar_vencimentos(collection_name: str, tipo_key: str):
-        collection = db[collection_name]
-        
-        # Buscar contas não canceladas com parcelas pendentes
-        contas = await collection.find(
-            {"cancelada": {"$ne": True}, "status": {"$in": ["pendente", "recebido_parcial", "pago_parcial"]}},
-            {"_id": 0}
-        ).limit(limit).to_list(None)
-        
-        for conta in contas:
-            atualizado = False
-            for i, parcela in enumerate(conta.get("parcelas", [])):
-                if parcela.get("status") == "pendente":
-                    data_venc = parse_date_only(parcela.get("data_vencimento", ""))
-                    if data_venc and data_venc < hoje:
-                        # Calcular dias de atraso
-                        try:
-                            dt_venc = datetime.strptime(data_venc, "%Y-%m-%d")
-                            dt_hoje = datetime.strptime(hoje, "%Y-%m-%d")
-                            dias_atraso = (dt_hoje - dt_venc).days
-                        except:
-                            dias_atraso = 0
-                        
-                        # Atualizar parcela para vencido
-                        await collection.update_one(
-                            {"id": conta["id"]},
-                            {"$set": {
-                                f"parcelas.{i}.status": "vencido",
-                                f"parcelas.{i}.dias_atraso": dias_atraso
-                            }}
-                        )
-                        resultados[tipo_key]["parcelas_vencidas"] += 1
-                        atualizado = True
-            
-            if atualizado:
-                # Recalcular status da conta
-                if tipo_key == "pagar":
-                    await atualizar_status_conta_pagar(conta["id"])
-                else:
-                    await atualizar_status_conta_receber(conta["id"])
-                resultados[tipo_key]["contas_processadas"] += 1
-    
     # Processar conforme tipo
     if tipo in ["receber", "ambos"]:
-        await processar_vencimentos("contas_receber", "receber")
+        resultados["receber"] = await marcar_parcelas_vencidas("receber")
     
     if tipo in ["pagar", "ambos"]:
-        await processar_vencimentos("contas_pagar", "pagar")
+        resultados["pagar"] = await marcar_parcelas_vencidas("pagar")
     
     return {
         "success": True,
         "tipo": tipo,
-        "data_referencia": hoje,
+        "data_referencia": parse_date_only(iso_utc_now()),
         "resultados": resultados
     }
 
@@ -15219,80 +18124,45 @@ async def get_fluxo_caixa_dashboard(
         from datetime import datetime, timedelta
         
         hoje = datetime.now()
-        inicio_mes = hoje.replace(day=1).isoformat()
+        inicio_mes = hoje.replace(day=1).strftime("%Y-%m-%d")
         fim_mes = (hoje.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
-        fim_mes_str = fim_mes.isoformat()
-        
-        # Buscar todas as contas a receber
-        receber_todas = await db.contas_receber.find({
-            "cancelada": {"$ne": True}
-        }, {"_id": 0}).to_list(None)
-        
-        # Processar parcelas do mês (a receber)
-        total_recebido = 0
-        total_a_receber = 0
-        
-        for conta in receber_todas:
-            for parcela in conta.get("parcelas", []):
-                data_venc = parse_date_only(parcela.get("data_vencimento", ""))
-                if not data_venc:
-                    continue
-                
-                # Se vence neste mês (status padronizado)
-                if inicio_mes <= data_venc <= fim_mes_str:
-                    if parcela.get("status") == "recebido":
-                        total_recebido += parcela.get("valor_recebido", 0)
-                    else:
-                        total_a_receber += parcela.get("valor", 0)
-        
-        # Buscar todas as contas a pagar
-        pagar_todas = await db.contas_pagar.find({
-            "cancelada": {"$ne": True}
-        }, {"_id": 0}).to_list(None)
-        
-        # Processar parcelas do mês (a pagar)
-        total_pago = 0
-        total_a_pagar = 0
-        
-        for conta in pagar_todas:
-            for parcela in conta.get("parcelas", []):
-                data_venc = parse_date_only(parcela.get("data_vencimento", ""))
-                if not data_venc:
-                    continue
-                
-                # Se vence neste mês (status padronizado)
-                if inicio_mes <= data_venc <= fim_mes_str:
-                    if parcela.get("status") == "pago":
-                        total_pago += parcela.get("valor_pago", 0)
-                    else:
-                        total_a_pagar += parcela.get("valor", 0)
+        fim_mes_str = fim_mes.strftime("%Y-%m-%d")
         
         # Projeção próximos 30 dias
         proximo_mes = parse_date_only((hoje + timedelta(days=30)).isoformat())
         
-        projecao_entradas = 0
-        for conta in receber_todas:
-            for parcela in conta.get("parcelas", []):
-                data_venc = parse_date_only(parcela.get("data_vencimento", ""))
-                if not data_venc:
-                    continue
-                
-                # Se vence nos próximos 30 dias (após o mês atual) - status padronizado
-                if fim_mes_str < data_venc <= proximo_mes:
-                    if parcela.get("status") != "recebido":
-                        projecao_entradas += parcela.get("valor", 0)
+        # Uma varredura no índice de parcelas: vencimentos do mês atual até a projeção (status padronizado)
+        totais = await db.parcelas_index.aggregate([
+            {"$match": {
+                "tipo": {"$in": ["receber", "pagar"]},
+                "data_vencimento": {"$gte": inicio_mes, "$lte": max(fim_mes_str, proximo_mes)}
+            }},
+            {"$group": {
+                "_id": {
+                    "tipo": "$tipo",
+                    "liquidada": "$liquidada",
+                    "mes_atual": {"$lte": ["$data_vencimento", fim_mes_str]}
+                },
+                "valor": {"$sum": "$valor"},
+                "valor_liquidado": {"$sum": "$valor_liquidado"}
+            }}
+        ]).to_list(None)
         
-        projecao_saidas = 0
-        for conta in pagar_todas:
-            for parcela in conta.get("parcelas", []):
-                data_venc = parse_date_only(parcela.get("data_vencimento", ""))
-                if not data_venc:
-                    continue
-                
-                # Se vence nos próximos 30 dias (após o mês atual) - status padronizado
-                if fim_mes_str < data_venc <= proximo_mes:
-                    if parcela.get("status") != "pago":
-                        projecao_saidas += parcela.get("valor", 0)
+        def somar(tipo: str, liquidada: bool, mes_atual: bool, campo: str) -> float:
+            return sum(
+                linha[campo] for linha in totais
+                if linha["_id"] == {"tipo": tipo, "liquidada": liquidada, "mes_atual": mes_atual}
+            )
+        
+        # Parcelas do mês: liquidadas pelo valor liquidado, pendentes pelo valor da parcela
+        total_recebido = somar("receber", True, True, "valor_liquidado")
+        total_a_receber = somar("receber", False, True, "valor")
+        total_pago = somar("pagar", True, True, "valor_liquidado")
+        total_a_pagar = somar("pagar", False, True, "valor")
+        
+        # Vencem nos próximos 30 dias (após o mês atual) e ainda não foram liquidadas
+        projecao_entradas = somar("receber", False, False, "valor")
+        projecao_saidas = somar("pagar", False, False, "valor")
         
         return {
             "mes_atual": {
@@ -15326,6 +18196,7 @@ class RequestIdMiddleware(BaseHTTPMiddleware):
         # Gerar request_id único
         rid = str(uuid.uuid4())[:8]
         request_id_var.set(rid)
+        request_user_cache_var.set({})
         
         # Medir tempo de execução
         start_time = time.time()
@@ -15340,6 +18211,37 @@ class RequestIdMiddleware(BaseHTTPMiddleware):
 
 app.add_middleware(RequestIdMiddleware)
 
+class RateLimitMiddleware(BaseHTTPMiddleware):
+    """
+    Aplica os limiters de RATE_LIMIT_ROTAS por prefixo de rota.
+    A chave é o usuário do token (sub) quando válido, senão o IP do cliente.
+    """
+    async def dispatch(self, request: Request, call_next):
+        limiter = next((l for prefixo, l in RATE_LIMIT_ROTAS if request.url.path.startswith(prefixo)), None)
+        if limiter is None or request.method == "OPTIONS":
+            return await call_next(request)
+        
+        chave = request.client.host if request.client else "0.0.0.0"
+        auth = request.headers.get("authorization", "")
+        if auth.lower().startswith("bearer "):
+            try:
+                sub = jwt.decode(auth[7:], JWT_SECRET, algorithms=[JWT_ALGORITHM]).get("sub")
+                if isinstance(sub, str):
+                    chave = f"user:{sub}"
+            except jwt.PyJWTError:
+                pass
+        
+        restante = await limiter.consumir(chave)
+        if restante:
+            return JSONResponse(
+                status_code=429,
+                content={"detail": f"Muitas requisições. Tente novamente em {restante} segundos."},
+                headers={"Retry-After": str(restante)}
+            )
+        return await call_next(request)
+
+app.add_middleware(RateLimitMiddleware)
+
 # ==================== CORS CONFIGURAÇÃO - CORREÇÃO 2 ====================
 # Correção 2: CORS com allow_credentials=True é incompatível com origins="*"
 # Solução: Se CORS_ORIGINS não definido ou "*", usa lista padrão segura para dev local
@@ -15371,7 +18273,317 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ==================== AGENDADOR DE ROTINAS ====================
+# Rotinas recorrentes rodam fora das requisições, em horários tipo cron (fuso AGENDADOR_TZ).
+# Cada rotina tem um documento em agendador_jobs com a próxima execução e um lease:
+# só o worker que obtém o lease executa, renovando-o a cada parte concluída e, durante
+# uma parte, a cada AGENDADOR_LEASE_S/3 por uma task de renovação. As rotinas
+# são geradores assíncronos que executam em partes e devolvem um checkpoint; se o worker
+# cair, outro retoma do checkpoint quando o lease expirar. Histórico em agendador_execucoes.
+
+import socket
+from zoneinfo import ZoneInfo
+
+AGENDADOR_ENABLED = os.environ.get('AGENDADOR_ENABLED', 'true').lower() == 'true'
+try:
+    AGENDADOR_TZ = ZoneInfo(os.environ.get('AGENDADOR_TZ', 'America/Sao_Paulo'))
+except Exception as e:
+    print(f"Aviso: fuso do agendador indisponível, usando UTC ({e})")
+    AGENDADOR_TZ = timezone.utc
+AGENDADOR_INTERVALO_S = int(os.environ.get('AGENDADOR_INTERVALO_S', 30))
+AGENDADOR_LEASE_S = int(os.environ.get('AGENDADOR_LEASE_S', 300))
+AGENDADOR_RETRY_S = int(os.environ.get('AGENDADOR_RETRY_S', 600))
+AGENDADOR_PAUSA_MS = int(os.environ.get('AGENDADOR_PAUSA_MS', 50))
+
+def _campo_cron(expr: str, minimo: int, maximo: int) -> set:
+    """Valores de um campo cron: '*', '*/n', 'a-b', 'a-b/n' e listas separadas por vírgula"""
+    valores = set()
+    for parte in expr.split(","):
+        faixa, _, passo = parte.partition("/")
+        if faixa == "*":
+            inicio, fim = minimo, maximo
+        elif "-" in faixa:
+            inicio, fim = (int(v) for v in faixa.split("-"))
+        else:
+            inicio = fim = int(faixa)
+        if inicio < minimo or fim > maximo or inicio > fim:
+            raise ValueError(f"Campo cron fora do intervalo: {parte}")
+        valores.update(range(inicio, fim + 1, int(passo or 1)))
+    return valores
+
+def proxima_execucao_cron(expr: str, depois: datetime) -> datetime:
+    """
+    Próximo instante (UTC) após 'depois' que satisfaz 'minuto hora dia mês dia_semana'
+    no fuso AGENDADOR_TZ. Dia da semana: 0 = domingo.
+    """
+    minuto, hora, dia, mes, dia_semana = expr.split()
+    minutos, horas = sorted(_campo_cron(minuto, 0, 59)), sorted(_campo_cron(hora, 0, 23))
+    dias, meses = _campo_cron(dia, 1, 31), _campo_cron(mes, 1, 12)
+    dias_semana = {d % 7 for d in _campo_cron(dia_semana, 0, 7)}
+    
+    local = depois.astimezone(AGENDADOR_TZ).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    data = local.date()
+    for _ in range(366 * 5):
+        if data.month in meses and data.day in dias and (data.isoweekday() % 7) in dias_semana:
+            for h in horas:
+                for m in minutos:
+                    candidato = datetime(data.year, data.month, data.day, h, m, tzinfo=AGENDADOR_TZ)
+                    if candidato >= local:
+                        return candidato.astimezone(timezone.utc)
+        data += timedelta(days=1)
+    raise ValueError(f"Expressão cron sem ocorrência: {expr}")
+
+# Rotinas: geradores assíncronos que recebem o checkpoint e produzem, a cada parte,
+# {"registros": linhas afetadas, "checkpoint": estado para retomar, "resultado": ...}
+
+async def rotina_vencimentos(checkpoint: Optional[dict]):
+    feitos = (checkpoint or {}).get("tipos", [])
+    for tipo in ("receber", "pagar"):
+        if tipo in feitos:
+            continue
+        resultado = await marcar_parcelas_vencidas(tipo)
+        feitos = feitos + [tipo]
+        yield {"registros": resultado["parcelas_vencidas"], "checkpoint": {"tipos": feitos}, "resultado": {tipo: resultado}}
+
+async def rotina_orcamentos_expirados(checkpoint: Optional[dict]):
+    resultado = await expirar_orcamentos("sistema")
+    yield {"registros": resultado["expirados"], "checkpoint": None, "resultado": resultado}
+
+async def rotina_reconciliar_reservas(checkpoint: Optional[dict]):
+    resultado = await reconciliar_estoque_reservado()
+    yield {"registros": resultado["produtos_corrigidos"], "checkpoint": None, "resultado": resultado}
+
+async def rotina_curva_abc(checkpoint: Optional[dict]):
+    resultado = await recalcular_curva_abc()
+    yield {"registros": resultado.get("produtos_atualizados", 0), "checkpoint": None,
+           "resultado": {k: v for k, v in resultado.items() if k != "message"}}
+
+async def rotina_arquivar_logs(checkpoint: Optional[dict]):
+    # Um lote por parte; o filtro por data torna a rotina naturalmente retomável
+    while True:
+        resultado = await arquivar_logs(DIAS_RETENCAO_LOGS, max_lotes=1)
+        if not resultado["logs_arquivados"]:
+            break
+        yield {"registros": resultado["logs_arquivados"], "checkpoint": None, "resultado": None}
+
+async def rotina_checkpoint_estoque(checkpoint: Optional[dict]):
+    # Um corte mensal por parte, do mais antigo pendente ao do mês atual
+    for corte in await cortes_mensais_pendentes():
+        resultado = await criar_checkpoint_estoque(corte)
+        yield {"registros": resultado["produtos"], "checkpoint": {"corte": corte}, "resultado": resultado}
+
+ROTINAS_AGENDADAS = {
+    "atualizar_vencimentos": {"cron": os.environ.get('CRON_VENCIMENTOS', '5 0 * * *'), "funcao": rotina_vencimentos},
+    "orcamentos_expirados": {"cron": os.environ.get('CRON_ORCAMENTOS_EXPIRADOS', '0 * * * *'), "funcao": rotina_orcamentos_expirados},
+    "reconciliar_reservas": {"cron": os.environ.get('CRON_RECONCILIAR_RESERVAS', '45 2 * * *'), "funcao": rotina_reconciliar_reservas},
+    "curva_abc": {"cron": os.environ.get('CRON_CURVA_ABC', '0 3 * * 0'), "funcao": rotina_curva_abc},
+    "arquivar_logs": {"cron": os.environ.get('CRON_ARQUIVAR_LOGS', '30 3 * * *'), "funcao": rotina_arquivar_logs},
+    "checkpoint_estoque": {"cron": os.environ.get('CRON_CHECKPOINT_ESTOQUE', '15 0 1 * *'), "funcao": rotina_checkpoint_estoque},
+}
+
+class AgendadorRotinas:
+    """Executa ROTINAS_AGENDADAS em uma task de fundo, com lease no MongoDB por rotina."""
+    def __init__(self, rotinas: dict):
+        self.rotinas = rotinas
+        self.dono = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.task = None
+    
+    def iniciar(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._executar())
+    
+    async def parar(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+    
+    async def registrar(self):
+        """Cria o documento de cada rotina e recalcula a próxima execução se o cron mudou"""
+        agora = datetime.now(timezone.utc)
+        for nome, config in self.rotinas.items():
+            await db.agendador_jobs.update_one(
+                {"nome": nome},
+                {"$setOnInsert": {
+                    "nome": nome, "cron": config["cron"],
+                    "proxima_execucao": proxima_execucao_cron(config["cron"], agora),
+                    "lease_dono": None, "lease_ate": None, "checkpoint": None
+                }},
+                upsert=True
+            )
+            await db.agendador_jobs.update_one(
+                {"nome": nome, "cron": {"$ne": config["cron"]}},
+                {"$set": {"cron": config["cron"], "proxima_execucao": proxima_execucao_cron(config["cron"], agora)}}
+            )
+    
+    async def _obter_lease(self, nome: str, agora: datetime, forcar: bool = False) -> Optional[dict]:
+        filtro = {"nome": nome, "$or": [{"lease_ate": None}, {"lease_ate": {"$lt": agora}}]}
+        if not forcar:
+            filtro["proxima_execucao"] = {"$lte": agora}
+        return await db.agendador_jobs.find_one_and_update(
+            filtro,
+            {"$set": {"lease_dono": self.dono, "lease_ate": agora + timedelta(seconds=AGENDADOR_LEASE_S)}},
+            projection={"_id": 0},
+            return_document=True
+        )
+    
+    async def _manter_lease(self, nome: str, perdido: asyncio.Event):
+        """Renova o lease enquanto a rotina roda: uma parte longa não deixa outro worker assumir"""
+        while True:
+            await asyncio.sleep(AGENDADOR_LEASE_S / 3)
+            try:
+                renovado = await db.agendador_jobs.update_one(
+                    {"nome": nome, "lease_dono": self.dono},
+                    {"$set": {"lease_ate": datetime.now(timezone.utc) + timedelta(seconds=AGENDADOR_LEASE_S)}}
+                )
+            except Exception as e:
+                print(f"Aviso: não foi possível renovar o lease da rotina {nome} ({e})")
+                continue
+            if not renovado.matched_count:
+                perdido.set()
+                return
+    
+    async def executar_rotina(self, nome: str, forcar: bool = False) -> Optional[dict]:
+        """Executa a rotina se for a hora dela (ou se forcar) e este worker obtiver o lease"""
+        config = self.rotinas[nome]
+        inicio = datetime.now(timezone.utc)
+        job = await self._obter_lease(nome, inicio, forcar)
+        if not job:
+            return None
+        
+        execucao = {
+            "id": str(uuid.uuid4()),
+            "job": nome,
+            "dono": self.dono,
+            "inicio": inicio.isoformat(),
+            "retomada": job.get("checkpoint") is not None,
+            "partes": 0,
+            "registros": 0,
+            "resultado": {},
+            "status": "sucesso",
+            "erro": None
+        }
+        proxima = proxima_execucao_cron(config["cron"], inicio)
+        checkpoint = job.get("checkpoint")
+        lease_perdido = asyncio.Event()
+        renovacao = asyncio.create_task(self._manter_lease(nome, lease_perdido))
+        try:
+            async for parte in config["funcao"](checkpoint):
+                execucao["partes"] += 1
+                execucao["registros"] += parte.get("registros", 0)
+                if parte.get("resultado"):
+                    execucao["resultado"].update(parte["resultado"])
+                checkpoint = parte.get("checkpoint")
+                renovado = await db.agendador_jobs.update_one(
+                    {"nome": nome, "lease_dono": self.dono},
+                    {"$set": {
+                        "checkpoint": checkpoint,
+                        "lease_ate": datetime.now(timezone.utc) + timedelta(seconds=AGENDADOR_LEASE_S)
+                    }}
+                )
+                if lease_perdido.is_set() or not renovado.matched_count:
+                    execucao["status"] = "lease_perdido"
+                    break
+                # Cede o event loop às requisições entre as partes
+                await asyncio.sleep(AGENDADOR_PAUSA_MS / 1000)
+        except asyncio.CancelledError:
+            execucao["status"] = "interrompida"
+            proxima = datetime.now(timezone.utc)
+            raise
+        except Exception as e:
+            execucao["status"] = "erro"
+            execucao["erro"] = str(e)
+            proxima = datetime.now(timezone.utc) + timedelta(seconds=AGENDADOR_RETRY_S)
+            logger.error(f"Erro na rotina agendada {nome}: {e}")
+        finally:
+            renovacao.cancel()
+            fim = datetime.now(timezone.utc)
+            execucao["fim"] = fim.isoformat()
+            execucao["duracao_ms"] = round((fim - inicio).total_seconds() * 1000, 2)
+            if execucao["status"] != "lease_perdido":
+                # Concluída: limpa o checkpoint; com erro ou interrompida, mantém para retomar
+                await db.agendador_jobs.update_one(
+                    {"nome": nome, "lease_dono": self.dono},
+                    {"$set": {
+                        "proxima_execucao": proxima,
+                        "checkpoint": None if execucao["status"] == "sucesso" else checkpoint,
+                        "lease_dono": None,
+                        "lease_ate": None,
+                        "ultima_execucao": execucao["fim"],
+                        "ultimo_status": execucao["status"]
+                    }}
+                )
+            await db.agendador_execucoes.insert_one(dict(execucao))
+        return execucao
+    
+    async def _executar(self):
+        try:
+            await self.registrar()
+        except Exception as e:
+            logger.error(f"Erro ao registrar rotinas agendadas: {e}")
+        while True:
+            for nome in self.rotinas:
+                try:
+                    await self.executar_rotina(nome)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Erro no agendador ({nome}): {e}")
+            await asyncio.sleep(AGENDADOR_INTERVALO_S)
+
+# Instância global do agendador
+agendador = AgendadorRotinas(ROTINAS_AGENDADAS)
+
+@api_router.get("/rotinas/agendador")
+async def get_agendador(current_user: dict = Depends(require_permission("configuracoes", "ler"))):
+    """Estado das rotinas agendadas (próxima execução, lease) e a última execução de cada uma"""
+    jobs = await db.agendador_jobs.find({}, {"_id": 0}).sort("nome", 1).to_list(None)
+    for job in jobs:
+        job["ultima"] = await db.agendador_execucoes.find_one(
+            {"job": job["nome"]}, {"_id": 0}, sort=[("inicio", -1)]
+        )
+    return {"ativo": AGENDADOR_ENABLED, "worker": agendador.dono, "jobs": jobs}
+
+@api_router.get("/rotinas/agendador/{nome}/execucoes")
+async def get_execucoes_rotina(
+    nome: str,
+    limit: int = 20,
+    current_user: dict = Depends(require_permission("configuracoes", "ler"))
+):
+    """Histórico de execuções de uma rotina (duração, partes e registros afetados)"""
+    if nome not in ROTINAS_AGENDADAS:
+        raise HTTPException(status_code=404, detail="Rotina não encontrada")
+    limit = max(1, min(limit, 200))
+    execucoes = await db.agendador_execucoes.find({"job": nome}, {"_id": 0}).sort("inicio", -1).limit(limit).to_list(limit)
+    return {"job": nome, "execucoes": execucoes}
+
+@api_router.post("/rotinas/agendador/{nome}/executar")
+async def executar_rotina_agora(
+    nome: str,
+    current_user: dict = Depends(require_permission("configuracoes", "editar"))
+):
+    """Antecipa a rotina para a próxima verificação do agendador (não executa na requisição)"""
+    if nome not in ROTINAS_AGENDADAS:
+        raise HTTPException(status_code=404, detail="Rotina não encontrada")
+    await db.agendador_jobs.update_one({"nome": nome}, {"$set": {"proxima_execucao": datetime.now(timezone.utc)}})
+    
+    await log_action(
+        ip="0.0.0.0",
+        user_id=current_user["id"],
+        user_nome=current_user["nome"],
+        tela="rotinas",
+        acao="antecipar_rotina",
+        detalhes={"job": nome}
+    )
+    
+    return {"message": f"Rotina {nome} agendada para a próxima verificação ({AGENDADOR_INTERVALO_S}s)"}
+
 # ==================== STARTUP EVENT - CORREÇÃO 6 ====================
+
 @app.on_event("startup")
 async def startup_create_indexes():
     """
@@ -15385,6 +18597,13 @@ async def startup_create_indexes():
         ("users", "email", {"unique": True, "name": "users_email_unique"}),
         ("users", "id", {"unique": True, "name": "users_id_unique"}),
         ("produtos", "sku", {"unique": True, "name": "produtos_sku_unique"}),
+        # Leitura de códigos no PDV (vazios e nulos ficam fora do índice único)
+        ("produtos", "codigo_barras", {"unique": True, "name": "produtos_codigo_barras_unique",
+                                       "partialFilterExpression": {"codigo_barras": {"$gt": ""}}}),
+        # Códigos das variações: o filtro parcial vale por documento, não por elemento do array,
+        # então a unicidade é garantida em validar_codigos_variacoes e aqui o índice só atende a busca
+        ("produtos", "variacoes.codigo_barras", {"name": "produtos_variacoes_codigo_barras_idx"}),
+        ("produtos", "variacoes.sku_variante", {"name": "produtos_variacoes_sku_idx"}),
         ("contas_pagar", "numero", {"unique": True, "name": "contas_pagar_numero_unique"}),
         ("contas_receber", "numero", {"unique": True, "name": "contas_receber_numero_unique"}),
         ("vendas", "numero_venda", {"unique": True, "name": "vendas_numero_unique"}),
@@ -15403,12 +18622,58 @@ async def startup_create_indexes():
         ("vendas", "created_at", {"name": "vendas_created_idx"}),
         ("vendas", "cliente_id", {"name": "vendas_cliente_idx"}),
         ("produtos", "categoria_id", {"name": "produtos_categoria_idx"}),
+        ("produtos", "marca_id", {"name": "produtos_marca_idx"}),
+        ("notas_fiscais", [("itens.produto_id", 1), ("data_emissao", -1)], {"name": "notas_fiscais_produto_emissao_idx"}),
+        
+        # Razão de estoque: movimentações por produto/data e checkpoints por corte
+        ("movimentacoes_estoque", [("produto_id", 1), ("timestamp", 1)], {"name": "movimentacoes_produto_timestamp_idx"}),
+        ("movimentacoes_estoque", "timestamp", {"name": "movimentacoes_timestamp_idx"}),
+        ("estoque_checkpoints", [("corte", 1), ("produto_id", 1)], {"unique": True, "name": "estoque_checkpoints_corte_produto_unique"}),
+        ("estoque_checkpoints_controle", "corte", {"unique": True, "name": "estoque_checkpoints_controle_corte_unique"}),
         ("logs", "timestamp", {"name": "logs_timestamp_idx"}),
         ("logs", "user_id", {"name": "logs_user_idx"}),
         ("logs", "arquivado", {"name": "logs_arquivado_idx"}),
         
+        # Analytics de logs: $match por arquivado/usuário/ação + faixa de timestamp
+        ("logs", [("arquivado", 1), ("timestamp", -1)], {"name": "logs_arquivado_timestamp_idx"}),
+        ("logs", [("user_id", 1), ("timestamp", -1)], {"name": "logs_user_timestamp_idx"}),
+        ("logs", [("acao", 1), ("timestamp", -1)], {"name": "logs_acao_timestamp_idx"}),
+        ("logs_seguranca", [("timestamp", -1)], {"name": "logs_seguranca_timestamp_idx"}),
+        ("logs_seguranca", [("tipo", 1), ("timestamp", -1)], {"name": "logs_seguranca_tipo_timestamp_idx"}),
+        
         # ETAPA 11: Índice para idempotency_keys
         ("idempotency_keys", "created_at", {"name": "idempotency_created_idx", "expireAfterSeconds": 86400}),  # TTL 24h
+        
+        # Contadores do rate limiter compartilhado (RATE_LIMIT_BACKEND=mongo), removidos ao expirar
+        ("rate_limits", "expira_em", {"name": "rate_limits_ttl", "expireAfterSeconds": 0}),
+        
+        # Rollup diário de vendas (chave única de cada linha + filtros dos relatórios)
+        ("vendas_diarias", [("data", 1), ("vendedor_id", 1), ("cliente_id", 1), ("efetivada", 1)],
+         {"unique": True, "name": "vendas_diarias_chave_unique"}),
+        ("vendas_diarias", [("efetivada", 1), ("data", 1)], {"name": "vendas_diarias_efetivada_data_idx"}),
+        ("vendas_item_diario", [("data", 1), ("vendedor_id", 1), ("cliente_id", 1), ("produto_id", 1)],
+         {"unique": True, "name": "vendas_item_diario_chave_unique"}),
+        ("vendas_item_diario", "produto_id", {"name": "vendas_item_diario_produto_idx"}),
+        
+        # Índice de parcelas do fluxo de caixa (chave única + faixas de vencimento/liquidação)
+        ("parcelas_index", [("tipo", 1), ("conta_id", 1), ("posicao", 1)],
+         {"unique": True, "name": "parcelas_index_chave_unique"}),
+        ("parcelas_index", [("tipo", 1), ("data_vencimento", 1)], {"name": "parcelas_index_vencimento_idx"}),
+        ("parcelas_index", [("tipo", 1), ("data_liquidacao", 1)], {"name": "parcelas_index_liquidacao_idx"}),
+        ("parcelas_index", [("tipo", 1), ("status", 1), ("data_vencimento", 1)], {"name": "parcelas_index_status_vencimento_idx"}),
+        
+        # Índice de busca (prefixos e trigramas normalizados por coleção)
+        ("busca_index", [("colecao", 1), ("doc_id", 1)], {"unique": True, "name": "busca_index_chave_unique"}),
+        ("busca_index", [("colecao", 1), ("tokens", 1)], {"name": "busca_index_tokens_idx"}),
+        ("busca_index", [("colecao", 1), ("trigramas", 1)], {"name": "busca_index_trigramas_idx"}),
+        
+        # Agendador de rotinas (um documento por rotina + histórico de execuções)
+        ("agendador_jobs", "nome", {"unique": True, "name": "agendador_jobs_nome_unique"}),
+        ("agendador_execucoes", [("job", 1), ("inicio", -1)], {"name": "agendador_execucoes_job_inicio_idx"}),
+        
+        # Rotina de vencimentos: parcelas pendentes com vencimento passado
+        ("contas_receber", [("parcelas.status", 1), ("parcelas.data_vencimento", 1)], {"name": "contas_receber_parcelas_vencimento_idx"}),
+        ("contas_pagar", [("parcelas.status", 1), ("parcelas.data_vencimento", 1)], {"name": "contas_pagar_parcelas_vencimento_idx"}),
     ]
     
     # ETAPA 11: Índice composto único para idempotency_keys
@@ -15423,6 +18688,17 @@ async def startup_create_indexes():
         if "already exists" not in str(e).lower():
             logger.error(f"Erro ao criar índice de idempotência: {e}")
     
+    # Índices substituídos por outros na mesma chave (ou que a cobrem) saem antes da criação
+    for collection_name, nome_indice in [
+        ("busca_index", "busca_index_tokens_doc_idx"),
+        ("produtos", "produtos_variacoes_codigo_barras_unique"),
+        ("produtos", "produtos_variacoes_sku_unique"),
+    ]:
+        try:
+            await db[collection_name].drop_index(nome_indice)
+        except Exception:
+            pass
+    
     created = 0
     skipped = 0
     errors = 0
@@ -15448,7 +18724,73 @@ async def startup_create_indexes():
                 logger.error(f"Erro ao criar índice {collection_name}.{field}: {error_msg}")
     
     logger.info(f"Índices: {created} criados, {skipped} já existiam, {errors} erros")
+    
+    # Backfill do rollup diário de vendas na primeira subida com vendas existentes
+    try:
+        if await db.vendas_diarias.estimated_document_count() == 0 and await db.vendas.estimated_document_count() > 0:
+            resultado = await reconstruir_rollup_vendas()
+            logger.info(f"Rollup de vendas reconstruído: {resultado}")
+    except Exception as e:
+        logger.error(f"Erro ao reconstruir rollup de vendas: {e}")
+    
+    # Migração das fotos base64 legadas para o bucket de imagens
+    try:
+        if await db.produtos.find_one(FILTRO_FOTOS_BASE64, {"_id": 0, "id": 1}):
+            resultado = await migrar_fotos_produtos()
+            logger.info(f"Imagens de produtos migradas: {resultado}")
+    except Exception as e:
+        logger.error(f"Erro ao migrar imagens de produtos: {e}")
+    
+    # Backfill do índice de parcelas na primeira subida com contas existentes
+    try:
+        if await db.parcelas_index.estimated_document_count() == 0 and (
+            await db.contas_receber.estimated_document_count() > 0
+            or await db.contas_pagar.estimated_document_count() > 0
+        ):
+            resultado = await reconstruir_parcelas_index()
+            logger.info(f"Índice de parcelas reconstruído: {resultado}")
+    except Exception as e:
+        logger.error(f"Erro ao reconstruir índice de parcelas: {e}")
+    
+    # Backfill do índice de busca para coleções com documentos e ainda sem linhas no índice
+    try:
+        for colecao in BUSCA_CAMPOS:
+            if await db[colecao].estimated_document_count() > 0 and not await db.busca_index.find_one(
+                {"colecao": colecao}, {"_id": 1}
+            ):
+                resultado = await reconstruir_busca(colecao)
+                logger.info(f"Índice de busca reconstruído: {resultado}")
+    except Exception as e:
+        logger.error(f"Erro ao reconstruir índice de busca: {e}")
+    
+    # Migração: produtos anteriores aos acumulados de custo de compra
+    try:
+        if await db.produtos.find_one({"qtd_comprada_acumulada": {"$exists": False}}, {"_id": 1}):
+            resultado = await reconstruir_custos_compra()
+            logger.info(f"Custos de compra reconstruídos: {resultado}")
+    except Exception as e:
+        logger.error(f"Erro ao reconstruir custos de compra: {e}")
+    
+    # Dimensões do catálogo (marcas, categorias, subcategorias) em memória
+    try:
+        await dimensoes_cache.carregar()
+        logger.info(f"Dimensões do catálogo carregadas: {dimensoes_cache.stats()['tabelas']}")
+    except Exception as e:
+        logger.error(f"Erro ao carregar dimensões do catálogo: {e}")
+    
+    # Rotinas recorrentes (vencimentos, orçamentos expirados, curva ABC, arquivo de logs)
+    if AGENDADOR_ENABLED:
+        agendador.iniciar()
+
+@app.on_event("startup")
+async def startup_log_writer():
+    if LOG_ASYNC_ENABLED:
+        log_writer.iniciar()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Gravar os logs pendentes antes de fechar a conexão
+    await agendador.parar()
+    await log_writer.parar()
+    password_hasher.executor.shutdown(wait=False)
     client.close()
\ No newline at end of file
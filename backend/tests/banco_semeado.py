@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Banco semeado compartilhado pelos testes que exercitam os handlers contra o MongoDB.
+executar_com_banco_semeado grava dados_semeados() em um banco temporário
+<DB_NAME>_teste_semeado, aponta server.db para ele e executa teste(dados).
+
+Requer MongoDB 5.0+ em MONGO_URL ($dateTrunc no rollup de vendas); sem ele os testes são ignorados.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+import asyncio
+import os
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import server
+
+USUARIO = {"id": "admin-teste", "nome": "Admin Teste", "papel": "admin"}
+DATA_INICIO = "2024-12-01"
+DATA_FIM = "2025-02-01"
+
+
+def _venda(id, created_at, user_id, cliente_id, itens, desconto=0, frete=0, status_venda="paga", **extra):
+    subtotal = sum(i["quantidade"] * i["preco_unitario"] for i in itens)
+    return {
+        "id": id,
+        "numero_venda": id.upper(),
+        "created_at": created_at,
+        "user_id": user_id,
+        "cliente_id": cliente_id,
+        "itens": itens,
+        "subtotal": subtotal,
+        "desconto": desconto,
+        "frete": frete,
+        "total": subtotal - desconto + frete,
+        "status_venda": status_venda,
+        **extra
+    }
+
+
+def _item(produto_id, quantidade, preco_unitario):
+    return {"produto_id": produto_id, "quantidade": quantidade, "preco_unitario": preco_unitario}
+
+
+def _parcela(numero, vencimento, valor, liquidada_em=None, campo_data="data_recebimento",
+             campo_valor="valor_recebido", status_liquidada="recebido"):
+    parcela = {"numero_parcela": numero, "data_vencimento": vencimento, "valor": valor, "status": "pendente"}
+    if liquidada_em:
+        parcela.update({"status": status_liquidada, campo_data: liquidada_em, campo_valor: valor})
+    return parcela
+
+
+def _parcela_pagar(numero, vencimento, valor, liquidada_em=None):
+    return _parcela(numero, vencimento, valor, liquidada_em, "data_pagamento", "valor_pago", "pago")
+
+
+def dados_semeados():
+    """Conjunto pequeno cobrindo virada de ano/mês, limite do período, rascunho, cancelada e devolução"""
+    return {
+        "users": [
+            {"id": "u1", "nome": "Vendedor Um"},
+            {"id": "u2", "nome": "Vendedor Dois"},
+        ],
+        "clientes": [
+            {"id": "c1", "nome": "Cliente Um", "ativo": True},
+            {"id": "c2", "nome": "Cliente Dois", "ativo": True},
+            {"id": "c3", "nome": "Cliente Três", "ativo": False},
+        ],
+        "produtos": [
+            {"id": "p1", "nome": "Body", "estoque_atual": 10, "estoque_minimo": 5, "preco_medio": 20.0},
+            {"id": "p2", "nome": "Macacão", "estoque_atual": 2, "estoque_minimo": 3, "preco_medio": 90.0},
+            {"id": "p3", "nome": "Meia", "estoque_atual": 50, "estoque_minimo": 10, "preco_medio": 12.5},
+            {"id": "p4", "nome": "Carrinho", "estoque_atual": 1, "estoque_minimo": 1, "preco_medio": 300.0},
+        ],
+        "vendas": [
+            # 2024-12-30 cai na semana ISO 1 de 2025 (chave mantém o ano civil: 2024-W01)
+            _venda("v1", "2024-12-30T10:00:00+00:00", "u1", "c1", [_item("p1", 2, 50.0)],
+                   status_venda="aguardando_pagamento"),
+            _venda("v2", "2025-01-02T09:30:00+00:00", "u1", "c2", [_item("p2", 1, 200.0), _item("p1", 1, 50.0)],
+                   desconto=10.0),
+            _venda("v3", "2025-01-15T14:00:00.123456+00:00", "u2", "c1", [_item("p3", 3, 30.0)],
+                   frete=5.0, status_venda="parcialmente_paga",
+                   itens_devolvidos=[{"produto_id": "p3", "quantidade": 1, "valor": 30.0, "data": "2025-01-16"}],
+                   valor_devolvido=30.0),
+            # Último instante do dia final do período
+            _venda("v4", "2025-02-01T23:59:59.999999+00:00", "u2", "c3", [_item("p4", 1, 500.0)]),
+            _venda("v5", "2025-01-20T11:00:00+00:00", "u1", "c2", [_item("p1", 10, 50.0)], status_venda="rascunho"),
+            _venda("v6", "2025-01-21T11:00:00+00:00", "u2", "c2", [_item("p2", 5, 200.0)],
+                   status_venda="cancelada", cancelada=True),
+            # Fora do período
+            _venda("v7", "2025-02-02T00:00:00+00:00", "u1", "c1", [_item("p2", 2, 200.0)]),
+        ],
+        "orcamentos": [
+            {"id": "o1", "created_at": "2024-12-10T10:00:00+00:00", "status": "aberto", "total": 100.0},
+            {"id": "o2", "created_at": "2025-01-05T10:00:00+00:00", "status": "vendido", "total": 250.0},
+            {"id": "o3", "created_at": "2025-01-06T10:00:00+00:00", "status": "vendido", "total": 150.0},
+            {"id": "o4", "created_at": "2025-01-07T10:00:00+00:00", "status": "devolvido", "total": 80.0},
+            {"id": "o5", "created_at": "2025-02-01T18:00:00+00:00", "status": "cancelado", "total": 60.0},
+            {"id": "o6", "created_at": "2025-03-01T10:00:00+00:00", "status": "aberto", "total": 999.0},
+        ],
+        "logs": [
+            {"id": f"l{i}", "timestamp": ts, "user_id": uid, "user_nome": nome, "acao": acao, "tela": tela}
+            for i, (ts, uid, nome, acao, tela) in enumerate([
+                ("2024-11-30T23:00:00+00:00", "u1", "Vendedor Um", "criar", "vendas"),
+                ("2024-12-01T00:00:00+00:00", "u1", "Vendedor Um", "criar", "vendas"),
+                ("2025-01-10T08:00:00+00:00", "u2", "Vendedor Dois", "editar", "clientes"),
+                ("2025-01-10T09:00:00+00:00", "u2", "Vendedor Dois", "criar", "vendas"),
+                ("2025-01-11T09:00:00+00:00", "u1", "Vendedor Um", "deletar", "produtos"),
+                ("2025-02-01T23:59:59+00:00", "u1", "Vendedor Um", "editar", "vendas"),
+                ("2025-02-02T00:00:01+00:00", "u2", "Vendedor Dois", "criar", "vendas"),
+            ])
+        ],
+        # Parcelas espalhadas por semanas/meses (inclui virada de ano e conta cancelada)
+        "contas_receber": [
+            {"id": "cr1", "numero": "CR-00001", "cancelada": False, "parcelas": [
+                _parcela(1, "2024-12-30", 100.0, "2024-12-31T10:00:00+00:00"),
+                _parcela(2, "2025-01-06", 100.0, "2025-01-06"),
+                _parcela(3, "2025-01-31", 100.0),
+            ]},
+            {"id": "cr2", "numero": "CR-00002", "cancelada": False, "parcelas": [
+                _parcela(1, "2025-01-06", 40.0, "2025-01-08"),
+                _parcela(2, "2025-02-01", 40.0),
+            ]},
+            {"id": "cr3", "numero": "CR-00003", "cancelada": True, "parcelas": [
+                _parcela(1, "2025-01-06", 999.0),
+            ]},
+        ],
+        "contas_pagar": [
+            {"id": "cp1", "numero": "CP-00001", "cancelada": False, "parcelas": [
+                _parcela_pagar(1, "2025-01-02", 70.0, "2025-01-02"),
+                _parcela_pagar(2, "2025-01-06", 70.0),
+                _parcela_pagar(3, "2025-02-02", 70.0),
+            ]},
+        ],
+    }
+
+
+def comparar(obtido, esperado, caminho="resultado"):
+    """Igualdade estrutural com tolerância para floats (a ordem de soma muda no banco)"""
+    if isinstance(esperado, dict):
+        assert isinstance(obtido, dict), f"{caminho}: esperado dict, obtido {obtido!r}"
+        assert set(obtido) == set(esperado), f"{caminho}: chaves {sorted(obtido)} != {sorted(esperado)}"
+        for chave in esperado:
+            comparar(obtido[chave], esperado[chave], f"{caminho}.{chave}")
+    elif isinstance(esperado, list):
+        assert isinstance(obtido, list) and len(obtido) == len(esperado), f"{caminho}: {obtido!r} != {esperado!r}"
+        for i, (o, e) in enumerate(zip(obtido, esperado)):
+            comparar(o, e, f"{caminho}[{i}]")
+    elif isinstance(esperado, float) or isinstance(obtido, float):
+        assert obtido == pytest.approx(esperado), f"{caminho}: {obtido!r} != {esperado!r}"
+    else:
+        assert obtido == esperado, f"{caminho}: {obtido!r} != {esperado!r}"
+
+
+def executar_com_banco_semeado(teste):
+    """Semeia um banco temporário, reconstrói o rollup e executa teste(dados) com server.db apontando para ele"""
+    dados = dados_semeados()
+
+    async def _rodar():
+        mongo_url = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+        client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=2000)
+        try:
+            info = await client.server_info()
+        except Exception:
+            client.close()
+            pytest.skip("MongoDB indisponível")
+        if int(info["version"].split(".")[0]) < 5:
+            client.close()
+            pytest.skip("$dateTrunc requer MongoDB 5.0+")
+
+        db = client[f"{os.environ.get('DB_NAME', 'erp')}_teste_semeado"]
+        await client.drop_database(db.name)
+        db_original = server.db
+        server.db = db
+        server.dimensoes_cache.invalidar()
+        server.produto_codigo_cache.clear()
+        try:
+            for colecao, docs in dados.items():
+                await db[colecao].insert_many([dict(doc) for doc in docs])
+            await server.reconstruir_rollup_vendas()
+            await server.reconstruir_parcelas_index()
+            await teste(dados)
+        finally:
+            server.db = db_original
+            await client.drop_database(db.name)
+            client.close()
+
+    asyncio.run(_rodar())
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Testes - Agendador de rotinas e varredura de vencimentos
+Lease/retomada do AgendadorRotinas e rotina de parcelas vencidas em lote.
+
+Os testes com banco requerem MongoDB 5.0+ em MONGO_URL (sem ele são ignorados);
+os das funções puras rodam sem MongoDB.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from banco_semeado import USUARIO, comparar, executar_com_banco_semeado
+
+
+def test_rotina_vencimentos_em_lote():
+    async def teste(dados):
+        hoje = datetime.strptime(server.parse_date_only(server.iso_utc_now()), "%Y-%m-%d").date()
+        await server.db.contas_receber.update_one({"id": "cr1"}, {"$set": {"cliente_id": "c1"}})
+        await server.db.logs.delete_many({})
+
+        # Referência: regra por parcela da rotina anterior + atualizar_status_conta_*
+        esperado = {}
+        parcelas_vencidas = 0
+        for tipo, liquidada in [("receber", "recebido"), ("pagar", "pago")]:
+            for conta in dados[f"contas_{tipo}"]:
+                if conta["cancelada"]:
+                    continue
+                parcelas = []
+                for p in conta["parcelas"]:
+                    p = dict(p)
+                    vencimento = datetime.strptime(p["data_vencimento"], "%Y-%m-%d").date()
+                    if p["status"] == "pendente" and vencimento < hoje:
+                        p.update(status="vencido", dias_atraso=(hoje - vencimento).days)
+                        parcelas_vencidas += 1
+                    parcelas.append(p)
+                liquidadas = sum(p["status"] == liquidada for p in parcelas)
+                vencidas = [p["dias_atraso"] for p in parcelas if p["status"] == "vencido"]
+                status = (f"{liquidada}_total" if liquidadas == len(parcelas) else
+                          f"{liquidada}_parcial" if liquidadas else "vencido" if vencidas else "pendente")
+                esperado[conta["id"]] = {"status": status, "dias_atraso": max(vencidas), "parcelas": parcelas}
+
+        resultado = await server.verificar_e_atualizar_parcelas_vencidas()
+        assert resultado["receber"]["parcelas_vencidas"] + resultado["pagar"]["parcelas_vencidas"] == parcelas_vencidas
+        assert resultado["receber"]["contas_processadas"] == 2
+
+        for tipo in ["receber", "pagar"]:
+            async for conta in server.db[f"contas_{tipo}"].find({"cancelada": False}, {"_id": 0}):
+                obtido = {k: conta[k] for k in ("status", "dias_atraso", "parcelas")}
+                comparar(obtido, esperado[conta["id"]], conta["id"])
+                # Índice de parcelas acompanha o novo status
+                indice = await server.db.parcelas_index.find(
+                    {"tipo": tipo, "conta_id": conta["id"]}, {"_id": 0, "status": 1}
+                ).sort("posicao", 1).to_list(None)
+                assert [l["status"] for l in indice] == [p["status"] for p in conta["parcelas"]]
+
+        assert await server.db.logs.count_documents({"acao": "parcela_vencida_automatica"}) == parcelas_vencidas
+        assert (await server.db.clientes.find_one({"id": "c1"}))["inadimplente"] is True
+        assert "inadimplente" not in await server.db.clientes.find_one({"id": "c2"})
+
+        # Segunda execução no mesmo dia não encontra nada novo
+        novamente = await server.rotina_atualizar_vencimentos(tipo="ambos", current_user=USUARIO)
+        assert novamente["resultados"]["receber"]["parcelas_vencidas"] == 0
+        assert novamente["resultados"]["pagar"]["parcelas_vencidas"] == 0
+    executar_com_banco_semeado(teste)
+
+def test_agendador_lease_e_retomada():
+    async def teste(dados):
+        chamadas = []
+
+        async def rotina_em_partes(checkpoint):
+            for parte in range((checkpoint or {}).get("proxima", 0), 3):
+                chamadas.append(parte)
+                yield {"registros": 10, "checkpoint": {"proxima": parte + 1}, "resultado": {f"parte_{parte}": True}}
+
+        rotinas = {"teste": {"cron": "0 3 * * *", "funcao": rotina_em_partes}}
+        worker_a = server.AgendadorRotinas(rotinas)
+        worker_b = server.AgendadorRotinas(rotinas)
+        await worker_a.registrar()
+
+        # Fora do horário nenhum worker executa; forçada, só quem obtém o lease executa
+        assert await worker_a.executar_rotina("teste") is None
+        await server.db.agendador_jobs.update_one(
+            {"nome": "teste"}, {"$set": {"lease_dono": worker_b.dono, "lease_ate": datetime.now(timezone.utc) + timedelta(minutes=5)}}
+        )
+        assert await worker_a.executar_rotina("teste", forcar=True) is None
+
+        # Lease expirado com checkpoint: outro worker retoma da parte seguinte
+        await server.db.agendador_jobs.update_one(
+            {"nome": "teste"}, {"$set": {"lease_ate": datetime.now(timezone.utc), "checkpoint": {"proxima": 1}}}
+        )
+        execucao = await worker_a.executar_rotina("teste", forcar=True)
+        assert chamadas == [1, 2]
+        assert execucao["status"] == "sucesso" and execucao["retomada"] is True
+        assert execucao["partes"] == 2 and execucao["registros"] == 20
+
+        job = await server.db.agendador_jobs.find_one({"nome": "teste"})
+        assert job["lease_dono"] is None and job["checkpoint"] is None
+        assert job["proxima_execucao"].replace(tzinfo=timezone.utc) > datetime.now(timezone.utc)
+        assert await server.db.agendador_execucoes.count_documents({"job": "teste"}) == 1
+    executar_com_banco_semeado(teste)
+
+
+def test_lease_renovado_durante_parte_longa(monkeypatch):
+    monkeypatch.setattr(server, "AGENDADOR_LEASE_S", 0.3)
+
+    async def teste(dados):
+        async def parte_longa(checkpoint):
+            await server.asyncio.sleep(1)
+            yield {"registros": 1, "checkpoint": None, "resultado": {"ok": True}}
+
+        rotinas = {"teste": {"cron": "0 3 * * *", "funcao": parte_longa}}
+        worker_a = server.AgendadorRotinas(rotinas)
+        worker_b = server.AgendadorRotinas(rotinas)
+        await worker_a.registrar()
+
+        # A parte dura mais que o lease; a renovação em segundo plano impede o segundo worker de assumir
+        execucao_a = server.asyncio.create_task(worker_a.executar_rotina("teste", forcar=True))
+        await server.asyncio.sleep(0.6)
+        assert await worker_b.executar_rotina("teste", forcar=True) is None
+        assert (await execucao_a)["status"] == "sucesso"
+        assert await server.db.agendador_execucoes.count_documents({"job": "teste"}) == 1
+    executar_com_banco_semeado(teste)
+
+
+def test_curva_abc_em_lote():
+    async def teste(dados):
+        agora = server.iso_utc_now()
+        await server.db.vendas.update_many({}, {"$set": {"data_venda": agora}})
+        resultado = await server.recalcular_curva_abc()
+
+        # Faturamento (sem a venda cancelada): p1 650, p2 600, p4 500, p3 90 de 1840
+        assert resultado["produtos_atualizados"] == 4
+        assert resultado["distribuicao"] == {"A": 2, "B": 0, "C": 2}
+        curvas = {p["id"]: (p["curva_abc"], p["giro_estoque"], p["faturamento_acumulado"])
+                  async for p in server.db.produtos.find({}, {"_id": 0})}
+        assert curvas == {"p1": ("A", 0.11, 650.0), "p2": ("A", 0.12, 600.0),
+                          "p3": ("C", 0.01, 90.0), "p4": ("C", 0.08, 500.0)}
+    executar_com_banco_semeado(teste)
+
+
+def _local(*args):
+    return datetime(*args, tzinfo=server.AGENDADOR_TZ)
+
+
+def test_proxima_execucao_cron():
+    proxima = server.proxima_execucao_cron
+    utc = timezone.utc
+
+    # Diário: ainda hoje se o horário não passou, senão amanhã (estritamente depois)
+    assert proxima("0 3 * * *", _local(2025, 1, 10, 2, 59, 30)) == _local(2025, 1, 10, 3, 0).astimezone(utc)
+    assert proxima("0 3 * * *", _local(2025, 1, 10, 3, 0)) == _local(2025, 1, 11, 3, 0).astimezone(utc)
+
+    # Passo, lista e faixa
+    assert proxima("*/15 * * * *", _local(2025, 1, 10, 10, 7)) == _local(2025, 1, 10, 10, 15).astimezone(utc)
+    assert proxima("0,30 8-9 * * *", _local(2025, 1, 10, 9, 45)) == _local(2025, 1, 11, 8, 0).astimezone(utc)
+
+    # Virada de mês/ano e dia da semana (0 e 7 = domingo; 2025-01-10 é sexta)
+    assert proxima("15 0 1 * *", _local(2025, 12, 5, 0, 0)) == _local(2026, 1, 1, 0, 15).astimezone(utc)
+    assert proxima("0 3 * * 0", _local(2025, 1, 10, 12, 0)) == _local(2025, 1, 12, 3, 0).astimezone(utc)
+    assert proxima("0 3 * * 7", _local(2025, 1, 10, 12, 0)) == _local(2025, 1, 12, 3, 0).astimezone(utc)
+
+    # Resultado sempre em UTC
+    assert proxima("0 3 * * *", _local(2025, 1, 10, 12, 0)).tzinfo == utc
+
+    for invalida in ["60 * * * *", "0 24 * * *", "0 3 0 * *", "0 3 * 13 *", "0 3 5-1 * *"]:
+        with pytest.raises(ValueError):
+            proxima(invalida, _local(2025, 1, 10, 12, 0))
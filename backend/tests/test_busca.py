@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Testes - Índice de busca sem acento (prefixo e aproximada)
+
+Os testes com banco requerem MongoDB 5.0+ em MONGO_URL (sem ele são ignorados);
+os das funções puras rodam sem MongoDB.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+import server
+from banco_semeado import USUARIO, executar_com_banco_semeado
+
+
+def test_busca_sem_acento():
+    async def teste(dados):
+        resultado = await server.reconstruir_busca()
+        assert resultado["produtos"] == len(dados["produtos"])
+
+        # Prefixo sem acento acha o nome acentuado; palavra inteira pontua mais que prefixo
+        encontrados = await server.buscar_ranqueado("produtos", "MACACAO")
+        assert [p["id"] for p in encontrados] == ["p2"] and encontrados[0]["busca_tipo"] == "prefixo"
+        assert (await server.buscar_ranqueado("produtos", "maca"))[0]["busca_score"] < encontrados[0]["busca_score"]
+
+        # Erro de digitação cai na busca aproximada por trigramas
+        aproximados = await server.buscar_ranqueado("produtos", "macaco")
+        assert [p["id"] for p in aproximados] == ["p2"] and aproximados[0]["busca_tipo"] == "aproximada"
+
+        # Inativos só com incluir_inativos; a listagem usa o mesmo índice
+        assert await server.buscar_ranqueado("clientes", "tres") == []
+        assert [c["id"] for c in await server.buscar_ranqueado("clientes", "tres", incluir_inativos=True)] == ["c3"]
+        clientes = await server.get_clientes(incluir_inativos=True, page=1, limit=20, sort="id", q="Três",
+                                             current_user=USUARIO)
+        assert [c["id"] for c in clientes["data"]] == ["c3"]
+
+        # Gravação sincroniza o índice; documento removido sai dele
+        await server.db.produtos.update_one({"id": "p4"}, {"$set": {"nome": "Carrinho de Bebê", "sku": "CAR-001"}})
+        await server.sincronizar_busca("produtos", ["p4"])
+        assert [p["id"] for p in await server.buscar_ranqueado("produtos", "carrinho bebe")] == ["p4"]
+        assert [p["id"] for p in await server.buscar_ranqueado("produtos", "car001")] == ["p4"]
+        await server.db.produtos.delete_one({"id": "p4"})
+        await server.sincronizar_busca("produtos", ["p4"])
+        assert await server.db.busca_index.count_documents({"colecao": "produtos", "doc_id": "p4"}) == 0
+    executar_com_banco_semeado(teste)
+
+
+def test_normalizacao_busca():
+    assert server.normalizar_busca("Calção-P") == "calcao p"
+    assert server.normalizar_busca("  JARDINEIRA   Rosa! ") == "jardineira rosa"
+    assert server.normalizar_busca("123.456.789-00") == "123 456 789 00"
+    assert server.normalizar_busca(None) == ""
+    assert server.normalizar_busca(7891000012) == "7891000012"
+
+    assert server.palavras_busca("Body body BÓDY azul") == ["body", "azul"]
+    assert server.trigramas_busca(["calcao", "p"]) == ["cal", "alc", "lca", "cao", "p"]
+
+
+def test_linha_busca():
+    linha = server.linha_busca("produtos", {
+        "id": "x1", "nome": "Calção Azul", "sku": "SKU-001", "codigo_barras": None, "preco": 10
+    })
+    assert linha["colecao"] == "produtos" and linha["doc_id"] == "x1"
+    assert linha["texto"] == "calcao azul sku 001"
+    assert linha["palavras"] == ["calcao", "azul", "sku", "001"]
+
+    # Prefixos de cada palavra e do valor com os caracteres juntos
+    for token in ["c", "calc", "calcao", "azul", "calcaoazul", "sku001", "001"]:
+        assert token in linha["tokens"], token
+    assert "alcao" not in linha["tokens"]
+    assert linha["tokens"] == sorted(linha["tokens"])
+    assert "lca" in linha["trigramas"]
+
+    # Prefixos limitados a BUSCA_PREFIXO_MAX caracteres
+    longa = server.linha_busca("produtos", {"id": "x2", "nome": "a" * (server.BUSCA_PREFIXO_MAX + 5)})
+    assert max(len(t) for t in longa["tokens"]) == server.BUSCA_PREFIXO_MAX
+
+
+def test_busca_ampla_completa_e_ordenada(monkeypatch):
+    monkeypatch.setattr(server, "BUSCA_MAX_IDS", 1)
+
+    async def teste(dados):
+        await server.reconstruir_busca("produtos")
+        assert await server.filtro_busca("produtos", "maca") == {"id": {"$in": ["p2"]}}
+        assert await server.filtro_busca("produtos", "--") == {}
+
+        # "m" casa Macacão e Meia: acima de BUSCA_MAX_IDS cai para $regex, mas a listagem
+        # continua completa e na ordenação pedida
+        for sort, esperado in [("id", ["p2", "p3"]), ("-id", ["p3", "p2"])]:
+            listagem = await server.get_produtos(incluir_inativos=True, page=1, limit=20, sort=sort, q="M",
+                                                 categoria_id=None, current_user=USUARIO)
+            assert [p["id"] for p in listagem["data"]] == esperado and listagem["meta"]["total"] == 2
+
+        # O $regex ignora acentos como o índice
+        monkeypatch.setattr(server, "BUSCA_MAX_IDS", 0)
+        listagem = await server.get_produtos(incluir_inativos=True, page=1, limit=20, sort="id", q="MACACAO",
+                                             categoria_id=None, current_user=USUARIO)
+        assert [p["id"] for p in listagem["data"]] == ["p2"]
+    executar_com_banco_semeado(teste)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Testes - Motor de movimentações de estoque (aplicar_movimentacoes_estoque)
+Guardas por produto em um único bulk_write, desfazer em falha parcial, itens repetidos
+no mesmo lote e liberação de reservas junto com a baixa.
+
+Requer MongoDB 5.0+ em MONGO_URL; sem ele os testes são ignorados.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+import pytest
+
+import server
+from banco_semeado import executar_com_banco_semeado
+
+
+async def estoque():
+    return {p["id"]: (p.get("estoque_atual", 0), p.get("estoque_reservado", 0))
+            async for p in server.db.produtos.find({}, {"_id": 0})}
+
+
+async def movimentacoes(referencia_id):
+    return await server.db.movimentacoes_estoque.find(
+        {"referencia_id": referencia_id}, {"_id": 0, "produto_id": 1, "tipo": 1, "quantidade": 1}
+    ).to_list(None)
+
+
+async def aplicar(itens, referencia_id, **kwargs):
+    return await server.aplicar_movimentacoes_estoque(
+        itens, tipo="saida", referencia_tipo="teste", referencia_id=referencia_id, user_id="admin-teste", **kwargs
+    )
+
+
+def test_falha_parcial_desfaz_o_lote():
+    async def teste(dados):
+        antes = await estoque()
+        with pytest.raises(server.EstoqueInsuficienteError) as erro:
+            await aplicar([{"produto_id": "p1", "quantidade": 3}, {"produto_id": "p2", "quantidade": 5},
+                           {"produto_id": "p3", "quantidade": 1}], "lote-falha")
+        assert erro.value.falhas == [{"produto_id": "p2", "nome": "Macacão", "encontrado": True,
+                                      "disponivel": 2, "solicitado": 5}]
+        # p1 e p3 chegaram a ser escritos e foram revertidos; nenhum marcador de lote fica para trás
+        assert await estoque() == antes
+        assert await server.db.produtos.count_documents({"lotes_estoque": {"$exists": True}}) == 0
+        assert await movimentacoes("lote-falha") == []
+
+        # Sem tudo_ou_nada, os que passaram ficam aplicados e só eles geram movimentação
+        resultado = await aplicar([{"produto_id": "p1", "quantidade": 3}, {"produto_id": "p2", "quantidade": 5}],
+                                  "lote-parcial", tudo_ou_nada=False)
+        assert resultado["aplicados"] == ["p1"] and [f["produto_id"] for f in resultado["falhas"]] == ["p2"]
+        estado = await estoque()
+        assert estado["p1"] == (7, 0) and estado["p2"] == (2, 0)
+        assert [m["produto_id"] for m in await movimentacoes("lote-parcial")] == ["p1"]
+
+        # Produto inexistente também é falha
+        with pytest.raises(server.EstoqueInsuficienteError) as erro:
+            await aplicar([{"produto_id": "p3", "quantidade": 1}, {"produto_id": "nao-existe", "quantidade": 1}],
+                          "lote-inexistente")
+        assert erro.value.falhas[0]["encontrado"] is False
+        assert (await estoque())["p3"] == (50, 0)
+    executar_com_banco_semeado(teste)
+
+
+def test_guardas_disponivel_atual_e_sem_validacao():
+    async def teste(dados):
+        await server.db.produtos.update_one({"id": "p1"}, {"$set": {"estoque_reservado": 8}})
+
+        # "disponivel" desconta a reserva (10 - 8 = 2); "atual" só olha o físico
+        with pytest.raises(server.EstoqueInsuficienteError) as erro:
+            await aplicar([{"produto_id": "p1", "quantidade": 3}], "guarda-disponivel")
+        assert erro.value.falhas[0]["disponivel"] == 2
+        await aplicar([{"produto_id": "p1", "quantidade": 3}], "guarda-atual", validar="atual")
+        assert (await estoque())["p1"] == (7, 8)
+        with pytest.raises(server.EstoqueInsuficienteError):
+            await aplicar([{"produto_id": "p4", "quantidade": 2}], "guarda-atual-falha", validar="atual")
+
+        # validar=None não tem guarda: o estoque pode ficar negativo
+        resultado = await aplicar([{"produto_id": "p4", "quantidade": 5}], "sem-guarda", validar=None)
+        assert resultado == {"aplicados": ["p4"], "falhas": [], "movimentacoes": 1}
+        assert (await estoque())["p4"] == (-4, 0)
+
+        # Entradas nunca são guardadas
+        await server.aplicar_movimentacoes_estoque(
+            [{"produto_id": "p4", "quantidade": 4}], tipo="entrada", referencia_tipo="teste",
+            referencia_id="entrada", user_id="admin-teste"
+        )
+        assert (await estoque())["p4"] == (0, 0)
+    executar_com_banco_semeado(teste)
+
+
+def test_produto_repetido_no_mesmo_lote():
+    async def teste(dados):
+        # Deltas do mesmo produto somam em uma escrita; cada item vira uma movimentação
+        resultado = await aplicar([{"produto_id": "p1", "quantidade": 2}, {"produto_id": "p1", "quantidade": 3}],
+                                  "repetido")
+        assert resultado == {"aplicados": ["p1"], "falhas": [], "movimentacoes": 2}
+        assert (await estoque())["p1"] == (5, 0)
+        assert sorted(m["quantidade"] for m in await movimentacoes("repetido")) == [2, 3]
+
+        # A guarda vale para a soma: 1 + 2 > 2 disponíveis, mesmo cada item cabendo sozinho
+        with pytest.raises(server.EstoqueInsuficienteError) as erro:
+            await aplicar([{"produto_id": "p2", "quantidade": 1}, {"produto_id": "p2", "quantidade": 2}],
+                          "repetido-falha")
+        assert erro.value.falhas[0]["solicitado"] == 3
+        assert (await estoque())["p2"] == (2, 0)
+
+        # "tipo" no item sobrepõe o do lote: saída 3 e entrada 2 dão -1 líquido
+        await aplicar([{"produto_id": "p2", "quantidade": 3}, {"produto_id": "p2", "quantidade": 2, "tipo": "entrada"}],
+                      "repetido-misto")
+        assert (await estoque())["p2"] == (1, 0)
+        assert sorted(m["tipo"] for m in await movimentacoes("repetido-misto")) == ["entrada", "saida"]
+    executar_com_banco_semeado(teste)
+
+
+def test_reservas_liberadas_na_mesma_escrita():
+    async def teste(dados):
+        await server.db.produtos.update_many({"id": {"$in": ["p1", "p2"]}}, {"$set": {"estoque_reservado": 2}})
+
+        # A baixa consome a própria reserva: p2 tem 0 disponível, mas a reserva liberada cobre a saída
+        resultado = await aplicar([{"produto_id": "p1", "quantidade": 3}, {"produto_id": "p2", "quantidade": 2}],
+                                  "conversao", reservas_liberadas=[{"produto_id": "p1", "quantidade": 2},
+                                                                   {"produto_id": "p2", "quantidade": 2}])
+        assert resultado["aplicados"] == ["p1", "p2"]
+        estado = await estoque()
+        assert estado["p1"] == (7, 0) and estado["p2"] == (0, 0)
+
+        # Só liberar reserva (sem itens) não gera movimentação
+        await server.db.produtos.update_one({"id": "p3"}, {"$set": {"estoque_reservado": 5}})
+        resultado = await server.aplicar_movimentacoes_estoque(
+            [], tipo="entrada", referencia_tipo="teste", referencia_id="expiracao", user_id="admin-teste",
+            validar=None, reservas_liberadas=[{"produto_id": "p3", "quantidade": 5}], registrar_movimentacao=False
+        )
+        assert resultado == {"aplicados": ["p3"], "falhas": [], "movimentacoes": 0}
+        assert (await estoque())["p3"] == (50, 0)
+
+        # Falha em outro produto desfaz também a liberação da reserva
+        await server.db.produtos.update_one({"id": "p1"}, {"$set": {"estoque_reservado": 1}})
+        with pytest.raises(server.EstoqueInsuficienteError):
+            await aplicar([{"produto_id": "p1", "quantidade": 1}, {"produto_id": "p4", "quantidade": 2}],
+                          "conversao-falha", reservas_liberadas=[{"produto_id": "p1", "quantidade": 1}])
+        assert (await estoque())["p1"] == (7, 1)
+    executar_com_banco_semeado(teste)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Testes - Razão de estoque: checkpoints mensais, auditoria, reconciliação
+e posição de estoque em data
+
+Requer MongoDB 5.0+ em MONGO_URL; sem ele os testes são ignorados.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+import json
+
+import server
+from banco_semeado import USUARIO, executar_com_banco_semeado
+
+
+def test_auditoria_estoque_com_checkpoint():
+    def _mov(produto_id, tipo, quantidade, timestamp):
+        return {"id": f"m-{produto_id}-{timestamp}", "produto_id": produto_id, "tipo": tipo,
+                "quantidade": quantidade, "referencia_tipo": "teste", "referencia_id": "t", "timestamp": timestamp}
+
+    async def teste(dados):
+        await server.db.produtos.update_many({"id": {"$in": ["p1", "p2"]}}, {"$set": {"ativo": True}})
+        await server.db.movimentacoes_estoque.insert_many([
+            _mov("p1", "entrada", 8, "2025-01-10T10:00:00+00:00"),
+            _mov("p1", "saida", 2, "2025-02-05T10:00:00+00:00"),
+            _mov("p2", "entrada", 5, "2025-01-15T10:00:00+00:00"),
+        ])
+        corte = "2025-03-01T00:00:00+00:00"
+        resultado = await server.criar_checkpoint_estoque(corte)
+        assert resultado == {"corte": corte, "corte_base": None, "produtos": 2}
+
+        pendentes = await server.cortes_mensais_pendentes()
+        assert "2025-02-01T00:00:00+00:00" in pendentes and corte not in pendentes
+
+        # Movimentações posteriores ao corte entram pelo delta
+        await server.db.movimentacoes_estoque.insert_many([
+            _mov("p1", "entrada", 4, "2025-03-10T10:00:00+00:00"),
+            _mov("p2", "saida", 1, "2025-03-20T10:00:00+00:00"),
+        ])
+        saldos, usado = await server.saldos_ledger()
+        assert usado == corte
+        assert saldos == await server.saldos_movimentacoes()
+
+        auditoria = await server.auditoria_estoque(current_user=USUARIO)
+        assert auditoria["checkpoint"] == corte and auditoria["total_produtos"] == 2
+        assert [d["produto_id"] for d in auditoria["divergencias"]] == ["p2"]
+        divergencia = auditoria["divergencias"][0]
+        assert divergencia["estoque_calculado"] == 4 and divergencia["diferenca"] == -2
+        assert divergencia["total_movimentacoes"] == 2
+
+        # Reconciliação leva sistema e razão à contagem física
+        reconciliado = await server.reconciliar_estoque("p2", estoque_fisico=3, motivo="contagem", current_user=USUARIO)
+        assert reconciliado["ajuste"] == 1 and reconciliado["ajuste_movimentacao"] == -1
+        auditoria = await server.auditoria_estoque(current_user=USUARIO)
+        assert auditoria["produtos_com_divergencia"] == 0
+    executar_com_banco_semeado(teste)
+
+def test_posicao_estoque_em_data():
+    async def corpo(resposta):
+        return "".join([parte async for parte in resposta.body_iterator])
+
+    async def teste(dados):
+        await server.db.produtos.update_one({"id": "p1"}, {"$set": {"categoria_id": "cat1"}})
+        await server.db.movimentacoes_estoque.insert_many([
+            {"id": "m1", "produto_id": "p1", "tipo": "entrada", "quantidade": 10, "timestamp": "2025-01-10T10:00:00+00:00"},
+            {"id": "m2", "produto_id": "p2", "tipo": "entrada", "quantidade": 3, "timestamp": "2025-01-20T23:00:00+00:00"},
+            {"id": "m3", "produto_id": "p1", "tipo": "saida", "quantidade": 4, "timestamp": "2025-02-03T10:00:00+00:00"},
+            {"id": "m4", "produto_id": "p1", "tipo": "saida", "quantidade": 1, "timestamp": "2025-02-20T10:00:00+00:00"},
+        ])
+        await server.criar_checkpoint_estoque("2025-02-01T00:00:00+00:00")
+
+        async def posicao(data, **filtros):
+            resposta = await server.get_posicao_estoque(
+                data=data, categoria_id=filtros.get("categoria_id"), marca_id=None,
+                incluir_zerados=False, formato=filtros.get("formato", "ndjson"), current_user=USUARIO
+            )
+            return await corpo(resposta)
+
+        # Antes do checkpoint: só movimentações; o dia informado entra inteiro
+        linhas = [json.loads(l) for l in (await posicao("2025-01-20")).splitlines()]
+        resumo = linhas.pop()["resumo"]
+        assert {l["produto_id"]: l["quantidade"] for l in linhas} == {"p1": 10, "p2": 3}
+        assert resumo["checkpoint"] is None and resumo["valor_total"] == 10 * 20.0 + 3 * 90.0
+
+        # Depois do checkpoint: corte mais o delta até a data, valorizado pelo custo gravado no
+        # corte (uma compra posterior que muda o preço médio não altera o fechamento)
+        await server.db.produtos.update_one({"id": "p1"}, {"$set": {"preco_medio": 99.0}})
+        linhas = [json.loads(l) for l in (await posicao("2025-02-10")).splitlines()]
+        resumo = linhas.pop()["resumo"]
+        assert resumo["checkpoint"] == "2025-02-01T00:00:00+00:00"
+        assert {l["produto_id"]: l["quantidade"] for l in linhas} == {"p1": 6, "p2": 3}
+        assert resumo["valor_total"] == 6 * 20.0 + 3 * 90.0
+
+        # Filtro por categoria e saída CSV
+        csv_texto = await posicao("2025-03-01", categoria_id="cat1", formato="csv")
+        assert csv_texto.splitlines() == [
+            "produto_id,sku,nome,categoria_id,marca_id,quantidade,custo_unitario,valor",
+            "p1,,Body,cat1,,5,20.0,100.0"
+        ]
+    executar_com_banco_semeado(teste)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Testes - Arquivamento de logs
+Logs movidos para o arquivo continuam aparecendo em /logs e na exportação.
+
+Requer MongoDB 5.0+ em MONGO_URL; sem ele os testes são ignorados.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+import server
+from banco_semeado import DATA_FIM, DATA_INICIO, USUARIO, comparar, executar_com_banco_semeado
+
+
+def test_logs_arquivados_continuam_consultaveis():
+    async def teste(dados):
+        cenarios = [
+            {"data_inicio": DATA_INICIO, "data_fim": DATA_FIM},
+            {"data_inicio": None, "data_fim": None, "user_id": "u2"},
+            {"data_inicio": None, "data_fim": None, "acao": "criar"},
+        ]
+
+        async def consultar():
+            resultados = []
+            for filtros in cenarios:
+                resultado = await server.get_logs(
+                    data_inicio=filtros["data_inicio"], data_fim=filtros["data_fim"],
+                    user_id=filtros.get("user_id"), severidade=None, tela=None, acao=filtros.get("acao"),
+                    metodo_http=None, limit=3, offset=1, current_user=USUARIO
+                )
+                # Logs vindos do arquivo trazem a marcação de arquivamento
+                resultado["logs"] = [
+                    {k: v for k, v in log.items() if k not in ("arquivado", "data_arquivamento")}
+                    for log in resultado["logs"]
+                ]
+                resultados.append(resultado)
+            return resultados
+
+        for log in dados["logs"]:
+            log.setdefault("arquivado", False)
+        await server.db.logs.delete_many({})
+        await server.db.logs.insert_many([dict(log) for log in dados["logs"]])
+        antes = await consultar()
+
+        resultado = await server.arquivar_logs(server.DIAS_RETENCAO_LOGS)
+        assert resultado["logs_arquivados"] == len(dados["logs"])
+        assert await server.db.logs.count_documents({}) == 0
+
+        comparar(await consultar(), antes, "logs")
+        exportado = await server.exportar_logs(
+            formato="json", data_inicio=DATA_INICIO, data_fim=DATA_FIM, current_user=USUARIO
+        )
+        assert exportado["total"] == antes[0]["total"]
+    executar_com_banco_semeado(teste)
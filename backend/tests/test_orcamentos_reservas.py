@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Testes - Reserva de estoque dos orçamentos (estoque_reservado)
+Orçamentos aberto/aprovado mantêm seus itens em estoque_reservado durante todo o ciclo:
+criação, edição, aprovação, conversão, expiração e reconciliação.
+
+Requer MongoDB 5.0+ em MONGO_URL; sem ele os testes são ignorados.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from banco_semeado import USUARIO, _item, executar_com_banco_semeado
+
+
+def test_reservas_acompanham_ciclo_do_orcamento():
+    async def reservado():
+        return {p["id"]: (p.get("estoque_atual", 0), p.get("estoque_reservado", 0))
+                async for p in server.db.produtos.find({}, {"_id": 0})}
+
+    async def teste(dados):
+        await server.db.orcamentos.delete_many({})
+
+        # Aberto reserva; editar aplica só a diferença
+        q1 = await server.create_orcamento(
+            server.OrcamentoCreate(cliente_id="c1", itens=[_item("p1", 3, 50.0)]), current_user=USUARIO
+        )
+        assert q1.status == "aberto" and (await reservado())["p1"] == (10, 3)
+        await server.update_orcamento(
+            q1.id, server.OrcamentoUpdate(itens=[_item("p1", 5, 50.0), _item("p2", 1, 200.0)]), current_user=USUARIO
+        )
+        estado = await reservado()
+        assert estado["p1"] == (10, 5) and estado["p2"] == (2, 1)
+
+        # Aumento acima do disponível é recusado sem mexer na reserva
+        with pytest.raises(server.HTTPException) as erro:
+            await server.update_orcamento(
+                q1.id, server.OrcamentoUpdate(itens=[_item("p1", 20, 50.0)]), current_user=USUARIO
+            )
+        assert erro.value.status_code == 400
+        assert await reservado() == estado
+
+        # Em análise não reserva, e converter não libera o que não reservou
+        q2 = await server.create_orcamento(
+            server.OrcamentoCreate(cliente_id="c2", itens=[_item("p2", 1, 100.0)], desconto=50.0), current_user=USUARIO
+        )
+        assert q2.status == "em_analise" and (await reservado())["p2"] == (2, 1)
+        await server.converter_orcamento_venda(
+            q2.id, server.ConversaoVendaRequest(forma_pagamento="pix"), current_user=USUARIO
+        )
+        assert (await reservado())["p2"] == (1, 1)
+
+        # Aprovar reserva (sem baixar estoque_atual)
+        q3 = await server.create_orcamento(
+            server.OrcamentoCreate(cliente_id="c1", itens=[_item("p1", 2, 50.0)], desconto=20.0), current_user=USUARIO
+        )
+        assert (await reservado())["p1"] == (10, 5)
+        await server.aprovar_orcamento(q3.id, current_user=USUARIO)
+        assert (await reservado())["p1"] == (10, 7)
+
+        # Expirar libera a reserva e não devolve estoque que não foi baixado
+        vencido = (datetime.now(timezone.utc) - timedelta(days=1)).isoformat()
+        await server.db.orcamentos.update_many({"id": {"$in": [q1.id, q3.id]}}, {"$set": {"data_validade": vencido}})
+        resultado = await server.expirar_orcamentos("sistema")
+        assert resultado["expirados"] == 2
+        estado = await reservado()
+        assert estado["p1"] == (10, 0) and estado["p2"] == (1, 0)
+
+        # Desvio do contador é corrigido pela reconciliação (também agendada)
+        await server.db.produtos.update_one({"id": "p3"}, {"$set": {"estoque_reservado": 7}})
+        await server.reconciliar_estoque_reservado()
+        assert all(reserva == 0 for _, reserva in (await reservado()).values())
+        assert "reconciliar_reservas" in server.ROTINAS_AGENDADAS
+    executar_com_banco_semeado(teste)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Testes - Paginação por cursor (keyset) nas listagens
+
+Os testes com banco requerem MongoDB 5.0+ em MONGO_URL (sem ele são ignorados);
+os das funções puras rodam sem MongoDB.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+import pytest
+
+import server
+from banco_semeado import USUARIO, executar_com_banco_semeado
+
+
+def test_paginacao_por_cursor():
+    async def teste(dados):
+        parametros = dict(status_venda=None, status_entrega=None, cliente_id=None, q=None,
+                          data_inicio=None, data_fim=None, current_user=USUARIO)
+        for sort in ["-created_at", "valor_final", "cliente_id"]:
+            completo = await server.get_vendas(page=1, limit=100, sort=sort, **parametros)
+            esperado = [v["id"] for v in completo["data"]]
+            assert completo["meta"]["next_cursor"] is None and completo["meta"]["total"] == len(dados["vendas"])
+
+            obtidos, after = [], None
+            while True:
+                pagina = await server.get_vendas(page=1, limit=2, sort=sort, after=after, contagem="nenhum", **parametros)
+                assert pagina["meta"]["total"] is None
+                obtidos.extend(v["id"] for v in pagina["data"])
+                after = pagina["meta"]["next_cursor"]
+                if not after:
+                    break
+            assert obtidos == esperado, sort
+
+        # Logs: o cursor percorre a mesma sequência da paginação por offset
+        filtros = dict(data_inicio=None, data_fim=None, user_id=None, severidade=None, tela=None,
+                       acao=None, metodo_http=None, current_user=USUARIO)
+        await server.db.logs.update_many({}, {"$set": {"arquivado": False}})
+        todos = await server.get_logs(limit=100, offset=0, **filtros)
+        obtidos, after = [], None
+        while True:
+            pagina = await server.get_logs(limit=3, offset=0, after=after, contagem="estimado", **filtros)
+            obtidos.extend(log["id"] for log in pagina["logs"])
+            after = pagina["next_cursor"]
+            if not after:
+                break
+        assert obtidos == [log["id"] for log in todos["logs"]]
+        assert pagina["total"] == todos["total"]
+    executar_com_banco_semeado(teste)
+
+
+def test_cursor_codificacao():
+    chave = ["2025-01-02T09:30:00+00:00", "v2"]
+    cursor = server.codificar_cursor(chave)
+    assert server.decodificar_cursor(cursor, 2) == chave
+
+    for invalido, tamanho in [(cursor, 3), ("nao-e-base64!", 2), (server.codificar_cursor({"a": 1}), 1)]:
+        with pytest.raises(server.HTTPException) as erro:
+            server.decodificar_cursor(invalido, tamanho)
+        assert erro.value.status_code == 400
+
+
+def test_filtro_apos_cursor():
+    # Decrescente: mesmo valor com id menor, valor menor, e os nulos (que vêm por último)
+    assert server.filtro_apos_cursor("created_at", -1, "2025-01-02", "v2") == {"$or": [
+        {"created_at": "2025-01-02", "id": {"$lt": "v2"}},
+        {"created_at": {"$lt": "2025-01-02"}},
+        {"created_at": None},
+    ]}
+    # Crescente: nulos vêm primeiro, então não entram depois de um valor
+    assert server.filtro_apos_cursor("valor_final", 1, 10.0, "v1") == {"$or": [
+        {"valor_final": 10.0, "id": {"$gt": "v1"}},
+        {"valor_final": {"$gt": 10.0}},
+    ]}
+    # Cursor parado em nulo
+    assert server.filtro_apos_cursor("cliente_id", 1, None, "v3") == {"$or": [
+        {"cliente_id": None, "id": {"$gt": "v3"}},
+        {"cliente_id": {"$ne": None}},
+    ]}
+    assert server.filtro_apos_cursor("cliente_id", -1, None, "v3") == {"$or": [
+        {"cliente_id": None, "id": {"$lt": "v3"}},
+    ]}
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Testes - Produtos: leitura de códigos no PDV, descrições com cache de
+dimensões do catálogo e custos de compra incrementais
+
+Os testes com banco requerem MongoDB 5.0+ em MONGO_URL (sem ele são ignorados);
+os das funções puras rodam sem MongoDB.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+import re
+
+import pytest
+
+import server
+from banco_semeado import USUARIO, _item, executar_com_banco_semeado
+
+
+def test_leitura_codigos_pdv():
+    async def teste(dados):
+        server.produto_codigo_cache.clear()
+        await server.db.produtos.update_one({"id": "p1"}, {"$set": {
+            "sku": "BODY-01", "codigo_barras": "7890000000017", "preco_venda": 40.0,
+            "variacoes": [{"id": "var-1", "sku_variante": "BODY-01-P", "codigo_barras": "7890000000024",
+                           "tamanho": "P", "estoque_atual": 4, "preco_adicional": 5.0}]
+        }})
+
+        lidos = await server.resolver_codigos_produto(["7890000000017", " BODY-01-P ", "7890000000024", "inexistente"])
+        assert lidos["7890000000017"]["id"] == "p1" and lidos["7890000000017"]["estoque_disponivel"] == 10
+        assert lidos["BODY-01-P"]["variacao"]["id"] == "var-1" and lidos["BODY-01-P"]["preco_unitario"] == 45.0
+        assert lidos["7890000000024"]["variacao"]["tamanho"] == "P"
+        assert lidos["inexistente"] is None
+
+        # Segunda leitura vem do cache; movimentação de estoque invalida o produto
+        misses = server.produto_codigo_cache.misses
+        await server.resolver_codigos_produto(["7890000000017"])
+        assert server.produto_codigo_cache.misses == misses
+        await server.aplicar_movimentacoes_estoque(
+            [{"produto_id": "p1", "quantidade": 3}], "saida", "teste", "t1", "admin-teste",
+            registrar_movimentacao=False
+        )
+        relido = await server.resolver_codigos_produto(["7890000000017"])
+        assert relido["7890000000017"]["estoque_atual"] == 7
+        assert server.produto_codigo_cache.misses == misses + 1
+
+        resposta = await server.get_produtos_por_codigos(
+            server.LeituraCodigosRequest(codigos=["BODY-01", "nada"]), current_user=USUARIO
+        )
+        assert list(resposta["produtos"]) == ["BODY-01"] and resposta["nao_encontrados"] == ["nada"]
+        server.produto_codigo_cache.clear()
+    executar_com_banco_semeado(teste)
+
+def test_descricoes_completas_com_cache_de_dimensoes():
+    async def teste(dados):
+        await server.db.marcas.insert_one({"id": "m1", "nome": "Marca Um", "created_at": "2024-01-01T00:00:00+00:00"})
+        await server.db.categorias.insert_one({"id": "cat1", "nome": "Roupas", "marca_id": "m1"})
+        await server.db.subcategorias.insert_one({"id": "sub1", "nome": "Bebê", "categoria_id": "cat1"})
+        await server.db.produtos.update_many({}, {"$set": {"marca_id": "m1", "categoria_id": "cat1", "subcategoria_id": "sub1"}})
+
+        descricoes = await server.descricoes_completas(["p2", "p1", "removido"])
+        assert descricoes == {
+            "p2": "Marca Um | Roupas | Bebê | Macacão",
+            "p1": "Marca Um | Roupas | Bebê | Body",
+            "removido": "Produto não encontrado"
+        }
+
+        # Relatórios seguintes reaproveitam as dimensões em memória
+        cargas = server.dimensoes_cache.cargas
+        curva = await server.relatorio_curva_abc(current_user=USUARIO)
+        assert all(p["produto_descricao"].startswith("Marca Um | Roupas | Bebê | ") for p in curva["produtos"])
+        assert server.dimensoes_cache.cargas == cargas
+
+        # Edição da marca invalida só a tabela de marcas
+        await server.update_marca("m1", server.MarcaCreate(nome="Marca Nova"), current_user=USUARIO)
+        assert await server.get_produto_descricao_completa("p3") == "Marca Nova | Roupas | Bebê | Meia"
+        assert server.dimensoes_cache.cargas == cargas + 1
+    executar_com_banco_semeado(teste)
+
+def test_custos_compra_incrementais():
+    async def teste(dados):
+        await server.db.produtos.update_many({}, {"$set": {"preco_inicial": 10.0}})
+        notas = [
+            {"id": "nf1", "data_emissao": "2025-01-10T10:00:00+00:00",
+             "itens": [_item("p1", 10, 20.0), _item("p2", 2, 80.0)]},
+            {"id": "nf2", "data_emissao": "2025-01-20T10:00:00+00:00",
+             "itens": [_item("p1", 5, 26.0), _item("p1", 5, 30.0)]},
+            # Lançada depois, mas com emissão anterior: não vira a última compra
+            {"id": "nf3", "data_emissao": "2025-01-05T10:00:00+00:00", "itens": [_item("p1", 10, 12.0)]},
+        ]
+        for nota in notas:
+            await server.db.notas_fiscais.insert_one({**nota, "confirmado": True, "cancelada": False, "status": "confirmada"})
+            await server.aplicar_custos_compra(nota)
+
+        async def custos():
+            return {p["id"]: p for p in await server.db.produtos.find(
+                {"id": {"$in": ["p1", "p2", "p3"]}},
+                {"_id": 0, "id": 1, "preco_medio": 1, "preco_ultima_compra": 1, "ultima_compra_nota_id": 1,
+                 "qtd_comprada_acumulada": 1, "valor_comprado_acumulado": 1}
+            ).to_list(None)}
+
+        p1 = (await custos())["p1"]
+        assert p1["preco_medio"] == 20.0 and p1["qtd_comprada_acumulada"] == 30
+        assert p1["preco_ultima_compra"] == 26.0 and p1["ultima_compra_nota_id"] == "nf2"
+
+        # Cancelar a última compra estorna os acumulados e refaz a última compra
+        await server.db.notas_fiscais.update_one({"id": "nf2"}, {"$set": {"cancelada": True, "status": "cancelada"}})
+        await server.estornar_custos_compra(notas[1])
+        incremental = await custos()
+        assert incremental["p1"]["preco_medio"] == 16.0 and incremental["p1"]["ultima_compra_nota_id"] == "nf1"
+        assert incremental["p1"]["preco_ultima_compra"] == 20.0 and incremental["p2"]["preco_medio"] == 80.0
+
+        # A reconstrução completa chega ao mesmo estado; sem compra volta ao preço inicial
+        resultado = await server.reconstruir_custos_compra()
+        assert resultado["produtos_com_compra"] == 2
+        reconstruido = await custos()
+        for pid in ("p1", "p2"):
+            assert reconstruido[pid] == incremental[pid], pid
+        assert reconstruido["p3"]["preco_medio"] == 10.0 and reconstruido["p3"]["preco_ultima_compra"] is None
+    executar_com_banco_semeado(teste)
+
+
+def test_intervalo_range_imagens():
+    intervalo = server._intervalo_range
+    assert intervalo(None, 1000) is None
+    assert intervalo("bytes=0-99", 1000) == (0, 99)
+    assert intervalo("bytes=500-", 1000) == (500, 999)
+    assert intervalo("bytes=-100", 1000) == (900, 999)
+    assert intervalo("bytes=-5000", 1000) == (0, 999)
+    assert intervalo("bytes=900-5000", 1000) == (900, 999)
+
+    # Múltiplos intervalos, outras unidades e valores inválidos: arquivo inteiro
+    assert intervalo("bytes=0-1,5-6", 1000) is None
+    assert intervalo("items=0-1", 1000) is None
+    assert intervalo("bytes=a-b", 1000) is None
+
+    for fora in ["bytes=1000-", "bytes=50-10"]:
+        with pytest.raises(server.HTTPException) as erro:
+            intervalo(fora, 1000)
+        assert erro.value.status_code == 416
+        assert erro.value.headers["Content-Range"] == "bytes */1000"
+
+
+def test_classificacao_das_fotos():
+    imagem_id = "3f2b8c1e-9a4d-4c7b-8e6f-1a2b3c4d5e6f"
+    url_longa = "https://cdn.exemplo.com/produtos/" + "a" * 80 + ".jpg"
+    assert server.foto_e_imagem_id(imagem_id)
+    assert not server.foto_e_imagem_id(url_longa)
+
+    # Só data URL ou base64 válido vai para o bucket; ids e URLs (mesmo longas) ficam como estão
+    assert server.foto_em_base64("data:image/png;base64,iVBORw0KGgo=")
+    assert server.foto_em_base64("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+    assert not server.foto_em_base64(imagem_id)
+    assert not server.foto_em_base64(url_longa)
+    # base64 válido que não é imagem (ex.: um nome curto) não vai para o bucket
+    assert not server.foto_em_base64("foto1234")
+
+    # O filtro da migração usa o mesmo critério
+    regex = re.compile(server.FILTRO_FOTOS_BASE64["fotos"]["$regex"])
+    for foto in ["data:image/png;base64,iVBORw0KGgo=", "/9j/4AAQSkZJRg", imagem_id, url_longa, "foto1234"]:
+        assert bool(regex.match(foto)) == server.foto_em_base64(foto)
+
+
+def test_variacoes_com_e_sem_codigo_de_barras():
+    def produto(sku, codigo):
+        return server.ProdutoCreate(
+            sku=sku, nome=f"Produto {sku}", marca_id="m1", categoria_id="cat1", subcategoria_id="sub1",
+            preco_inicial=10.0, preco_venda=20.0, tem_variacoes=True,
+            variacoes=[server.ProdutoVariante(sku_variante=f"{sku}-P", codigo_barras=codigo),
+                       server.ProdutoVariante(sku_variante=f"{sku}-M")]
+        )
+
+    async def teste(dados):
+        # Duas variações sem código em produtos diferentes não conflitam
+        a = await server.create_produto(produto("VAR-A", "7890000000031"), current_user=USUARIO)
+        b = await server.create_produto(produto("VAR-B", "7890000000048"), current_user=USUARIO)
+        await server.update_produto(b.id, produto("VAR-B", "7890000000055"), current_user=USUARIO)
+        await server.update_produto(a.id, produto("VAR-A", "7890000000031"), current_user=USUARIO)
+
+        # Código ou SKU de variação de outro produto, ou repetido no mesmo produto, é recusado
+        for repetido in [produto("VAR-C", "7890000000031"), produto("VAR-A", "7890000000062")]:
+            with pytest.raises(server.HTTPException) as erro:
+                await server.create_produto(repetido, current_user=USUARIO)
+            assert erro.value.status_code == 400
+        duplicado = produto("VAR-D", "7890000000079")
+        duplicado.variacoes[1].codigo_barras = "7890000000079"
+        with pytest.raises(server.HTTPException) as erro:
+            await server.create_produto(duplicado, current_user=USUARIO)
+        assert "repetido" in erro.value.detail
+        assert await server.db.produtos.count_documents({"sku": {"$in": ["VAR-C", "VAR-D"]}}) == 0
+    executar_com_banco_semeado(teste)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Testes - Rate limiter de janela deslizante (RateLimiter + MemoriaRateLimitBackend)
+Roda sem MongoDB: o relógio é fixado em pontos conhecidos de cada janela.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+import asyncio
+
+import server
+
+JANELA = 300
+INICIO = 1000 * JANELA  # início de uma janela qualquer
+
+
+def limitador(max_attempts=10, max_chaves=100):
+    return server.RateLimiter(max_attempts=max_attempts, window_seconds=JANELA, nome="teste",
+                              backend=server.MemoriaRateLimitBackend(max_chaves=max_chaves))
+
+
+def test_bloqueia_ao_atingir_o_limite(monkeypatch):
+    monkeypatch.setattr(server.time, "time", lambda: INICIO + 10)
+    rl = limitador()
+
+    async def teste():
+        for _ in range(10):
+            assert await rl.consumir("ip") == 0
+        assert await rl.is_rate_limited("ip")
+        assert not await rl.is_rate_limited("outro-ip")
+        # Bloqueada, a requisição não conta como tentativa
+        assert await rl.consumir("ip") > 0
+        assert await rl.backend.contagens("teste:ip", INICIO // JANELA) == (10, 0)
+    asyncio.run(teste())
+
+
+def test_tempo_restante(monkeypatch):
+    agora = [INICIO]
+    monkeypatch.setattr(server.time, "time", lambda: agora[0])
+    rl = limitador()
+
+    async def teste():
+        for _ in range(10):
+            await rl.record_attempt("ip")
+        # Janela atual cheia: só libera depois da virada, quando as 10 passam a "anterior" com peso total
+        assert await rl.get_remaining_time("ip") == JANELA
+        agora[0] = INICIO + 120
+        assert await rl.get_remaining_time("ip") == JANELA - 120
+
+        # Na janela seguinte a anterior perde peso: 10 * (1 - f) + 5 < 10 quando f > 0,5
+        agora[0] = INICIO + JANELA
+        for _ in range(5):
+            await rl.record_attempt("ip")
+        agora[0] = INICIO + JANELA + 60
+        assert await rl.get_remaining_time("ip") == 90
+        agora[0] = INICIO + JANELA + 151
+        assert await rl.get_remaining_time("ip") == 0 and not await rl.is_rate_limited("ip")
+
+        # Duas janelas depois nada resta
+        agora[0] = INICIO + 3 * JANELA
+        assert await rl.backend.contagens("teste:ip", INICIO // JANELA + 3) == (0, 0)
+    asyncio.run(teste())
+
+
+def test_descarte_lru():
+    janela = INICIO // JANELA
+    backend = server.MemoriaRateLimitBackend(max_chaves=2)
+
+    async def teste():
+        await backend.incrementar("a", janela, JANELA)
+        await backend.incrementar("b", janela, JANELA)
+        # Ler "a" a torna a mais recente; "b" é a descartada quando "c" entra
+        assert await backend.contagens("a", janela) == (1, 0)
+        await backend.incrementar("c", janela, JANELA)
+        assert list(backend.contadores) == ["a", "c"]
+        assert await backend.contagens("b", janela) == (0, 0)
+    asyncio.run(teste())
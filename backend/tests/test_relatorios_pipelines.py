@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""
+Testes de regressão - Relatórios Avançados em pipelines de agregação
+Compara a saída dos handlers (rollup diário + $match/$group no MongoDB) com a
+implementação anterior em Python, sobre o mesmo conjunto de dados semeado.
+O fluxo de caixa resumido ($setWindowFields) é comparado ao modo completo.
+
+Os testes com banco requerem MongoDB 5.0+ em MONGO_URL (sem ele são ignorados);
+os das funções puras rodam sem MongoDB.
+"""
+import sys
+sys.path.insert(0, '/app/backend')
+
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+from banco_semeado import DATA_FIM, DATA_INICIO, USUARIO, comparar, executar_com_banco_semeado
+
+
+# ==================== IMPLEMENTAÇÃO ANTERIOR (REFERÊNCIA) ====================
+
+def _vendas_efetivadas(vendas):
+    return [v for v in vendas if v["status_venda"] not in ["rascunho", "cancelada"]]
+
+
+def referencia_kpis(dados, data_inicio, data_fim):
+    vendas = _vendas_efetivadas(dados["vendas"])
+    produtos = dados["produtos"]
+    orcamentos = dados["orcamentos"]
+    if data_inicio and data_fim:
+        vendas = [v for v in vendas if data_inicio <= v["created_at"][:10] <= data_fim]
+        orcamentos = [o for o in orcamentos if data_inicio <= o["created_at"][:10] <= data_fim]
+
+    total_vendas = len(vendas)
+    faturamento_total = sum(v["total"] for v in vendas)
+    convertidos = len([o for o in orcamentos if o["status"] == "vendido"])
+
+    produtos_vendidos = {}
+    for venda in vendas:
+        for item in venda.get("itens", []):
+            linha = produtos_vendidos.setdefault(item["produto_id"], {"quantidade": 0, "faturamento": 0})
+            linha["quantidade"] += item["quantidade"]
+            linha["faturamento"] += item["quantidade"] * item["preco_unitario"]
+    top = sorted(produtos_vendidos.items(), key=lambda x: x[1]["faturamento"], reverse=True)[:5]
+
+    return {
+        "vendas": {
+            "total": total_vendas,
+            "faturamento": faturamento_total,
+            "ticket_medio": faturamento_total / total_vendas if total_vendas > 0 else 0,
+            "total_descontos": sum(v.get("desconto", 0) for v in vendas),
+            "total_frete": sum(v.get("frete", 0) for v in vendas),
+            "faturamento_liquido": faturamento_total
+        },
+        "estoque": {
+            "valor_total": sum(p["estoque_atual"] * p.get("preco_medio", 0) for p in produtos),
+            "produtos_total": len(produtos),
+            "alertas_minimo": len([p for p in produtos if p["estoque_atual"] <= p["estoque_minimo"]])
+        },
+        "orcamentos": {
+            "total": len(orcamentos),
+            "abertos": len([o for o in orcamentos if o["status"] == "aberto"]),
+            "convertidos": convertidos,
+            "taxa_conversao": (convertidos / len(orcamentos) * 100) if len(orcamentos) > 0 else 0
+        },
+        "clientes": {
+            "total": len(dados["clientes"]),
+            "ativos": len(set(v["cliente_id"] for v in vendas))
+        },
+        "top_produtos": [
+            {"produto_id": pid, "quantidade": d["quantidade"], "faturamento": d["faturamento"]}
+            for pid, d in top
+        ]
+    }
+
+
+def referencia_vendas_periodo(dados, data_inicio, data_fim, agrupamento):
+    vendas_periodo = [
+        v for v in _vendas_efetivadas(dados["vendas"])
+        if data_inicio <= v["created_at"][:10] <= data_fim
+    ]
+    agrupadas = {}
+    for venda in vendas_periodo:
+        if agrupamento == "dia":
+            chave = venda["created_at"][:10]
+        elif agrupamento == "mes":
+            chave = venda["created_at"][:7]
+        else:
+            data = datetime.fromisoformat(venda["created_at"])
+            chave = f"{data.year}-W{data.isocalendar()[1]:02d}"
+        linha = agrupadas.setdefault(chave, {"quantidade": 0, "faturamento": 0, "ticket_medio": 0})
+        linha["quantidade"] += 1
+        linha["faturamento"] += venda["total"]
+    for linha in agrupadas.values():
+        linha["ticket_medio"] = linha["faturamento"] / linha["quantidade"]
+    return {
+        "total_vendas": len(vendas_periodo),
+        "faturamento_total": sum(v["total"] for v in vendas_periodo),
+        "dados": agrupadas
+    }
+
+
+def referencia_vendas_vendedor(dados, data_inicio, data_fim):
+    vendas = _vendas_efetivadas(dados["vendas"])
+    if data_inicio and data_fim:
+        vendas = [v for v in vendas if data_inicio <= v["created_at"][:10] <= data_fim]
+    por_vendedor = {}
+    for venda in vendas:
+        linha = por_vendedor.setdefault(venda.get("user_id"), {"quantidade": 0, "faturamento": 0})
+        linha["quantidade"] += 1
+        linha["faturamento"] += venda["total"]
+    resultado = []
+    for user_id, linha in por_vendedor.items():
+        usuario = next((u for u in dados["users"] if u["id"] == user_id), None)
+        resultado.append({
+            "quantidade": linha["quantidade"],
+            "faturamento": linha["faturamento"],
+            "ticket_medio": linha["faturamento"] / linha["quantidade"],
+            "user_id": user_id,
+            "user_nome": usuario["nome"] if usuario else "Usuário Desconhecido"
+        })
+    resultado.sort(key=lambda x: x["faturamento"], reverse=True)
+    return resultado
+
+
+def referencia_dre(dados, data_inicio, data_fim):
+    vendas_periodo = [
+        v for v in _vendas_efetivadas(dados["vendas"])
+        if data_inicio <= v["created_at"][:10] <= data_fim
+    ]
+    receita_bruta = sum(v["total"] for v in vendas_periodo)
+    descontos = sum(v.get("desconto", 0) for v in vendas_periodo)
+    receita_liquida = receita_bruta - descontos
+    cmv = 0
+    for venda in vendas_periodo:
+        for item in venda.get("itens", []):
+            produto = next((p for p in dados["produtos"] if p["id"] == item["produto_id"]), None)
+            if produto:
+                cmv += item["quantidade"] * produto.get("preco_medio", 0)
+    lucro_bruto = receita_liquida - cmv
+    margem = (lucro_bruto / receita_liquida * 100) if receita_liquida > 0 else 0
+    return {
+        "receita_bruta": receita_bruta,
+        "descontos": descontos,
+        "receita_liquida": receita_liquida,
+        "cmv": cmv,
+        "lucro_bruto": lucro_bruto,
+        "margem_bruta_percentual": margem,
+        "lucro_liquido": lucro_bruto,
+        "margem_liquida_percentual": margem
+    }
+
+
+def referencia_curva_abc(dados):
+    faturamento_por_produto = {}
+    for venda in _vendas_efetivadas(dados["vendas"]):
+        for item in venda.get("itens", []):
+            faturamento_por_produto[item["produto_id"]] = (
+                faturamento_por_produto.get(item["produto_id"], 0) + item["quantidade"] * item["preco_unitario"]
+            )
+    faturamento_total = sum(faturamento_por_produto.values())
+    acumulado = 0
+    curva = []
+    for pid, faturamento in sorted(faturamento_por_produto.items(), key=lambda x: x[1], reverse=True):
+        produto = next((p for p in dados["produtos"] if p["id"] == pid), None)
+        percentual = (faturamento / faturamento_total * 100) if faturamento_total > 0 else 0
+        acumulado += percentual
+        classe = "A" if acumulado <= 80 else ("B" if acumulado <= 95 else "C")
+        curva.append({
+            "produto_id": pid,
+            "produto_nome": produto["nome"] if produto else "Desconhecido",
+            "faturamento": faturamento,
+            "percentual": percentual,
+            "percentual_acumulado": acumulado,
+            "classe": classe
+        })
+    return {"total_produtos": len(curva), "faturamento_total": faturamento_total, "produtos": curva}
+
+
+def referencia_rfm(dados):
+    referencia = datetime.now(timezone.utc)
+    rfm = {}
+    for venda in _vendas_efetivadas(dados["vendas"]):
+        linha = rfm.setdefault(venda["cliente_id"], {
+            "recencia": 9999, "frequencia": 0, "valor_monetario": 0, "ultima_compra": None
+        })
+        dias = (referencia - datetime.fromisoformat(venda["created_at"])).days
+        if dias < linha["recencia"]:
+            linha["recencia"] = dias
+            linha["ultima_compra"] = venda["created_at"]
+        linha["frequencia"] += 1
+        linha["valor_monetario"] += venda["total"]
+    return {
+        cliente_id: {
+            "recencia_dias": linha["recencia"],
+            "frequencia": linha["frequencia"],
+            "valor_monetario": linha["valor_monetario"],
+            "ultima_compra": linha["ultima_compra"]
+        }
+        for cliente_id, linha in rfm.items()
+    }
+
+
+def referencia_conversao(dados, data_inicio, data_fim):
+    orcamentos = dados["orcamentos"]
+    if data_inicio and data_fim:
+        orcamentos = [o for o in orcamentos if data_inicio <= o["created_at"][:10] <= data_fim]
+    total = len(orcamentos)
+    vendidos = len([o for o in orcamentos if o["status"] == "vendido"])
+    return {
+        "total_orcamentos": total,
+        "status": {
+            "abertos": len([o for o in orcamentos if o["status"] == "aberto"]),
+            "vendidos": vendidos,
+            "devolvidos": len([o for o in orcamentos if o["status"] == "devolvido"]),
+            "cancelados": len([o for o in orcamentos if o.get("status") == "cancelado"])
+        },
+        "taxa_conversao_percentual": (vendidos / total * 100) if total > 0 else 0,
+        "valores": {
+            "valor_medio_orcamento": sum(o["total"] for o in orcamentos) / total if total > 0 else 0,
+            "valor_medio_vendido": (
+                sum(o["total"] for o in orcamentos if o["status"] == "vendido") / vendidos if vendidos > 0 else 0
+            )
+        }
+    }
+
+
+def referencia_auditoria(dados, data_inicio, data_fim, user_id=None, acao=None):
+    logs = sorted(dados["logs"], key=lambda log: log["timestamp"], reverse=True)
+    if data_inicio and data_fim:
+        logs = [log for log in logs if data_inicio <= log["timestamp"][:10] <= data_fim]
+    if user_id:
+        logs = [log for log in logs if log["user_id"] == user_id]
+    if acao:
+        logs = [log for log in logs if log["acao"] == acao]
+    por_tipo, por_usuario, por_tela = {}, {}, {}
+    for log_item in logs:
+        por_tipo[log_item["acao"]] = por_tipo.get(log_item["acao"], 0) + 1
+        por_usuario[log_item["user_nome"]] = por_usuario.get(log_item["user_nome"], 0) + 1
+        por_tela[log_item["tela"]] = por_tela.get(log_item["tela"], 0) + 1
+    return {
+        "total_acoes": len(logs),
+        "acoes_por_tipo": por_tipo,
+        "acoes_por_usuario": por_usuario,
+        "acoes_por_tela": por_tela,
+        "logs_recentes": logs[:50]
+    }
+
+
+# ==================== TESTES ====================
+
+
+def test_kpis_dashboard():
+    async def teste(dados):
+        for inicio, fim in [(DATA_INICIO, DATA_FIM), (None, None)]:
+            obtido = await server.get_kpis_dashboard(data_inicio=inicio, data_fim=fim, current_user=USUARIO)
+            esperado = referencia_kpis(dados, inicio, fim)
+            top_obtido = [
+                {k: p[k] for k in ("produto_id", "quantidade", "faturamento")} for p in obtido["top_produtos"]
+            ]
+            comparar(top_obtido, esperado.pop("top_produtos"), "top_produtos")
+            for secao, valores in esperado.items():
+                comparar(obtido[secao], valores, secao)
+    executar_com_banco_semeado(teste)
+
+def test_vendas_por_periodo():
+    async def teste(dados):
+        for agrupamento in ["dia", "semana", "mes"]:
+            obtido = await server.relatorio_vendas_periodo(
+                data_inicio=DATA_INICIO, data_fim=DATA_FIM, agrupamento=agrupamento, current_user=USUARIO
+            )
+            esperado = referencia_vendas_periodo(dados, DATA_INICIO, DATA_FIM, agrupamento)
+            comparar({k: obtido[k] for k in esperado}, esperado, agrupamento)
+        # Virada de ano mantém o ano civil na chave da semana
+        obtido = await server.relatorio_vendas_periodo(
+            data_inicio=DATA_INICIO, data_fim=DATA_FIM, agrupamento="semana", current_user=USUARIO
+        )
+        assert "2024-W01" in obtido["dados"]
+    executar_com_banco_semeado(teste)
+
+def test_vendas_por_vendedor():
+    async def teste(dados):
+        for inicio, fim in [(DATA_INICIO, DATA_FIM), (None, None)]:
+            obtido = await server.relatorio_vendas_vendedor(data_inicio=inicio, data_fim=fim, current_user=USUARIO)
+            comparar(obtido["vendedores"], referencia_vendas_vendedor(dados, inicio, fim), "vendedores")
+    executar_com_banco_semeado(teste)
+
+def test_dre():
+    async def teste(dados):
+        obtido = await server.relatorio_dre(data_inicio=DATA_INICIO, data_fim=DATA_FIM, current_user=USUARIO)
+        esperado = referencia_dre(dados, DATA_INICIO, DATA_FIM)
+        comparar({k: obtido[k] for k in esperado}, esperado, "dre")
+    executar_com_banco_semeado(teste)
+
+def test_curva_abc():
+    async def teste(dados):
+        obtido = await server.relatorio_curva_abc(current_user=USUARIO)
+        esperado = referencia_curva_abc(dados)
+        produtos_obtidos = [
+            {k: p[k] for k in esperado["produtos"][0]} for p in obtido["produtos"]
+        ]
+        comparar(produtos_obtidos, esperado.pop("produtos"), "produtos")
+        comparar({k: obtido[k] for k in esperado}, esperado, "curva_abc")
+    executar_com_banco_semeado(teste)
+
+def test_rfm():
+    async def teste(dados):
+        obtido = await server.relatorio_rfm(current_user=USUARIO)
+        por_cliente = {
+            c["cliente_id"]: {k: c[k] for k in ("recencia_dias", "frequencia", "valor_monetario", "ultima_compra")}
+            for c in obtido["clientes"]
+        }
+        comparar(por_cliente, referencia_rfm(dados), "rfm")
+        assert obtido["total_clientes"] == len(por_cliente)
+    executar_com_banco_semeado(teste)
+
+def test_conversao_orcamentos():
+    async def teste(dados):
+        for inicio, fim in [(DATA_INICIO, DATA_FIM), (None, None)]:
+            obtido = await server.relatorio_conversao_orcamentos(
+                data_inicio=inicio, data_fim=fim, current_user=USUARIO
+            )
+            esperado = referencia_conversao(dados, inicio, fim)
+            comparar({k: obtido[k] for k in esperado}, esperado, "conversao")
+    executar_com_banco_semeado(teste)
+
+def test_auditoria():
+    async def teste(dados):
+        cenarios = [
+            {"data_inicio": DATA_INICIO, "data_fim": DATA_FIM},
+            {"data_inicio": None, "data_fim": None, "user_id": "u2"},
+            {"data_inicio": DATA_INICIO, "data_fim": DATA_FIM, "acao": "criar"},
+        ]
+        for filtros in cenarios:
+            obtido = await server.relatorio_auditoria(
+                user_id=filtros.get("user_id"), acao=filtros.get("acao"),
+                data_inicio=filtros["data_inicio"], data_fim=filtros["data_fim"], current_user=USUARIO
+            )
+            esperado = referencia_auditoria(
+                dados, filtros["data_inicio"], filtros["data_fim"], filtros.get("user_id"), filtros.get("acao")
+            )
+            comparar({k: obtido[k] for k in esperado}, esperado, str(filtros))
+    executar_com_banco_semeado(teste)
+
+def test_fluxo_caixa_resumo_e_detalhes():
+    async def teste(dados):
+        for regime in ["caixa", "competencia"]:
+            for tipo_visao in ["diario", "semanal", "mensal"]:
+                cenario = f"{regime}/{tipo_visao}"
+                completo = await server.get_fluxo_caixa(
+                    data_inicio=DATA_INICIO, data_fim=DATA_FIM, regime=regime, tipo_visao=tipo_visao,
+                    apenas_resumo=False, current_user=USUARIO
+                )
+                resumo = await server.get_fluxo_caixa(
+                    data_inicio=DATA_INICIO, data_fim=DATA_FIM, regime=regime, tipo_visao=tipo_visao,
+                    apenas_resumo=True, current_user=USUARIO
+                )
+                esperado = [
+                    {
+                        **{k: p[k] for k in ("periodo", "entradas", "saidas", "saldo_periodo", "saldo_acumulado")},
+                        "qtd_entradas": len(p["detalhes_entradas"]),
+                        "qtd_saidas": len(p["detalhes_saidas"]),
+                    }
+                    for p in completo["fluxo"]
+                ]
+                comparar(resumo["fluxo"], esperado, cenario)
+                comparar(resumo["resumo"], completo["resumo"], cenario)
+
+                # Detalhes paginados de cada período reproduzem os detalhes do modo completo
+                for p in completo["fluxo"]:
+                    detalhes, cursor = [], None
+                    while True:
+                        pagina = await server.get_fluxo_caixa_detalhes(
+                            periodo=p["periodo"], regime=regime, tipo_visao=tipo_visao, tipo=None,
+                            data_inicio=DATA_INICIO, data_fim=DATA_FIM, cursor=cursor, limit=1,
+                            current_user=USUARIO
+                        )
+                        detalhes.extend(pagina["detalhes"])
+                        cursor = pagina["proximo_cursor"]
+                        if not cursor:
+                            break
+                    chave = lambda d: (d["data"], d["referencia"]["conta_id"], d["referencia"]["parcela"])
+                    for sentido in ["entrada", "saida"]:
+                        obtidos = [{k: v for k, v in d.items() if k != "sentido"}
+                                   for d in detalhes if d["sentido"] == sentido]
+                        comparar(
+                            sorted(obtidos, key=chave),
+                            sorted(p[f"detalhes_{sentido}s"], key=chave), f"{cenario} {p['periodo']} {sentido}s"
+                        )
+
+        # Semana iniciada na segunda-feira 2024-12-30 reúne a virada de ano
+        semanal = await server.get_fluxo_caixa(
+            data_inicio=DATA_INICIO, data_fim=DATA_FIM, regime="competencia", tipo_visao="semanal",
+            apenas_resumo=True, current_user=USUARIO
+        )
+        assert semanal["fluxo"][0]["periodo"] == "2024-12-30"
+        assert semanal["fluxo"][0]["saidas"] == pytest.approx(70.0)
+    executar_com_banco_semeado(teste)
+
+
+
+def test_detalhes_fluxo_caixa_datas_invalidas():
+    async def detalhes(**datas):
+        return await server.get_fluxo_caixa_detalhes(
+            periodo=datas.pop("periodo", "2025-01-06"), regime="caixa", tipo_visao="diario", tipo=None,
+            cursor=None, limit=10, current_user=USUARIO, **datas
+        )
+
+    for datas, erro in [({"periodo": "06/01/2025"}, "Período inválido"),
+                        ({"data_inicio": "2025-13-01"}, "data_inicio inválida"),
+                        ({"data_inicio": DATA_INICIO, "data_fim": "amanhã"}, "data_fim inválida")]:
+        with pytest.raises(server.HTTPException) as excecao:
+            asyncio.run(detalhes(**{"data_inicio": None, "data_fim": None, **datas}))
+        assert excecao.value.status_code == 400 and excecao.value.detail.startswith(erro)
+
+def test_pagamento_de_rascunho_atualiza_rollup():
+    async def teste(dados):
+        resultado = await server.registrar_pagamento(
+            "v5", server.RegistrarPagamentoRequest(valor=500.0), current_user=USUARIO
+        )
+        assert resultado["status_venda"] == "paga"
+        next(v for v in dados["vendas"] if v["id"] == "v5")["status_venda"] = "paga"
+
+        obtido = await server.get_kpis_dashboard(data_inicio=DATA_INICIO, data_fim=DATA_FIM, current_user=USUARIO)
+        esperado = referencia_kpis(dados, DATA_INICIO, DATA_FIM)
+        comparar(obtido["vendas"], esperado["vendas"], "vendas")
+        obtido = await server.relatorio_vendas_periodo(
+            data_inicio=DATA_INICIO, data_fim=DATA_FIM, agrupamento="dia", current_user=USUARIO
+        )
+        esperado = referencia_vendas_periodo(dados, DATA_INICIO, DATA_FIM, "dia")
+        comparar({k: obtido[k] for k in esperado}, esperado, "vendas_periodo")
+    executar_com_banco_semeado(teste)
+
+
+def test_contas_do_cliente_com_resumo():
+    async def teste(dados):
+        await server.db.contas_receber.insert_many([
+            {"id": f"crc{i}", "cliente_id": "c1", "cancelada": False, "created_at": f"2025-01-0{i}T10:00:00+00:00",
+             "valor_total": 100.0, "valor_recebido": 40.0 * (i % 2), "valor_pendente": 100.0 - 40.0 * (i % 2),
+             "parcelas": [{"numero_parcela": 1, "status": "recebido"}, {"numero_parcela": 2, "status": "pendente"}]
+                        if i % 2 else [{"numero_parcela": 1, "status": "pendente"}]}
+            for i in range(1, 4)
+        ])
+        contas, resumo = await server.listar_contas_com_resumo(
+            server.db.contas_receber, {"cliente_id": "c1", "cancelada": False}, "valor_recebido",
+            "total_recebido", server.PROJECAO_LISTA_CONTAS_RECEBER, max_contas=2
+        )
+        # Totais de todas as contas; linhas limitadas, sem as parcelas completas
+        assert resumo == {"quantidade": 3, "total_valor": 300.0, "total_recebido": 80.0, "total_pendente": 220.0}
+        assert [c["id"] for c in contas] == ["crc3", "crc2"]
+        assert "parcelas" not in contas[0]
+        assert (contas[0]["parcelas_count"], contas[0]["parcelas_recebidas_count"]) == (2, 1)
+        assert (contas[1]["parcelas_count"], contas[1]["parcelas_recebidas_count"]) == (1, 0)
+
+        vazio = await server.listar_contas_receber_cliente("c2", current_user=USUARIO)
+        assert vazio == {"contas": [], "resumo": {"quantidade": 0, "total_valor": 0, "total_recebido": 0,
+                                                  "total_pendente": 0}}
+    executar_com_banco_semeado(teste)
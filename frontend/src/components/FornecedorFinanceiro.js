@@ -266,10 +266,10 @@ const FornecedorFinanceiro = ({ fornecedorId, fornecedorNome }) => {
                   <div className="font-semibold">{formatDate(conta.created_at)}</div>
                 </div>
               </div>
-              {conta.parcelas && conta.parcelas.length > 1 && (
+              {conta.parcelas_count > 1 && (
                 <div className="mt-2 pt-2 border-t">
                   <div className="text-xs text-gray-500">
-                    {conta.parcelas.filter(p => p.status === 'pago').length} de {conta.parcelas.length} parcelas pagas
+                    {conta.parcelas_pagas_count} de {conta.parcelas_count} parcelas pagas
                   </div>
                 </div>
               )}
@@ -22,6 +22,7 @@ const FluxoCaixa = () => {
     data_fim: new Date().toISOString().split('T')[0]
   });
   const [expandedPeriodos, setExpandedPeriodos] = useState({});
+  const [detalhesPorPeriodo, setDetalhesPorPeriodo] = useState({});
   
   // Paginação
   const [paginaAtual, setPaginaAtual] = useState(1);
@@ -52,13 +53,16 @@ const FluxoCaixa = () => {
       const params = new URLSearchParams({
         data_inicio: filtros.data_inicio,
         data_fim: filtros.data_fim,
-        tipo_visao: 'diario'
+        tipo_visao: 'diario',
+        apenas_resumo: 'true'
       });
       
       const response = await axios.get(`${API}/fluxo-caixa?${params}`, {
         headers: { Authorization: `Bearer ${token}` }
       });
       setFluxo(response.data);
+      setDetalhesPorPeriodo({});
+      setExpandedPeriodos({});
       setPaginaAtual(1);
     } catch (error) {
       console.error('Erro ao buscar fluxo:', error);
@@ -76,7 +80,50 @@ const FluxoCaixa = () => {
     toast.info('Exportação em desenvolvimento');
   };
 
+  // Detalhes do período carregados sob demanda, uma página por vez
+  const fetchDetalhes = async (periodo, cursor = null) => {
+    setDetalhesPorPeriodo(prev => ({
+      ...prev,
+      [periodo]: { entradas: [], saidas: [], ...prev[periodo], carregando: true }
+    }));
+    try {
+      const token = localStorage.getItem('token');
+      const params = new URLSearchParams({
+        periodo,
+        regime: fluxo?.regime || 'caixa',
+        tipo_visao: fluxo?.tipo_visao || 'diario',
+        data_inicio: fluxo?.periodo?.inicio || filtros.data_inicio,
+        data_fim: fluxo?.periodo?.fim || filtros.data_fim
+      });
+      if (cursor) params.append('cursor', cursor);
+      
+      const response = await axios.get(`${API}/fluxo-caixa/detalhes?${params}`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      const detalhes = response.data.detalhes;
+      setDetalhesPorPeriodo(prev => ({
+        ...prev,
+        [periodo]: {
+          entradas: [...prev[periodo].entradas, ...detalhes.filter(d => d.sentido === 'entrada')],
+          saidas: [...prev[periodo].saidas, ...detalhes.filter(d => d.sentido === 'saida')],
+          cursor: response.data.proximo_cursor,
+          carregando: false
+        }
+      }));
+    } catch (error) {
+      console.error('Erro ao buscar detalhes:', error);
+      toast.error('Erro ao carregar movimentações do período');
+      setDetalhesPorPeriodo(prev => ({
+        ...prev,
+        [periodo]: { ...prev[periodo], carregando: false }
+      }));
+    }
+  };
+
   const toggleDetalhes = (periodo) => {
+    if (!expandedPeriodos[periodo] && !detalhesPorPeriodo[periodo]) {
+      fetchDetalhes(periodo);
+    }
     setExpandedPeriodos(prev => ({
       ...prev,
       [periodo]: !prev[periodo]
@@ -283,7 +330,7 @@ const FluxoCaixa = () => {
                         <div>
                           <p className="font-semibold text-gray-900">{formatDateStringBR(item.periodo)}</p>
                           <p className="text-sm text-gray-600">
-                            {item.detalhes_entradas.length + item.detalhes_saidas.length} movimentações
+                            {item.qtd_entradas + item.qtd_saidas} movimentações
                           </p>
                         </div>
                       </div>
@@ -314,18 +361,20 @@ const FluxoCaixa = () => {
                   </div>
 
                   {/* Detalhes Expandidos */}
-                  {expandedPeriodos[item.periodo] && (
+                  {expandedPeriodos[item.periodo] && (() => {
+                    const detalhes = detalhesPorPeriodo[item.periodo] || { entradas: [], saidas: [], carregando: true };
+                    return (
                     <div className="p-4 bg-white border-t">
                       <div className="grid grid-cols-2 gap-6">
                         {/* Entradas */}
                         <div>
                           <h4 className="font-semibold text-green-700 mb-3 flex items-center gap-2">
                             <TrendingUp size={16} />
-                            Entradas ({item.detalhes_entradas.length})
+                            Entradas ({item.qtd_entradas})
                           </h4>
-                          {item.detalhes_entradas.length > 0 ? (
+                          {detalhes.entradas.length > 0 ? (
                             <div className="space-y-2">
-                              {item.detalhes_entradas.map((entrada, idx) => (
+                              {detalhes.entradas.map((entrada, idx) => (
                                 <div key={idx} className="flex justify-between items-start p-2 bg-green-50 rounded">
                                   <div>
                                     <p className="font-medium text-sm">{entrada.descricao}</p>
@@ -336,7 +385,7 @@ const FluxoCaixa = () => {
                               ))}
                             </div>
                           ) : (
-                            <p className="text-sm text-gray-500">Nenhuma entrada</p>
+                            <p className="text-sm text-gray-500">{detalhes.carregando ? 'Carregando...' : 'Nenhuma entrada'}</p>
                           )}
                         </div>
 
@@ -344,11 +393,11 @@ const FluxoCaixa = () => {
                         <div>
                           <h4 className="font-semibold text-red-700 mb-3 flex items-center gap-2">
                             <TrendingDown size={16} />
-                            Saídas ({item.detalhes_saidas.length})
+                            Saídas ({item.qtd_saidas})
                           </h4>
-                          {item.detalhes_saidas.length > 0 ? (
+                          {detalhes.saidas.length > 0 ? (
                             <div className="space-y-2">
-                              {item.detalhes_saidas.map((saida, idx) => (
+                              {detalhes.saidas.map((saida, idx) => (
                                 <div key={idx} className="flex justify-between items-start p-2 bg-red-50 rounded">
                                   <div>
                                     <p className="font-medium text-sm">{saida.descricao}</p>
@@ -359,12 +408,25 @@ const FluxoCaixa = () => {
                               ))}
                             </div>
                           ) : (
-                            <p className="text-sm text-gray-500">Nenhuma saída</p>
+                            <p className="text-sm text-gray-500">{detalhes.carregando ? 'Carregando...' : 'Nenhuma saída'}</p>
                           )}
                         </div>
                       </div>
+                      {detalhes.cursor && (
+                        <div className="mt-4 text-center">
+                          <Button
+                            variant="outline"
+                            size="sm"
+                            onClick={() => fetchDetalhes(item.periodo, detalhes.cursor)}
+                            disabled={detalhes.carregando}
+                          >
+                            {detalhes.carregando ? 'Carregando...' : 'Carregar mais'}
+                          </Button>
+                        </div>
+                      )}
                     </div>
-                  )}
+                    );
+                  })()}
                 </div>
               ))}
 
@@ -17,6 +17,10 @@ import { ReactSortable } from 'react-sortablejs';
 
 const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
+// Fotos salvas são ids do repositório de imagens; fotos ainda não enviadas são data URLs
+const urlFoto = (foto, miniatura = false) =>
+  foto && !foto.startsWith('data:') ? `${API}/imagens/${foto}${miniatura ? '/miniatura' : ''}` : foto;
+
 const Produtos = () => {
   const [produtos, setProdutos] = useState([]);
   const [produtosFiltrados, setProdutosFiltrados] = useState([]);
@@ -1153,10 +1157,10 @@ const Produtos = () => {
                               style={{ borderColor: index === fotoPrincipalIndex ? '#3b82f6' : '#e5e7eb' }}
                             >
                               <img 
-                                src={foto} 
+                                src={urlFoto(foto, true)} 
                                 alt={`Produto ${index + 1}`}
                                 className="w-full h-48 object-cover"
-                                onClick={() => setZoomImage(foto)}
+                                onClick={() => setZoomImage(urlFoto(foto))}
                               />
                               
                               {/* Badge de Imagem Principal */}
@@ -1181,7 +1185,7 @@ const Produtos = () => {
                                   className="bg-white"
                                   onClick={(e) => {
                                     e.stopPropagation();
-                                    setZoomImage(foto);
+                                    setZoomImage(urlFoto(foto));
                                   }}
                                 >
                                   <ZoomIn size={16} className="mr-1" />
@@ -1595,10 +1599,10 @@ const Produtos = () => {
                   {p.fotos && p.fotos.length > 0 ? (
                     <div className="relative">
                       <img 
-                        src={p.fotos[p.foto_principal_index || 0]} 
+                        src={urlFoto(p.fotos[p.foto_principal_index || 0], true)} 
                         alt={p.nome}
                         className="w-16 h-16 object-cover rounded border cursor-pointer hover:opacity-80 transition-opacity"
-                        onClick={() => setZoomImage(p.fotos[p.foto_principal_index || 0])}
+                        onClick={() => setZoomImage(urlFoto(p.fotos[p.foto_principal_index || 0]))}
                       />
                       {p.fotos.length > 1 && (
                         <div className="absolute -bottom-1 -right-1 bg-blue-500 text-white text-xs rounded-full w-5 h-5 flex items-center justify-center font-bold">